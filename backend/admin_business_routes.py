@@ -5,8 +5,12 @@ Uses JWT authentication (not flask_login session)
 from flask import Blueprint, jsonify, request
 from functools import wraps
 import logging
-import requests
 from datetime import datetime
+from geo_index import get_location_index
+from geocoding import (
+    geocode_location, geocode_with_google, geocode_with_nominatim,
+    running_job, start_bulk_geocode, job_name
+)
 
 admin_business_bp = Blueprint('admin_business', __name__, url_prefix='/api/admin/businesses')
 
@@ -434,40 +438,6 @@ def get_business_locations(business_id):
     })
 
 
-def auto_geocode_location(address, city):
-    """
-    Auto-geocode a location using address and city.
-    Returns (latitude, longitude, source) or (None, None, None) if not found.
-    Source is 'google' or 'nominatim'.
-    """
-    if not address and not city:
-        return None, None, None
-
-    # Build query - try with address first, then city only
-    queries_to_try = []
-    if address and city:
-        queries_to_try.append(f"{address}, {city}, Bosnia and Herzegovina")
-        queries_to_try.append(f"{address}, {city}")
-    if city:
-        queries_to_try.append(f"{city}, Bosnia and Herzegovina")
-
-    # Try Google first (fast, no rate limit)
-    for query in queries_to_try:
-        result = geocode_with_google(query)
-        if result:
-            logger.info(f"Auto-geocoded '{query}' via Google -> {result[0]}, {result[1]}")
-            return result[0], result[1], 'google'
-
-    # Fallback to Nominatim (requires 1 sec delay between requests)
-    for query in queries_to_try:
-        result = geocode_with_nominatim(query)
-        if result:
-            logger.info(f"Auto-geocoded '{query}' via Nominatim -> {result[0]}, {result[1]}")
-            return result[0], result[1], 'nominatim'
-
-    return None, None, None
-
-
 @admin_business_bp.route('/<int:business_id>/locations', methods=['POST'])
 @jwt_admin_required
 def create_business_location(business_id):
@@ -505,7 +475,7 @@ def create_business_location(business_id):
     # Auto-geocode if coordinates not provided but address/city are
     geocoded = False
     if (not latitude or not longitude) and (address or city):
-        auto_lat, auto_lng, source = auto_geocode_location(address, city)
+        auto_lat, auto_lng, source = geocode_location(address, city)
         if auto_lat and auto_lng:
             latitude = auto_lat
             longitude = auto_lng
@@ -525,6 +495,7 @@ def create_business_location(business_id):
 
     db.session.add(location)
     db.session.commit()
+    get_location_index().invalidate()
 
     log_msg = f"Created location '{name}' for business {business.name}"
     if geocoded:
@@ -595,7 +566,7 @@ def update_business_location(business_id, location_id):
     geocoded = False
     if address_changed and 'latitude' not in data and 'longitude' not in data:
         if new_address or new_city:
-            auto_lat, auto_lng, source = auto_geocode_location(new_address, new_city)
+            auto_lat, auto_lng, source = geocode_location(new_address, new_city)
             if auto_lat and auto_lng:
                 location.latitude = auto_lat
                 location.longitude = auto_lng
@@ -603,6 +574,7 @@ def update_business_location(business_id, location_id):
 
     location.updated_at = datetime.now()
     db.session.commit()
+    get_location_index().invalidate()
 
     log_msg = f"Updated location {location_id} for business {business_id}"
     if geocoded:
@@ -637,6 +609,7 @@ def delete_business_location(business_id, location_id):
 
     db.session.delete(location)
     db.session.commit()
+    get_location_index().invalidate()
 
     logger.info(f"Deleted location '{location_name}' from business {business_id}")
 
@@ -663,7 +636,6 @@ def bulk_import_locations(business_id):
       - working_hours: JSON object with hours
     - auto_geocode: boolean (default true) - whether to auto-geocode missing coords
     """
-    import time
     from models import db, Business, BusinessLocation
 
     business = Business.query.get(business_id)
@@ -698,20 +670,15 @@ def bulk_import_locations(business_id):
             longitude = loc_data.get('longitude')
 
             # Auto-geocode if enabled and coords not provided
+            # (cached by address; geocoding.py throttles Nominatim)
             was_geocoded = False
-            used_nominatim = False
             if auto_geocode_enabled and (not latitude or not longitude) and (address or city):
-                auto_lat, auto_lng, source = auto_geocode_location(address, city)
+                auto_lat, auto_lng, source = geocode_location(address, city)
                 if auto_lat and auto_lng:
                     latitude = auto_lat
                     longitude = auto_lng
                     was_geocoded = True
                     geocoded_count += 1
-                    if source == 'nominatim':
-                        used_nominatim = True
-                # Rate limit only for Nominatim (1 sec between requests)
-                if used_nominatim:
-                    time.sleep(1.1)
 
             location = BusinessLocation(
                 business_id=business_id,
@@ -738,6 +705,7 @@ def bulk_import_locations(business_id):
 
     if created:
         db.session.commit()
+        get_location_index().invalidate()
         logger.info(f"Bulk imported {len(created)} locations for business {business.name} ({geocoded_count} auto-geocoded)")
 
     return jsonify({
@@ -752,98 +720,6 @@ def bulk_import_locations(business_id):
 
 # ==================== GEOCODING ====================
 
-import os
-
-# Google Geocoding API settings
-GOOGLE_GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
-GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY')
-
-# Nominatim API settings (free, fallback if Google fails)
-NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
-NOMINATIM_HEADERS = {
-    "User-Agent": "PopustBA/1.0 (contact@popust.ba)"
-}
-
-
-def geocode_with_google(address_query):
-    """
-    Geocode using Google Geocoding API.
-    Returns (latitude, longitude, display_name) or None if not found.
-    """
-    if not GOOGLE_MAPS_API_KEY:
-        logger.warning("Google Maps API key not configured")
-        return None
-
-    try:
-        params = {
-            'address': address_query,
-            'key': GOOGLE_MAPS_API_KEY,
-            'region': 'ba',  # Bias towards Bosnia
-            'language': 'bs'  # Bosnian language
-        }
-
-        response = requests.get(GOOGLE_GEOCODING_URL, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-
-        if data.get('status') == 'OK' and data.get('results'):
-            result = data['results'][0]
-            location = result['geometry']['location']
-            return (
-                location['lat'],
-                location['lng'],
-                result.get('formatted_address', '')
-            )
-        elif data.get('status') == 'ZERO_RESULTS':
-            return None
-        else:
-            logger.warning(f"Google Geocoding API error: {data.get('status')} - {data.get('error_message', '')}")
-            return None
-
-    except requests.exceptions.Timeout:
-        logger.warning("Google Geocoding API timeout")
-        return None
-    except Exception as e:
-        logger.warning(f"Google Geocoding API error: {e}")
-        return None
-
-
-def geocode_with_nominatim(query):
-    """
-    Geocode using Nominatim (OpenStreetMap) API.
-    Returns (latitude, longitude, display_name) or None if not found.
-    """
-    try:
-        params = {
-            'q': query,
-            'format': 'json',
-            'limit': 1,
-            'addressdetails': 1
-        }
-
-        response = requests.get(
-            NOMINATIM_URL,
-            params=params,
-            headers=NOMINATIM_HEADERS,
-            timeout=10
-        )
-        response.raise_for_status()
-        results = response.json()
-
-        if results:
-            result = results[0]
-            return (
-                float(result['lat']),
-                float(result['lon']),
-                result.get('display_name', '')
-            )
-        return None
-
-    except Exception as e:
-        logger.warning(f"Nominatim geocoding error: {e}")
-        return None
-
-
 @admin_business_bp.route('/geocode', methods=['POST'])
 @jwt_admin_required
 def geocode_address():
@@ -926,22 +802,34 @@ def geocode_address():
 def geocode_existing_locations(business_id):
     """
     Geocode all existing locations for a business that don't have coordinates.
-    Uses OpenStreetMap Nominatim (free) with Google as primary if configured.
+    Uses Google as primary if configured, with OpenStreetMap Nominatim (free) as fallback.
     This is useful for bulk-imported locations that need geocoding.
+
+    Runs in the background and returns a job handle right away (202); poll
+    GET /<business_id>/locations/geocode-all/<job_id> for progress. Results
+    are cached by address, so branches sharing an address cost one lookup.
     Body:
-    - limit: max locations to process (default 50, max 500)
+    - limit: max locations to process (default 500, max 5000)
     - skip_geocoded: whether to skip already geocoded locations (default true)
     """
-    import time
-    from models import db, Business, BusinessLocation
+    from flask import current_app
+    from models import Business, BusinessLocation
     from sqlalchemy import or_
 
     business = Business.query.get(business_id)
     if not business:
         return jsonify({'error': 'Business not found'}), 404
 
+    running = running_job(business_id)
+    if running:
+        return jsonify({
+            'success': True,
+            'message': 'Geocoding is already running for this business',
+            **_geocode_job_status(running, business_id)
+        }), 202
+
     data = request.get_json() or {}
-    limit = min(data.get('limit', 50), 500)  # Max 500 per request
+    limit = min(data.get('limit', 500), 5000)
     skip_geocoded = data.get('skip_geocoded', True)
 
     # Query locations without coordinates
@@ -954,7 +842,9 @@ def geocode_existing_locations(business_id):
             )
         )
 
-    locations = query.limit(limit).all()
+    locations = query.with_entities(
+        BusinessLocation.id, BusinessLocation.address, BusinessLocation.city
+    ).order_by(BusinessLocation.id).limit(limit).all()
 
     if not locations:
         return jsonify({
@@ -965,74 +855,62 @@ def geocode_existing_locations(business_id):
             'failed': 0
         })
 
-    processed = 0
-    geocoded = 0
-    failed = 0
-    results = []
+    run = start_bulk_geocode(current_app._get_current_object(), business_id, [tuple(row) for row in locations])
+    logger.info(f"Started geocode job {run.id} for {len(locations)} locations of business {business.name}")
 
-    for location in locations:
-        processed += 1
+    return jsonify({
+        'success': True,
+        'message': f'Geocoding {len(locations)} locations in the background',
+        'queued': len(locations),
+        **_geocode_job_status(run, business_id)
+    }), 202
 
-        if not location.address and not location.city:
-            results.append({
-                'id': location.id,
-                'name': location.name,
-                'status': 'skipped',
-                'reason': 'No address or city'
-            })
-            failed += 1
-            continue
 
-        # Auto-geocode
-        auto_lat, auto_lng, source = auto_geocode_location(location.address, location.city)
+@admin_business_bp.route('/<int:business_id>/locations/geocode-all/<int:job_id>', methods=['GET'])
+@jwt_admin_required
+def get_geocode_job(business_id, job_id):
+    """
+    Progress of a geocode-all job.
+    Once it has finished, 'missing' lists the locations still without coordinates.
+    """
+    from models import JobRun
+
+    run = JobRun.query.filter_by(id=job_id, job_name=job_name(business_id)).first()
+    if not run:
+        return jsonify({'error': 'Job not found'}), 404
 
-        if auto_lat and auto_lng:
-            location.latitude = auto_lat
-            location.longitude = auto_lng
-            location.updated_at = datetime.now()
-            geocoded += 1
-            results.append({
-                'id': location.id,
-                'name': location.name,
-                'status': 'geocoded',
-                'latitude': auto_lat,
-                'longitude': auto_lng,
-                'source': source
-            })
-            # Rate limit only for Nominatim (1 sec between requests)
-            if source == 'nominatim' and processed < len(locations):
-                time.sleep(1.1)
-        else:
-            failed += 1
-            results.append({
-                'id': location.id,
-                'name': location.name,
-                'status': 'failed',
-                'address': location.address,
-                'city': location.city
-            })
+    return jsonify({'success': True, **_geocode_job_status(run, business_id, include_missing=run.status != 'started')})
 
-    if geocoded > 0:
-        db.session.commit()
-        logger.info(f"Geocoded {geocoded}/{processed} locations for business {business.name}")
 
-    # Count remaining locations without coordinates
-    remaining = BusinessLocation.query.filter_by(business_id=business_id).filter(
+def _geocode_job_status(run, business_id, include_missing=False):
+    """Job handle fields shared by the start and status endpoints"""
+    from models import BusinessLocation
+    from sqlalchemy import or_
+
+    missing = BusinessLocation.query.filter_by(business_id=business_id).filter(
         or_(
             BusinessLocation.latitude.is_(None),
             BusinessLocation.longitude.is_(None)
         )
-    ).count()
-
-    return jsonify({
-        'success': True,
-        'message': f'Processed {processed} locations: {geocoded} geocoded, {failed} failed',
-        'processed': processed,
-        'geocoded': geocoded,
-        'failed': failed,
-        'remaining': remaining,
-        'results': results
-    })
+    )
+    status = {
+        'job_id': run.id,
+        'status': run.status,
+        'started_at': run.started_at.isoformat() if run.started_at else None,
+        'completed_at': run.completed_at.isoformat() if run.completed_at else None,
+        'processed': run.records_processed or 0,
+        'geocoded': run.records_success or 0,
+        'failed': run.records_failed or 0,
+        'remaining': missing.count(),
+        'error': run.error_message,
+        'status_url': f"/api/admin/businesses/{business_id}/locations/geocode-all/{run.id}",
+    }
+    if include_missing:
+        status['missing'] = [
+            {'id': loc.id, 'name': loc.name, 'address': loc.address, 'city': loc.city}
+            for loc in missing.order_by(BusinessLocation.id).limit(500).all()
+        ]
+    return status
 
 
 # ==================== FEATURED PRODUCTS ====================
@@ -0,0 +1,77 @@
+"""
+Admin API routes for request performance profiling.
+Serves the per-endpoint SQL stats collected by query_profiler (QUERY_PROFILING=true).
+"""
+
+from flask import Blueprint, jsonify, request
+from functools import wraps
+import logging
+
+from auth_api import decode_jwt_token
+from models import User
+from query_profiler import get_query_profiler
+
+admin_performance_bp = Blueprint('admin_performance', __name__, url_prefix='/api/admin/performance')
+logger = logging.getLogger(__name__)
+
+SORT_FIELDS = ('total_db_ms', 'avg_db_ms', 'max_db_ms', 'avg_queries', 'max_queries', 'over_budget', 'requests')
+
+
+def jwt_admin_required(f):
+    """Decorator to require JWT admin authentication"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        try:
+            token = auth_header.split(' ')[1] if ' ' in auth_header else auth_header
+            payload = decode_jwt_token(token)
+
+            if not payload:
+                return jsonify({'error': 'Invalid or expired token'}), 401
+
+            user = User.query.filter_by(id=payload['user_id']).first()
+            if not user or not user.is_admin:
+                return jsonify({'error': 'Access denied'}), 403
+
+            return f(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Auth error: {e}")
+            return jsonify({'error': 'Authentication failed'}), 401
+
+    return decorated_function
+
+
+@admin_performance_bp.route('/queries', methods=['GET'])
+@jwt_admin_required
+def get_query_stats():
+    """
+    Per-endpoint SQL stats for this worker process.
+
+    Query params:
+    - sort: one of SORT_FIELDS (default total_db_ms)
+    - limit: int (default 50)
+    """
+    profiler = get_query_profiler()
+    if profiler is None:
+        return jsonify({'enabled': False, 'endpoints': []})
+
+    sort = request.args.get('sort', 'total_db_ms')
+    if sort not in SORT_FIELDS:
+        return jsonify({'error': f"sort must be one of {', '.join(SORT_FIELDS)}"}), 400
+    limit = min(request.args.get('limit', 50, type=int), 500)
+
+    return jsonify({'enabled': True, **profiler.snapshot(sort=sort, limit=limit)})
+
+
+@admin_performance_bp.route('/queries/reset', methods=['POST'])
+@jwt_admin_required
+def reset_query_stats():
+    """Clear this worker's collected stats"""
+    profiler = get_query_profiler()
+    if profiler is None:
+        return jsonify({'enabled': False})
+    profiler.reset()
+    return jsonify({'enabled': True, 'reset': True})
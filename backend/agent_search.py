@@ -14,6 +14,7 @@ from agents import graph
 from agents.context import AgentContext
 from agents.state import InputState
 from models import SearchLog
+from image_derivatives import variants_for
 
 logger = logging.getLogger(__name__)
 
@@ -275,6 +276,7 @@ def format_agent_products(products: List[Dict[str, Any]]) -> List[Dict[str, Any]
             "tags": product.get("tags"),
             "city": product.get("city"),
             "image_url": product.get("image_path"),
+            "image_variants": variants_for(product.get("image_path"), product.get("image_variants")),
             "product_url": product.get("product_url"),
             "views": product.get("views"),
             "enriched_description": product.get("enriched_description"),
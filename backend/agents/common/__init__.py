@@ -1,10 +1,11 @@
 """Common utilities shared across agents."""
 
-from agents.common.db_utils import search_by_vector
+from agents.common.db_utils import search_by_vector, search_structured_items
 from agents.common.llm_utils import get_chat_model, get_embedding_model
 
 __all__ = [
     "search_by_vector",
+    "search_structured_items",
     "get_chat_model",
     "get_embedding_model",
 ]
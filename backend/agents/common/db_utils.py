@@ -1,11 +1,14 @@
 """Database utilities for agents."""
 
 import logging
+import math
 import re
 from datetime import date
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Sequence
 from sqlalchemy import text
 from agents.common.llm_utils import get_embedding_model
+from vector_engine import engine_candidates_cte
+from vector_shards import shard_candidates_cte
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +17,13 @@ logger = logging.getLogger(__name__)
 VECTOR_WEIGHT = 0.6  # Semantic similarity weight
 TEXT_WEIGHT = 0.4    # Trigram/lexical similarity weight
 
+# ivfflat lists scanned per query (recall vs latency)
+IVFFLAT_PROBES = 10
+
+# Vector candidates taken from the in-process engine, as a multiple of the
+# rows the SQL ranks (room for hybrid re-ranking and quantization error)
+ENGINE_CANDIDATE_FACTOR = 2
+
 # Minimum thresholds for including a result
 MIN_VECTOR_SCORE = 0.25  # Minimum semantic similarity
 MIN_TEXT_SCORE = 0.10    # Minimum trigram similarity (lowered for short brand names)
@@ -23,6 +33,18 @@ MIN_TEXT_SCORE = 0.10    # Minimum trigram similarity (lowered for short brand n
 # Uses feature flag 'size_extraction_search' to enable/disable
 SIZE_MATCH_BOOST = 0.15
 
+# Brand boost for structured searches (brand known from vision/camera output)
+BRAND_MATCH_BOOST = 0.10
+
+# Distance decay for searches with a user location: a product gets
+# DISTANCE_BOOST * exp(-km / DISTANCE_DECAY_KM) for its store's nearest location
+DISTANCE_BOOST = 0.10
+DISTANCE_DECAY_KM = 5.0
+DISTANCE_MAX_KM = DISTANCE_DECAY_KM * 6  # Boost below 0.3% of DISTANCE_BOOST beyond this
+
+# Size tokens stripped from structured titles before embedding (embeddings are size-agnostic)
+SIZE_TOKEN_PATTERN = re.compile(r'\b\d+(?:[.,]\d+)?\s*(?:g|kg|mg|ml|cl|dl|l|kom|pranja)\b', re.IGNORECASE)
+
 
 def is_size_extraction_enabled() -> bool:
     """Check if size extraction feature is enabled via feature flag."""
@@ -98,6 +120,41 @@ def calculate_size_boost(product: dict, size_value: Optional[str], size_unit: Op
     return 0.0
 
 
+def calculate_brand_boost(product: dict, brand: Optional[str]) -> float:
+    """
+    Calculate boost for a product whose brand matches the hinted brand.
+
+    Args:
+        product: Product dict with 'title' and optionally 'brand'
+        brand: Target brand (e.g., 'Milka')
+
+    Returns:
+        Boost value (0.0 or BRAND_MATCH_BOOST)
+    """
+    if not brand or not brand.strip():
+        return 0.0
+
+    target = brand.strip().lower()
+    product_brand = (product.get('brand') or '').strip().lower()
+    if product_brand and product_brand not in ('unknown', ''):
+        return BRAND_MATCH_BOOST if product_brand == target else 0.0
+
+    # No structured brand - look for it as a whole word in the title
+    if re.search(rf'\b{re.escape(target)}\b', (product.get('title') or '').lower()):
+        return BRAND_MATCH_BOOST
+    return 0.0
+
+
+def _normalize_size_value(size_value: Any) -> Optional[str]:
+    """Format a size hint the way search_by_vector formats product sizes ('500' -> '500.0')."""
+    if size_value is None or size_value == '':
+        return None
+    try:
+        return str(float(str(size_value).replace(',', '.')))
+    except ValueError:
+        return None
+
+
 def search_by_vector(
     db_session,
     query_vector: List[float],
@@ -109,6 +166,7 @@ def search_by_vector(
     business_ids: Optional[List[int]] = None,
     query_text: Optional[str] = None,
     only_discounted: bool = False,
+    user_location: Optional[Sequence[float]] = None,
 ) -> List[Dict[str, Any]]:
     """Search for products using hybrid vector + trigram similarity.
 
@@ -126,30 +184,35 @@ def search_by_vector(
         business_ids: Optional list of business IDs to filter by.
         query_text: Original query text for trigram matching (optional but recommended).
         only_discounted: If True, only return products with active discounts.
+        user_location: Optional (latitude, longitude); products from stores with a
+            location nearby get a distance-decay boost (see apply_distance_boost).
 
     Returns:
         List of product dictionaries with similarity scores.
     """
     # Set ivfflat probes for better recall
-    db_session.execute(text("SET ivfflat.probes = 10"))
+    db_session.execute(text(f"SET ivfflat.probes = {int(IVFFLAT_PROBES)}"))
 
     # Build the WHERE clause - show all products (expired discounts become regular products)
-    where_clauses = ["1=1"]
+    # Product filters (everything but the store filter) are also applied inside store shards
+    product_filters = []
 
     if category:
-        where_clauses.append(f"p.category = '{category}'")
-
-    if business_ids:
-        ids_str = ",".join(map(str, business_ids))
-        where_clauses.append(f"p.business_id IN ({ids_str})")
+        product_filters.append(f"p.category = '{category}'")
 
     if max_price:
-        where_clauses.append(f"COALESCE(p.discount_price, p.base_price) <= {max_price}")
+        product_filters.append(f"COALESCE(p.discount_price, p.base_price) <= {max_price}")
 
     if only_discounted:
         # Only include products with active discounts (discount_price exists and not expired)
-        where_clauses.append("p.discount_price IS NOT NULL")
-        where_clauses.append("(p.expires IS NULL OR p.expires >= CURRENT_DATE)")
+        product_filters.append("p.discount_price IS NOT NULL")
+        product_filters.append("(p.expires IS NULL OR p.expires >= CURRENT_DATE)")
+
+    where_clauses = ["1=1"] + product_filters
+
+    if business_ids:
+        ids_str = ",".join(map(str, business_ids))
+        where_clauses.append(f"p.business_id IN ({ids_str})")
 
     where_sql = " AND ".join(where_clauses)
 
@@ -159,6 +222,34 @@ def search_by_vector(
     # Escape query text for SQL (handle single quotes)
     safe_query_text = (query_text or "").replace("'", "''").lower()
 
+    # Candidate planning: the in-process engine (exact, any filters) or, for
+    # store-filtered searches, the selected stores' own vector indexes; either
+    # way Postgres only scores the candidates (see vector_engine, vector_shards)
+    text_match = None
+    if query_text and query_text.strip():
+        text_match = (
+            f"lower(p.title) % '{safe_query_text}' OR lower(p.enriched_description) % '{safe_query_text}'",
+            f"similarity(lower(p.title), '{safe_query_text}')",
+        )
+    candidates_name = "engine_candidates"
+    candidates_cte = engine_candidates_cte(
+        query_vector, k * 10 * ENGINE_CANDIDATE_FACTOR,
+        business_ids=business_ids, category=category, max_price=max_price, only_discounted=only_discounted,
+        filter_sql=" AND ".join(where_clauses[1:]) or None, text_match=text_match,
+    )
+    if candidates_cte is None and business_ids:
+        candidates_name = "shard_candidates"
+        candidates_cte = shard_candidates_cte(
+            db_session, business_ids, f"'{vector_str}'::vector", k * 10,
+            filter_sql=" AND ".join(product_filters) or None, text_match=text_match,
+        )
+    if candidates_cte and text_match:
+        # The % operator (index-backed) matches down to the hybrid text threshold
+        db_session.execute(text(f"SET LOCAL pg_trgm.similarity_threshold = {MIN_TEXT_SCORE}"))
+    candidates_prefix = f"WITH {candidates_cte}" if candidates_cte else ""
+    candidates_with = f",\n            {candidates_cte}" if candidates_cte else ""
+    candidates_join = f"INNER JOIN {candidates_name} c ON c.product_id = p.id" if candidates_cte else ""
+
     # Use hybrid search if we have query text, otherwise fall back to vector-only
     if query_text and len(query_text.strip()) > 0:
         # Hybrid query combining vector similarity and trigram matching
@@ -167,7 +258,7 @@ def search_by_vector(
                 SELECT
                     '{safe_query_text}'::text AS query_text,
                     '{vector_str}'::vector AS query_vec
-            )
+            ){candidates_with}
             SELECT
                 p.id,
                 p.title,
@@ -180,9 +271,11 @@ def search_by_vector(
                 p.expires,
                 p.discount_starts,
                 p.image_path,
+                p.image_variants,
                 p.business_id,
                 p.size_value,
                 p.size_unit,
+                p.brand,
                 p.contributed_by,
                 b.name as business_name,
                 b.logo_path as business_logo,
@@ -209,6 +302,7 @@ def search_by_vector(
                 ) AS final_score
             FROM products p
             INNER JOIN product_embeddings pe ON p.id = pe.product_id
+            {candidates_join}
             LEFT JOIN businesses b ON p.business_id = b.id
             LEFT JOIN users u ON p.contributed_by = u.id
             CROSS JOIN q
@@ -225,6 +319,7 @@ def search_by_vector(
     else:
         # Fall back to vector-only search if no query text
         query = f"""
+            {candidates_prefix}
             SELECT
                 p.id,
                 p.title,
@@ -237,9 +332,11 @@ def search_by_vector(
                 p.expires,
                 p.discount_starts,
                 p.image_path,
+                p.image_variants,
                 p.business_id,
                 p.size_value,
                 p.size_unit,
+                p.brand,
                 p.contributed_by,
                 b.name as business_name,
                 b.logo_path as business_logo,
@@ -252,6 +349,7 @@ def search_by_vector(
                 1 - (pe.embedding <=> '{vector_str}'::vector) AS final_score
             FROM products p
             INNER JOIN product_embeddings pe ON p.id = pe.product_id
+            {candidates_join}
             LEFT JOIN businesses b ON p.business_id = b.id
             LEFT JOIN users u ON p.contributed_by = u.id
             WHERE {where_sql}
@@ -302,9 +400,11 @@ def search_by_vector(
             "expires": expires,
             "discount_starts": discount_starts,
             "image_path": row.image_path,
+            "image_variants": row.image_variants,
             # Size fields for size-based boosting
             "size_value": str(row.size_value) if row.size_value else None,
             "size_unit": row.size_unit,
+            "brand": row.brand,
             # Use final_score as the primary similarity metric
             "similarity": float(row.final_score),
             # Also expose component scores for debugging
@@ -327,12 +427,52 @@ def search_by_vector(
 
         all_products.append(product)
 
+    if user_location:
+        apply_distance_boost(all_products, user_location)
+
     # Apply max_per_store limit: take top N from each store, then sort all by similarity
     products = _limit_per_store(all_products, max_per_store=max_per_store, total_limit=k)
 
     return products
 
 
+def apply_distance_boost(products: List[Dict[str, Any]], user_location: Sequence[float]) -> None:
+    """Boost products by the distance to their store's nearest location and re-sort.
+
+    Distances come from the in-memory location index (geo_index), one radius
+    lookup per search. Products whose store has no location within
+    DISTANCE_MAX_KM keep their score; each product gets 'distance_km'
+    (None when unknown) and 'distance_boost'.
+
+    Args:
+        products: Product dicts from search_by_vector.
+        user_location: (latitude, longitude) of the user.
+    """
+    from geo_index import get_location_index, valid_coordinates
+
+    latitude, longitude = user_location
+    if not products or not valid_coordinates(latitude, longitude):
+        return
+
+    try:
+        business_ids = {p["business"]["id"] for p in products if p["business"]["id"] is not None}
+        distances = get_location_index().nearest_per_business(
+            latitude, longitude, DISTANCE_MAX_KM, business_ids=business_ids
+        )
+    except Exception as e:
+        logger.warning(f"Distance boost skipped: {e}")
+        return
+
+    for product in products:
+        distance_km = distances.get(product["business"]["id"])
+        boost = DISTANCE_BOOST * math.exp(-distance_km / DISTANCE_DECAY_KM) if distance_km is not None else 0.0
+        product["distance_km"] = round(distance_km, 2) if distance_km is not None else None
+        product["distance_boost"] = boost
+        product["similarity"] = product.get("similarity", 0) + boost
+
+    products.sort(key=lambda p: p.get("similarity", 0), reverse=True)
+
+
 def _limit_per_store(
     products: List[Dict[str, Any]],
     max_per_store: int,
@@ -383,6 +523,7 @@ async def search_by_vector_grouped(
     max_price: Optional[float] = None,
     business_ids: Optional[List[int]] = None,
     only_discounted: bool = False,
+    user_location: Optional[Sequence[float]] = None,
 ) -> Dict[str, List[Dict[str, Any]]]:
     """Search for products using hybrid vector + trigram similarity for multiple items.
 
@@ -396,6 +537,7 @@ async def search_by_vector_grouped(
         category: Optional category filter.
         max_price: Optional maximum price filter.
         business_ids: Optional list of business IDs to filter by.
+        user_location: Optional (latitude, longitude) for the distance boost.
 
     Returns:
         Dictionary mapping original item names to their search results.
@@ -444,6 +586,7 @@ async def search_by_vector_grouped(
             business_ids=business_ids,
             query_text=original_text,  # Pass original text for trigram matching
             only_discounted=only_discounted,
+            user_location=user_location,
         )
 
         # ==================== SIZE BOOST RE-RANKING (TESTING) ====================
@@ -467,3 +610,82 @@ async def search_by_vector_grouped(
         grouped_results[display_name] = results
 
     return grouped_results
+
+
+def search_structured_items(
+    db_session,
+    items: List[Dict[str, Any]],
+    embedding_model: str = "text-embedding-3-small",
+    k: int = 10,
+    similarity_threshold: Optional[float] = None,
+    business_ids: Optional[List[int]] = None,
+    max_per_store: int = 2,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Search for pre-parsed items without going through the intent parser.
+
+    For callers that already have structured product data (camera search
+    vision output): builds the embedding and trigram texts directly, runs
+    the hybrid search_by_vector and re-ranks with brand and size hints.
+    Size boosting is always applied here - the hints come from the item,
+    not from a parse of free text.
+
+    Args:
+        db_session: SQLAlchemy database session.
+        items: List of item dicts with 'title' and optionally 'brand',
+               'product_type', 'size_value', 'size_unit', 'embedding_text'.
+        embedding_model: Name of the embedding model to use.
+        k: Number of results to return per item.
+        similarity_threshold: Optional minimum similarity (after boosts).
+        business_ids: Optional list of business IDs to filter by.
+        max_per_store: Maximum products per store.
+
+    Returns:
+        Dictionary mapping item titles to their ranked results.
+    """
+    embed_fn = get_embedding_model(embedding_model)
+    grouped_results = {}
+
+    for item in items:
+        title = (item.get("title") or "").strip()
+        brand = (item.get("brand") or "").strip()
+        if not title and not brand:
+            continue
+
+        # Trigram text keeps the brand (exact brand matches score high)
+        query_text = title
+        if brand and brand.lower() not in title.lower():
+            query_text = f"{brand} {title}"
+
+        # Embedding text without size, like the intent parser's embedding_text
+        embedding_text = item.get("embedding_text")
+        if not embedding_text:
+            embedding_text = " ".join(SIZE_TOKEN_PATTERN.sub(" ", query_text).split()) or query_text
+        query_vector = embed_fn(embedding_text.lower())
+
+        size_value = _normalize_size_value(item.get("size_value"))
+        size_unit = (item.get("size_unit") or "").strip().lower() or None
+
+        # Over-fetch so boosted products below the cut can move up
+        results = search_by_vector(
+            db_session=db_session,
+            query_vector=query_vector,
+            k=k * 2,
+            max_per_store=max_per_store,
+            business_ids=business_ids,
+            query_text=query_text,
+        )
+
+        for product in results:
+            size_boost = calculate_size_boost(product, size_value, size_unit)
+            brand_boost = calculate_brand_boost(product, brand)
+            product['size_boost'] = size_boost
+            product['brand_boost'] = brand_boost
+            product['similarity'] = product.get('similarity', 0) + size_boost + brand_boost
+
+        results.sort(key=lambda x: x.get('similarity', 0), reverse=True)
+        if similarity_threshold is not None:
+            results = [r for r in results if r.get('similarity', 0) >= similarity_threshold]
+
+        grouped_results[title or brand] = results[:k]
+
+    return grouped_results
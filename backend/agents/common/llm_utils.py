@@ -1,19 +1,13 @@
 """LLM utilities for agents."""
 
-import os
 from typing import List
-from openai import OpenAI
 
+import llm_clients
 
-_openai_client = None
 
-
-def get_openai_client() -> OpenAI:
-    """Get or create OpenAI client instance."""
-    global _openai_client
-    if _openai_client is None:
-        _openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    return _openai_client
+def get_openai_client():
+    """Get the process-wide OpenAI client (shared by all request threads)."""
+    return llm_clients.get_openai_client()
 
 
 def get_embedding_model(model: str = "text-embedding-3-small"):
@@ -77,6 +77,7 @@ async def semantic_search_node(state: AgentState, runtime: Any = None) -> Dict:
     search_items = state.search_items or []
     business_ids = getattr(state, 'business_ids', None)
     only_discounted = getattr(state, 'only_discounted', False)
+    user_location = getattr(state, 'user_location', None)
 
     # Normalize query to lowercase for consistent embedding matching
     query_normalized = query.lower() if query else query
@@ -109,6 +110,7 @@ async def semantic_search_node(state: AgentState, runtime: Any = None) -> Dict:
                 max_price=max_price,
                 business_ids=business_ids,
                 only_discounted=only_discounted,
+                user_location=user_location,
             )
 
             # Filter by similarity threshold for each group
@@ -160,6 +162,7 @@ async def semantic_search_node(state: AgentState, runtime: Any = None) -> Dict:
                 business_ids=business_ids,
                 query_text=query,  # Pass original query for hybrid trigram matching
                 only_discounted=only_discounted,
+                user_location=user_location,
             )
 
             # Filter by similarity threshold
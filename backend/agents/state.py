@@ -26,6 +26,9 @@ class AgentState:
     only_discounted: bool = field(default=False)
     """Filter to show only discounted products."""
 
+    user_location: Optional[List[float]] = field(default=None)
+    """Optional [latitude, longitude]; nearby stores rank higher."""
+
     # Routing
     intent: Literal["semantic_search", "meal_planning", "general", "unknown"] = field(default="unknown")
     """Detected intent from the supervisor."""
@@ -75,6 +78,9 @@ class InputState:
     only_discounted: bool = field(default=False)
     """Filter to show only discounted products."""
 
+    user_location: Optional[List[float]] = field(default=None)
+    """Optional [latitude, longitude]; nearby stores rank higher."""
+
 
 @dataclass
 class OutputState:
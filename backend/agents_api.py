@@ -426,6 +426,20 @@ def log_search_quality(query, results, metadata, search_items=None, user_id=None
         db.session.rollback()
 
 
+def _parse_location(location):
+    """[lat, lon] from a {"lat", "lon"} request object, or None if missing/invalid"""
+    from geo_index import valid_coordinates
+
+    if not isinstance(location, dict):
+        return None
+    try:
+        lat = float(location.get("lat"))
+        lon = float(location.get("lon", location.get("lng")))
+    except (TypeError, ValueError):
+        return None
+    return [lat, lon] if valid_coordinates(lat, lon) else None
+
+
 @agents_api_bp.route('/search', methods=['POST'])
 def unified_search():
     """Unified search endpoint - the main entry point for all user queries.
@@ -435,6 +449,7 @@ def unified_search():
 
     Request JSON:
         - query (str): User's search query
+        - location (dict, optional): {"lat": float, "lon": float}; stores nearby rank higher
 
     Returns:
         JSON response with results, explanation, and metadata.
@@ -543,12 +558,16 @@ def unified_search():
         # Get only_discounted filter from request
         only_discounted = data.get("only_discounted", False)
 
+        # Get optional user location for distance-aware ranking
+        user_location = _parse_location(data.get("location"))
+
         # Create input state
         input_state = InputState(
             query=query,
             user_id=user_id,
             business_ids=business_ids,
-            only_discounted=only_discounted
+            only_discounted=only_discounted,
+            user_location=user_location
         )
 
         # Create context with DB session
@@ -0,0 +1,26 @@
+"""Add claimed_at to user_product_images for processing leases
+
+Revision ID: a3e7c9b2d4f1
+Revises: f5c8d2a1b6e9
+Create Date: 2026-10-19 22:14:05.118462
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3e7c9b2d4f1'
+down_revision: Union[str, None] = 'f5c8d2a1b6e9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('user_product_images', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('user_product_images', 'claimed_at')
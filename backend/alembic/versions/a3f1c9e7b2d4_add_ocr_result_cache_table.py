@@ -0,0 +1,41 @@
+"""Add ocr_result_cache table for content-addressed OCR results
+
+Revision ID: a3f1c9e7b2d4
+Revises: 96e2fc992d14
+Create Date: 2026-10-19 10:12:41.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f1c9e7b2d4'
+down_revision: Union[str, None] = '96e2fc992d14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('ocr_result_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('image_hash', sa.String(length=64), nullable=False),
+    sa.Column('model', sa.String(length=100), nullable=False),
+    sa.Column('prompt_hash', sa.String(length=64), nullable=False),
+    sa.Column('result_text', sa.Text(), nullable=False),
+    sa.Column('input_tokens', sa.Integer(), nullable=True),
+    sa.Column('output_tokens', sa.Integer(), nullable=True),
+    sa.Column('hit_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_hit_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('image_hash', 'model', 'prompt_hash', name='uq_ocr_result_cache_key')
+    )
+    op.create_index('ix_ocr_result_cache_created_at', 'ocr_result_cache', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_ocr_result_cache_created_at', table_name='ocr_result_cache')
+    op.drop_table('ocr_result_cache')
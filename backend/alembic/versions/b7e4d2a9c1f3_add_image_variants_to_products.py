@@ -0,0 +1,26 @@
+"""Add image_variants to products
+
+Revision ID: b7e4d2a9c1f3
+Revises: a3f1c9e7b2d4
+Create Date: 2026-10-19 14:05:12.118734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e4d2a9c1f3'
+down_revision: Union[str, None] = 'a3f1c9e7b2d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('products', sa.Column('image_variants', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('products', 'image_variants')
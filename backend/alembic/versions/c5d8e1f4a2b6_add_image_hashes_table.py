@@ -0,0 +1,43 @@
+"""Add image_hashes table
+
+Revision ID: c5d8e1f4a2b6
+Revises: b7e4d2a9c1f3
+Create Date: 2026-10-19 15:32:47.402918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5d8e1f4a2b6'
+down_revision: Union[str, None] = 'b7e4d2a9c1f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('image_hashes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('phash', sa.BigInteger(), nullable=False),
+    sa.Column('dhash', sa.BigInteger(), nullable=False),
+    sa.Column('source', sa.String(length=20), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=True),
+    sa.Column('image_url', sa.String(), nullable=True),
+    sa.Column('result', sa.JSON(), nullable=True),
+    sa.Column('hit_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_hit_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_image_hashes_source_created', 'image_hashes', ['source', 'created_at'], unique=False)
+    op.create_index('ix_image_hashes_product_id', 'image_hashes', ['product_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_image_hashes_product_id', table_name='image_hashes')
+    op.drop_index('ix_image_hashes_source_created', table_name='image_hashes')
+    op.drop_table('image_hashes')
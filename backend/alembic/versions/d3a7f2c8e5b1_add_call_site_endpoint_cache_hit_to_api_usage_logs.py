@@ -0,0 +1,32 @@
+"""Add call_site, endpoint and cache_hit to api_usage_logs
+
+Revision ID: d3a7f2c8e5b1
+Revises: c5d8e1f4a2b6
+Create Date: 2026-10-19 17:08:12.551204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a7f2c8e5b1'
+down_revision: Union[str, None] = 'c5d8e1f4a2b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('api_usage_logs', sa.Column('call_site', sa.String(length=100), nullable=True))
+    op.add_column('api_usage_logs', sa.Column('endpoint', sa.String(length=200), nullable=True))
+    op.add_column('api_usage_logs', sa.Column('cache_hit', sa.Boolean(), nullable=False, server_default='false'))
+    op.create_index(op.f('ix_api_usage_logs_endpoint'), 'api_usage_logs', ['endpoint'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_api_usage_logs_endpoint'), table_name='api_usage_logs')
+    op.drop_column('api_usage_logs', 'cache_hit')
+    op.drop_column('api_usage_logs', 'endpoint')
+    op.drop_column('api_usage_logs', 'call_site')
@@ -0,0 +1,39 @@
+"""Add geocode_cache table for address geocoding results
+
+Revision ID: e4b9c1d7f3a2
+Revises: d3a7f2c8e5b1
+Create Date: 2026-10-19 19:42:03.118470
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b9c1d7f3a2'
+down_revision: Union[str, None] = 'd3a7f2c8e5b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('geocode_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('address_key', sa.String(length=500), nullable=False),
+    sa.Column('city_key', sa.String(length=100), nullable=False),
+    sa.Column('latitude', sa.Float(), nullable=True),
+    sa.Column('longitude', sa.Float(), nullable=True),
+    sa.Column('source', sa.String(length=20), nullable=True),
+    sa.Column('display_name', sa.String(length=500), nullable=True),
+    sa.Column('hit_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_hit_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('address_key', 'city_key', name='uq_geocode_cache_key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('geocode_cache')
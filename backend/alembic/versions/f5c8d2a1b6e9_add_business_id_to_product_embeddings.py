@@ -0,0 +1,81 @@
+"""Add business_id to product_embeddings for per-store vector indexes
+
+Revision ID: f5c8d2a1b6e9
+Revises: e4b9c1d7f3a2
+Create Date: 2026-10-19 21:08:51.402317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f5c8d2a1b6e9'
+down_revision: Union[str, None] = 'e4b9c1d7f3a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Copy of products.business_id - partial indexes can only filter on the table's own columns
+    op.add_column('product_embeddings', sa.Column('business_id', sa.Integer(), nullable=True))
+    op.execute("""
+        UPDATE product_embeddings pe
+        SET business_id = p.business_id
+        FROM products p
+        WHERE p.id = pe.product_id
+    """)
+    op.create_index('ix_product_embeddings_business_id', 'product_embeddings', ['business_id'])
+
+    # Kept in sync by triggers so every embedding writer (ORM and raw SQL) stays correct
+    op.execute("""
+        CREATE OR REPLACE FUNCTION product_embeddings_set_business_id() RETURNS trigger AS $$
+        BEGIN
+            SELECT business_id INTO NEW.business_id FROM products WHERE id = NEW.product_id;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER product_embeddings_business_id
+        BEFORE INSERT OR UPDATE OF product_id ON product_embeddings
+        FOR EACH ROW EXECUTE FUNCTION product_embeddings_set_business_id()
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION products_sync_embedding_business_id() RETURNS trigger AS $$
+        BEGIN
+            UPDATE product_embeddings SET business_id = NEW.business_id WHERE product_id = NEW.id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER products_embedding_business_id
+        AFTER UPDATE OF business_id ON products
+        FOR EACH ROW WHEN (OLD.business_id IS DISTINCT FROM NEW.business_id)
+        EXECUTE FUNCTION products_sync_embedding_business_id()
+    """)
+
+
+def downgrade() -> None:
+    # Shard indexes (vector_shards.py) reference the column
+    op.execute("""
+        DO $$
+        DECLARE index_name text;
+        BEGIN
+            FOR index_name IN
+                SELECT indexname FROM pg_indexes
+                WHERE tablename = 'product_embeddings' AND indexname LIKE 'idx\\_product\\_embeddings\\_shard\\_%'
+            LOOP
+                EXECUTE format('DROP INDEX IF EXISTS %I', index_name);
+            END LOOP;
+        END $$
+    """)
+    op.execute("DROP TRIGGER IF EXISTS products_embedding_business_id ON products")
+    op.execute("DROP FUNCTION IF EXISTS products_sync_embedding_business_id()")
+    op.execute("DROP TRIGGER IF EXISTS product_embeddings_business_id ON product_embeddings")
+    op.execute("DROP FUNCTION IF EXISTS product_embeddings_set_business_id()")
+    op.drop_index('ix_product_embeddings_business_id', table_name='product_embeddings')
+    op.drop_column('product_embeddings', 'business_id')
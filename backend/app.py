@@ -138,6 +138,11 @@ from rate_limiter import init_limiter
 limiter = init_limiter(app)
 print("🛡️ Rate limiter initialized (anti-scraping protection)")
 
+# Opt-in per-request SQL profiling (QUERY_PROFILING=true)
+from query_profiler import init_query_profiler
+if init_query_profiler(app, db):
+    print("🔎 Query profiler enabled")
+
 # Add custom Jinja2 filters
 @app.template_filter('from_json')
 def from_json_filter(value):
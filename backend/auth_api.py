@@ -38,10 +38,9 @@ def correct_bosnian_text(term: str) -> str:
     term = term.strip()
 
     try:
-        from openai import OpenAI
-        import os
+        from llm_clients import get_openai_client
 
-        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        client = get_openai_client()
 
         response = client.chat.completions.create(
             model="gpt-4o-mini",
@@ -2310,9 +2309,8 @@ def upload_user_product_image():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
 
-    import boto3
-    from botocore.exceptions import ClientError
     from models import UserProductImage
+    from storage import StorageError, get_storage
     import uuid
     from PIL import Image
     import io
@@ -2364,26 +2362,12 @@ def upload_user_product_image():
         s3_path = f"popust/user-images/{request.current_user_id}/{unique_id}.jpg"
 
         # Upload to S3
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=s3_path,
-            Body=thumbnail_bytes,
-            ContentType='image/jpeg',
-            CacheControl='max-age=31536000'
-        )
+        storage = get_storage()
+        storage.put(s3_path, thumbnail_bytes, 'image/jpeg', cache_control='max-age=31536000')
 
         # Build public URL
-        cdn_url = os.environ.get('CDN_URL', f'https://{bucket}.s3.eu-central-1.amazonaws.com')
-        image_url = f"{cdn_url}/{s3_path}"
+        cdn_url = os.environ.get('CDN_URL')
+        image_url = f"{cdn_url}/{s3_path}" if cdn_url else storage.url(s3_path)
 
         # Create database record
         product_image = UserProductImage(
@@ -2402,26 +2386,31 @@ def upload_user_product_image():
 
         # Process image in background thread
         import threading
-        def process_in_background(app_context, img_id, usr_id):
+        def process_in_background(app_context, img_id, usr_id, img_bytes):
             with app_context:
                 try:
-                    from jobs.process_product_images import extract_product_name_from_image, add_to_user_preferences, trigger_user_scan
+                    from jobs.process_product_images import (
+                        claim_pending_images, identify_product_image, add_to_user_preferences, trigger_user_scan
+                    )
                     from models import UserProductImage
                     from app import db
 
+                    # Atomic claim - skip if the batch job already picked it up
+                    if not claim_pending_images(limit=1, image_ids=[img_id]):
+                        return
+
                     img = UserProductImage.query.get(img_id)
                     if not img:
                         return
 
-                    img.status = 'processing'
-                    db.session.commit()
-
-                    result = extract_product_name_from_image(img.image_url)
+                    result = identify_product_image(img.image_url, img_bytes)
 
                     if result and result.get('product_name'):
                         img.extracted_name = result['product_name']
                         if result.get('price'):
                             img.extracted_price = result['price']
+                        if result.get('matched_product_id'):
+                            img.matched_product_id = result['matched_product_id']
                         img.extracted_data = result
                         img.status = 'processed'
                         img.processed_at = datetime.now()
@@ -2451,7 +2440,7 @@ def upload_user_product_image():
 
         thread = threading.Thread(
             target=process_in_background,
-            args=(app.app_context(), image_id, user_id)
+            args=(app.app_context(), image_id, user_id, thumbnail_bytes)
         )
         thread.daemon = True
         thread.start()
@@ -2461,7 +2450,7 @@ def upload_user_product_image():
             'image': product_image.to_dict()
         }), 201
 
-    except ClientError as e:
+    except StorageError as e:
         app.logger.error(f"S3 upload error: {e}")
         return jsonify({'error': 'Failed to upload image to storage'}), 500
     except Exception as e:
@@ -2477,9 +2466,8 @@ def delete_user_product_image(image_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
 
-    import boto3
-    from botocore.exceptions import ClientError
     from models import UserProductImage
+    from storage import StorageError, get_storage
 
     image = UserProductImage.query.filter_by(
         id=image_id,
@@ -2500,16 +2488,9 @@ def delete_user_product_image(image_id):
             s3_path = '/'.join(url_parts[3:]) if len(url_parts) > 3 else None
 
             if s3_path:
-                s3_client = boto3.client(
-                    's3',
-                    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-                    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-                    region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-                )
-                bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-                s3_client.delete_object(Bucket=bucket, Key=s3_path)
+                get_storage().delete(s3_path)
 
-    except ClientError as e:
+    except StorageError as e:
         app.logger.warning(f"Failed to delete S3 object: {e}")
         # Continue with database deletion even if S3 fails
 
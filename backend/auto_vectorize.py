@@ -2,19 +2,18 @@
 Automatic Vectorization for Products
 Triggers embedding generation when products are created or updated
 """
-import os
 import logging
 import hashlib
 from typing import Optional
-from openai import OpenAI
 from datetime import datetime
 from app import db
 from models import Product, ProductEmbedding
+from llm_clients import get_openai_client
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Shared OpenAI client (pooled transport, timeouts, per-model limits)
+openai_client = get_openai_client()
 
 
 def compute_product_hash(product: Product) -> str:
@@ -0,0 +1,370 @@
+"""
+Cross-store cheapest-basket optimizer for shopping lists.
+
+For every item on the user's active ShoppingList we collect equivalent offers
+in other stores:
+1. Clones - ProductMatch rows with match_type='clone' and products sharing the
+   same match_key (same brand + type + size)
+2. Brand variants - ProductMatch rows with match_type='brand_variant'
+   (same type + size, different brand), used only when substitutes are allowed
+
+Offers are loaded with a fixed number of queries (items, matches, candidates)
+and packed into a compact price matrix (items x stores, np.inf = unavailable).
+The cheapest single store and the best k-store split are then solved with
+vectorized NumPy over store combinations, after pruning stores that cannot
+improve any basket.
+"""
+import itertools
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager
+
+from app import db
+from models import Product, Business, ProductMatch, ShoppingListItem
+
+logger = logging.getLogger(__name__)
+
+# Hard cap on evaluated store combinations per k (keeps worst case in milliseconds)
+MAX_COMBINATIONS = 200_000
+# Combinations are evaluated in chunks to bound temporary array size
+COMBINATION_CHUNK = 20_000
+DEFAULT_MAX_STORES = 2
+
+
+def effective_price(product: Product) -> Optional[float]:
+    """Price a shopper would pay today (active discount or base price)"""
+    if product.has_discount:
+        return product.discount_price
+    if product.base_price is None or product.base_price <= 0:
+        return None
+    return product.base_price
+
+
+def load_basket_candidates(items: List[ShoppingListItem], allow_substitutes: bool = True,
+                           business_ids: Optional[List[int]] = None) -> Dict[int, List[dict]]:
+    """
+    Load equivalent offers for all shopping list items in bulk.
+
+    Args:
+        items: Shopping list items (not yet purchased)
+        allow_substitutes: Include brand_variant matches as substitutes
+        business_ids: Optional whitelist of stores to consider
+
+    Returns:
+        Dict mapping item_id -> list of offers
+        ({'product_id', 'business_id', 'price', 'match_type'})
+    """
+    if not items:
+        return {}
+
+    source_ids = {item.product_id for item in items}
+    match_types = ['clone', 'brand_variant'] if allow_substitutes else ['clone']
+
+    # 1 query: all matches touching any list product
+    matches = db.session.query(
+        ProductMatch.product_a_id, ProductMatch.product_b_id, ProductMatch.match_type
+    ).filter(
+        ProductMatch.match_type.in_(match_types),
+        or_(
+            ProductMatch.product_a_id.in_(source_ids),
+            ProductMatch.product_b_id.in_(source_ids)
+        )
+    ).all()
+
+    related = {pid: {} for pid in source_ids}  # source product -> {candidate_id: match_type}
+    for a_id, b_id, match_type in matches:
+        if a_id in related:
+            related[a_id][b_id] = match_type
+        if b_id in related:
+            related[b_id][a_id] = match_type
+
+    source_products = {item.product_id: item.product for item in items}
+    match_keys = {p.match_key for p in source_products.values() if p and p.match_key}
+    candidate_ids = set(source_ids)
+    for rel in related.values():
+        candidate_ids.update(rel.keys())
+
+    # 1 query: every candidate product (by id or by shared match_key)
+    filters = [Product.id.in_(candidate_ids)]
+    if match_keys:
+        filters.append(Product.match_key.in_(match_keys))
+    query = Product.query.filter(or_(*filters))
+    if business_ids:
+        query = query.filter(Product.business_id.in_(business_ids))
+    candidates = {p.id: p for p in query.all()}
+
+    by_match_key = {}
+    for product in candidates.values():
+        if product.match_key in match_keys:
+            by_match_key.setdefault(product.match_key, []).append(product.id)
+
+    offers = {}
+    for item in items:
+        source = source_products.get(item.product_id)
+        item_offers = {}
+
+        def add_offer(product_id, match_type):
+            product = candidates.get(product_id)
+            if not product:
+                return
+            price = effective_price(product)
+            if price is None:
+                return
+            existing = item_offers.get(product_id)
+            # Prefer the stronger relation if a product is reachable both ways
+            if existing and existing['match_type'] in ('self', 'clone'):
+                return
+            item_offers[product_id] = {
+                'product_id': product_id,
+                'business_id': product.business_id,
+                'price': float(price),
+                'match_type': match_type,
+            }
+
+        add_offer(item.product_id, 'self')
+        if source is not None and source.match_key:
+            for pid in by_match_key.get(source.match_key, []):
+                add_offer(pid, 'clone')
+        for pid, match_type in related.get(item.product_id, {}).items():
+            add_offer(pid, match_type)
+
+        offers[item.id] = list(item_offers.values())
+
+    return offers
+
+
+def build_price_matrix(items: List[ShoppingListItem], offers: Dict[int, List[dict]]):
+    """
+    Pack offers into a dense items x stores price matrix.
+
+    Substitutes (brand variants) only fill a cell when no clone exists in that
+    store, so an exact product is always preferred at equal store choice.
+
+    Returns:
+        (prices, qty, store_ids, choice) where prices[i, s] is the unit price of
+        item i in store s (np.inf when unavailable), and choice[(i, s)] is the
+        offer that produced that price.
+    """
+    store_ids = sorted({o['business_id'] for item_offers in offers.values() for o in item_offers})
+    store_index = {sid: idx for idx, sid in enumerate(store_ids)}
+
+    prices = np.full((len(items), len(store_ids)), np.inf, dtype=np.float64)
+    exact = np.zeros((len(items), len(store_ids)), dtype=bool)
+    qty = np.array([max(1, item.qty or 1) for item in items], dtype=np.float64)
+    choice = {}
+
+    for i, item in enumerate(items):
+        for offer in offers.get(item.id, []):
+            s = store_index[offer['business_id']]
+            is_exact = offer['match_type'] != 'brand_variant'
+            if exact[i, s] and not is_exact:
+                continue
+            if offer['price'] < prices[i, s] or (is_exact and not exact[i, s]):
+                prices[i, s] = offer['price']
+                exact[i, s] = is_exact
+                choice[(i, s)] = offer
+
+    return prices, qty, store_ids, choice
+
+
+def prune_stores(prices: np.ndarray) -> np.ndarray:
+    """
+    Return column indices of stores worth considering.
+
+    A store is dropped when another store offers every item at a price that is
+    less or equal (and covers at least the same items) - such a store can never
+    make a combination cheaper.
+    """
+    n_stores = prices.shape[1]
+    if n_stores <= 1:
+        return np.arange(n_stores)
+
+    # dominated[a, b] == True when store b is at least as good as store a on every item
+    le = (prices[:, None, :] <= prices[:, :, None]).all(axis=0)
+    strictly_better = (prices[:, None, :] < prices[:, :, None]).any(axis=0)
+    dominated = le & strictly_better
+    np.fill_diagonal(dominated, False)
+
+    keep = ~dominated.any(axis=1)
+    # Identical columns dominate nobody - keep the first of each duplicate group
+    kept = np.flatnonzero(keep)
+    _, first = np.unique(prices[:, kept].T, axis=0, return_index=True)
+    return np.sort(kept[first])
+
+
+def _score_combinations(prices: np.ndarray, qty: np.ndarray, combos: np.ndarray):
+    """Vectorized cost/coverage for an array of store combinations (C x k)"""
+    best = prices[:, combos].min(axis=2)  # items x C
+    available = np.isfinite(best)
+    covered = available.sum(axis=0)
+    cost = np.where(available, best * qty[:, None], 0.0).sum(axis=0)
+    return cost, covered
+
+
+def solve_best_split(prices: np.ndarray, qty: np.ndarray, k: int):
+    """
+    Find the store combination of size <= k that covers the most items at the
+    lowest total cost.
+
+    Returns:
+        (store_columns, total_cost, covered_count) or (None, None, 0) when
+        there are no stores.
+    """
+    n_items, n_stores = prices.shape
+    if n_stores == 0 or n_items == 0:
+        return None, None, 0
+
+    candidates = prune_stores(prices)
+    k = max(1, min(k, len(candidates)))
+
+    # Lower bound: every item bought at its cheapest available store
+    row_min = prices.min(axis=1)
+    bound_available = np.isfinite(row_min)
+    bound_covered = int(bound_available.sum())
+    bound_cost = float(np.where(bound_available, row_min * qty, 0.0).sum())
+
+    best = (None, np.inf, -1)
+    for size in range(1, k + 1):
+        combo_iter = itertools.combinations(candidates, size)
+        evaluated = 0
+        while evaluated < MAX_COMBINATIONS:
+            chunk = list(itertools.islice(combo_iter, COMBINATION_CHUNK))
+            if not chunk:
+                break
+            evaluated += len(chunk)
+            combos = np.asarray(chunk, dtype=np.intp)
+            cost, covered = _score_combinations(prices, qty, combos)
+
+            # Most coverage first, then cheapest
+            order = np.lexsort((cost, -covered))
+            top = order[0]
+            top_covered, top_cost = int(covered[top]), float(cost[top])
+            if top_covered > best[2] or (top_covered == best[2] and top_cost < best[1] - 1e-9):
+                best = (combos[top].tolist(), top_cost, top_covered)
+
+            if best[2] == bound_covered and best[1] <= bound_cost + 1e-9:
+                # Cannot do better than the per-item minimum - stop searching
+                return best
+        else:
+            logger.warning(f"Basket optimizer: combination cap reached for k={size}")
+
+    return best
+
+
+def _describe_solution(items, prices, qty, store_ids, choice, columns, businesses):
+    """Turn a store-column solution into a JSON-friendly breakdown"""
+    stores = {}
+    missing = []
+    total = 0.0
+    for i, item in enumerate(items):
+        row = prices[i, columns]
+        if not np.isfinite(row).any():
+            missing.append({'item_id': item.id, 'product_id': item.product_id})
+            continue
+        col = columns[int(np.argmin(row))]
+        offer = choice[(i, col)]
+        business_id = store_ids[col]
+        line_total = round(offer['price'] * qty[i], 2)
+        total += line_total
+
+        if business_id not in stores:
+            business = businesses.get(business_id)
+            stores[business_id] = {
+                'store': {
+                    'id': business_id,
+                    'name': business.name if business else None,
+                    'logo': business.logo_path if business else None,
+                },
+                'items': [],
+                'subtotal': 0.0,
+            }
+        stores[business_id]['items'].append({
+            'item_id': item.id,
+            'source_product_id': item.product_id,
+            'product_id': offer['product_id'],
+            'match_type': offer['match_type'],
+            'qty': int(qty[i]),
+            'unit_price': offer['price'],
+            'subtotal': line_total,
+        })
+        stores[business_id]['subtotal'] += line_total
+
+    groups = list(stores.values())
+    for group in groups:
+        group['subtotal'] = round(group['subtotal'], 2)
+
+    return {
+        'stores': groups,
+        'total': round(total, 2),
+        'covered_items': len(items) - len(missing),
+        'missing_items': missing,
+    }
+
+
+def optimize_shopping_list(shopping_list_id: int, max_stores: int = DEFAULT_MAX_STORES,
+                           allow_substitutes: bool = True,
+                           business_ids: Optional[List[int]] = None) -> dict:
+    """
+    Compute cheapest single-store and best k-store basket for a shopping list.
+
+    Args:
+        shopping_list_id: ShoppingList.id
+        max_stores: Maximum number of stores in the split basket
+        allow_substitutes: Allow brand variants (different brand, same type+size)
+        business_ids: Optional whitelist of stores
+
+    Returns:
+        Dict with 'current_total', 'single_store', 'split' and 'savings'
+    """
+    items = ShoppingListItem.query.filter(
+        ShoppingListItem.list_id == shopping_list_id,
+        ShoppingListItem.purchased_at.is_(None)
+    ).join(Product).options(contains_eager(ShoppingListItem.product)).all()
+
+    empty = {
+        'list_id': shopping_list_id,
+        'item_count': len(items),
+        'store_count': 0,
+        'current_total': 0,
+        'single_store': None,
+        'split': None,
+        'savings': {'single_store': 0, 'split': 0},
+    }
+    if not items:
+        return empty
+
+    offers = load_basket_candidates(items, allow_substitutes=allow_substitutes, business_ids=business_ids)
+    prices, qty, store_ids, choice = build_price_matrix(items, offers)
+    if not store_ids:
+        return empty
+
+    businesses = {b.id: b for b in Business.query.filter(Business.id.in_(store_ids)).all()}
+    current_total = round(sum(item.subtotal for item in items), 2)
+
+    single_cols, _, _ = solve_best_split(prices, qty, 1)
+    split_cols, _, _ = solve_best_split(prices, qty, max_stores)
+
+    single = _describe_solution(items, prices, qty, store_ids, choice, single_cols, businesses) if single_cols else None
+    split = _describe_solution(items, prices, qty, store_ids, choice, split_cols, businesses) if split_cols else None
+
+    def saving(solution):
+        # Only meaningful when the alternative basket covers the whole list
+        if not solution or solution['missing_items']:
+            return 0
+        return round(max(0.0, current_total - solution['total']), 2)
+
+    return {
+        'list_id': shopping_list_id,
+        'item_count': len(items),
+        'store_count': len(store_ids),
+        'current_total': current_total,
+        'single_store': single,
+        'split': split,
+        'savings': {
+            'single_store': saving(single),
+            'split': saving(split),
+        },
+    }
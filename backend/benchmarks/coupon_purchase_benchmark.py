@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Concurrency test for coupon purchases.
+
+Creates one benchmark coupon with a small inventory and fires hundreds of
+parallel POST /api/coupons/<id>/purchase requests at it from benchmark users
+(some users buy more than once), then checks the books:
+
+    - exactly min(quantity, distinct buyers) purchases succeed (no oversell,
+      no sale refused while units were left)
+    - remaining_quantity == total_quantity - user_coupons rows
+    - no user holds two active coupons for it
+    - credits spent == successful purchases * credits_cost
+
+Usage:
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/coupon_purchase_benchmark.py
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/coupon_purchase_benchmark.py --purchases 500 --quantity 50
+
+Options:
+    --purchases     Purchase requests (default: 300)
+    --users         Distinct buyers; requests cycle through them (default: 250)
+    --quantity      Coupon inventory (default: 100)
+    --credits-cost  Credits per coupon (default: 20)
+    --concurrency   Parallel threads (default: 12 - stays within the app's DB pool of 15)
+    --output        Write JSON results to this file
+
+Buyers are bench-user-coupon-N@benchmark.local and the coupon belongs to the
+bench-store-coupons store, so seed_catalog.py --reset-only removes them.
+The exclusive_coupons_enabled flag is switched on for the run and restored
+afterwards. SENDGRID_API_KEY is ignored, so the queued emails are only logged.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from datetime import date, datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+if not os.environ.get('BENCHMARK_DATABASE_URL'):
+    sys.exit('BENCHMARK_DATABASE_URL is not set - refusing to run (never point this at production)')
+os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ['RATELIMIT_ENABLED'] = 'false'
+os.environ.setdefault('RECEIPT_RESUME_ON_START', 'false')
+os.environ.pop('SENDGRID_API_KEY', None)
+
+from sqlalchemy import func  # noqa: E402
+
+from load_test import run_load  # noqa: E402
+
+from main import app  # noqa: E402
+from app import db  # noqa: E402
+from auth_api import generate_jwt_token  # noqa: E402
+from models import Business, Coupon, FeatureFlag, User, UserCoupon  # noqa: E402
+
+BENCH_STORE_SLUG = 'bench-store-coupons'
+FEATURE_FLAG = 'exclusive_coupons_enabled'
+
+
+def prepare(users, quantity, credits_cost):
+    """Fresh coupon and buyers that can each afford it; returns (coupon_id, user ids)"""
+    store = Business.query.filter_by(slug=BENCH_STORE_SLUG).first()
+    if store is None:
+        store = Business(name='Bench Coupons', slug=BENCH_STORE_SLUG, city='Sarajevo')
+        db.session.add(store)
+        db.session.flush()
+
+    # user_coupons cascade
+    Coupon.query.filter_by(business_id=store.id).delete(synchronize_session=False)
+    coupon = Coupon(
+        business_id=store.id,
+        article_name='Bench kupon',
+        normal_price=10.0,
+        discount_percent=50,
+        total_quantity=quantity,
+        remaining_quantity=quantity,
+        credits_cost=credits_cost,
+        valid_days=7,
+        is_active=True,
+    )
+    db.session.add(coupon)
+
+    user_ids = [f"bench-user-coupon-{i + 1}" for i in range(users)]
+    existing = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()}
+    for user_id in user_ids:
+        user = existing.get(user_id)
+        if user is None:
+            user = User(id=user_id, email=f"{user_id}@benchmark.local", first_name='Bench', is_verified=True)
+            db.session.add(user)
+        user.is_admin = False
+        user.monthly_credits = 0
+        user.monthly_credits_used = 0
+        user.monthly_credits_reset_date = date.today()
+        user.extra_credits = credits_cost
+        user.lifetime_credits_spent = 0
+
+    db.session.commit()
+    return coupon.id, user_ids
+
+
+def check(coupon_id, user_ids, credits_cost):
+    coupon = db.session.get(Coupon, coupon_id)
+    db.session.refresh(coupon)
+    sold = UserCoupon.query.filter_by(coupon_id=coupon_id).count()
+    max_per_user = db.session.query(func.count(UserCoupon.id)).filter(
+        UserCoupon.coupon_id == coupon_id, UserCoupon.status == 'active'
+    ).group_by(UserCoupon.user_id).order_by(func.count(UserCoupon.id).desc()).limit(1).scalar() or 0
+    spent = db.session.query(func.coalesce(func.sum(User.lifetime_credits_spent), 0)).filter(
+        User.id.in_(user_ids)
+    ).scalar()
+    return {
+        'total_quantity': coupon.total_quantity,
+        'remaining_quantity': coupon.remaining_quantity,
+        'user_coupons': sold,
+        'max_active_per_user': max_per_user,
+        'credits_spent': int(spent),
+        'expected_credits_spent': sold * credits_cost,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coupon purchase concurrency test')
+    parser.add_argument('--purchases', type=int, default=300)
+    parser.add_argument('--users', type=int, default=250)
+    parser.add_argument('--quantity', type=int, default=100)
+    parser.add_argument('--credits-cost', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=12)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    app.config['RATELIMIT_ENABLED'] = False
+    app.config['TESTING'] = True
+
+    with app.app_context():
+        flag_was = FeatureFlag.is_enabled(FEATURE_FLAG, default=False)
+        FeatureFlag.set_flag(FEATURE_FLAG, True)
+        coupon_id, user_ids = prepare(args.users, args.quantity, args.credits_cost)
+        headers = [
+            {'Authorization': f"Bearer {generate_jwt_token(user_id, f'{user_id}@benchmark.local')}"}
+            for user_id in user_ids
+        ]
+        db.session.remove()
+
+    outcomes = {}
+    lock = threading.Lock()
+
+    def purchase(i):
+        response = app.test_client().post(
+            f"/api/coupons/{coupon_id}/purchase", headers=headers[i % len(headers)]
+        )
+        key = 'ok' if response.status_code == 200 else f"{response.status_code} {(response.get_json() or {}).get('error')}"
+        with lock:
+            outcomes[key] = outcomes.get(key, 0) + 1
+        return response.status_code in (200, 400)  # 400: sold out / already owned
+
+    try:
+        summary = run_load(purchase, args.purchases, args.concurrency)
+        with app.app_context():
+            books = check(coupon_id, user_ids, args.credits_cost)
+            db.session.remove()
+    finally:
+        with app.app_context():
+            FeatureFlag.set_flag(FEATURE_FLAG, flag_was)
+            db.session.remove()
+
+    distinct_buyers = min(args.users, args.purchases)
+    problems = []
+    if books['remaining_quantity'] < 0:
+        problems.append('negative inventory')
+    if books['total_quantity'] - books['remaining_quantity'] != books['user_coupons']:
+        problems.append('inventory does not match user_coupons')
+    if books['user_coupons'] != min(args.quantity, distinct_buyers):
+        problems.append(f"expected {min(args.quantity, distinct_buyers)} sales")
+    if books['max_active_per_user'] > 1:
+        problems.append('user holds two active coupons')
+    if books['credits_spent'] != books['expected_credits_spent']:
+        problems.append('credits spent do not match sales')
+
+    print(f"{args.purchases} purchases, {args.concurrency} threads: {summary['rps']} rps, "
+          f"p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms")
+    for key, count in sorted(outcomes.items(), key=lambda item: -item[1]):
+        print(f"  {count:>5}  {key}")
+    print(f"  sold {books['user_coupons']}/{books['total_quantity']}, remaining {books['remaining_quantity']}, "
+          f"credits spent {books['credits_spent']}")
+    print('OK' if not problems else f"FAILED: {', '.join(problems)}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(),
+                'purchases': args.purchases,
+                'users': args.users,
+                'concurrency': args.concurrency,
+                'summary': summary,
+                'outcomes': outcomes,
+                'books': books,
+                'problems': problems,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for credit deductions.
+
+Fires parallel deductions at one benchmark user and reports throughput and
+latency percentiles, then checks the ledger: the final balance must equal the
+starting balance minus the successful deductions (no lost updates), and no
+more deductions may succeed than the balance covered (no overdraft).
+
+Modes:
+    atomic  MonthlyCreditsService.deduct_credits (one conditional UPDATE ... RETURNING)
+    legacy  The previous read-modify-write sequence (get_balance, re-read the
+            User, update counters in Python, commit, get_balance again), kept
+            here as the baseline
+
+Usage:
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/credits_benchmark.py
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/credits_benchmark.py --mode atomic --starting-credits 500
+
+Options:
+    --mode              atomic, legacy or both (default: both)
+    --concurrency       Parallel threads (default: 12 - stays within the app's DB pool of 15)
+    --deductions        Deductions per mode (default: 2000)
+    --starting-credits  Extra credits before each run (default: --deductions, so all
+                        should succeed; set lower to exercise the insufficient path)
+    --output            Write JSON results to this file
+
+The benchmark user (bench-user-credits@benchmark.local) is removed by
+seed_catalog.py --reset-only like the other benchmark users.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from datetime import date, datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+if not os.environ.get('BENCHMARK_DATABASE_URL'):
+    sys.exit('BENCHMARK_DATABASE_URL is not set - refusing to run (never point this at production)')
+os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from load_test import run_load  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import User  # noqa: E402
+from credits_service import InsufficientCreditsError  # noqa: E402
+from credits_service_monthly import MonthlyCreditsService  # noqa: E402
+
+BENCH_USER_ID = 'bench-user-credits'
+BENCH_USER_EMAIL = 'bench-user-credits@benchmark.local'
+
+
+def legacy_deduct(user_id, amount):
+    """The pre-UPDATE ... RETURNING deduction, for comparison"""
+    balance = MonthlyCreditsService.get_balance(user_id)
+    if balance['total_credits'] < amount:
+        raise InsufficientCreditsError(amount, balance['total_credits'])
+
+    user = User.query.get(user_id)
+    extra_used = min(amount, user.extra_credits or 0)
+    user.extra_credits = (user.extra_credits or 0) - extra_used
+    user.monthly_credits_used = (user.monthly_credits_used or 0) + amount - extra_used
+    user.lifetime_credits_spent = (user.lifetime_credits_spent or 0) + amount
+    db.session.commit()
+
+    return MonthlyCreditsService.get_balance(user_id, auto_reset_monthly=False)
+
+
+def atomic_deduct(user_id, amount):
+    return MonthlyCreditsService.deduct_credits(user_id, amount, 'BENCHMARK')
+
+
+def prepare_user(starting_credits):
+    """Benchmark user with exactly starting_credits, all in the extra bucket"""
+    user = db.session.get(User, BENCH_USER_ID)
+    if user is None:
+        user = User(id=BENCH_USER_ID, email=BENCH_USER_EMAIL, first_name='Bench', is_verified=True)
+        db.session.add(user)
+    user.is_admin = False
+    user.monthly_credits = 0
+    user.monthly_credits_used = 0
+    user.monthly_credits_reset_date = date.today()  # No reset during the run
+    user.extra_credits = starting_credits
+    user.lifetime_credits_spent = 0
+    db.session.commit()
+
+
+def read_balance():
+    user = db.session.get(User, BENCH_USER_ID)
+    db.session.refresh(user)
+    return max(0, (user.monthly_credits or 0) - (user.monthly_credits_used or 0)) + (user.extra_credits or 0)
+
+
+def run_mode(name, deduct, deductions, concurrency, starting_credits):
+    with app.app_context():
+        prepare_user(starting_credits)
+        db.session.remove()
+
+    succeeded = 0
+    insufficient = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal succeeded, insufficient
+        with app.app_context():
+            try:
+                deduct(BENCH_USER_ID, 1)
+            except InsufficientCreditsError:
+                with lock:
+                    insufficient += 1
+                return True  # Expected once the balance runs out
+            finally:
+                db.session.remove()
+        with lock:
+            succeeded += 1
+        return True
+
+    summary = run_load(one, deductions, concurrency)
+
+    with app.app_context():
+        final_balance = read_balance()
+        db.session.remove()
+
+    expected = starting_credits - succeeded
+    summary.update({
+        'mode': name,
+        'starting_credits': starting_credits,
+        'succeeded': succeeded,
+        'insufficient': insufficient,
+        'final_balance': final_balance,
+        'expected_balance': expected,
+        'lost_updates': final_balance - expected,
+        'overdraft': max(0, succeeded - starting_credits),
+    })
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Credit deduction concurrency benchmark')
+    parser.add_argument('--mode', choices=['atomic', 'legacy', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, default=12)
+    parser.add_argument('--deductions', type=int, default=2000)
+    parser.add_argument('--starting-credits', type=int)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    starting_credits = args.starting_credits if args.starting_credits is not None else args.deductions
+    modes = ['legacy', 'atomic'] if args.mode == 'both' else [args.mode]
+    functions = {'legacy': legacy_deduct, 'atomic': atomic_deduct}
+
+    results = []
+    print(f"{'mode':<8} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'ok':>6} {'insuff':>7} {'lost':>6} {'overdraft':>10}")
+    for mode in modes:
+        r = run_mode(mode, functions[mode], args.deductions, args.concurrency, starting_credits)
+        results.append(r)
+        print(f"{mode:<8} {str(r['rps']):>9} {str(r['p50_ms']):>8} {str(r['p95_ms']):>8} "
+              f"{r['succeeded']:>6} {r['insufficient']:>7} {r['lost_updates']:>6} {r['overdraft']:>10}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(),
+                'concurrency': args.concurrency,
+                'deductions': args.deductions,
+                'results': results,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    # A lost update or overdraft in the atomic path is a bug
+    atomic = next((r for r in results if r['mode'] == 'atomic'), None)
+    return 1 if atomic and (atomic['lost_updates'] or atomic['overdraft']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Deterministic local stand-in for the OpenAI client used by the benchmarks.
+
+Embeddings are unit vectors seeded from a hash of the input text, so the same
+text always maps to the same vector and benchmark runs are reproducible.
+Chat completions return canned responses shaped like the ones the app
+expects (intent parser JSON array, supervisor JSON object, plain text
+explanations). An optional artificial latency simulates the network round
+trip without calling the real API.
+
+An embedding source (e.g. search_replay.py's on-disk cache of real
+embeddings) can be plugged in: texts it knows are answered from it without
+the artificial latency, everything else falls back to the hash vectors.
+
+Usage (must run BEFORE any app module is imported):
+    import fake_openai
+    fake_openai.install(latency_ms=50)
+"""
+
+import hashlib
+import json
+import re
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """Deterministic unit vector for text (same text -> same vector)"""
+    seed = int.from_bytes(hashlib.sha256((text or '').strip().lower().encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _token_count(text):
+    return max(1, len((text or '').split()))
+
+
+def _split_query_items(query):
+    """Split 'mlijeko, jaja i hljeb' into items like the intent parser would"""
+    parts = re.split(r',|\s+i\s+', query or '')
+    return [p.strip() for p in parts if p.strip()] or [query]
+
+
+def _chat_content(messages, response_format=None):
+    """Pick a canned response based on the prompt the caller sent"""
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '') or ''
+    user = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '') or ''
+
+    # Intent parser (agents/prompts.py INITIAL_PARSER_PROMPT) expects a JSON array
+    if 'embedding_text' in system and 'normalized_query' in system:
+        return json.dumps([
+            {
+                'original': item,
+                'corrected': item,
+                'normalized_query': item,
+                'embedding_text': item,
+                'query': item,
+                'expanded_query': item,
+                'size_value': None,
+                'size_unit': None,
+            }
+            for item in _split_query_items(user)
+        ], ensure_ascii=False)
+
+    if response_format and response_format.get('type') == 'json_object':
+        # Supervisor intent detection; other JSON callers get their defaults
+        if 'intent' in system.lower():
+            return json.dumps({'intent': 'semantic_search', 'confidence': 0.9, 'parameters': {}})
+        return json.dumps({'items': []})
+
+    return 'Pronađeni proizvodi odgovaraju traženom upitu.'
+
+
+class _Embeddings:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, model=None, input=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input or [])
+        source = type(self._owner).embedding_source
+        known = [source(model, text) for text in texts] if source else [None] * len(texts)
+        if any(vector is None for vector in known):
+            self._owner._sleep()
+        data = [
+            SimpleNamespace(
+                index=i,
+                embedding=(vector if vector is not None else fake_embedding(text)).tolist(),
+                object='embedding',
+            )
+            for i, (text, vector) in enumerate(zip(texts, known))
+        ]
+        tokens = sum(_token_count(t) for t in texts)
+        self._owner.calls['embeddings'] += 1
+        return SimpleNamespace(
+            data=data,
+            model=model,
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens),
+        )
+
+
+class _Completions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, model=None, messages=None, response_format=None, **kwargs):
+        self._owner._sleep()
+        messages = messages or []
+        content = _chat_content(messages, response_format)
+        prompt_tokens = sum(_token_count(m.get('content') if isinstance(m.get('content'), str) else '')
+                            for m in messages)
+        completion_tokens = _token_count(content)
+        self._owner.calls['chat'] += 1
+        return SimpleNamespace(
+            id='chatcmpl-benchmark',
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason='stop',
+                message=SimpleNamespace(role='assistant', content=content),
+            )],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+
+class FakeOpenAI:
+    """Drop-in replacement for openai.OpenAI (embeddings + chat completions only)"""
+
+    latency_ms = 0
+    calls = {'embeddings': 0, 'chat': 0}
+    embedding_source = None  # Optional fn(model, text) -> np.ndarray or None
+
+    def __init__(self, *args, **kwargs):
+        self.embeddings = _Embeddings(self)
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def _sleep(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+
+def reset_call_counts():
+    FakeOpenAI.calls = {'embeddings': 0, 'chat': 0}
+
+
+def install(latency_ms=None):
+    """
+    Replace openai.OpenAI with FakeOpenAI.
+
+    Modules that do `from openai import OpenAI` pick up the fake as long as
+    this runs before they are imported. latency_ms=None keeps the current
+    setting, so a second install() does not undo the first one's latency.
+    """
+    import openai
+
+    if latency_ms is not None:
+        FakeOpenAI.latency_ms = latency_ms
+    openai.OpenAI = FakeOpenAI
+    return FakeOpenAI
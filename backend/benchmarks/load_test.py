@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Concurrent load test for the search endpoint (and any other HTTP endpoint).
+
+Fires requests from N concurrent clients against a running backend and
+reports requests/second and latency percentiles. Used to compare gunicorn
+worker models under LLM-bound load.
+
+Usage:
+    # 1. Start the server with the worker model under test, e.g.
+    #    GUNICORN_WORKER_CLASS=sync    RATELIMIT_ENABLED=false gunicorn main:app -c gunicorn.conf.py
+    #    GUNICORN_WORKER_CLASS=gthread RATELIMIT_ENABLED=false gunicorn main:app -c gunicorn.conf.py
+    # 2. Run the load test against it
+    python benchmarks/load_test.py --url http://localhost:8080 --concurrency 16 --requests 200
+    python benchmarks/load_test.py --compare sync.json gthread.json
+
+Options:
+    --url           Backend base URL (default: http://localhost:8080)
+    --path          Endpoint path (default: /search)
+    --method        HTTP method (default: POST)
+    --concurrency   Concurrent clients (default: 16)
+    --requests      Total requests (default: 200)
+    --queries       File with one search query per line (default: built-in list)
+    --output        Write JSON results to this file
+    --compare       Compare two JSON result files (baseline, candidate)
+
+Rate limiting must be disabled (RATELIMIT_ENABLED=false) or the search
+limit (100/min per IP) will dominate the results.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_QUERIES = [
+    'mlijeko', 'kafa', 'jaja', 'hljeb', 'piletina', 'deterdžent za veš',
+    'čokolada milka', 'jogurt', 'sir', 'sok od narandže', 'pivo', 'voda 1.5l',
+    'šampon', 'pasta za zube', 'brašno', 'ulje', 'šećer', 'riža', 'tjestenina',
+    'mlijeko, jaja i hljeb',
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def summarize(latencies_ms, errors, wall_seconds):
+    """Build the summary dict for a run"""
+    ordered = sorted(latencies_ms)
+    total = len(latencies_ms) + errors
+    return {
+        'requests': total,
+        'errors': errors,
+        'wall_seconds': round(wall_seconds, 3),
+        'rps': round(len(latencies_ms) / wall_seconds, 2) if wall_seconds > 0 else None,
+        'p50_ms': round(percentile(ordered, 50), 1) if ordered else None,
+        'p95_ms': round(percentile(ordered, 95), 1) if ordered else None,
+        'p99_ms': round(percentile(ordered, 99), 1) if ordered else None,
+        'max_ms': round(ordered[-1], 1) if ordered else None,
+    }
+
+
+def run_load(request_fn, total_requests, concurrency):
+    """
+    Call request_fn(i) total_requests times from `concurrency` threads.
+    request_fn returns True on success (raises or returns False on error).
+
+    Returns:
+        Summary dict (see summarize)
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = request_fn(i)
+        except Exception:
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with lock:
+            if ok:
+                latencies.append(elapsed_ms)
+            else:
+                errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    wall = time.perf_counter() - wall_start
+
+    return summarize(latencies, errors, wall)
+
+
+def http_request_fn(base_url, path, method, queries, timeout=120):
+    """Build a request function for run_load (one pooled session per thread)"""
+    local = threading.local()
+    url = base_url.rstrip('/') + path
+
+    def request_fn(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        query = queries[i % len(queries)]
+        kwargs = {'params': {'q': query}} if method == 'GET' else {'json': {'query': query}}
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.ConnectionError:
+            # Server closed an idle keep-alive connection - retry once like a browser would
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        return response.status_code < 400
+
+    return request_fn
+
+
+def compare(baseline_path, candidate_path):
+    """Print a side-by-side comparison of two result files"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+
+    print(f"{'metric':<10} {'baseline':>12} {'candidate':>12} {'change':>10}")
+    for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'errors'):
+        a, b = baseline['summary'].get(key), candidate['summary'].get(key)
+        change = ''
+        if a and b:
+            change = f"{(b - a) / a * 100:+.1f}%"
+        print(f"{key:<10} {str(a):>12} {str(b):>12} {change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent HTTP load test')
+    parser.add_argument('--url', default=os.environ.get('BACKEND_URL', 'http://localhost:8080'))
+    parser.add_argument('--path', default='/search')
+    parser.add_argument('--method', default='POST')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--queries')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    request_fn = http_request_fn(args.url, args.path, args.method.upper(), queries)
+
+    print(f"Load test: {args.method.upper()} {args.url}{args.path} "
+          f"({args.requests} requests, concurrency {args.concurrency})")
+    summary = run_load(request_fn, args.requests, args.concurrency)
+
+    for key, value in summary.items():
+        print(f"  {key:<14} {value}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'url': args.url,
+                'path': args.path,
+                'concurrency': args.concurrency,
+                'summary': summary,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    return 0 if summary['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Pre-deploy benchmark suite for the hot read paths.
+
+Runs in-process against a seeded benchmark database (see seed_catalog.py)
+with OpenAI replaced by the deterministic local fake, so the numbers measure
+our code and SQL - not the network or the model. For every scenario it
+reports p50/p95/p99 latency and SQL queries per request, and writes a JSON
+report that can be compared against a baseline to catch regressions.
+
+Scenarios:
+    search          POST /search (agent search: parser -> embeddings -> pgvector)
+    products        GET  /api/products (paginated listing)
+    featured        GET  /api/featured-data (homepage)
+    related         GET  /api/products/<id>/related (clones / variants / siblings)
+    daily_scan      jobs.scan_user_products.scan_single_user, per benchmark user
+    daily_scan_full jobs.scan_user_products.run_daily_scan, once (opt-in; includes
+                    the job's fixed 5s pause between user batches)
+
+The scan job's per-user/per-term pacing delays are set to 0 for the run.
+
+Usage:
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/run_benchmarks.py --output bench.json
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/run_benchmarks.py --baseline main.json --output pr.json
+    python benchmarks/run_benchmarks.py --compare main.json pr.json
+
+Options:
+    --scenarios         Comma-separated scenarios (default: all except daily_scan_full)
+    --iterations        Measured requests per scenario (default: 50)
+    --warmup            Unmeasured requests per scenario (default: 5)
+    --llm-latency-ms    Artificial latency added to every fake OpenAI call (default: 0)
+    --output            Write the JSON report here
+    --baseline          Compare against this report and exit 1 on regression
+    --max-regression    Allowed p95 slowdown vs baseline, as a fraction (default: 0.25)
+    --compare           Only print a comparison of two existing reports
+
+Query counts are a hard gate: any scenario issuing more queries per request
+than the baseline fails, because N+1 regressions tend to hide in the noise of
+a small benchmark catalog and only show up on production data.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from load_test import percentile  # noqa: E402
+
+DEFAULT_SCENARIOS = ['search', 'products', 'featured', 'related', 'daily_scan']
+ALL_SCENARIOS = DEFAULT_SCENARIOS + ['daily_scan_full']
+
+
+class QueryCounter:
+    """Counts SQL statements issued through the engine while active"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+def summarize_scenario(latencies_ms, query_counts, errors):
+    ordered = sorted(latencies_ms)
+    queries = sorted(query_counts)
+
+    def rounded(value):
+        return round(value, 1) if value is not None else None
+
+    return {
+        'iterations': len(latencies_ms) + errors,
+        'errors': errors,
+        'p50_ms': rounded(percentile(ordered, 50)),
+        'p95_ms': rounded(percentile(ordered, 95)),
+        'p99_ms': rounded(percentile(ordered, 99)),
+        'mean_ms': rounded(sum(ordered) / len(ordered)) if ordered else None,
+        'max_ms': rounded(ordered[-1]) if ordered else None,
+        'queries_mean': round(sum(queries) / len(queries), 1) if queries else None,
+        'queries_max': queries[-1] if queries else None,
+    }
+
+
+def measure(fn, iterations, warmup, counter):
+    """Call fn(i) warmup + iterations times, recording latency and query count"""
+    for i in range(warmup):
+        try:
+            fn(i)
+        except Exception:
+            pass
+
+    latencies, query_counts, errors = [], [], 0
+    for i in range(iterations):
+        counter.reset()
+        start = time.perf_counter()
+        try:
+            ok = fn(warmup + i)
+        except Exception as e:
+            print(f"    iteration {i} failed: {e}")
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if ok:
+            latencies.append(elapsed_ms)
+            query_counts.append(counter.count)
+        else:
+            errors += 1
+    return summarize_scenario(latencies, query_counts, errors)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare_reports(baseline, candidate, max_regression):
+    """
+    Print a comparison table and return a list of regression messages.
+
+    A scenario regresses when its p95 is more than max_regression slower than
+    the baseline, or when it issues more queries per request than before.
+    """
+    regressions = []
+    print(f"{'scenario':<16} {'p95 base':>10} {'p95 new':>10} {'change':>9} {'queries':>15}")
+    for name, new in candidate['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old:
+            print(f"{name:<16} {'-':>10} {str(new.get('p95_ms')):>10} {'new':>9}")
+            continue
+
+        change = ''
+        a, b = old.get('p95_ms'), new.get('p95_ms')
+        if a and b:
+            ratio = (b - a) / a
+            change = f"{ratio * 100:+.1f}%"
+            if ratio > max_regression:
+                regressions.append(f"{name}: p95 {a}ms -> {b}ms ({change})")
+
+        qa, qb = old.get('queries_max'), new.get('queries_max')
+        if qa is not None and qb is not None and qb > qa:
+            regressions.append(f"{name}: queries/request {qa} -> {qb}")
+
+        if new.get('errors') and not old.get('errors'):
+            regressions.append(f"{name}: {new['errors']} errors (baseline had none)")
+
+        print(f"{name:<16} {str(a):>10} {str(b):>10} {change:>9} {f'{qa} -> {qb}':>15}")
+    return regressions
+
+
+def build_scenarios(app, db, client, auth_headers, fixtures, queries):
+    """Return {name: fn(i) -> bool}"""
+    from load_test import DEFAULT_QUERIES
+
+    import jobs.scan_user_products as scan_job
+
+    # The scan job paces itself against the real OpenAI API; with the local
+    # fake those sleeps would be the whole measurement
+    scan_job.DELAY_BETWEEN_SEARCHES = 0
+    scan_job.DELAY_BETWEEN_USERS = 0
+
+    queries = queries or DEFAULT_QUERIES
+    product_ids = fixtures['product_ids']
+    users = fixtures['users']
+
+    def search(i):
+        # Fresh cookie jar per request: anonymous searches are limited per session
+        anonymous = app.test_client(use_cookies=False)
+        response = anonymous.post('/search', json={'query': queries[i % len(queries)]})
+        return response.status_code == 200
+
+    def products(i):
+        response = client.get(f'/api/products?page={i % 10 + 1}', headers=auth_headers)
+        return response.status_code == 200
+
+    def featured(i):
+        response = client.get('/api/featured-data', headers=auth_headers)
+        return response.status_code == 200
+
+    def related(i):
+        product_id = product_ids[i % len(product_ids)]
+        response = client.get(f'/api/products/{product_id}/related', headers=auth_headers)
+        return response.status_code == 200
+
+    def daily_scan(i):
+        from models import User
+
+        with app.app_context():
+            user = db.session.get(User, users[i % len(users)])
+            scan_job.scan_single_user(user)
+            db.session.remove()
+        # scan_single_user returns None both on error and on "nothing to scan";
+        # the seeded users always have tracked products, so count it as success
+        return True
+
+    def daily_scan_full(i):
+        from models import UserProductScan
+        from datetime import date
+
+        with app.app_context():
+            # run_daily_scan skips users already scanned today
+            UserProductScan.query.filter(
+                UserProductScan.user_id.in_(users),
+                UserProductScan.scan_date == date.today()
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            db.session.remove()
+        scan_job.run_daily_scan()
+        return True
+
+    return {
+        'search': search,
+        'products': products,
+        'featured': featured,
+        'related': related,
+        'daily_scan': daily_scan,
+        'daily_scan_full': daily_scan_full,
+    }
+
+
+def load_fixtures(app, db):
+    """Pick benchmark users and products seeded by seed_catalog.py"""
+    from models import Business, Product, User
+    from seed_catalog import BENCH_EMAIL_PATTERN, BENCH_SLUG_PREFIX
+
+    with app.app_context():
+        users = [u.id for u in User.query.filter(User.email.like(BENCH_EMAIL_PATTERN)).order_by(User.id).all()]
+        product_ids = [row[0] for row in db.session.query(Product.id).join(
+            Business, Business.id == Product.business_id
+        ).filter(
+            Business.slug.like(f'{BENCH_SLUG_PREFIX}%')
+        ).order_by(Product.id).limit(200).all()]
+        catalog_size = db.session.query(Product.id).count()
+        db.session.remove()
+
+    if not users or not product_ids:
+        sys.exit('No benchmark data found - run benchmarks/seed_catalog.py first')
+    return {'users': users, 'product_ids': product_ids, 'catalog_size': catalog_size}
+
+
+def run(args):
+    if not os.environ.get('BENCHMARK_DATABASE_URL'):
+        sys.exit('BENCHMARK_DATABASE_URL is not set - refusing to run (never point this at production)')
+    os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ['RATELIMIT_ENABLED'] = 'false'
+    # Benchmarks must not send emails or start background workers
+    os.environ.setdefault('RECEIPT_RESUME_ON_START', 'false')
+    os.environ.pop('SENDGRID_API_KEY', None)
+
+    import fake_openai
+    fake_llm = fake_openai.install(latency_ms=args.llm_latency_ms)
+
+    from sqlalchemy import event
+
+    from main import app
+    from app import db
+    from auth_api import generate_jwt_token
+
+    app.config['RATELIMIT_ENABLED'] = False
+    app.config['TESTING'] = True
+
+    fixtures = load_fixtures(app, db)
+    counter = QueryCounter()
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    auth_headers = {'Authorization': f"Bearer {generate_jwt_token(fixtures['users'][0], 'bench-user-1@benchmark.local')}"}
+    client = app.test_client()
+
+    queries = None
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    scenarios = build_scenarios(app, db, client, auth_headers, fixtures, queries)
+    selected = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in selected if s not in scenarios]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(ALL_SCENARIOS)})")
+
+    print(f"Benchmark catalog: {fixtures['catalog_size']} products, {len(fixtures['users'])} users")
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'catalog_size': fixtures['catalog_size'],
+        'iterations': args.iterations,
+        'llm_latency_ms': args.llm_latency_ms,
+        'scenarios': {},
+    }
+
+    for name in selected:
+        # The full scan covers every user already - one pass is the measurement
+        iterations, warmup = (1, 0) if name == 'daily_scan_full' else (args.iterations, args.warmup)
+        print(f"  {name} ({iterations} iterations)...")
+        fake_openai.reset_call_counts()
+        summary = measure(scenarios[name], iterations, warmup, counter)
+        summary['llm_calls'] = dict(fake_llm.calls)
+        report['scenarios'][name] = summary
+        print(f"    p50 {summary['p50_ms']}ms  p95 {summary['p95_ms']}ms  p99 {summary['p99_ms']}ms  "
+              f"queries {summary['queries_mean']} (max {summary['queries_max']})  errors {summary['errors']}")
+
+    with app.app_context():
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-deploy benchmark suite')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--llm-latency-ms', type=int, default=0)
+    parser.add_argument('--queries')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'))
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            candidate = json.load(f)
+        regressions = compare_reports(baseline, candidate, args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        return 1 if regressions else 0
+
+    report = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+
+    return 1 if any(s['errors'] for s in report['scenarios'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
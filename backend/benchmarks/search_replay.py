@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+"""
+Offline replay of logged searches against candidate retrieval configs.
+
+admin_search_routes.rerun_search re-runs one logged query through the full
+LLM-backed agent. This harness replays thousands of SearchLog / UserSearch
+queries in parallel straight through the retrieval layer
+(search_by_vector_grouped / search_by_vector, as semantic_search_node calls
+them), once per config, and reports for each config:
+
+    - latency percentiles and throughput of the retrieval path
+    - ranking overlap with the logged results (what users saw)
+    - ranking overlap with the first config ('current': today's settings),
+      which isolates the effect of the change from catalog drift since logging
+
+Nothing calls an LLM: OpenAI is replaced by benchmarks/fake_openai.py, the
+parse comes from SearchLog.parsed_query (the intent parser output that was
+logged), and query embeddings come from an on-disk cache of real embeddings.
+Texts missing from the cache fall back to hash vectors - fine for latency,
+meaningless for quality - and are counted in the report; run once with
+--warm-embeddings (needs OPENAI_API_KEY) to fill the cache.
+
+Usage:
+    BENCHMARK_DATABASE_URL=postgresql://<replica> python benchmarks/search_replay.py --warm-embeddings --limit 2000
+    BENCHMARK_DATABASE_URL=postgresql://<replica> python benchmarks/search_replay.py --config text_heavy.json --output replay.json
+
+Options:
+    --source           searchlog, usersearch or both (default: searchlog)
+    --limit            Logged searches per source, newest first (default: 2000)
+    --since-days       Only searches from the last N days (default: 30)
+    --concurrency      Parallel replays (default: 8 - stays within the app's DB pool of 15)
+    --config           JSON file with a candidate config (repeatable)
+    --embedding-cache  npz file with cached query embeddings (default: benchmarks/replay_embeddings.npz)
+    --warm-embeddings  Fetch embeddings missing from the cache with the real API and save them
+    --llm-latency-ms   Simulated embedding call latency when a config turns the cache off (default: 150)
+    --worst            Queries with the largest ranking change listed per config (default: 10)
+    --output           Write the JSON report here
+
+Config files are flat JSON objects:
+    name                Label in the report (default: file name)
+    k                   Results per item (default: the logged k)
+    similarity_threshold  Minimum final similarity (default: the logged threshold)
+    embedding_cache     false: pay --llm-latency-ms per query embedding (default: true)
+    vector_weight, text_weight, min_vector_score, min_text_score,
+    size_match_boost, ivfflat_probes, engine_candidate_factor
+                        Override the agents.common.db_utils constants of the same
+                        (upper-case) name for the run
+    vector_engine       true/false: candidates from the in-process engine (vector_engine.py).
+                        A snapshot is built before the config is timed; without one
+                        the config fails instead of silently measuring pgvector.
+    vector_shards       true/false: per-store shard indexes for store filters (vector_shards.py)
+
+The replay only reads; point BENCHMARK_DATABASE_URL at a replica or a
+restored snapshot so the logs and the catalog are real.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+if not os.environ.get('BENCHMARK_DATABASE_URL'):
+    sys.exit('BENCHMARK_DATABASE_URL is not set - refusing to run (point it at a replica or snapshot)')
+os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('RECEIPT_RESUME_ON_START', 'false')
+os.environ.setdefault('LLM_USAGE_LOGGING', '0')  # Fake embedding calls must not land in the usage table
+
+import openai  # noqa: E402
+
+RealOpenAI = openai.OpenAI  # Kept for --warm-embeddings before the fake replaces it
+
+import fake_openai  # noqa: E402
+
+fake_openai.install(latency_ms=0)
+
+from load_test import run_load  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import SearchLog, UserSearch  # noqa: E402
+import agents.common.db_utils as db_utils  # noqa: E402
+from agents.common.db_utils import search_by_vector, search_by_vector_grouped  # noqa: E402
+from agents.common.llm_utils import get_embedding_model  # noqa: E402
+from agents.context import AgentContext  # noqa: E402
+from agents.nodes.semantic_search import _extract_price_from_query  # noqa: E402
+import vector_engine  # noqa: E402
+import vector_shards  # noqa: E402
+
+DEFAULTS = AgentContext()
+EMBEDDING_MODEL = DEFAULTS.embedding_model
+DEFAULT_EMBEDDING_CACHE = os.path.join(BENCHMARK_DIR, 'replay_embeddings.npz')
+
+RETRIEVAL_SETTINGS = {
+    'vector_weight': (db_utils, 'VECTOR_WEIGHT'),
+    'text_weight': (db_utils, 'TEXT_WEIGHT'),
+    'min_vector_score': (db_utils, 'MIN_VECTOR_SCORE'),
+    'min_text_score': (db_utils, 'MIN_TEXT_SCORE'),
+    'size_match_boost': (db_utils, 'SIZE_MATCH_BOOST'),
+    'ivfflat_probes': (db_utils, 'IVFFLAT_PROBES'),
+    'engine_candidate_factor': (db_utils, 'ENGINE_CANDIDATE_FACTOR'),
+    'vector_engine': (vector_engine, 'ENGINE_ENABLED'),
+    'vector_shards': (vector_shards, 'SHARDS_ENABLED'),
+}
+HARNESS_SETTINGS = {'name', 'k', 'similarity_threshold', 'embedding_cache'}
+
+RBO_PERSISTENCE = 0.9  # Weight of rank d+1 relative to rank d
+
+
+@dataclass
+class ReplayCase:
+    """One logged search to replay"""
+    source: str
+    log_id: int
+    query: str
+    items: list | None          # Logged intent parser output (search_items)
+    business_ids: list | None
+    only_discounted: bool
+    k: int | None
+    threshold: float | None
+    logged: dict                # {group: [product_id, ...]} in rank order
+
+
+# ==================== LOADING ====================
+
+def _groups_from_detail(results_detail):
+    groups = {}
+    for row in sorted(results_detail or [], key=lambda r: r.get('rank') or 0):
+        groups.setdefault(row.get('group') or '', []).append(row.get('product_id'))
+    return groups
+
+
+def _groups_from_results(results):
+    if isinstance(results, str):
+        try:
+            results = json.loads(results)
+        except ValueError:
+            return {}
+    if isinstance(results, dict):
+        return {name: [p.get('id') for p in products or []] for name, products in results.items()}
+    return {'': [p.get('id') for p in results or [] if isinstance(p, dict)]}
+
+
+def load_cases(source, limit, since_days):
+    cutoff = datetime.now() - timedelta(days=since_days)
+    cases = []
+
+    if source in ('searchlog', 'both'):
+        logs = SearchLog.query.filter(
+            SearchLog.created_at >= cutoff,
+            db.or_(SearchLog.search_type.is_(None), SearchLog.search_type == 'text')
+        ).order_by(SearchLog.created_at.desc()).limit(limit).all()
+        for log in logs:
+            cases.append(ReplayCase(
+                'searchlog', log.id, log.query, log.parsed_query or None, log.selected_stores or None,
+                False, log.k, log.similarity_threshold, _groups_from_detail(log.results_detail)
+            ))
+
+    if source in ('usersearch', 'both'):
+        searches = UserSearch.query.filter(
+            UserSearch.created_at >= cutoff
+        ).order_by(UserSearch.created_at.desc()).limit(limit).all()
+        for search in searches:
+            cases.append(ReplayCase(
+                'usersearch', search.id, search.query, None, None,
+                bool(search.only_discounted), None, None, _groups_from_results(search.results)
+            ))
+
+    # Identical searches replay identically - keep the newest of each
+    unique = {}
+    for case in cases:
+        key = (
+            case.query.strip().lower(), tuple(sorted(case.business_ids or [])), case.only_discounted,
+            json.dumps(case.items, sort_keys=True, ensure_ascii=False)
+        )
+        unique.setdefault(key, case)
+    return [case for case in unique.values() if case.query and case.query.strip()]
+
+
+def embedding_texts(case):
+    """Texts the retrieval path will embed for this case (same rules as search_by_vector_grouped)"""
+    if case.items:
+        texts = []
+        for item in case.items:
+            text = item.get("embedding_text") or item.get("normalized_query") or item.get("query") or item.get("original", "")
+            texts.append(text.lower() if text else text)
+        return texts
+    return [case.query.lower()]
+
+
+# ==================== EMBEDDING CACHE ====================
+
+class EmbeddingCache:
+    """Real query embeddings on disk, keyed by the exact embedded text"""
+
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        self.vectors = {}
+        self.enabled = True
+        self.latency_ms = 0
+        if path and os.path.exists(path):
+            data = np.load(path)
+            if str(data['model']) != model:
+                sys.exit(f"{path} holds {data['model']} embeddings, the app uses {model}")
+            self.vectors = {str(text): vector for text, vector in zip(data['texts'], data['vectors'])}
+
+    def lookup(self, model, text):
+        """fake_openai embedding source"""
+        if model != self.model:
+            return None
+        vector = self.vectors.get(text)
+        if vector is not None and not self.enabled:
+            time.sleep(self.latency_ms / 1000.0)  # Config without the cache pays for the call
+        return vector
+
+    def missing(self, texts):
+        return sorted({text for text in texts if text and text not in self.vectors})
+
+    def warm(self, texts, api_key, batch_size=100):
+        client = RealOpenAI(api_key=api_key)
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            response = client.embeddings.create(model=self.model, input=batch)
+            for item in response.data:
+                self.vectors[batch[item.index]] = np.asarray(item.embedding, dtype=np.float32)
+            print(f"  embedded {min(start + batch_size, len(texts))}/{len(texts)}")
+
+    def save(self):
+        if not self.path or not self.vectors:
+            return
+        texts = list(self.vectors)
+        np.savez(
+            self.path, model=np.array(self.model), texts=np.array(texts),
+            vectors=np.stack([self.vectors[text] for text in texts]).astype(np.float32)
+        )
+
+
+# ==================== METRICS ====================
+
+def _flatten(groups, order=None):
+    names = list(order or []) + [name for name in groups if name not in (order or [])]
+    ranked = []
+    seen = set()
+    for name in names:
+        for product_id in groups.get(name, []):
+            if product_id not in seen:
+                seen.add(product_id)
+                ranked.append(product_id)
+    return ranked
+
+
+def rank_biased_overlap(a, b, p=RBO_PERSISTENCE):
+    """RBO truncated at the longer list and normalized so identical lists score 1.0"""
+    depth = max(len(a), len(b))
+    if depth == 0:
+        return 1.0
+    seen_a, seen_b = set(), set()
+    overlap = 0
+    score = 0.0
+    for d in range(1, depth + 1):
+        if d <= len(a):
+            item = a[d - 1]
+            overlap += item in seen_b
+            seen_a.add(item)
+        if d <= len(b):
+            item = b[d - 1]
+            overlap += item in seen_a
+            seen_b.add(item)
+        score += p ** (d - 1) * overlap / d
+    return score * (1 - p) / (1 - p ** depth)
+
+
+def compare_rankings(reference, candidate):
+    """Overlap metrics of candidate {group: ids} against reference {group: ids}"""
+    ref = _flatten(reference)
+    new = _flatten(candidate, order=list(reference))
+    ref_set, new_set = set(ref), set(new)
+
+    shared_groups = [name for name in reference if reference[name] and candidate.get(name)]
+    top1 = None
+    if shared_groups:
+        top1 = sum(reference[name][0] == candidate[name][0] for name in shared_groups) / len(shared_groups)
+
+    union = ref_set | new_set
+    return {
+        'overlap': len(ref_set & new_set) / len(ref_set) if ref_set else None,  # Recall of the reference
+        'jaccard': len(ref_set & new_set) / len(union) if union else 1.0,
+        'rbo': rank_biased_overlap(ref, new),
+        'top1': top1,
+        'identical': ref == new,
+    }
+
+
+def summarize_metrics(comparisons):
+    summary = {}
+    for key in ('overlap', 'jaccard', 'rbo', 'top1'):
+        values = [c[key] for c in comparisons if c[key] is not None]
+        summary[key] = round(sum(values) / len(values), 4) if values else None
+    summary['identical'] = round(sum(c['identical'] for c in comparisons) / len(comparisons), 4) if comparisons else None
+    return summary
+
+
+# ==================== REPLAY ====================
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - HARNESS_SETTINGS - set(RETRIEVAL_SETTINGS)
+    if unknown:
+        sys.exit(f"{path}: unknown settings {', '.join(sorted(unknown))}")
+    config.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    return config
+
+
+def apply_config(config):
+    """Set the module overrides; returns the previous values to restore"""
+    previous = {}
+    for key, (module, attr) in RETRIEVAL_SETTINGS.items():
+        if key in config:
+            previous[(module, attr)] = getattr(module, attr)
+            setattr(module, attr, config[key])
+    return previous
+
+
+def replay_case(case, config):
+    """Run one logged search through the retrieval path; returns {group: [ids]}"""
+    k = config.get('k') or case.k or DEFAULTS.default_k
+    threshold = config.get('similarity_threshold')
+    if threshold is None:
+        threshold = case.threshold if case.threshold is not None else DEFAULTS.similarity_threshold
+    max_price = _extract_price_from_query(case.query)
+
+    with app.app_context():
+        try:
+            if case.items:
+                grouped = asyncio.run(search_by_vector_grouped(
+                    db_session=db.session,
+                    search_items=case.items,
+                    embedding_model=EMBEDDING_MODEL,
+                    k=k,
+                    max_price=max_price,
+                    business_ids=case.business_ids,
+                    only_discounted=case.only_discounted,
+                ))
+            else:
+                query_vector = get_embedding_model(EMBEDDING_MODEL)(case.query.lower())
+                grouped = {'': search_by_vector(
+                    db.session,
+                    query_vector=query_vector,
+                    k=k,
+                    max_price=max_price,
+                    business_ids=case.business_ids,
+                    query_text=case.query,
+                    only_discounted=case.only_discounted,
+                )}
+        finally:
+            db.session.remove()
+
+    return {
+        name: [p['id'] for p in results if p.get('similarity', 0) >= threshold]
+        for name, results in grouped.items()
+    }
+
+
+class ConfigSetupError(RuntimeError):
+    """A config's retrieval path could not be prepared; the config is reported as failed"""
+
+
+def prepare_vector_engine():
+    """
+    Build and map an engine snapshot before timing. engine_candidates_cte
+    returns None until a snapshot exists, so without this the first part of
+    the run (or all of it, if the background build fails) measures pgvector.
+    """
+    engine = vector_engine.get_vector_engine()
+    started = time.perf_counter()
+    try:
+        rows = engine.build_now()
+    except Exception as e:
+        raise ConfigSetupError(f"vector engine snapshot build failed: {e}") from e
+    if not rows:
+        raise ConfigSetupError('vector engine has no snapshot (no embeddings?)')
+    print(f"Vector engine snapshot ready: {rows} rows in {time.perf_counter() - started:.1f}s")
+
+
+def run_config(config, cases, cache, concurrency):
+    results = {}
+    failures = []
+    lock = threading.Lock()
+
+    def one(i):
+        case = cases[i]
+        try:
+            groups = replay_case(case, config)
+        except Exception as e:
+            with lock:
+                failures.append(f"{case.source}:{case.log_id} {e}")
+            return False
+        with lock:
+            results[i] = groups
+        return True
+
+    previous = apply_config(config)
+    cache.enabled = config.get('embedding_cache', True)
+    try:
+        if vector_engine.ENGINE_ENABLED:
+            prepare_vector_engine()
+        summary = run_load(one, len(cases), concurrency)
+    finally:
+        for (module, attr), value in previous.items():
+            setattr(module, attr, value)
+        cache.enabled = True
+    return summary, results, failures
+
+
+def worst_cases(cases, comparisons, count):
+    ranked = sorted(comparisons.items(), key=lambda item: item[1]['rbo'])
+    return [
+        {'source': cases[i].source, 'log_id': cases[i].log_id, 'query': cases[i].query, **metrics}
+        for i, metrics in ranked[:count] if not metrics['identical']
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline search replay against retrieval configs')
+    parser.add_argument('--source', choices=['searchlog', 'usersearch', 'both'], default='searchlog')
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--since-days', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--config', action='append', default=[])
+    parser.add_argument('--embedding-cache', default=DEFAULT_EMBEDDING_CACHE)
+    parser.add_argument('--warm-embeddings', action='store_true')
+    parser.add_argument('--llm-latency-ms', type=int, default=150)
+    parser.add_argument('--worst', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    configs = [{'name': 'current'}] + [load_config(path) for path in args.config]
+
+    with app.app_context():
+        cases = load_cases(args.source, args.limit, args.since_days)
+        db.session.remove()
+    if not cases:
+        sys.exit('No logged searches in range')
+    print(f"Replaying {len(cases)} distinct logged searches ({args.source}, last {args.since_days} days)")
+
+    cache = EmbeddingCache(args.embedding_cache, EMBEDDING_MODEL)
+    cache.latency_ms = args.llm_latency_ms
+    missing = cache.missing(text for case in cases for text in embedding_texts(case))
+    if missing and args.warm_embeddings:
+        if not OPENAI_API_KEY:
+            sys.exit('--warm-embeddings needs OPENAI_API_KEY')
+        print(f"Fetching {len(missing)} missing embeddings")
+        cache.warm(missing, OPENAI_API_KEY)
+        cache.save()
+        missing = []
+    if missing:
+        print(f"WARNING: {len(missing)} query texts are not in the embedding cache; they use hash "
+              f"vectors, so their quality metrics are meaningless (run with --warm-embeddings)")
+    fake_openai.FakeOpenAI.embedding_source = cache.lookup
+    fake_openai.FakeOpenAI.latency_ms = args.llm_latency_ms
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'source': args.source,
+        'cases': len(cases),
+        'concurrency': args.concurrency,
+        'uncached_embeddings': len(missing),
+        'configs': [],
+    }
+    baseline_results = None
+
+    header = (f"{'config':<18} {'p50':>7} {'p95':>7} {'p99':>7} {'qps':>7} {'err':>5}  "
+              f"{'vs logged: ovl':>14} {'rbo':>6} {'top1':>6}  {'vs current: rbo':>15} {'same':>6}")
+    print(header)
+    for config in configs:
+        try:
+            summary, results, failures = run_config(config, cases, cache, args.concurrency)
+        except ConfigSetupError as e:
+            if config is configs[0]:
+                sys.exit(f"Baseline config 'current' failed: {e}")
+            report['configs'].append({'config': config, 'error': str(e)})
+            print(f"{config['name'][:18]:<18} FAILED: {e}")
+            continue
+
+        vs_logged = {i: compare_rankings(cases[i].logged, groups) for i, groups in results.items()}
+        entry = {
+            'config': config,
+            'latency': summary,
+            'failures': failures[:20],
+            'vs_logged': summarize_metrics(list(vs_logged.values())),
+        }
+        if baseline_results is None:
+            baseline_results = results
+            entry['worst_vs_logged'] = worst_cases(cases, vs_logged, args.worst)
+        else:
+            vs_baseline = {
+                i: compare_rankings(baseline_results[i], groups)
+                for i, groups in results.items() if i in baseline_results
+            }
+            entry['vs_current'] = summarize_metrics(list(vs_baseline.values()))
+            entry['worst_vs_current'] = worst_cases(cases, vs_baseline, args.worst)
+        report['configs'].append(entry)
+
+        current = entry.get('vs_current', {})
+        print(f"{config['name'][:18]:<18} {str(summary['p50_ms']):>7} {str(summary['p95_ms']):>7} "
+              f"{str(summary['p99_ms']):>7} {str(summary['rps']):>7} {summary['errors']:>5}  "
+              f"{str(entry['vs_logged']['overlap']):>14} {str(entry['vs_logged']['rbo']):>6} "
+              f"{str(entry['vs_logged']['top1']):>6}  {str(current.get('rbo', '-')):>15} "
+              f"{str(current.get('identical', '-')):>6}")
+
+    for entry in report['configs'][1:]:
+        if entry.get('worst_vs_current'):
+            print(f"\nLargest ranking changes for {entry['config']['name']}:")
+            for case in entry['worst_vs_current']:
+                print(f"  rbo {case['rbo']:.2f}  {case['source']}:{case['log_id']}  {case['query'][:70]}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Results written to {args.output}")
+
+    return 1 if any('error' in entry or entry['latency']['errors'] for entry in report['configs']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Seed a synthetic catalog for the benchmark suite.
+
+Creates benchmark stores, products (with brand/type/size/match_key so the
+related-products and basket code paths have something to chew on), clone
+ProductMatch rows, 1536-d pgvector embeddings and a few users with tracked
+products for the daily scan. Embeddings are clustered around a per-type
+centroid (see fake_openai.fake_embedding) so ivfflat behaves like it does
+on real data instead of on uniform noise.
+
+Everything created here is tagged so it can be removed again:
+    businesses  slug LIKE 'bench-store-%'
+    users       email LIKE 'bench-user-%@benchmark.local'
+
+Usage:
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/seed_catalog.py --products 10000
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/seed_catalog.py --products 500000 --stores 60
+    BENCHMARK_DATABASE_URL=postgresql://... python benchmarks/seed_catalog.py --reset-only
+
+Options:
+    --products      Number of products to create (default: 10000)
+    --stores        Number of benchmark stores (default: 40)
+    --users         Number of benchmark users with tracked products (default: 20)
+    --batch-size    Rows per INSERT batch (default: 2000)
+    --seed          RNG seed (default: 42)
+    --reset-only    Only remove previously seeded benchmark data
+
+BENCHMARK_DATABASE_URL is required and is used instead of DATABASE_URL so the
+seeder can never point at production by accident.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+if not os.environ.get('BENCHMARK_DATABASE_URL'):
+    sys.exit('BENCHMARK_DATABASE_URL is not set - refusing to seed (never point this at production)')
+os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+import numpy as np
+
+import fake_openai
+
+fake_openai.install()
+
+from sqlalchemy import text
+
+from app import app, db
+from models import (Business, Coupon, Product, ProductEmbedding, ProductMatch, User,
+                    UserTrackedProduct, UserProductScan, UserScanResult)
+
+BENCH_SLUG_PREFIX = 'bench-store-'
+BENCH_EMAIL_PATTERN = 'bench-user-%@benchmark.local'
+
+BRANDS = [
+    'Meggle', 'Milka', 'Ariel', 'Persil', 'Franck', 'Nescafe', 'Podravka', 'Vindija',
+    'Dukat', 'Kraš', 'Argeta', 'Zvijezda', 'Barcaffe', 'Jana', 'Coca-Cola', 'Nivea',
+    'Colgate', 'Palmolive', 'Solana', 'Bimal', 'Vegeta', 'Fructal', 'Sarajevski kiseljak',
+    'Bambi', 'Čokolino', 'Zlatiborac', 'Natura', 'Perwoll', 'Domestos', 'Lenor',
+]
+
+# (product_type, category_group, [(size_value, size_unit), ...])
+PRODUCT_TYPES = [
+    ('mlijeko', 'mlijeko', [(1, 'l'), (0.5, 'l'), (1.5, 'l')]),
+    ('jogurt', 'mlijeko', [(0.5, 'l'), (1, 'l'), (180, 'g')]),
+    ('sir', 'mlijeko', [(200, 'g'), (500, 'g'), (1, 'kg')]),
+    ('maslac', 'mlijeko', [(125, 'g'), (250, 'g')]),
+    ('kafa', 'kafa', [(100, 'g'), (200, 'g'), (500, 'g')]),
+    ('instant kafa', 'kafa', [(100, 'g'), (200, 'g')]),
+    ('čokolada', 'slatkisi', [(80, 'g'), (100, 'g'), (250, 'g')]),
+    ('keks', 'slatkisi', [(150, 'g'), (300, 'g')]),
+    ('deterdžent za veš', 'ves', [(2.5, 'kg'), (5, 'kg'), (40, 'pranja')]),
+    ('omekšivač', 'ves', [(1, 'l'), (2, 'l')]),
+    ('sredstvo za čišćenje', 'ciscenje', [(750, 'ml'), (1, 'l')]),
+    ('šampon', 'higijena', [(250, 'ml'), (400, 'ml')]),
+    ('pasta za zube', 'higijena', [(75, 'ml'), (100, 'ml')]),
+    ('toaletni papir', 'higijena', [(8, 'kom'), (16, 'kom')]),
+    ('piletina', 'meso', [(500, 'g'), (1, 'kg')]),
+    ('pašteta', 'meso', [(95, 'g'), (200, 'g')]),
+    ('hljeb', 'pekara', [(500, 'g'), (800, 'g')]),
+    ('sok od narandže', 'pica', [(1, 'l'), (2, 'l')]),
+    ('pivo', 'pica', [(0.5, 'l'), (0.33, 'l')]),
+    ('voda', 'pica', [(1.5, 'l'), (0.5, 'l')]),
+    ('ulje', 'kuhinja', [(1, 'l'), (2, 'l')]),
+    ('brašno', 'kuhinja', [(1, 'kg'), (5, 'kg')]),
+    ('šećer', 'kuhinja', [(1, 'kg')]),
+    ('riža', 'kuhinja', [(500, 'g'), (1, 'kg')]),
+    ('tjestenina', 'kuhinja', [(500, 'g')]),
+    ('smrznuto povrće', 'smrznuto', [(450, 'g'), (1, 'kg')]),
+    ('jabuke', 'voce_povrce', [(1, 'kg')]),
+    ('hrana za pse', 'ljubimci', [(1, 'kg'), (3, 'kg')]),
+    ('pelene', 'bebe', [(44, 'kom'), (64, 'kom')]),
+]
+
+VARIANTS = [
+    None, 'light', 'bez laktoze', 'classic', 'premium', 'gold', 'bio', 'family pack',
+    'mini', 'extra', 'original', 'intense', 'sensitive', 'fresh', 'protein', 'zero',
+]
+
+TRACKED_TERMS = ['mlijeko', 'kafa', 'čokolada', 'deterdžent za veš', 'piletina', 'jogurt', 'šampon', 'pivo']
+
+# Each SKU shows up in roughly this many stores (clone groups for related products)
+STORES_PER_SKU = 8
+
+
+def format_size(size_value, size_unit):
+    value = int(size_value) if float(size_value).is_integer() else size_value
+    return f"{value}{size_unit}" if size_unit in ('g', 'kg', 'l', 'ml') else f"{value} {size_unit}"
+
+
+def sku_attributes(sku):
+    """Map a SKU index to (brand, product_type, category_group, size_value, size_unit, variant)"""
+    brand = BRANDS[sku % len(BRANDS)]
+    sku //= len(BRANDS)
+    product_type, category_group, sizes = PRODUCT_TYPES[sku % len(PRODUCT_TYPES)]
+    sku //= len(PRODUCT_TYPES)
+    size_value, size_unit = sizes[sku % len(sizes)]
+    sku //= len(sizes)
+    variant = VARIANTS[sku % len(VARIANTS)]
+    return brand, product_type, category_group, size_value, size_unit, variant
+
+
+def type_centroids():
+    return {pt: fake_openai.fake_embedding(pt) for pt, _, _ in PRODUCT_TYPES}
+
+
+def clustered_embeddings(rng, centroids, product_types, spread=0.6):
+    """Unit vectors near each product type's centroid"""
+    base = np.stack([centroids[pt] for pt in product_types])
+    # Scaled so the noise has roughly unit norm, like the centroid
+    noise = rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(base.shape[1])
+    vectors = base + spread * noise
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def reset_benchmark_data():
+    """Remove everything a previous seed run created"""
+    bench_users = [u.id for u in User.query.filter(User.email.like(BENCH_EMAIL_PATTERN)).all()]
+    if bench_users:
+        scan_ids = [s.id for s in UserProductScan.query.filter(UserProductScan.user_id.in_(bench_users)).all()]
+        if scan_ids:
+            UserScanResult.query.filter(UserScanResult.scan_id.in_(scan_ids)).delete(synchronize_session=False)
+        UserProductScan.query.filter(UserProductScan.user_id.in_(bench_users)).delete(synchronize_session=False)
+        UserTrackedProduct.query.filter(UserTrackedProduct.user_id.in_(bench_users)).delete(synchronize_session=False)
+        User.query.filter(User.id.in_(bench_users)).delete(synchronize_session=False)
+
+    business_ids = [b.id for b in Business.query.filter(Business.slug.like(f'{BENCH_SLUG_PREFIX}%')).all()]
+    if business_ids:
+        # coupon_purchase_benchmark.py coupons (user_coupons cascade)
+        Coupon.query.filter(Coupon.business_id.in_(business_ids)).delete(synchronize_session=False)
+        # product_embeddings and product_matches cascade on product delete
+        deleted = db.session.execute(
+            text("DELETE FROM products WHERE business_id = ANY(:ids)"), {'ids': business_ids}
+        ).rowcount
+        Business.query.filter(Business.id.in_(business_ids)).delete(synchronize_session=False)
+        print(f"Removed {deleted} benchmark products from {len(business_ids)} stores")
+
+    db.session.commit()
+
+
+def seed_stores(count):
+    stores = []
+    for i in range(count):
+        store = Business(
+            name=f"Bench Store {i + 1}",
+            slug=f"{BENCH_SLUG_PREFIX}{i + 1}",
+            city='Tuzla',
+            status='active',
+            is_promo_active=True,
+            business_type='supermarket',
+        )
+        db.session.add(store)
+        stores.append(store)
+    db.session.commit()
+    return [s.id for s in stores]
+
+
+def seed_products(store_ids, total, batch_size, rng):
+    """Insert products + embeddings + clone matches in batches"""
+    product_table = Product.__table__
+    embedding_table = ProductEmbedding.__table__
+    match_table = ProductMatch.__table__
+
+    sku_count = max(1, total // STORES_PER_SKU)
+    centroids = type_centroids()
+    first_product_for_sku = {}
+    today = date.today()
+    now = datetime.now()
+    created = 0
+    matches = 0
+
+    while created < total:
+        n = min(batch_size, total - created)
+        skus = rng.integers(0, sku_count, size=n)
+        stores = rng.choice(store_ids, size=n)
+        base_prices = np.round(rng.uniform(0.8, 45.0, size=n), 2)
+        discounted = rng.random(n) < 0.3
+
+        rows = []
+        product_types = []
+        for i in range(n):
+            brand, product_type, category_group, size_value, size_unit, variant = sku_attributes(int(skus[i]))
+            title = ' '.join(p for p in (brand, product_type, variant, format_size(size_value, size_unit)) if p)
+            base_price = float(base_prices[i])
+            rows.append({
+                'business_id': int(stores[i]),
+                'city': 'Tuzla',
+                'title': title,
+                'base_price': base_price,
+                'discount_price': round(base_price * 0.8, 2) if discounted[i] else None,
+                'expires': today + timedelta(days=int(rng.integers(3, 30))),
+                'category': category_group,
+                'category_group': category_group,
+                'brand': brand,
+                'product_type': product_type,
+                'size_value': size_value,
+                'size_unit': size_unit,
+                'variant': variant,
+                'match_key': f"{brand.lower()}:{product_type}:{size_value}{size_unit}:{variant or ''}",
+                'product_metadata': {'benchmark': True},
+                'views': int(rng.integers(0, 500)),
+                'created_at': now,
+            })
+            product_types.append(product_type)
+
+        ids = [row[0] for row in db.session.execute(
+            product_table.insert().returning(product_table.c.id), rows
+        ).all()]
+
+        vectors = clustered_embeddings(rng, centroids, product_types)
+        db.session.execute(embedding_table.insert(), [
+            {
+                'product_id': product_id,
+                'embedding': vectors[i],
+                'embedding_text': rows[i]['title'],
+                'model_version': 'text-embedding-3-small',
+            }
+            for i, product_id in enumerate(ids)
+        ])
+
+        match_rows = []
+        for i, product_id in enumerate(ids):
+            sku = int(skus[i])
+            first = first_product_for_sku.get(sku)
+            if first is None:
+                first_product_for_sku[sku] = product_id
+            else:
+                match_rows.append({
+                    'product_a_id': first,
+                    'product_b_id': product_id,
+                    'match_type': 'clone',
+                    'confidence': 100,
+                    'created_by': 'auto',
+                    'created_at': now,
+                })
+        if match_rows:
+            db.session.execute(match_table.insert(), match_rows)
+            matches += len(match_rows)
+
+        db.session.commit()
+        created += n
+        print(f"  {created}/{total} products, {matches} clone matches")
+
+    return created, matches
+
+
+def seed_users(count, store_ids, rng):
+    for i in range(count):
+        user = User(
+            id=f"bench-user-{i + 1}",
+            email=f"bench-user-{i + 1}@benchmark.local",
+            first_name='Bench',
+            is_verified=True,
+            preferences={
+                'grocery_interests': TRACKED_TERMS,
+                # Half the users filter by a few preferred stores, like real users do
+                'preferred_stores': [int(s) for s in rng.choice(store_ids, size=5, replace=False)] if i % 2 else None,
+            },
+        )
+        db.session.add(user)
+        for term in TRACKED_TERMS:
+            db.session.add(UserTrackedProduct(
+                user_id=user.id,
+                search_term=term,
+                original_text=term,
+                source='grocery_interests',
+            ))
+    db.session.commit()
+
+
+def rebuild_vector_index():
+    """ivfflat lists are fixed at build time - rebuild after a bulk load"""
+    db.session.execute(text("REINDEX INDEX product_embeddings_vector_idx"))
+    db.session.execute(text("ANALYZE products"))
+    db.session.execute(text("ANALYZE product_embeddings"))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a synthetic benchmark catalog')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--stores', type=int, default=40)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset-only', action='store_true')
+    args = parser.parse_args()
+
+    with app.app_context():
+        print("Removing previous benchmark data...")
+        reset_benchmark_data()
+        if args.reset_only:
+            return 0
+
+        rng = np.random.default_rng(args.seed)
+        start = time.time()
+
+        store_ids = seed_stores(args.stores)
+        print(f"Created {len(store_ids)} stores")
+
+        print(f"Creating {args.products} products...")
+        products, matches = seed_products(store_ids, args.products, args.batch_size, rng)
+
+        seed_users(args.users, store_ids, rng)
+        print(f"Created {args.users} users with {len(TRACKED_TERMS)} tracked products each")
+
+        print("Rebuilding vector index...")
+        rebuild_vector_index()
+
+        print(f"Done in {time.time() - start:.1f}s: {products} products, {matches} clone matches")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""
+Bulk email dispatch for campaign jobs.
+
+The weekly/bi-weekly campaigns used to call send_email once per user with a
+sleep in between: one HTTP request, one new SendGrid client and one
+EmailNotification commit per recipient. This module sends them in bulk:
+
+- Shared content (activation, re-engagement): the email is rendered once
+  with a name placeholder and sent to up to BATCH_SIZE recipients per
+  request as SendGrid personalizations, each with its own name substitution.
+  Malformed addresses are failed before batching, and a batch SendGrid
+  rejects with 400 (one bad address fails the whole request) is split in
+  halves until only the rejected recipients fail.
+- Per-user content (weekly summary): each message is its own request, but
+  messages are produced lazily and sent from a worker pool, so rendering the
+  next summary overlaps with sending the previous ones.
+
+Requests share the process-wide SendGrid client and a process-wide
+requests-per-second budget; 429/5xx/connection errors are retried with
+backoff. EmailNotification rows are written with multi-row INSERTs.
+
+Without SENDGRID_API_KEY nothing is sent, like send_email (dev mode).
+
+Environment:
+    BULK_EMAIL_WORKERS              Concurrent SendGrid requests (default: 8)
+    BULK_EMAIL_REQUESTS_PER_SECOND  Request budget for the process (default: 20)
+    BULK_EMAIL_BATCH_SIZE           Recipients per request for shared content (default: 500, max 1000)
+    BULK_EMAIL_MAX_RETRIES          Retries per request (default: 3)
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from sendgrid.helpers.mail import Content, Email, Mail, Personalization, Substitution, To
+
+from sendgrid_utils import SENDGRID_ENABLED, SENDGRID_FROM_EMAIL, SENDGRID_FROM_NAME, get_sendgrid_client
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('BULK_EMAIL_WORKERS', '8'))
+REQUESTS_PER_SECOND = float(os.environ.get('BULK_EMAIL_REQUESTS_PER_SECOND', '20'))
+BATCH_SIZE = min(1000, int(os.environ.get('BULK_EMAIL_BATCH_SIZE', '500')))  # SendGrid allows 1000
+MAX_RETRIES = int(os.environ.get('BULK_EMAIL_MAX_RETRIES', '3'))
+LOG_BATCH_SIZE = 500     # EmailNotification rows per INSERT
+PROGRESS_EVERY = 1000    # Log progress every N recipients
+
+NAME_TOKEN = '-recipient_name-'
+# Deliberately loose: only weeds out what SendGrid rejects outright (no @, spaces, list separators)
+EMAIL_PATTERN = re.compile(r'^[^@\s<>(),;:"\[\]]+@[^@\s<>(),;:"\[\]]+\.[^@\s<>(),;:"\[\]]+$')
+
+
+@dataclass
+class Recipient:
+    """One recipient of shared content"""
+    email: str
+    name: str = ''
+    user_id: str = None
+    extra_data: dict = None
+
+
+@dataclass
+class OutgoingEmail:
+    """A fully rendered message for one recipient"""
+    email: str
+    subject: str
+    html: str
+    user_id: str = None
+    extra_data: dict = None
+
+
+@dataclass
+class DispatchResult:
+    sent: int = 0
+    failed: int = 0
+    requests: int = 0
+    errors: list = field(default_factory=list)  # First few error messages
+
+
+class RateBudget:
+    """Token bucket shared by every sender in the process"""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self._tokens = per_second
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.per_second <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.per_second, self._tokens + (now - self._updated) * self.per_second)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.per_second
+            time.sleep(wait_seconds)
+
+
+_budget = RateBudget(REQUESTS_PER_SECOND)
+
+
+class SharedTemplate:
+    """
+    Content rendered once per batch; only the greeting name differs.
+
+    render is one of the sendgrid_utils render_*_email functions; it is called
+    with NAME_TOKEN as the user name. Those put the name after a space
+    ("Poštovani{greeting}"), so the space moves into the substitution value
+    and an empty name renders exactly like send_*_email.
+    """
+
+    def __init__(self, render, *args):
+        self._render = render
+        self._args = args
+
+    def compile(self):
+        """(subject, html) with NAME_TOKEN where the name goes"""
+        subject, html = self._render(NAME_TOKEN, *self._args)
+        return subject.replace(' ' + NAME_TOKEN, NAME_TOKEN), html.replace(' ' + NAME_TOKEN, NAME_TOKEN)
+
+    @staticmethod
+    def name_value(name):
+        return f" {name}" if name else ''
+
+
+def _from_email():
+    return Email(SENDGRID_FROM_EMAIL, SENDGRID_FROM_NAME)
+
+
+def is_valid_email(email):
+    return bool(email) and EMAIL_PATTERN.match(email) is not None
+
+
+def _post(message, description):
+    """
+    Send one request with retries.
+
+    Returns:
+        (error, status): (None, None) on success, else the error message and
+        the last HTTP status (None for connection errors)
+    """
+    if not SENDGRID_ENABLED:
+        logger.info(f"[DEV MODE] Bulk email: {description}")
+        return None, None
+
+    error = None
+    for attempt in range(MAX_RETRIES + 1):
+        _budget.acquire()
+        try:
+            response = get_sendgrid_client().send(message)
+            if response.status_code in (200, 202):
+                return None, None
+            status = response.status_code
+            error = f"SendGrid status {status}"
+        except Exception as e:
+            status = getattr(e, 'status_code', None)  # python_http_client HTTPError
+            error = str(e) or type(e).__name__
+            body = getattr(e, 'body', None)
+            if body:
+                error = f"{error}: {body.decode(errors='replace') if isinstance(body, bytes) else body}"[:500]
+        retryable = status is None or status == 429 or status >= 500
+        if not retryable or attempt == MAX_RETRIES:
+            break
+        time.sleep(min(30, 2 ** attempt))
+    return error, status
+
+
+def _send_shared_batch(subject, html, batch):
+    """
+    Send one batch of shared content.
+
+    Returns:
+        ([(recipients, error), ...], requests made)
+    """
+    message = Mail(from_email=_from_email(), subject=subject, html_content=Content('text/html', html))
+    for recipient in batch:
+        personalization = Personalization()
+        personalization.add_to(To(recipient.email))
+        personalization.add_substitution(Substitution(NAME_TOKEN, SharedTemplate.name_value(recipient.name)))
+        message.add_personalization(personalization)
+    error, status = _post(message, f"'{subject}' to {len(batch)} recipients")
+    if status != 400:
+        return [(batch, error)], 1
+
+    if len(batch) == 1:
+        logger.warning(f"SendGrid rejected {batch[0].email}: {error}")
+        return [(batch, error)], 1
+    # The whole request was rejected - bisect so only the bad recipient(s) fail
+    middle = len(batch) // 2
+    left, left_requests = _send_shared_batch(subject, html, batch[:middle])
+    right, right_requests = _send_shared_batch(subject, html, batch[middle:])
+    return left + right, 1 + left_requests + right_requests
+
+
+def _send_one(outgoing):
+    message = Mail(
+        from_email=_from_email(),
+        to_emails=To(outgoing.email),
+        subject=outgoing.subject,
+        html_content=Content('text/html', outgoing.html)
+    )
+    error, _ = _post(message, f"'{outgoing.subject}' to {outgoing.email}")
+    return [([outgoing], error)], 1
+
+
+class BulkEmailDispatcher:
+    """
+    Sends one campaign and logs it as EmailNotification rows of email_type.
+
+    Call from the job thread inside an app context; only that thread touches
+    the database (worker threads just talk to SendGrid).
+    """
+
+    def __init__(self, email_type, workers=None):
+        self.email_type = email_type
+        self.workers = workers or WORKERS
+        self.result = DispatchResult()
+        self._log_rows = []
+        self._processed = 0
+
+    def send_shared(self, template, recipients, batch_size=None):
+        """
+        Send shared content to many recipients.
+
+        Args:
+            template: SharedTemplate
+            recipients: Iterable of Recipient
+            batch_size: Recipients per SendGrid request (default: BATCH_SIZE)
+        """
+        batch_size = min(1000, batch_size or BATCH_SIZE)
+
+        def tasks():
+            batch = []
+            for recipient in recipients:
+                if not is_valid_email(recipient.email):
+                    # Would get the whole batch rejected
+                    logger.warning(f"{self.email_type}: skipping invalid address {recipient.email!r}")
+                    self._record([recipient], None, 'Invalid email address')
+                    continue
+                batch.append(recipient)
+                if len(batch) >= batch_size:
+                    yield self._shared_task(template, batch)
+                    batch = []
+            if batch:
+                yield self._shared_task(template, batch)
+
+        return self._run(tasks())
+
+    def send_each(self, messages):
+        """
+        Send individually rendered messages.
+
+        Args:
+            messages: Iterable of OutgoingEmail (a generator is consumed lazily,
+                at most a few requests ahead of the senders)
+        """
+        return self._run((_send_one, (outgoing,), [outgoing], outgoing.subject) for outgoing in messages)
+
+    def fail(self, email, error, user_id=None):
+        """Count and log a recipient that failed before sending (e.g. rendering)"""
+        self._record([Recipient(email or 'unknown', user_id=user_id)], None, str(error))
+
+    def _shared_task(self, template, batch):
+        # Compiled per batch: subject rotation in render_* still varies across batches
+        subject, html = template.compile()
+        return _send_shared_batch, (subject, html, batch), batch, subject.replace(NAME_TOKEN, '')
+
+    def _run(self, tasks):
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bulk-email') as executor:
+            for func, args, recipients, subject in tasks:
+                if len(pending) >= self.workers * 2:
+                    self._collect(pending, wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[executor.submit(func, *args)] = (recipients, subject)
+            self._collect(pending, wait(pending).done)
+        self._flush_log()
+        logger.info(
+            f"{self.email_type}: {self.result.sent} sent, {self.result.failed} failed "
+            f"in {self.result.requests} requests"
+        )
+        return self.result
+
+    def _collect(self, pending, done):
+        for future in done:
+            recipients, subject = pending.pop(future)
+            try:
+                outcomes, requests = future.result()
+            except Exception as e:
+                outcomes, requests = [(recipients, str(e))], 1
+            self.result.requests += requests
+            for sent_to, error in outcomes:
+                self._record(sent_to, subject, error)
+
+    def _record(self, recipients, subject, error):
+        if error:
+            self.result.failed += len(recipients)
+            if len(self.result.errors) < 10:
+                self.result.errors.append(error)
+            logger.error(f"{self.email_type}: send to {len(recipients)} recipient(s) failed: {error}")
+        else:
+            self.result.sent += len(recipients)
+
+        for recipient in recipients:
+            self._log_rows.append({
+                'email': recipient.email,
+                'email_type': self.email_type,
+                'subject': subject,
+                'user_id': recipient.user_id,
+                'status': 'failed' if error else 'sent',
+                'error_message': error,
+                'extra_data': recipient.extra_data,
+            })
+        if len(self._log_rows) >= LOG_BATCH_SIZE:
+            self._flush_log()
+
+        previous = self._processed
+        self._processed += len(recipients)
+        if self._processed // PROGRESS_EVERY > previous // PROGRESS_EVERY:
+            logger.info(f"{self.email_type} progress: {self._processed} processed, {self.result.sent} sent")
+
+    def _flush_log(self):
+        from app import db
+        from models import EmailNotification
+
+        rows, self._log_rows = self._log_rows, []
+        if not rows:
+            return
+        try:
+            EmailNotification.log_emails(rows)
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Could not log {len(rows)} {self.email_type} emails: {e}")
@@ -7,6 +7,8 @@ import logging
 from auth_api import require_jwt_auth
 from openai_utils import openai_client
 from image_search import upload_to_s3
+from image_hash_index import get_image_hash_index, hash_image_bytes
+from llm_usage import record_cache_hit, usage_context
 from datetime import datetime
 import json
 import threading
@@ -17,8 +19,13 @@ camera_search_bp = Blueprint('camera_search', __name__, url_prefix='/api/camera'
 logger = logging.getLogger(__name__)
 
 
-def log_camera_search_background(user_id: int, image_base64: str, vision_result: dict, product_results: list):
-    """Background task to upload image to S3 and log search - doesn't block response"""
+def log_camera_search_background(user_id: int, image_base64: str, vision_result: dict, product_results: list,
+                                 image_hashes: tuple = None):
+    """Background task to upload image to S3 and log search - doesn't block response
+
+    image_hashes is passed for snapshots that went to the vision API, so the
+    result can be reused for near-identical photos.
+    """
     from flask import current_app
     from models import db, SearchLog
 
@@ -39,6 +46,16 @@ def log_camera_search_background(user_id: int, image_base64: str, vision_result:
             except Exception as e:
                 logger.error(f"Failed to upload camera search image to S3: {e}")
 
+            # Remember the identification for near-identical snapshots
+            if image_hashes:
+                try:
+                    get_image_hash_index().record(
+                        image_hashes, 'camera', result=vision_result, image_url=image_s3_path
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to index camera search image: {e}")
+                    db.session.rollback()
+
             # Log to SearchLog
             try:
                 search_query = vision_result.get('title') or ' '.join(vision_result.get('search_terms', []))
@@ -201,32 +218,84 @@ For products, include both Latin script and common Bosnian names."""
         }
 
 
-def search_products_by_vision_result(vision_result: dict, user_city: str = None, limit: int = 10):
-    """Search products using semantic search (same as homepage) for better results"""
-    from agent_search import run_agent_search, format_agent_products
+def vision_result_from_product(product) -> dict:
+    """Build an analyze_product_image()-shaped result from a catalog product"""
+    search_terms = [t for t in (product.title, product.brand, product.product_type) if t]
+    return {
+        "title": product.title,
+        "brand": product.brand,
+        "product_type": product.product_type,
+        "size_value": product.size_value,
+        "size_unit": product.size_unit,
+        "search_terms": search_terms,
+        "confidence": "high",
+        "matched_product_id": product.id,
+    }
+
+
+def identify_from_hash_index(image_hashes: tuple) -> dict | None:
+    """Vision result for a near-identical known photo, or None on a miss"""
+    from models import db, Product
+
+    match = get_image_hash_index().lookup(image_hashes, sources=('camera', 'product'))
+    if not match:
+        return None
+
+    if match.source == 'product':
+        product = db.session.get(Product, match.product_id) if match.product_id else None
+        if not product:
+            return None
+        result = vision_result_from_product(product)
+    else:
+        result = match.result
+        if not result or result.get('error'):
+            return None
+
+    logger.info(f"Camera search hash hit: {match.source} #{match.id} "
+                f"(pHash d={match.phash_distance}, dHash d={match.dhash_distance})")
+    return result
 
-    # Build search query from vision result
-    title = vision_result.get('title', '')
-    brand = vision_result.get('brand', '')
 
-    # Combine title and brand for better search
-    search_query = title
-    if brand and brand.lower() not in title.lower():
-        search_query = f"{brand} {title}"
+def search_products_by_vision_result(vision_result: dict, user_city: str = None, limit: int = 10):
+    """Search products straight from the structured vision result
 
-    if not search_query or not search_query.strip():
+    The vision output is already parsed (brand, type, size), so this skips the
+    agent graph (intent parser + explanation LLM calls) and runs the hybrid
+    vector + trigram search with brand/size re-ranking directly.
+    """
+    from app import db
+    from agent_search import format_agent_products
+    from agents.context import AgentContext
+    from agents.common.db_utils import search_structured_items
+
+    title = (vision_result.get('title') or '').strip()
+    brand = (vision_result.get('brand') or '').strip()
+    if not title and not brand:
         return []
 
-    logger.info(f"[TIMING] Camera semantic search query: {search_query}")
-
-    # Use the same agent search as homepage for semantic matching
-    agent_result = run_agent_search(
-        query=search_query,
+    logger.info(f"[TIMING] Camera structured search: title={title!r} brand={brand!r} "
+                f"size={vision_result.get('size_value')}{vision_result.get('size_unit') or ''}")
+
+    context = AgentContext()
+    grouped = search_structured_items(
+        db.session,
+        items=[{
+            'title': title,
+            'brand': brand,
+            'product_type': vision_result.get('product_type'),
+            'size_value': vision_result.get('size_value'),
+            'size_unit': vision_result.get('size_unit'),
+        }],
+        embedding_model=context.embedding_model,
         k=limit,
+        similarity_threshold=context.similarity_threshold,
     )
 
-    # Format products to match expected structure
-    raw_products = agent_result.get("products", [])
+    raw_products = []
+    for group_name, group_products in grouped.items():
+        for product in group_products:
+            product['search_group'] = group_name
+            raw_products.append(product)
     formatted_products = format_agent_products(raw_products)
 
     # Transform for ProductCardMobile compatibility (add image_path, has_discount)
@@ -323,11 +392,26 @@ def camera_search():
             # Remove data URL prefix if present
             if ',' in image_base64:
                 image_base64 = image_base64.split(',')[1]
-            image_size_kb = len(base64.b64decode(image_base64)) / 1024
+            image_data = base64.b64decode(image_base64)
+            image_size_kb = len(image_data) / 1024
 
-        # Analyze image with Vision API
         logger.info(f"[TIMING] Camera search START for user {current_user.id}, image size: {image_size_kb:.1f}KB")
-        vision_result = analyze_product_image(image_base64)
+
+        # Near-identical photos of known products resolve locally; Vision API only on a miss
+        image_hashes = hash_image_bytes(image_data)
+        vision_result = None
+        with usage_context(feature='camera_vision'):
+            if image_hashes:
+                try:
+                    vision_result = identify_from_hash_index(image_hashes)
+                except Exception as e:
+                    logger.warning(f"Image hash lookup failed: {e}")
+            hash_hit = vision_result is not None
+
+            if hash_hit:
+                record_cache_hit('gpt-4o-mini')
+            else:
+                vision_result = analyze_product_image(image_base64)
 
         if vision_result.get('error'):
             return jsonify({
@@ -344,7 +428,8 @@ def camera_search():
         # Log search and upload image in background thread (non-blocking for faster response)
         thread = threading.Thread(
             target=log_camera_search_background,
-            args=(current_user.id, image_base64, vision_result, product_results)
+            args=(current_user.id, image_base64, vision_result, product_results,
+                  None if hash_hit else image_hashes)
         )
         thread.daemon = True
         thread.start()
@@ -392,7 +477,8 @@ def camera_search():
             'already_tracked': already_tracked,
             'search_terms': vision_result.get('search_terms', []),
             'timing': {
-                'total_seconds': round(total_time, 2)
+                'total_seconds': round(total_time, 2),
+                'vision_cache_hit': hash_hit
             }
         })
 
@@ -10,13 +10,16 @@ Use get_jwt_user() to get the current user after authentication.
 from flask import Blueprint, request, jsonify
 from datetime import datetime, timedelta
 from functools import wraps
+from sqlalchemy import func, update
 from app import db
 from models import (
     Coupon, UserCoupon, Business, FeatureFlag, User,
     BusinessMembership, user_has_business_role, Store, Campaign
 )
+from credits_service import InsufficientCreditsError
 from credits_service_monthly import MonthlyCreditsService
 from sendgrid_utils import (
+    queue_email,
     send_coupon_purchase_email,
     send_coupon_sale_notification_email,
     send_coupon_redemption_email,
@@ -282,7 +285,16 @@ def get_feature_status():
 @coupon_bp.route('/api/coupons/<int:coupon_id>/purchase', methods=['POST'])
 @jwt_required
 def purchase_coupon(coupon_id):
-    """Purchase a coupon with credits"""
+    """
+    Purchase a coupon with credits
+
+    One transaction: reserve a unit with a conditional decrement (only
+    succeeds while remaining_quantity > 0), deduct the credits (locks the
+    user row, so one user's purchases run one at a time), then insert the
+    UserCoupon. Any failure rolls the whole thing back, so a coupon can't be
+    oversold and credits are never taken without a coupon. Emails go to the
+    background sender after the commit.
+    """
     current_user = get_jwt_user()
     if not is_feature_enabled(current_user):
         return jsonify({'error': 'Feature not available'}), 403
@@ -294,103 +306,113 @@ def purchase_coupon(coupon_id):
     if not coupon.is_active:
         return jsonify({'error': 'Kupon više nije aktivan'}), 400
 
+    # Cheap early exits; the reservation below is what actually decides
     if coupon.remaining_quantity <= 0:
         return jsonify({'error': 'Svi kuponi su rasprodani'}), 400
 
-    # Check if user already has an active coupon for this
-    existing = UserCoupon.query.filter(
-        UserCoupon.user_id == current_user.id,
-        UserCoupon.coupon_id == coupon_id,
-        UserCoupon.status == 'active'
-    ).first()
-    if existing:
+    def has_active_coupon():
+        return db.session.query(UserCoupon.id).filter(
+            UserCoupon.user_id == current_user.id,
+            UserCoupon.coupon_id == coupon_id,
+            UserCoupon.status == 'active'
+        ).first() is not None
+
+    if has_active_coupon():
         return jsonify({'error': 'Već imate aktivan kupon za ovu ponudu'}), 400
 
-    # Check credits
-    balance = MonthlyCreditsService.get_balance(current_user.id)
-    available = balance.get('total_available', 0)
-    if available < coupon.credits_cost:
+    # Reserve one unit
+    remaining = db.session.execute(
+        update(Coupon)
+        .where(Coupon.id == coupon_id, Coupon.is_active == True, Coupon.remaining_quantity > 0)
+        .values(remaining_quantity=Coupon.remaining_quantity - 1)
+        .returning(Coupon.remaining_quantity)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if remaining is None:
+        db.session.rollback()
+        return jsonify({'error': 'Svi kuponi su rasprodani'}), 400
+
+    try:
+        # Spend credits (same transaction)
+        MonthlyCreditsService.deduct_credits(
+            current_user.id,
+            coupon.credits_cost,
+            'COUPON_PURCHASE',
+            {'coupon_id': coupon_id, 'article': coupon.article_name},
+            commit=False
+        )
+
+        # Re-check under the user row lock: a parallel purchase by the same
+        # user has committed (or rolled back) by now
+        if has_active_coupon():
+            db.session.rollback()
+            return jsonify({'error': 'Već imate aktivan kupon za ovu ponudu'}), 400
+
+        # Calculate expiry date in Bosnia timezone
+        bosnia_now = get_bosnia_time()
+        expires_at = bosnia_now + timedelta(days=coupon.valid_days)
+
+        user_coupon = UserCoupon(
+            coupon_id=coupon_id,
+            user_id=current_user.id,
+            redemption_code=UserCoupon.generate_redemption_code(),
+            status='active',
+            purchased_at=datetime.utcnow(),
+            expires_at=expires_at.replace(tzinfo=None)  # Store as naive UTC
+        )
+        db.session.add(user_coupon)
+        db.session.commit()
+    except InsufficientCreditsError as e:
+        db.session.rollback()
         return jsonify({
             'error': 'Nedovoljno kredita',
-            'available': available,
-            'required': coupon.credits_cost
+            'available': e.credits_available,
+            'required': e.credits_needed
         }), 400
-
-    # Spend credits
-    result = MonthlyCreditsService.deduct_credits(
-        current_user.id,
-        coupon.credits_cost,
-        'COUPON_PURCHASE',
-        {'coupon_id': coupon_id, 'article': coupon.article_name}
-    )
-    if not result.get('success'):
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Coupon purchase failed for coupon {coupon_id}, user {current_user.id}: {e}")
         return jsonify({'error': 'Greška pri plaćanju kreditima'}), 500
 
-    # Calculate expiry date in Bosnia timezone
-    bosnia_now = get_bosnia_time()
-    expires_at = bosnia_now + timedelta(days=coupon.valid_days)
-
-    # Create user coupon
-    user_coupon = UserCoupon(
-        coupon_id=coupon_id,
-        user_id=current_user.id,
-        redemption_code=UserCoupon.generate_redemption_code(),
-        status='active',
-        purchased_at=datetime.utcnow(),
-        expires_at=expires_at.replace(tzinfo=None)  # Store as naive UTC
-    )
-
-    # Decrease remaining quantity
-    coupon.remaining_quantity -= 1
-
-    db.session.add(user_coupon)
-    db.session.commit()
+    business = coupon.business
 
-    # Send email notification to buyer
-    try:
-        coupon_data = {
+    # Email the buyer
+    queue_email(
+        send_coupon_purchase_email,
+        current_user.email,
+        current_user.first_name or '',
+        {
             'redemption_code': user_coupon.redemption_code,
             'article_name': coupon.article_name,
-            'business_name': coupon.business.name,
-            'business_address': coupon.business.address or '',
+            'business_name': business.name,
+            'business_address': business.address or '',
             'original_price': coupon.normal_price,
             'final_price': coupon.final_price,
             'discount_percent': coupon.discount_percent,
             'expires_at': expires_at.strftime('%d.%m.%Y'),
             'valid_days': coupon.valid_days
         }
-        send_coupon_purchase_email(
-            current_user.email,
-            current_user.first_name or '',
-            coupon_data
-        )
-    except Exception as e:
-        logger.error(f"Failed to send purchase email to buyer: {e}")
-
-    # Send notification to business owner
-    try:
-        # Find business owner
-        owner_membership = BusinessMembership.query.filter(
-            BusinessMembership.business_id == coupon.business_id,
-            BusinessMembership.role == 'owner',
-            BusinessMembership.is_active == True
-        ).first()
+    )
 
-        if owner_membership:
-            sale_data = {
+    # Notify the business owner
+    owner_membership = BusinessMembership.query.filter(
+        BusinessMembership.business_id == coupon.business_id,
+        BusinessMembership.role == 'owner',
+        BusinessMembership.is_active == True
+    ).first()
+    if owner_membership:
+        queue_email(
+            send_coupon_sale_notification_email,
+            owner_membership.user.email,
+            business.name,
+            {
                 'buyer_name': f"{current_user.first_name or ''} {current_user.last_name or ''}".strip() or 'Korisnik',
                 'article_name': coupon.article_name,
                 'final_price': coupon.final_price,
-                'remaining_quantity': coupon.remaining_quantity,
-                'total_sold': coupon.total_quantity - coupon.remaining_quantity
+                'remaining_quantity': remaining,
+                'total_sold': coupon.total_quantity - remaining
             }
-            send_coupon_sale_notification_email(
-                owner_membership.user.email,
-                coupon.business.name,
-                sale_data
-            )
-    except Exception as e:
-        logger.error(f"Failed to send sale notification to business: {e}")
+        )
 
     return jsonify({
         'success': True,
@@ -399,8 +421,8 @@ def purchase_coupon(coupon_id):
             'redemption_code': user_coupon.redemption_code,
             'expires_at': user_coupon.expires_at.isoformat(),
             'article_name': coupon.article_name,
-            'business_name': coupon.business.name,
-            'google_link': coupon.business.google_link
+            'business_name': business.name,
+            'google_link': business.google_link
         }
     })
 
@@ -737,7 +759,8 @@ def update_coupon(business_id, coupon_id):
         if 'total_quantity' in data:
             diff = data['total_quantity'] - coupon.total_quantity
             coupon.total_quantity = data['total_quantity']
-            coupon.remaining_quantity = max(0, coupon.remaining_quantity + diff)
+            # Relative to the row's current value, so sales made meanwhile aren't undone
+            coupon.remaining_quantity = func.greatest(Coupon.remaining_quantity + diff, 0)
 
     db.session.commit()
 
@@ -1968,6 +1991,8 @@ def create_business_product(business_id):
         try:
             import base64
             from image_search import upload_to_s3
+            from image_derivatives import enqueue_product_derivatives
+            from storage import get_storage
 
             image_data = base64.b64decode(data['image_base64'])
             # Create slugified filename from product title
@@ -1977,9 +2002,10 @@ def create_business_product(business_id):
 
             if uploaded_path:
                 # Store full S3 URL for consistency with other upload methods
-                full_s3_url = f"https://aipijaca.s3.eu-central-1.amazonaws.com/{uploaded_path}"
+                full_s3_url = get_storage().url(uploaded_path)
                 product.image_path = full_s3_url
                 db.session.commit()
+                enqueue_product_derivatives(product.id, image_data)
                 image_path = full_s3_url
                 logger.info(f"Product {product.id} image uploaded to S3: {full_s3_url}")
         except Exception as e:
@@ -2270,6 +2296,7 @@ def business_product_set_image(business_id, product_id):
     """Set product image from a URL - downloads and uploads to S3"""
     from models import Product
     from image_search import upload_to_s3
+    from image_derivatives import enqueue_product_derivatives
     import requests as http_requests
 
     current_user = get_jwt_user()
@@ -2312,6 +2339,7 @@ def business_product_set_image(business_id, product_id):
         if uploaded_path:
             product.image_path = uploaded_path
             db.session.commit()
+            enqueue_product_derivatives(product.id, image_data)
             logger.info(f"Business product {product_id} image uploaded to S3: {uploaded_path}")
 
             return jsonify({
@@ -1,9 +1,15 @@
 """
 Monthly Credits Service with Two-Bucket System
 Handles regular credits (reset monthly) and extra credits (accumulate)
+
+Balance changes (deduct, refund, add extra, lazy monthly reset / admin
+upgrade) are single conditional UPDATE ... RETURNING statements: the check
+and the write happen in one round-trip on the locked row, so concurrent
+requests can't overdraw or lose each other's updates.
 """
 from datetime import datetime, date, timedelta
 from calendar import monthrange
+from sqlalchemy import and_, case, func, or_, update
 from app import db
 from models import User, CreditTransaction, Referral
 import logging
@@ -105,6 +111,53 @@ def get_next_month_first() -> date:
         return date(today.year, today.month + 1, 1)
 
 
+def _monthly_max_expr():
+    """Monthly allowance for the row's user (admins get ADMIN_MONTHLY_CREDITS)"""
+    return case((User.is_admin == True, ADMIN_MONTHLY_CREDITS), else_=REGULAR_USER_MONTHLY_CREDITS)
+
+
+def _needs_reset_expr():
+    """
+    SQL condition: the row's regular bucket must be refilled before use.
+
+    True in a new month (same rule as is_new_month) and for admins below
+    their allowance.
+    """
+    return or_(
+        User.monthly_credits_reset_date.is_(None),
+        User.monthly_credits_reset_date < date.today().replace(day=1),
+        and_(User.is_admin == True, func.coalesce(User.monthly_credits, 0) < ADMIN_MONTHLY_CREDITS)
+    )
+
+
+def _effective_columns():
+    """
+    (monthly_credits, monthly_credits_used, extra_credits) as they are after
+    any pending reset - lets one UPDATE apply the reset and the operation.
+    """
+    needs_reset = _needs_reset_expr()
+    monthly = case((needs_reset, _monthly_max_expr()), else_=func.coalesce(User.monthly_credits, 0))
+    used = case((needs_reset, 0), else_=func.coalesce(User.monthly_credits_used, 0))
+    return monthly, used, func.coalesce(User.extra_credits, 0)
+
+
+_BALANCE_COLUMNS = (User.monthly_credits, User.monthly_credits_used, User.extra_credits, User.is_admin)
+
+
+def _balance_from_row(row) -> dict:
+    """Balance dict (get_balance shape) from a row of _BALANCE_COLUMNS"""
+    regular = max(0, (row.monthly_credits or 0) - (row.monthly_credits_used or 0))
+    extra = row.extra_credits or 0
+    return {
+        'regular_credits': regular,
+        'extra_credits': extra,
+        'total_credits': regular + extra,
+        'next_reset_date': get_next_month_first(),
+        'monthly_limit': ADMIN_MONTHLY_CREDITS if row.is_admin else REGULAR_USER_MONTHLY_CREDITS,
+        'is_unlimited': bool(row.is_admin)
+    }
+
+
 def is_new_month(last_reset_date: date) -> bool:
     """Check if we're in a new month compared to the last reset date"""
     today = date.today()
@@ -131,8 +184,8 @@ class MonthlyCreditsService:
         Returns:
             dict with 'regular_credits', 'extra_credits', 'total_credits', 'next_reset_date'
         """
-        user = User.query.get(user_id)
-        if not user:
+        row = db.session.query(*_BALANCE_COLUMNS, User.monthly_credits_reset_date).filter(User.id == user_id).first()
+        if not row:
             return {
                 'regular_credits': 0,
                 'extra_credits': 0,
@@ -140,66 +193,52 @@ class MonthlyCreditsService:
                 'next_reset_date': get_next_month_first()
             }
 
-        # Check if user is admin
-        is_admin = user.is_admin
-        monthly_credits_max = ADMIN_MONTHLY_CREDITS if is_admin else REGULAR_USER_MONTHLY_CREDITS
-
-        # For admins, always ensure they have maximum credits
-        if is_admin and (user.monthly_credits or 0) < monthly_credits_max:
-            logger.info(f"Auto-upgrading admin credits for user {user_id}: {user.monthly_credits} -> {monthly_credits_max}")
-            user.monthly_credits = monthly_credits_max
-            user.monthly_credits_used = 0
-            user.monthly_credits_reset_date = date.today()
-            db.session.commit()
-
-        # Check if we need to reset monthly credits
-        if auto_reset_monthly:
-            last_reset_date = user.monthly_credits_reset_date
+        # Admins are always topped up to their allowance; everyone else resets monthly
+        admin_short = row.is_admin and (row.monthly_credits or 0) < ADMIN_MONTHLY_CREDITS
+        if admin_short or (auto_reset_monthly and is_new_month(row.monthly_credits_reset_date)):
+            logger.info(f"Monthly credit reset for user {user_id} (admin={row.is_admin})")
+            # None: another request reset it first - read its result
+            row = MonthlyCreditsService._perform_monthly_reset(user_id) or db.session.query(
+                *_BALANCE_COLUMNS
+            ).filter(User.id == user_id).first()
 
-            if is_new_month(last_reset_date):
-                logger.info(f"Monthly credit reset for user {user_id} (admin={is_admin})")
-                MonthlyCreditsService._perform_monthly_reset(user_id, monthly_credits_max)
-                user = User.query.get(user_id)  # Refresh
-
-        # Calculate available regular credits
-        monthly_credits = user.monthly_credits or 0
-        monthly_credits_used = user.monthly_credits_used or 0
-        regular_credits_available = max(0, monthly_credits - monthly_credits_used)
-
-        return {
-            'regular_credits': regular_credits_available,
-            'extra_credits': user.extra_credits or 0,
-            'total_credits': regular_credits_available + (user.extra_credits or 0),
-            'next_reset_date': get_next_month_first(),
-            'monthly_limit': monthly_credits_max,
-            'is_unlimited': is_admin
-        }
+        return _balance_from_row(row)
 
     @staticmethod
-    def _perform_monthly_reset(user_id: str, monthly_credits_max: int) -> None:
+    def _perform_monthly_reset(user_id: str, monthly_credits_max: int = None):
         """
         Internal method to perform monthly credit reset
 
+        Conditional on the reset still being due, so two requests racing into a
+        new month reset once and a deduction made in between is not wiped.
+
         Args:
             user_id: User ID
-            monthly_credits_max: Maximum monthly credits (40 for users, 100000 for admins)
-        """
-        user = User.query.get(user_id)
-        if not user:
-            return
-
-        # Reset regular credits to max (overwrite, don't accumulate)
-        old_monthly_used = user.monthly_credits_used or 0
-        user.monthly_credits = monthly_credits_max
-        user.monthly_credits_used = 0
-        user.monthly_credits_reset_date = date.today()
+            monthly_credits_max: Maximum monthly credits (default: per-user allowance -
+                40 for users, 100000 for admins)
 
+        Returns:
+            Row of the new balance columns, or None if no reset was due
+        """
+        row = db.session.execute(
+            update(User)
+            .where(User.id == user_id, _needs_reset_expr())
+            .values(
+                monthly_credits=monthly_credits_max if monthly_credits_max is not None else _monthly_max_expr(),
+                monthly_credits_used=0,
+                monthly_credits_reset_date=date.today()
+            )
+            .returning(*_BALANCE_COLUMNS)
+            .execution_options(synchronize_session=False)
+        ).first()
         db.session.commit()
 
-        logger.info(f"Monthly reset for user {user_id}: Set to {monthly_credits_max} regular credits (was {old_monthly_used} used)")
+        if row:
+            logger.info(f"Monthly reset for user {user_id}: Set to {row.monthly_credits} regular credits")
+        return row
 
     @staticmethod
-    def deduct_credits(user_id: str, amount: int, action: str, metadata: dict = None) -> dict:
+    def deduct_credits(user_id: str, amount: int, action: str, metadata: dict = None, commit: bool = True) -> dict:
         """
         Deduct credits from user balance (extra credits first, then regular)
 
@@ -208,6 +247,8 @@ class MonthlyCreditsService:
             amount: Number of credits to deduct
             action: Action name
             metadata: Optional metadata
+            commit: If False, leave the deduction in the caller's transaction
+                (the user row stays locked until the caller commits or rolls back)
 
         Returns:
             dict with balance info
@@ -215,31 +256,42 @@ class MonthlyCreditsService:
         Raises:
             InsufficientCreditsError: If not enough credits
         """
-        balance = MonthlyCreditsService.get_balance(user_id)
+        monthly, used, extra = _effective_columns()
+        extra_used = func.least(amount, extra)
+
+        # Reset if due, spend extra credits first, then regular - only if the
+        # whole amount is covered
+        row = db.session.execute(
+            update(User)
+            .where(User.id == user_id, extra + func.greatest(monthly - used, 0) >= amount)
+            .values(
+                monthly_credits=monthly,
+                monthly_credits_used=used + (amount - extra_used),
+                monthly_credits_reset_date=case(
+                    (_needs_reset_expr(), date.today()), else_=User.monthly_credits_reset_date
+                ),
+                extra_credits=extra - extra_used,
+                # Track lifetime credits spent (for feedback bonus eligibility)
+                lifetime_credits_spent=func.coalesce(User.lifetime_credits_spent, 0) + amount
+            )
+            .returning(*_BALANCE_COLUMNS, User.lifetime_credits_spent)
+            .execution_options(synchronize_session=False)
+        ).first()
 
-        if balance['total_credits'] < amount:
+        if row is None:
+            # Nothing was written. Read the balance without writing (a reset here
+            # would commit the caller's transaction); missing user reads as 0
+            available = db.session.query(extra + func.greatest(monthly - used, 0)).filter(
+                User.id == user_id
+            ).scalar()
             from credits_service import InsufficientCreditsError
-            raise InsufficientCreditsError(amount, balance['total_credits'])
-
-        user = User.query.get(user_id)
-        if not user:
-            raise ValueError(f"User {user_id} not found")
-
-        # Use extra credits first, then regular credits
-        extra_used = min(amount, user.extra_credits or 0)
-        regular_used = amount - extra_used
-
-        user.extra_credits = (user.extra_credits or 0) - extra_used
-        user.monthly_credits_used = (user.monthly_credits_used or 0) + regular_used
-
-        # Track lifetime credits spent (for feedback bonus eligibility)
-        user.lifetime_credits_spent = (user.lifetime_credits_spent or 0) + amount
+            raise InsufficientCreditsError(amount, available or 0)
 
-        db.session.commit()
-
-        logger.info(f"Deducted {amount} credits from user {user_id}: {extra_used} extra + {regular_used} regular (lifetime spent: {user.lifetime_credits_spent})")
+        if commit:
+            db.session.commit()
 
-        new_balance = MonthlyCreditsService.get_balance(user_id, auto_reset_monthly=False)
+        new_balance = _balance_from_row(row)
+        logger.info(f"Deducted {amount} credits from user {user_id} (lifetime spent: {row.lifetime_credits_spent})")
 
         return {
             'balance': new_balance['total_credits'],
@@ -262,25 +314,27 @@ class MonthlyCreditsService:
         Returns:
             dict with balance info
         """
-        user = User.query.get(user_id)
-        if not user:
+        used = func.coalesce(User.monthly_credits_used, 0)
+
+        # Refund to monthly_credits_used first (reduce the used amount);
+        # anything beyond it goes to extra_credits
+        row = db.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(
+                monthly_credits_used=func.greatest(used - amount, 0),
+                extra_credits=func.coalesce(User.extra_credits, 0) + func.greatest(amount - used, 0)
+            )
+            .returning(*_BALANCE_COLUMNS)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if row is None:
             raise ValueError(f"User {user_id} not found")
-
-        # Refund to monthly_credits_used first (reduce the used amount)
-        monthly_credits_used = user.monthly_credits_used or 0
-        if monthly_credits_used >= amount:
-            user.monthly_credits_used = monthly_credits_used - amount
-        else:
-            # If more than monthly_credits_used, add remainder to extra_credits
-            remainder = amount - monthly_credits_used
-            user.monthly_credits_used = 0
-            user.extra_credits = (user.extra_credits or 0) + remainder
-
         db.session.commit()
 
         logger.info(f"Refunded {amount} credits to user {user_id}")
 
-        new_balance = MonthlyCreditsService.get_balance(user_id, auto_reset_monthly=False)
+        new_balance = _balance_from_row(row)
 
         return {
             'balance': new_balance['total_credits'],
@@ -303,16 +357,20 @@ class MonthlyCreditsService:
         Returns:
             dict with balance info
         """
-        user = User.query.get(user_id)
-        if not user:
+        row = db.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(extra_credits=func.coalesce(User.extra_credits, 0) + amount)
+            .returning(*_BALANCE_COLUMNS)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if row is None:
             raise ValueError(f"User {user_id} not found")
-
-        user.extra_credits = (user.extra_credits or 0) + amount
         db.session.commit()
 
-        logger.info(f"Added {amount} extra credits to user {user_id} for {action}. New extra credits: {user.extra_credits}")
+        logger.info(f"Added {amount} extra credits to user {user_id} for {action}. New extra credits: {row.extra_credits}")
 
-        balance = MonthlyCreditsService.get_balance(user_id, auto_reset_monthly=False)
+        balance = _balance_from_row(row)
 
         return {
             'balance': balance['total_credits'],
@@ -356,8 +414,13 @@ class MonthlyCreditsService:
         )
         db.session.add(referral)
 
-        # Add bonus credits to referrer
-        referrer.extra_credits = (referrer.extra_credits or 0) + REFERRAL_BONUS_CREDITS
+        # Add bonus credits to referrer (in SQL, so a concurrent deduction isn't overwritten)
+        db.session.execute(
+            update(User)
+            .where(User.id == referrer.id)
+            .values(extra_credits=func.coalesce(User.extra_credits, 0) + REFERRAL_BONUS_CREDITS)
+            .execution_options(synchronize_session=False)
+        )
 
         db.session.commit()
 
@@ -0,0 +1,296 @@
+"""
+Spatial index over store locations.
+
+BusinessLocation rows carry latitude/longitude, but the table only has btree
+indexes on business and city, so "which stores are near me" meant loading
+every location and computing distances. Every process keeps the active,
+geocoded locations of active businesses in a k-d tree instead. Points are
+stored as unit vectors on the sphere: the straight-line (chord) distance
+between two of them grows monotonically with the great-circle distance, so
+k-nearest and radius queries prune exactly and there is no wrap-around at
+the antimeridian or distortion near the poles.
+
+The tree is rebuilt when the table changes: at most every REFRESH_SECONDS a
+count/max(updated_at) probe is compared with the one the tree was built
+from, and the admin location endpoints call invalidate() so the change shows
+up in that process at once. A full rebuild every REBUILD_SECONDS picks up
+business status changes.
+
+search_by_vector uses nearest_per_business() for its optional distance-decay
+term; the lookup is in memory, so ranking by distance adds no query.
+
+Environment:
+    GEO_INDEX_REFRESH_SECONDS  Seconds between change probes (default: 60)
+"""
+
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from itertools import count
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+REFRESH_SECONDS = float(os.environ.get('GEO_INDEX_REFRESH_SECONDS', '60'))
+REBUILD_SECONDS = 3600     # Pick up business status changes
+MAX_RESULTS = 200          # Cap on k for API callers
+
+
+def to_unit_vector(latitude, longitude):
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def km_to_chord(km):
+    """Great-circle distance -> straight-line distance between unit vectors"""
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def valid_coordinates(latitude, longitude):
+    return (
+        latitude is not None and longitude is not None
+        and -90 <= latitude <= 90 and -180 <= longitude <= 180
+        and not (latitude == 0 and longitude == 0)  # Unset coordinates saved as zeros
+    )
+
+
+class KDTree:
+    """
+    Static 3-d tree over (point, payload) pairs.
+
+    Built once from a list (median split, axis cycling with depth); queries
+    take squared Euclidean bounds and an optional payload predicate, so
+    filtered k-nearest searches still prune on distance.
+    """
+
+    def __init__(self, items):
+        self.size = len(items)
+        self._root = self._build(list(items), 0)
+
+    def _build(self, items, depth):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        mid = len(items) // 2
+        point, payload = items[mid]
+        return (point, payload, axis,
+                self._build(items[:mid], depth + 1), self._build(items[mid + 1:], depth + 1))
+
+    @staticmethod
+    def _distance2(a, b):
+        return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+    def nearest(self, point, k, max_distance2=math.inf, accept=None):
+        """Up to k (distance2, payload) closest to point, nearest first"""
+        if k <= 0:
+            return []
+        heap = []  # Max-heap on distance: (-distance2, tiebreak, payload)
+        tiebreak = count()
+
+        def visit(node):
+            if node is None:
+                return
+            node_point, payload, axis, left, right = node
+            distance2 = self._distance2(point, node_point)
+            if distance2 <= max_distance2 and (accept is None or accept(payload)):
+                if len(heap) < k:
+                    heapq.heappush(heap, (-distance2, next(tiebreak), payload))
+                elif distance2 < -heap[0][0]:
+                    heapq.heapreplace(heap, (-distance2, next(tiebreak), payload))
+            diff = point[axis] - node_point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            bound = max_distance2 if len(heap) < k else min(max_distance2, -heap[0][0])
+            if diff * diff <= bound:
+                visit(far)
+
+        visit(self._root)
+        return sorted(((-neg, payload) for neg, _, payload in heap), key=lambda item: item[0])
+
+    def within(self, point, max_distance2, accept=None):
+        """All (distance2, payload) within max_distance2 of point, nearest first"""
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            node_point, payload, axis, left, right = node
+            distance2 = self._distance2(point, node_point)
+            if distance2 <= max_distance2 and (accept is None or accept(payload)):
+                found.append((distance2, payload))
+            diff = point[axis] - node_point[axis]
+            stack.append(left if diff < 0 else right)
+            if diff * diff <= max_distance2:
+                stack.append(right if diff < 0 else left)
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+@dataclass(frozen=True)
+class StoreLocation:
+    """An indexed location (plain data - safe to share across threads)"""
+    id: int
+    business_id: int
+    business_name: str
+    business_logo: str | None
+    name: str
+    address: str | None
+    city: str | None
+    latitude: float
+    longitude: float
+
+    def to_dict(self, distance_km=None):
+        return {
+            'id': self.id,
+            'business_id': self.business_id,
+            'business_name': self.business_name,
+            'business_logo': self.business_logo,
+            'name': self.name,
+            'address': self.address,
+            'city': self.city,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'distance_km': round(distance_km, 2) if distance_km is not None else None,
+        }
+
+
+def _business_filter(business_ids):
+    if not business_ids:
+        return None
+    allowed = set(business_ids)
+    return lambda location: location.business_id in allowed
+
+
+class LocationIndex:
+    """Process-local k-d tree over active business_locations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = KDTree([])
+        self._signature = None
+        self._checked_at = 0.0
+        self._built_at = 0.0
+
+    def _probe(self):
+        from app import db
+        from models import BusinessLocation
+
+        return tuple(db.session.query(
+            db.func.count(BusinessLocation.id), db.func.max(BusinessLocation.updated_at)
+        ).one())
+
+    def _load(self):
+        from app import db
+        from models import Business, BusinessLocation
+
+        return db.session.query(
+            BusinessLocation.id, BusinessLocation.business_id, Business.name, Business.logo_path,
+            BusinessLocation.name, BusinessLocation.address, BusinessLocation.city,
+            BusinessLocation.latitude, BusinessLocation.longitude
+        ).join(Business, Business.id == BusinessLocation.business_id).filter(
+            BusinessLocation.is_active.is_(True),
+            BusinessLocation.latitude.isnot(None),
+            BusinessLocation.longitude.isnot(None),
+            Business.status == 'active'
+        ).all()
+
+    def refresh(self, force_rebuild=False):
+        """Rebuild the tree if the table changed since it was built"""
+        now = time.time()
+        with self._lock:
+            if not force_rebuild and now - self._checked_at < REFRESH_SECONDS:
+                return
+            self._checked_at = now
+            signature = self._probe()
+            if not force_rebuild and signature == self._signature and now - self._built_at < REBUILD_SECONDS:
+                return
+            items = [
+                (to_unit_vector(row[7], row[8]), StoreLocation(*row))
+                for row in self._load() if valid_coordinates(row[7], row[8])
+            ]
+            self._tree = KDTree(items)
+            self._signature = signature
+            self._built_at = now
+        logger.info(f"Location index built: {len(items)} locations")
+
+    def invalidate(self):
+        """Check for changes on the next lookup (call after editing locations)"""
+        self._checked_at = 0.0
+
+    def _current_tree(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Location index refresh failed: {e}")
+        return self._tree
+
+    def nearest(self, latitude, longitude, k=10, max_km=None, business_ids=None):
+        """
+        The k locations closest to a point.
+
+        Args:
+            latitude, longitude: Query point
+            k: Number of locations (capped at MAX_RESULTS)
+            max_km: Optional radius; farther locations are left out
+            business_ids: Optional list of business IDs to restrict to
+
+        Returns:
+            List of (distance_km, StoreLocation), nearest first
+        """
+        tree = self._current_tree()
+        bound = km_to_chord(max_km) ** 2 if max_km is not None else math.inf
+        found = tree.nearest(
+            to_unit_vector(latitude, longitude), min(k, MAX_RESULTS), bound, _business_filter(business_ids)
+        )
+        return [(chord_to_km(math.sqrt(d2)), location) for d2, location in found]
+
+    def within(self, latitude, longitude, radius_km, business_ids=None):
+        """All locations within radius_km of a point as (distance_km, StoreLocation), nearest first"""
+        tree = self._current_tree()
+        found = tree.within(
+            to_unit_vector(latitude, longitude), km_to_chord(radius_km) ** 2, _business_filter(business_ids)
+        )
+        return [(chord_to_km(math.sqrt(d2)), location) for d2, location in found]
+
+    def nearest_per_business(self, latitude, longitude, max_km, business_ids=None):
+        """{business_id: km to its closest location} for businesses with a location within max_km"""
+        distances = {}
+        for distance_km, location in self.within(latitude, longitude, max_km, business_ids):
+            distances.setdefault(location.business_id, distance_km)  # Nearest first
+        return distances
+
+    @property
+    def size(self):
+        return self._tree.size
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_location_index():
+    """Get the process-wide index (loaded from the database on first lookup)"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LocationIndex()
+    return _index
@@ -0,0 +1,458 @@
+"""
+Address geocoding: providers, result cache and bulk geocoding jobs.
+
+Lookups go to Google first (when GOOGLE_MAPS_API_KEY is set) and fall back to
+Nominatim. Each provider has a process-wide throttle: Nominatim's usage
+policy allows one request per second, Google allows far more, so a bulk job
+runs its lookups on a worker pool and the throttles decide how parallel that
+really is.
+
+geocode_location() results are stored in geocode_cache keyed by the
+normalized address and city, so re-importing a chain or re-running
+geocode-all doesn't repeat lookups for addresses we already resolved.
+"Not found" is cached too, for GEOCODE_NEGATIVE_TTL_DAYS.
+
+start_bulk_geocode() runs geocode-all for a business in the background and
+returns a JobRun id; progress is written to that row, so any worker can
+answer the status request.
+
+Environment:
+    GEOCODE_GOOGLE_RPS         Google requests per second per process (default: 20)
+    GEOCODE_NOMINATIM_RPS      Nominatim requests per second per process (default: 1)
+    GEOCODE_WORKERS            Concurrent lookups in a bulk job (default: 8)
+    GEOCODE_NEGATIVE_TTL_DAYS  How long "not found" is cached (default: 7)
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Google Geocoding API settings
+GOOGLE_GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY')
+
+# Nominatim API settings (free, fallback if Google fails)
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_HEADERS = {
+    "User-Agent": "PopustBA/1.0 (contact@popust.ba)"
+}
+
+GOOGLE_RPS = float(os.environ.get('GEOCODE_GOOGLE_RPS', '20'))
+NOMINATIM_RPS = float(os.environ.get('GEOCODE_NOMINATIM_RPS', '1'))
+WORKERS = int(os.environ.get('GEOCODE_WORKERS', '8'))
+NEGATIVE_TTL_DAYS = int(os.environ.get('GEOCODE_NEGATIVE_TTL_DAYS', '7'))
+
+JOB_NAME_PREFIX = 'geocode_locations'
+JOB_STALE_SECONDS = 3600   # A 'started' job older than this is treated as dead
+PROGRESS_EVERY = 25        # Locations between progress commits
+
+
+class ProviderThrottle:
+    """Spaces requests to one provider evenly across all threads of the process"""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_google_throttle = ProviderThrottle(GOOGLE_RPS)
+_nominatim_throttle = ProviderThrottle(NOMINATIM_RPS)
+
+
+class GeocodingError(Exception):
+    """A provider failed (timeout, HTTP error, quota) - not an answer about the address"""
+    pass
+
+
+def geocode_with_google(address_query, raise_errors=False):
+    """
+    Geocode using Google Geocoding API.
+    Returns (latitude, longitude, display_name) or None if not found.
+    With raise_errors, provider failures raise GeocodingError instead of
+    returning None, so only a real ZERO_RESULTS comes back as None.
+    """
+    if not GOOGLE_MAPS_API_KEY:
+        logger.warning("Google Maps API key not configured")
+        return None
+
+    try:
+        params = {
+            'address': address_query,
+            'key': GOOGLE_MAPS_API_KEY,
+            'region': 'ba',  # Bias towards Bosnia
+            'language': 'bs'  # Bosnian language
+        }
+
+        _google_throttle.wait()
+        response = requests.get(GOOGLE_GEOCODING_URL, params=params, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+
+        if data.get('status') == 'OK' and data.get('results'):
+            result = data['results'][0]
+            location = result['geometry']['location']
+            return (
+                location['lat'],
+                location['lng'],
+                result.get('formatted_address', '')
+            )
+        elif data.get('status') in ('ZERO_RESULTS', 'OK'):
+            return None
+        else:
+            raise GeocodingError(f"{data.get('status')} - {data.get('error_message', '')}")
+
+    except requests.exceptions.Timeout:
+        logger.warning("Google Geocoding API timeout")
+        if raise_errors:
+            raise GeocodingError("Google Geocoding API timeout")
+        return None
+    except Exception as e:
+        logger.warning(f"Google Geocoding API error: {e}")
+        if raise_errors:
+            raise GeocodingError(f"Google: {e}") from e
+        return None
+
+
+def geocode_with_nominatim(query, raise_errors=False):
+    """
+    Geocode using Nominatim (OpenStreetMap) API.
+    Returns (latitude, longitude, display_name) or None if not found.
+    With raise_errors, provider failures raise GeocodingError instead of
+    returning None, so only an empty result list comes back as None.
+    """
+    try:
+        params = {
+            'q': query,
+            'format': 'json',
+            'limit': 1,
+            'addressdetails': 1
+        }
+
+        _nominatim_throttle.wait()
+        response = requests.get(
+            NOMINATIM_URL,
+            params=params,
+            headers=NOMINATIM_HEADERS,
+            timeout=10
+        )
+        response.raise_for_status()
+        results = response.json()
+
+        if results:
+            result = results[0]
+            return (
+                float(result['lat']),
+                float(result['lon']),
+                result.get('display_name', '')
+            )
+        return None
+
+    except Exception as e:
+        logger.warning(f"Nominatim geocoding error: {e}")
+        if raise_errors:
+            raise GeocodingError(f"Nominatim: {e}") from e
+        return None
+
+
+def _lookup_providers(address, city):
+    """
+    Ask the providers; returns (result, conclusive).
+
+    result is (latitude, longitude, source, display_name) or None. conclusive
+    is False when nothing was found but some provider call failed - the
+    address may well exist, so the miss must not be cached.
+    """
+    # Build query - try with address first, then city only
+    queries_to_try = []
+    if address and city:
+        queries_to_try.append(f"{address}, {city}, Bosnia and Herzegovina")
+        queries_to_try.append(f"{address}, {city}")
+    if city:
+        queries_to_try.append(f"{city}, Bosnia and Herzegovina")
+
+    conclusive = True
+
+    # Try Google first (fast, generous rate limit)
+    if GOOGLE_MAPS_API_KEY:
+        for query in queries_to_try:
+            try:
+                result = geocode_with_google(query, raise_errors=True)
+            except GeocodingError:
+                conclusive = False
+                continue
+            if result:
+                logger.info(f"Auto-geocoded '{query}' via Google -> {result[0]}, {result[1]}")
+                return (result[0], result[1], 'google', result[2]), True
+
+    # Fallback to Nominatim (throttled to its usage policy)
+    for query in queries_to_try:
+        try:
+            result = geocode_with_nominatim(query, raise_errors=True)
+        except GeocodingError:
+            conclusive = False
+            continue
+        if result:
+            logger.info(f"Auto-geocoded '{query}' via Nominatim -> {result[0]}, {result[1]}")
+            return (result[0], result[1], 'nominatim', result[2]), True
+
+    return None, conclusive
+
+
+# ==================== CACHE ====================
+
+_PUNCTUATION = re.compile(r'[\s,.;:/\\\-]+')
+
+
+def _normalize(value):
+    value = unicodedata.normalize('NFKC', value or '').lower()
+    return _PUNCTUATION.sub(' ', value).strip()
+
+
+def cache_key(address, city):
+    """(address_key, city_key) for geocode_cache"""
+    return _normalize(address)[:500], _normalize(city)[:100]
+
+
+def _get_cached(key):
+    """
+    Cached result for key: (latitude, longitude, source), (None, None, None)
+    for a fresh "not found" entry, or None when there is nothing usable.
+
+    Uses its own connection so the caller's session is never committed.
+    """
+    from sqlalchemy import select, update
+    from app import db
+    from models import GeocodeCache
+
+    table = GeocodeCache.__table__
+    try:
+        with db.engine.begin() as conn:
+            entry = conn.execute(
+                select(table.c.id, table.c.latitude, table.c.longitude, table.c.source, table.c.created_at)
+                .where(table.c.address_key == key[0], table.c.city_key == key[1])
+            ).first()
+            if entry is None:
+                return None
+            if entry.latitude is None or entry.longitude is None:
+                if entry.created_at < datetime.now() - timedelta(days=NEGATIVE_TTL_DAYS):
+                    return None
+                return None, None, None
+            conn.execute(
+                update(table).where(table.c.id == entry.id)
+                .values(hit_count=table.c.hit_count + 1, last_hit_at=datetime.now())
+            )
+        return entry.latitude, entry.longitude, entry.source
+    except Exception as e:
+        logger.warning(f"Geocode cache lookup failed: {e}")
+        return None
+
+
+def _store_cached(key, result):
+    from sqlalchemy.dialects.postgresql import insert
+    from app import db
+    from models import GeocodeCache
+
+    latitude, longitude, source, display_name = result or (None, None, None, None)
+    values = {
+        'latitude': latitude,
+        'longitude': longitude,
+        'source': source,
+        'display_name': (display_name or '')[:500] or None,
+        'created_at': datetime.now(),
+    }
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                insert(GeocodeCache.__table__)
+                .values(address_key=key[0], city_key=key[1], hit_count=0, **values)
+                .on_conflict_do_update(constraint='uq_geocode_cache_key', set_=values)
+            )
+    except Exception as e:
+        logger.warning(f"Geocode cache store failed: {e}")
+
+
+def geocode_location(address, city, use_cache=True):
+    """
+    Geocode a location using address and city.
+    Returns (latitude, longitude, source) or (None, None, None) if not found.
+    Source is 'google' or 'nominatim' (the provider that originally answered
+    when the result comes from the cache).
+
+    Needs an app context. The cache is read and written on separate
+    connections, so the caller's session is left alone.
+    """
+    if not address and not city:
+        return None, None, None
+
+    key = cache_key(address, city)
+    if use_cache:
+        cached = _get_cached(key)
+        if cached is not None:
+            return cached
+
+    result, conclusive = _lookup_providers(address, city)
+    # Misses are cached only when every provider answered; a failure (timeout,
+    # quota, 429) must not block the address for NEGATIVE_TTL_DAYS
+    if use_cache and (result or conclusive):
+        _store_cached(key, result)
+    return result[:3] if result else (None, None, None)
+
+
+# ==================== BULK JOBS ====================
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+
+def _get_job_executor():
+    global _job_executor
+    if _job_executor is None:
+        with _job_executor_lock:
+            if _job_executor is None:
+                _job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='geocode-job')
+    return _job_executor
+
+
+def job_name(business_id):
+    return f"{JOB_NAME_PREFIX}:{business_id}"
+
+
+def running_job(business_id):
+    """The JobRun of a live geocode-all job for this business, or None"""
+    from models import JobRun
+
+    run = JobRun.get_last_run(job_name(business_id))
+    if run is None or run.status != 'started':
+        return None
+    if (datetime.now() - run.started_at).total_seconds() > JOB_STALE_SECONDS:
+        return None
+    return run
+
+
+def start_bulk_geocode(app, business_id, locations):
+    """
+    Geocode locations in the background.
+
+    Args:
+        app: Flask app (the job needs its own app context)
+        business_id: Business the locations belong to (names the job)
+        locations: List of (location_id, address, city)
+
+    Returns:
+        The JobRun tracking the job (status 'started')
+    """
+    from app import db
+    from models import JobRun
+
+    run = JobRun.start(job_name(business_id))
+    run.records_processed = 0
+    run.records_success = 0
+    run.records_failed = 0
+    db.session.commit()
+    _get_job_executor().submit(_run_bulk_geocode, app, run.id, list(locations))
+    return run
+
+
+def _geocode_in_context(app, address, city):
+    from app import db
+
+    with app.app_context():
+        try:
+            return geocode_location(address, city)
+        finally:
+            db.session.remove()
+
+
+def _run_bulk_geocode(app, run_id, locations):
+    from sqlalchemy import update
+    from app import db
+    from models import BusinessLocation, JobRun
+    from geo_index import get_location_index
+
+    with app.app_context():
+        run = db.session.get(JobRun, run_id)
+        processed = geocoded = failed = 0
+        flushed_at = 0
+        pending_updates = []
+
+        def flush():
+            nonlocal flushed_at
+            if pending_updates:
+                db.session.execute(update(BusinessLocation), pending_updates)
+                pending_updates.clear()
+            run.records_processed = processed
+            run.records_success = geocoded
+            run.records_failed = failed
+            db.session.commit()
+            flushed_at = processed
+
+        try:
+            # One lookup per distinct address; branches sharing one reuse it
+            by_key = {}
+            for location_id, address, city in locations:
+                if not address and not city:
+                    processed += 1
+                    failed += 1
+                    continue
+                key = cache_key(address, city)
+                by_key.setdefault(key, (address, city, []))[2].append(location_id)
+
+            with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='geocode') as executor:
+                futures = {
+                    executor.submit(_geocode_in_context, app, address, city): location_ids
+                    for address, city, location_ids in by_key.values()
+                }
+                for future in as_completed(futures):
+                    location_ids = futures[future]
+                    try:
+                        latitude, longitude, source = future.result()
+                    except Exception as e:
+                        logger.warning(f"Geocoding failed for locations {location_ids}: {e}")
+                        latitude = longitude = None
+                    processed += len(location_ids)
+                    if latitude and longitude:
+                        geocoded += len(location_ids)
+                        now = datetime.now()
+                        pending_updates.extend(
+                            {'id': location_id, 'latitude': latitude, 'longitude': longitude, 'updated_at': now}
+                            for location_id in location_ids
+                        )
+                    else:
+                        failed += len(location_ids)
+                    if processed - flushed_at >= PROGRESS_EVERY:
+                        flush()
+
+            flush()
+            run.complete(records_processed=processed, records_success=geocoded, records_failed=failed)
+            logger.info(f"Geocode job {run_id}: {geocoded}/{processed} locations geocoded, {failed} failed")
+        except Exception as e:
+            logger.error(f"Geocode job {run_id} failed: {e}", exc_info=True)
+            db.session.rollback()
+            try:
+                run.fail(str(e)[:1000])
+            except Exception:
+                db.session.rollback()
+        finally:
+            if geocoded:
+                get_location_index().invalidate()
+            db.session.remove()
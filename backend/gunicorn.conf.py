@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration.
+
+Most endpoints (/search, camera search, agents API, receipt upload) spend
+seconds waiting on OpenAI/S3. With sync workers one slow request blocks a
+whole worker, so 2 workers = 2 concurrent requests per instance.
+
+We default to gthread workers: each worker process serves GUNICORN_THREADS
+requests concurrently. This is safe for our stack:
+- Flask-SQLAlchemy sessions are scoped per thread (and removed at teardown)
+- OpenAI/Anthropic/boto3 clients are thread-safe and shared per process
+- The DB pool (pool_size + max_overflow in app.py) covers all threads
+
+Set GUNICORN_WORKER_CLASS=sync to go back to the old behavior.
+
+Usage:
+  gunicorn main:app -c gunicorn.conf.py
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+
+# LLM-bound requests can legitimately take a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+# Short keep-alive: with gthread an idle kept-alive connection stays pinned to
+# its worker, so long values add queueing delay when that worker is saturated
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 1))
+
+# Recycle workers periodically to bound memory growth (LangGraph, PIL buffers)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,198 @@
+"""
+Product image derivatives (resized WebP/JPEG renditions).
+
+Originals are stored as uploaded, often several megabytes. For listings we
+generate small and medium renditions in WebP (modern browsers) and JPEG
+(fallback), store them next to the originals and record their URLs in
+Product.image_variants together with the image_path they were built from.
+When image_path changes the recorded variants no longer match and are
+ignored until they are regenerated.
+
+Generation runs off the request thread (enqueue_product_derivatives) on
+upload, and jobs/generate_image_derivatives.py backfills existing products.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageOps
+
+from storage import StorageError, get_storage, put_many
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels per rendition
+DERIVATIVE_SIZES = {
+    'small': 320,   # product grid cards
+    'medium': 640,  # product detail / retina grid
+}
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+MAX_SOURCE_BYTES = 15 * 1024 * 1024
+CACHE_CONTROL = 'max-age=31536000, immutable'
+
+DERIVATIVE_WORKERS = int(os.environ.get('DERIVATIVE_WORKERS', '2'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def variants_for(image_path, image_variants):
+    """
+    Public variants for serialization, or None if missing/stale.
+
+    Returns:
+        {'small': {'webp': url, 'jpg': url}, 'medium': {...}} or None
+    """
+    if not image_path or not image_variants or image_variants.get('source') != image_path:
+        return None
+    return {size: image_variants[size] for size in DERIVATIVE_SIZES if size in image_variants}
+
+
+def derivative_key(product_id, image_path, size, ext):
+    """
+    Storage key for a rendition.
+
+    The source path hash is part of the key so a new image never reuses an
+    old (immutably cached) URL.
+    """
+    digest = hashlib.sha1(image_path.encode('utf-8')).hexdigest()[:12]
+    return f"derivatives/products/{product_id}/{digest}_{size}.{ext}"
+
+
+def load_source_image(image_path):
+    """Fetch original image bytes (our storage first, then plain HTTP)"""
+    storage = get_storage()
+    key = image_path if not image_path.startswith(('http://', 'https://', 'file://')) else storage.key_from_url(image_path)
+    if key:
+        return storage.get(key)
+
+    response = requests.get(image_path, timeout=15, stream=True)
+    response.raise_for_status()
+    data = response.raw.read(MAX_SOURCE_BYTES + 1, decode_content=True)
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError(f"Source image too large: {image_path}")
+    return data
+
+
+def render_derivatives(image_bytes):
+    """
+    Resize an image into every rendition.
+
+    Returns:
+        List of (size_name, ext, content_type, bytes)
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    img = ImageOps.exif_transpose(img)
+
+    # Flatten transparency onto white (JPEG has no alpha, product shots are on white)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    renditions = []
+    for size_name, max_side in DERIVATIVE_SIZES.items():
+        resized = img.copy()
+        # thumbnail() never upscales, so small originals keep their size
+        resized.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        webp = io.BytesIO()
+        resized.save(webp, format='WEBP', quality=WEBP_QUALITY, method=4)
+        renditions.append((size_name, 'webp', 'image/webp', webp.getvalue()))
+
+        jpeg = io.BytesIO()
+        resized.save(jpeg, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        renditions.append((size_name, 'jpg', 'image/jpeg', jpeg.getvalue()))
+
+    return renditions
+
+
+def build_derivatives(product_id, image_path, image_bytes=None):
+    """
+    Render and upload every rendition for one product image.
+
+    Does not touch the database - returns the value for Product.image_variants,
+    or None if the image could not be processed.
+    """
+    try:
+        if image_bytes is None:
+            image_bytes = load_source_image(image_path)
+        renditions = render_derivatives(image_bytes)
+    except (StorageError, requests.RequestException, ValueError, OSError) as e:
+        logger.warning(f"Derivatives for product {product_id} skipped: {e}")
+        return None
+
+    keys = [derivative_key(product_id, image_path, size, ext) for size, ext, _, _ in renditions]
+    uploaded = put_many(
+        [(key, data, content_type) for key, (_, _, content_type, data) in zip(keys, renditions)],
+        cache_control=CACHE_CONTROL
+    )
+    if not all(uploaded):
+        logger.warning(f"Derivatives for product {product_id}: upload failed")
+        return None
+
+    storage = get_storage()
+    variants = {'source': image_path}
+    for key, (size, ext, _, _) in zip(keys, renditions):
+        variants.setdefault(size, {})[ext] = storage.url(key)
+    return variants
+
+
+def get_derivative_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix='derivatives')
+    return _executor
+
+
+def _generate_for_product(app, product_id, image_bytes=None):
+    from app import db
+    from models import Product
+
+    with app.app_context():
+        try:
+            product = db.session.get(Product, product_id)
+            if not product or not product.image_path:
+                return
+            image_path = product.image_path
+            variants = build_derivatives(product_id, image_path, image_bytes)
+            if not variants:
+                return
+
+            # Only record them if the image was not replaced meanwhile
+            updated = Product.query.filter(
+                Product.id == product_id,
+                Product.image_path == image_path
+            ).update({'image_variants': variants}, synchronize_session=False)
+            db.session.commit()
+            if updated:
+                logger.info(f"Generated image derivatives for product {product_id}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Derivative generation failed for product {product_id}: {e}")
+        finally:
+            db.session.remove()
+
+
+def enqueue_product_derivatives(product_id, image_bytes=None):
+    """
+    Generate derivatives for a product in the background.
+
+    Call after the new image_path is committed. Pass image_bytes when the
+    caller already has the original in memory to skip downloading it again.
+    """
+    from flask import current_app
+
+    app = current_app._get_current_object()
+    return get_derivative_executor().submit(_generate_for_product, app, product_id, image_bytes)
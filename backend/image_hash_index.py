@@ -0,0 +1,312 @@
+"""
+Perceptual-hash index for product identification from photos.
+
+Camera searches and user product images used to go to the vision API every
+time, even for a photo we had already identified (the same packshot, a
+re-upload, a burst of near-identical snapshots). Each identified image is
+stored as a 64-bit pHash + dHash pair in the image_hashes table together with
+its result; catalog product images are hashed by jobs/index_image_hashes.py.
+
+Every process keeps the hashes in a BK-tree keyed by pHash, so a
+Hamming-radius lookup touches a small fraction of the entries. A hit must be
+within PHASH_RADIUS on pHash and DHASH_RADIUS on dHash; only then is the
+stored result (or the matched product) reused. The tree is refreshed
+incrementally from the table and rebuilt periodically so deleted/expired rows
+drop out. Incremental refreshes read rows created since the newest loaded
+created_at minus REFRESH_OVERLAP and skip ids already in the tree: ids and
+created_at are assigned before commit, so a row can become visible after
+newer ones and a plain "id > max id" watermark would skip it for good.
+
+Environment:
+    IMAGE_HASH_PHASH_RADIUS   Max pHash Hamming distance for a hit (default: 6)
+    IMAGE_HASH_DHASH_RADIUS   Max dHash Hamming distance for a hit (default: 10)
+    IMAGE_HASH_CAMERA_TTL_DAYS  How long camera/user snapshots stay matchable (default: 30)
+"""
+
+import io
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+PHASH_RADIUS = int(os.environ.get('IMAGE_HASH_PHASH_RADIUS', '6'))
+DHASH_RADIUS = int(os.environ.get('IMAGE_HASH_DHASH_RADIUS', '10'))
+SNAPSHOT_TTL_DAYS = int(os.environ.get('IMAGE_HASH_CAMERA_TTL_DAYS', '30'))
+REFRESH_SECONDS = 60       # Pick up rows written by other workers
+REBUILD_SECONDS = 3600     # Drop deleted/expired rows
+REFRESH_OVERLAP = timedelta(minutes=5)  # Re-read window for rows committed late
+
+SNAPSHOT_SOURCES = ('camera', 'user_image')
+
+_DCT_SIZE = 32
+_HASH_SIZE = 8
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis (pHash only needs a fixed 32x32 transform)"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] = np.sqrt(1.0 / n)
+    return matrix
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def to_signed64(value):
+    """Unsigned 64-bit hash -> signed value for a BIGINT column"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned64(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def compute_hashes(image):
+    """
+    pHash and dHash of a PIL image.
+
+    Returns:
+        (phash, dhash) as unsigned 64-bit ints
+    """
+    image = ImageOps.exif_transpose(image).convert('L')
+
+    # dHash: 9x8 thumbnail, 1 where a pixel is brighter than its right neighbour
+    small = np.asarray(image.resize((_HASH_SIZE + 1, _HASH_SIZE), Image.Resampling.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int((small[:, 1:] > small[:, :-1]).flatten())
+
+    # pHash: low-frequency 8x8 block of the 32x32 DCT against its median (DC excluded)
+    pixels = np.asarray(image.resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:_HASH_SIZE, :_HASH_SIZE].flatten()
+    phash = _bits_to_int(low > np.median(low[1:]))
+
+    return phash, dhash
+
+
+def hash_image_bytes(image_bytes):
+    """(phash, dhash) for encoded image bytes, or None if they can't be decoded"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.draft('L', (128, 128))  # Let JPEG decode at reduced size
+            return compute_hashes(img)
+    except Exception as e:
+        logger.warning(f"Could not hash image: {e}")
+        return None
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance.
+
+    Entries with the same hash share a node. search() only descends into
+    children whose edge distance can still be within the radius (triangle
+    inequality).
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, payloads, {distance: child}]
+        self.size = 0
+
+    def add(self, value, payload):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [payload], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(payload)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [payload], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """All (distance, payload) within radius, nearest first"""
+        if self._root is None:
+            return []
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, payload) for payload in node[1])
+            low, high = distance - radius, distance + radius
+            stack.extend(child for edge, child in node[2].items() if low <= edge <= high)
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+@dataclass
+class HashMatch:
+    """A stored image close enough to the query image"""
+    id: int
+    source: str
+    product_id: int | None
+    result: dict | None
+    phash_distance: int
+    dhash_distance: int
+
+
+class ImageHashIndex:
+    """Process-local BK-tree over the image_hashes table"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = BKTree()
+        self._ids = set()          # Row ids in the tree (overlapping refreshes re-read some)
+        self._watermark = None     # Newest created_at loaded from the table
+        self._refreshed_at = 0.0
+        self._built_at = 0.0
+
+    def _load(self, since=None):
+        from app import db
+        from models import ImageHash
+
+        cutoff = datetime.now() - timedelta(days=SNAPSHOT_TTL_DAYS)
+        query = db.session.query(
+            ImageHash.id, ImageHash.phash, ImageHash.dhash, ImageHash.source, ImageHash.created_at
+        ).filter(
+            db.or_(ImageHash.source.notin_(SNAPSHOT_SOURCES), ImageHash.created_at >= cutoff)
+        )
+        if since is not None:
+            query = query.filter(ImageHash.created_at >= since)
+        return query.order_by(ImageHash.id).all()
+
+    def _insert(self, row_id, phash, dhash, source, created_at):
+        if row_id in self._ids:
+            return
+        self._ids.add(row_id)
+        self._tree.add(to_unsigned64(phash), (row_id, to_unsigned64(dhash), source, created_at))
+
+    def refresh(self, force_rebuild=False):
+        """Pull new rows; rebuild from scratch when the tree is stale"""
+        now = time.time()
+        with self._lock:
+            rebuild = force_rebuild or now - self._built_at > REBUILD_SECONDS
+            if not rebuild and now - self._refreshed_at < REFRESH_SECONDS:
+                return
+            since = None if rebuild or self._watermark is None else self._watermark - REFRESH_OVERLAP
+            rows = self._load(since)
+            if rebuild:
+                self._tree = BKTree()
+                self._ids = set()
+                self._watermark = None
+                self._built_at = now
+            for row in rows:
+                self._insert(row.id, row.phash, row.dhash, row.source, row.created_at)
+                if self._watermark is None or row.created_at > self._watermark:
+                    self._watermark = row.created_at
+            self._refreshed_at = now
+            if rebuild:
+                logger.info(f"Image hash index built: {self._tree.size} entries")
+
+    def lookup(self, hashes, sources):
+        """
+        Closest stored image from one of `sources` within both radii.
+
+        Args:
+            hashes: (phash, dhash) from compute_hashes / hash_image_bytes
+            sources: Iterable of ImageHash.source values to accept
+
+        Returns:
+            HashMatch or None
+        """
+        from app import db
+        from models import ImageHash
+
+        if not hashes:
+            return None
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Image hash index refresh failed: {e}")
+
+        phash, dhash = hashes
+        cutoff = datetime.now() - timedelta(days=SNAPSHOT_TTL_DAYS)
+        with self._lock:
+            candidates = self._tree.search(phash, PHASH_RADIUS)
+
+        candidates = [
+            (p_distance, hamming(dhash, entry_dhash), row_id)
+            for p_distance, (row_id, entry_dhash, source, created_at) in candidates
+            if source in sources and (source not in SNAPSHOT_SOURCES or created_at >= cutoff)
+        ]
+        candidates = sorted(c for c in candidates if c[1] <= DHASH_RADIUS)
+
+        for p_distance, d_distance, row_id in candidates:
+            entry = db.session.get(ImageHash, row_id)
+            if entry is None:
+                continue  # Deleted since the tree was built
+            try:
+                ImageHash.query.filter_by(id=row_id).update(
+                    {'hit_count': ImageHash.hit_count + 1, 'last_hit_at': datetime.now()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+            return HashMatch(entry.id, entry.source, entry.product_id, entry.result, p_distance, d_distance)
+        return None
+
+    def record(self, hashes, source, result=None, product_id=None, image_url=None, commit=True):
+        """Store an identified image and make it matchable in this process right away"""
+        from app import db
+        from models import ImageHash
+
+        if not hashes:
+            return None
+        phash, dhash = hashes
+        entry = ImageHash(
+            phash=to_signed64(phash),
+            dhash=to_signed64(dhash),
+            source=source,
+            product_id=product_id,
+            image_url=image_url,
+            result=result,
+            created_at=datetime.now()
+        )
+        db.session.add(entry)
+        if not commit:
+            return entry
+        db.session.commit()
+        with self._lock:
+            self._insert(entry.id, entry.phash, entry.dhash, source, entry.created_at)
+        return entry
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_image_hash_index():
+    """Get the process-wide index (loaded from the database on first lookup)"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ImageHashIndex()
+    return _index
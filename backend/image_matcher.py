@@ -1,15 +1,44 @@
 """
 AI Image Matcher using GPT-4o Vision for product image matching.
+
+Candidate images are not sent as full-resolution URLs. They are downloaded,
+resized into small labelled tiles and composed into one contact sheet per
+product ("O" = original, 1-10 = suggestions). Sheets are sized for
+"low" detail (the model sees at most 512x512 for a flat 85 tokens), so a
+whole product costs less than a single high-detail image. Several products'
+sheets go into one Vision request, and requests run on a bounded pool, so
+bulk matching costs a fraction of the tokens and round-trips. Existence of stored
+images is checked with one list-objects scan per key prefix instead of a
+HEAD per image.
 """
 import os
+import io
+import json
 import base64
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from openai import OpenAI
+from llm_clients import get_openai_client as get_shared_openai_client
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from storage import StorageError, get_storage
+
+MATCH_MODEL = "gpt-4o"
+MAX_SUGGESTIONS = 10
+TILE_SIZE = 128            # px per tile (square, padded on white)
+SHEET_COLUMNS = 4          # 11 tiles -> 4x3 sheet, 512x384: fits "low" detail without downscaling
+SHEET_DETAIL = "low"
+LABEL_FONT_SIZE = 20
+SHEET_JPEG_QUALITY = 80
+PRODUCTS_PER_REQUEST = int(os.environ.get('IMAGE_MATCH_PRODUCTS_PER_REQUEST', '4'))
+MATCH_WORKERS = int(os.environ.get('IMAGE_MATCH_WORKERS', '4'))
+TILE_WORKERS = 8
 
 
 def get_openai_client():
-    """Get OpenAI client instance."""
-    return OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    """Get the shared OpenAI client instance."""
+    return get_shared_openai_client()
 
 
 def download_image_as_base64(url: str, timeout: int = 10) -> str | None:
@@ -41,89 +70,151 @@ def get_image_url(path: str) -> str:
         return ''
     if path.startswith('http'):
         return path
-    bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-    region = os.environ.get('AWS_REGION', 'eu-central-1')
-    return f"https://{bucket}.s3.{region}.amazonaws.com/{path}"
+    return get_storage().url(path)
 
 
-def check_image_exists(path: str) -> bool:
-    """Check if an image exists in S3."""
-    import boto3
-    from botocore.exceptions import ClientError
-
+def _storage_key(path: str) -> str | None:
+    """Storage key for a stored image path/URL (None for foreign URLs)"""
     if not path:
-        return False
+        return None
+    if path.startswith(('http://', 'https://', 'file://')):
+        return get_storage().key_from_url(path)
+    return path
 
-    # If it's a full URL, extract the S3 key
-    if path.startswith('http'):
-        # Extract path after bucket.s3.region.amazonaws.com/
-        import re
-        match = re.search(r'amazonaws\.com/(.+)$', path)
-        if match:
-            path = match.group(1)
+
+def check_images_exist(paths: list[str]) -> dict[str, bool]:
+    """
+    Check which stored images exist, with one list call per key prefix.
+
+    Suggestions share a handful of prefixes, so this replaces one HEAD per
+    image with a few list-objects pages. Foreign URLs are reported as
+    existing (we can't list them; downloading will tell).
+
+    Returns:
+        {path: exists}
+    """
+    storage = get_storage()
+    keys = {path: _storage_key(path) for path in paths if path}
+    prefixes = {posixpath.dirname(key) + '/' for key in keys.values() if key}
+
+    listed = set()
+    for prefix in prefixes:
+        try:
+            listed.update(storage.list_keys(prefix))
+        except StorageError as e:
+            print(f"Error listing {prefix}: {e}")
+            return {path: bool(key) for path, key in keys.items()}
+
+    result = {}
+    for path in paths:
+        if not path:
+            result[path] = False
+        elif path.startswith(('http://', 'https://')) and not keys.get(path):
+            result[path] = True
         else:
-            return False
+            result[path] = keys.get(path) in listed
+    return result
+
 
+def check_image_exists(path: str) -> bool:
+    """Check if an image exists in S3."""
+    return check_images_exist([path]).get(path, False)
+
+
+def load_image_bytes(path: str) -> bytes | None:
+    """Image bytes from our storage, or over HTTP for foreign URLs"""
+    key = _storage_key(path)
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        s3_client.head_object(Bucket=bucket, Key=path)
-        return True
-    except ClientError:
-        return False
-    except Exception as e:
-        print(f"Error checking image existence: {e}")
-        return False
+        if key:
+            return get_storage().get(key)
+        resp = requests.get(path, headers={
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        }, timeout=10)
+        resp.raise_for_status()
+        if len(resp.content) > 5 * 1024 * 1024:
+            return None
+        return resp.content
+    except (StorageError, requests.RequestException) as e:
+        print(f"Failed to load image {path}: {e}")
+        return None
 
 
-def match_product_images(
-    product_title: str,
-    original_image_path: str | None,
-    suggested_image_paths: list[str]
-) -> dict:
-    """
-    Use GPT-4o Vision to match product images.
+def _label_font():
+    try:
+        return ImageFont.load_default(size=LABEL_FONT_SIZE)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
 
-    Args:
-        product_title: The product title/name
-        original_image_path: Path to original product image (can be None)
-        suggested_image_paths: List of S3 paths to suggested images
 
-    Returns:
-        Dict with matches, best_match, and analysis
-    """
-    client = get_openai_client()
+def make_tile(image_bytes: bytes, label: str) -> Image.Image | None:
+    """Resize an image into a labelled TILE_SIZE square (None if undecodable)"""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft('RGB', (TILE_SIZE * 2, TILE_SIZE * 2))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+    except Exception:
+        return None
 
-    if not suggested_image_paths:
-        return {
-            'matches': [],
-            'best_match': None,
-            'analysis': 'No suggested images to match'
-        }
+    img.thumbnail((TILE_SIZE, TILE_SIZE), Image.Resampling.LANCZOS)
+    tile = Image.new('RGB', (TILE_SIZE, TILE_SIZE), (255, 255, 255))
+    tile.paste(img, ((TILE_SIZE - img.width) // 2, (TILE_SIZE - img.height) // 2))
 
-    # Build the message content with images
-    content = []
+    draw = ImageDraw.Draw(tile)
+    draw.rectangle([0, 0, 32, 26], fill=(0, 0, 0))
+    draw.text((4, 1), label, fill=(255, 255, 0), font=_label_font())
+    draw.rectangle([0, 0, TILE_SIZE - 1, TILE_SIZE - 1], outline=(160, 160, 160))
+    return tile
 
-    # Add text prompt
-    prompt = f"""You are an expert product image matcher. Your task is to analyze images and determine which ones best match the product.
 
-Product Name: "{product_title}"
+def build_contact_sheet(tiles: list[Image.Image]) -> bytes:
+    """Compose tiles into a grid and encode it as JPEG"""
+    columns = min(SHEET_COLUMNS, len(tiles))
+    rows = (len(tiles) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * TILE_SIZE, rows * TILE_SIZE), (255, 255, 255))
+    for i, tile in enumerate(tiles):
+        sheet.paste(tile, ((i % columns) * TILE_SIZE, (i // columns) * TILE_SIZE))
+    buffer = io.BytesIO()
+    sheet.save(buffer, format='JPEG', quality=SHEET_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
 
-"""
 
-    if original_image_path:
-        prompt += "I'm showing you the ORIGINAL product image first, followed by suggested images numbered 1-10.\n"
-        prompt += "Compare each suggested image to the original and rate similarity.\n\n"
-    else:
-        prompt += "I'm showing you suggested images numbered 1-10 for this product.\n"
-        prompt += "Determine which images best match the product name.\n\n"
+def prepare_product_sheet(product: dict, exists: dict, executor: ThreadPoolExecutor) -> dict:
+    """
+    Download and tile one product's images.
 
-    prompt += """For each suggested image, provide:
+    Returns:
+        {'sheet': jpeg bytes or None, 'has_original': bool,
+         'suggestions': [path per tile number 1..n]}
+    """
+    candidates = [p for p in product.get('suggested_image_paths', [])[:MAX_SUGGESTIONS] if exists.get(p, True)]
+    original = product.get('original_image_path')
+    paths = ([original] if original else []) + candidates
+    contents = list(executor.map(load_image_bytes, paths))
+
+    tiles = []
+    has_original = False
+    suggestions = []
+    if original:
+        tile = make_tile(contents[0], 'O') if contents[0] else None
+        if tile:
+            tiles.append(tile)
+            has_original = True
+        contents = contents[1:]
+
+    for path, content in zip(candidates, contents):
+        tile = make_tile(content, str(len(suggestions) + 1)) if content else None
+        if tile:
+            tiles.append(tile)
+            suggestions.append(path)
+
+    return {
+        'sheet': build_contact_sheet(tiles) if suggestions else None,
+        'has_original': has_original,
+        'suggestions': suggestions,
+    }
+
+
+MATCH_RULES = """For each numbered suggestion tile, provide:
 1. A confidence score (0-100%) indicating how well it matches the product
 2. A brief reason
 
@@ -134,109 +225,193 @@ IMPORTANT:
 - 80-99% = Same product, minor differences (different size, slightly different packaging)
 - 60-79% = Similar product (same type, different brand or significant differences)
 - 40-59% = Related product (same category, but clearly different)
-- 0-39% = Wrong product
+- 0-39% = Wrong product"""
 
-Respond in this JSON format:
-{
-    "matches": [
-        {"index": 1, "confidence": 95, "reason": "Exact match - same brand and packaging"},
-        {"index": 2, "confidence": 60, "reason": "Similar product but different brand"},
-        ...
-    ],
-    "best_match_index": 1,
-    "analysis": "Brief overall analysis"
-}"""
-
-    content.append({"type": "text", "text": prompt})
-
-    # Add original image if available
-    image_urls = []
-    if original_image_path:
-        original_url = get_image_url(original_image_path)
-        image_urls.append(("Original", original_url))
-        content.append({
-            "type": "text",
-            "text": "ORIGINAL PRODUCT IMAGE:"
-        })
-        content.append({
-            "type": "image_url",
-            "image_url": {"url": original_url, "detail": "low"}
-        })
 
-    # Add suggested images
-    content.append({
-        "type": "text",
-        "text": "\nSUGGESTED IMAGES:"
-    })
+def _build_batch_request(entries: list[tuple[str, dict, dict]]) -> list[dict]:
+    """Message content for several products: (ref, product, prepared sheet)"""
+    prompt = f"""You are an expert product image matcher. You will see {len(entries)} contact sheet(s), one per product.
+Each sheet is a grid of labelled tiles: the tile labelled "O" (if present) is the ORIGINAL product image,
+tiles labelled 1, 2, 3, ... are suggested images. Compare each suggestion to the product name and,
+when an original is shown, to the original.
+
+{MATCH_RULES}
 
-    for i, path in enumerate(suggested_image_paths[:10], 1):
-        img_url = get_image_url(path)
-        image_urls.append((f"Suggestion {i}", img_url))
+Respond in this JSON format:
+{{
+    "products": [
+        {{
+            "product": "A",
+            "matches": [
+                {{"index": 1, "confidence": 95, "reason": "Exact match - same brand and packaging"}},
+                {{"index": 2, "confidence": 60, "reason": "Similar product but different brand"}}
+            ],
+            "best_match_index": 1,
+            "analysis": "Brief overall analysis"
+        }}
+    ]
+}}"""
+    content = [{"type": "text", "text": prompt}]
+    for ref, product, prepared in entries:
+        original_note = "with original" if prepared['has_original'] else "no original"
         content.append({
             "type": "text",
-            "text": f"\nImage {i}:"
+            "text": f"\nPRODUCT {ref}: \"{product['title']}\" ({original_note}, suggestions 1-{len(prepared['suggestions'])})"
         })
         content.append({
             "type": "image_url",
-            "image_url": {"url": img_url, "detail": "low"}
+            "image_url": {
+                "url": "data:image/jpeg;base64," + base64.standard_b64encode(prepared['sheet']).decode('utf-8'),
+                "detail": SHEET_DETAIL
+            }
         })
-
+    return content
+
+
+def _map_result(result: dict, suggestions: list[str]) -> dict:
+    """Model output (tile numbers) -> API result with image paths"""
+    matches = []
+    best_match = None
+
+    for match in result.get('matches', []):
+        idx = (match.get('index') or 0) - 1  # Convert to 0-based
+        if 0 <= idx < len(suggestions):
+            match_data = {
+                'index': idx + 1,
+                'image_path': suggestions[idx],
+                'confidence': match.get('confidence', 0),
+                'reason': match.get('reason', ''),
+                'is_best': (idx + 1) == result.get('best_match_index')
+            }
+            matches.append(match_data)
+
+            if match_data['is_best']:
+                best_match = match_data
+
+    # Sort by confidence descending
+    matches.sort(key=lambda x: x['confidence'], reverse=True)
+
+    # If no best match was identified, use highest confidence
+    if not best_match and matches:
+        best_match = matches[0]
+        matches[0]['is_best'] = True
+
+    return {
+        'matches': matches,
+        'best_match': best_match,
+        'analysis': result.get('analysis', '')
+    }
+
+
+def _match_chunk(client, entries: list[tuple[str, dict, dict]]) -> dict:
+    """One Vision request for several products; returns {product_id: result}"""
     try:
         response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": content
-                }
-            ],
-            max_tokens=1000,
+            model=MATCH_MODEL,
+            messages=[{"role": "user", "content": _build_batch_request(entries)}],
+            max_tokens=600 * len(entries),
             response_format={"type": "json_object"}
         )
-
-        import json
-        result_text = response.choices[0].message.content
-        result = json.loads(result_text)
-
-        # Map results to include image paths
-        matches = []
-        best_match = None
-
-        for match in result.get('matches', []):
-            idx = match.get('index', 0) - 1  # Convert to 0-based
-            if 0 <= idx < len(suggested_image_paths):
-                match_data = {
-                    'index': idx + 1,
-                    'image_path': suggested_image_paths[idx],
-                    'confidence': match.get('confidence', 0),
-                    'reason': match.get('reason', ''),
-                    'is_best': (idx + 1) == result.get('best_match_index')
-                }
-                matches.append(match_data)
-
-                if match_data['is_best']:
-                    best_match = match_data
-
-        # Sort by confidence descending
-        matches.sort(key=lambda x: x['confidence'], reverse=True)
-
-        # If no best match was identified, use highest confidence
-        if not best_match and matches:
-            best_match = matches[0]
-            matches[0]['is_best'] = True
-
-        return {
-            'matches': matches,
-            'best_match': best_match,
-            'analysis': result.get('analysis', '')
-        }
-
+        parsed = json.loads(response.choices[0].message.content)
+        by_ref = {str(item.get('product', '')).strip().upper(): item for item in parsed.get('products', [])}
     except Exception as e:
         print(f"GPT-4o Vision error: {e}")
         import traceback
         traceback.print_exc()
+        return {
+            product['id']: {'matches': [], 'best_match': None, 'analysis': f'Error: {str(e)}'}
+            for _, product, _ in entries
+        }
+
+    results = {}
+    for ref, product, prepared in entries:
+        item = by_ref.get(ref)
+        if item is None:
+            results[product['id']] = {'matches': [], 'best_match': None, 'analysis': 'No result returned for this product'}
+        else:
+            results[product['id']] = _map_result(item, prepared['suggestions'])
+    return results
+
+
+def match_products_batch(products: list[dict], products_per_request: int = PRODUCTS_PER_REQUEST,
+                         max_workers: int = MATCH_WORKERS) -> dict:
+    """
+    Match images for many products with few Vision requests.
+
+    Args:
+        products: List of {'id', 'title', 'original_image_path', 'suggested_image_paths'}
+        products_per_request: Contact sheets per Vision request
+        max_workers: Concurrent Vision requests
+
+    Returns:
+        {product_id: {'matches', 'best_match', 'analysis'}} (same shape as match_product_images)
+    """
+    results = {}
+
+    # One prefix scan for every stored image of every product
+    all_paths = []
+    for product in products:
+        all_paths.extend(product.get('suggested_image_paths', [])[:MAX_SUGGESTIONS])
+    exists = check_images_exist(all_paths)
+
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix='match-tiles') as tile_executor:
+        prepared = [prepare_product_sheet(product, exists, tile_executor) for product in products]
+
+    ready = []
+    for product, sheet in zip(products, prepared):
+        if sheet['sheet'] is None:
+            results[product['id']] = {
+                'matches': [],
+                'best_match': None,
+                'analysis': 'No suggested images to match'
+            }
+        else:
+            ready.append((product, sheet))
+
+    if not ready:
+        return results
+
+    chunks = []
+    for i in range(0, len(ready), products_per_request):
+        chunk = ready[i:i + products_per_request]
+        # Letters keep product references unambiguous next to tile numbers
+        chunks.append([(chr(ord('A') + j), product, sheet) for j, (product, sheet) in enumerate(chunk)])
+
+    client = get_openai_client()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='match-vision') as executor:
+        for chunk_results in executor.map(lambda chunk: _match_chunk(client, chunk), chunks):
+            results.update(chunk_results)
+
+    return results
+
+
+def match_product_images(
+    product_title: str,
+    original_image_path: str | None,
+    suggested_image_paths: list[str]
+) -> dict:
+    """
+    Use GPT-4o Vision to match product images.
+
+    Args:
+        product_title: The product title/name
+        original_image_path: Path to original product image (can be None)
+        suggested_image_paths: List of S3 paths to suggested images
+
+    Returns:
+        Dict with matches, best_match, and analysis
+    """
+    if not suggested_image_paths:
         return {
             'matches': [],
             'best_match': None,
-            'analysis': f'Error: {str(e)}'
+            'analysis': 'No suggested images to match'
         }
+
+    results = match_products_batch([{
+        'id': 0,
+        'title': product_title,
+        'original_image_path': original_image_path,
+        'suggested_image_paths': suggested_image_paths,
+    }])
+    return results[0]
@@ -1,10 +1,31 @@
 """
 Image search service using DuckDuckGo for product image suggestions.
 """
-import requests
+import hashlib
+import io
 import os
-import boto3
-from botocore.exceptions import ClientError
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from storage import StorageError, delete_prefix, get_storage, get_storage_executor
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', '8'))
+FETCH_TIMEOUT = (3, 8)  # (connect, read) seconds per candidate
+SUGGESTION_DEADLINE = float(os.environ.get('IMAGE_SUGGESTION_DEADLINE', '20'))
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MIN_IMAGE_SIDE = 100  # Smaller images are icons/thumbnails, useless as product photos
+SHARED_SUGGESTIONS_PREFIX = 'popust/suggestions/shared/'
+FETCH_POOL_HOSTS = 32  # Per-host connection pools kept alive (least recently used are closed)
+
+_fetch_session = None
+_session_lock = threading.Lock()
+_fetch_executor = None
+_executor_lock = threading.Lock()
 
 
 def clean_search_query(query: str, is_custom_query: bool = False) -> str:
@@ -109,7 +130,39 @@ def search_duckduckgo_images(query: str, num_results: int = 5, is_custom_query:
         return []
 
 
-def download_image(url: str, timeout: int = 10) -> tuple[bytes, str] | None:
+def get_fetch_session() -> requests.Session:
+    """
+    Session shared by all candidate fetches in this process.
+
+    Candidates often come from the same few CDNs, so pooled connections let
+    concurrent fetches reuse TLS connections. The adapter keeps pools for at
+    most FETCH_POOL_HOSTS hosts and closes the least recently used one beyond
+    that, so the long tail of one-off hosts does not accumulate.
+    """
+    global _fetch_session
+    if _fetch_session is None:
+        with _session_lock:
+            if _fetch_session is None:
+                session = requests.Session()
+                session.headers['User-Agent'] = USER_AGENT
+                adapter = HTTPAdapter(pool_connections=FETCH_POOL_HOSTS, pool_maxsize=FETCH_WORKERS)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _fetch_session = session
+    return _fetch_session
+
+
+def get_fetch_executor():
+    """Bounded pool shared by all suggestion fetches in this process"""
+    global _fetch_executor
+    if _fetch_executor is None:
+        with _executor_lock:
+            if _fetch_executor is None:
+                _fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='image-fetch')
+    return _fetch_executor
+
+
+def download_image(url: str, timeout: tuple | int = FETCH_TIMEOUT) -> tuple[bytes, str] | None:
     """
     Download an image from URL.
 
@@ -117,20 +170,20 @@ def download_image(url: str, timeout: int = 10) -> tuple[bytes, str] | None:
         Tuple of (image_bytes, content_type) or None if failed
     """
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        resp = requests.get(url, headers=headers, timeout=timeout, stream=True)
-        resp.raise_for_status()
+        with get_fetch_session().get(url, timeout=timeout, stream=True) as resp:
+            resp.raise_for_status()
 
-        content_type = resp.headers.get('Content-Type', 'image/jpeg')
-        if 'image' not in content_type:
-            return None
+            content_type = resp.headers.get('Content-Type', 'image/jpeg')
+            if 'image' not in content_type:
+                return None
 
-        # Limit size to 5MB
-        content = resp.content
-        if len(content) > 5 * 1024 * 1024:
-            return None
+            # Limit size to 5MB without buffering anything larger
+            declared = resp.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > MAX_IMAGE_BYTES:
+                return None
+            content = resp.raw.read(MAX_IMAGE_BYTES + 1, decode_content=True)
+            if len(content) > MAX_IMAGE_BYTES:
+                return None
 
         return content, content_type
 
@@ -139,6 +192,31 @@ def download_image(url: str, timeout: int = 10) -> tuple[bytes, str] | None:
         return None
 
 
+def fetch_candidate(url: str) -> tuple[bytes, str, str] | None:
+    """
+    Download and validate one candidate image.
+
+    Returns:
+        Tuple of (image_bytes, content_type, sha256 hex) or None if the image
+        is unusable (broken, not an image, or too small to show)
+    """
+    result = download_image(url)
+    if not result:
+        return None
+
+    image_bytes, content_type = result
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = img.size
+            img.verify()
+    except Exception:
+        return None
+    if min(width, height) < MIN_IMAGE_SIDE:
+        return None
+
+    return image_bytes, content_type, hashlib.sha256(image_bytes).hexdigest()
+
+
 def get_extension_from_content_type(content_type: str) -> str:
     """Get file extension from content type."""
     mapping = {
@@ -164,91 +242,95 @@ def upload_to_s3(image_bytes: bytes, s3_path: str, content_type: str) -> str | N
         S3 path if successful, None otherwise
     """
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=s3_path,
-            Body=image_bytes,
-            ContentType=content_type,
-            CacheControl='max-age=31536000'
-        )
-
-        return s3_path
-
-    except ClientError as e:
+        return get_storage().put(s3_path, image_bytes, content_type, cache_control='max-age=31536000')
+
+    except StorageError as e:
         print(f"S3 upload error: {e}")
         return None
 
 
+def suggestion_key(content_hash: str, content_type: str) -> str:
+    """Content-addressed key, so identical images are stored once across products"""
+    return f"{SHARED_SUGGESTIONS_PREFIX}{content_hash[:2]}/{content_hash}{get_extension_from_content_type(content_type)}"
+
+
+def store_suggestion(image_bytes: bytes, content_hash: str, content_type: str) -> str | None:
+    """Upload a suggestion unless an identical image is already stored"""
+    key = suggestion_key(content_hash, content_type)
+    try:
+        if get_storage().exists(key):
+            return key
+    except StorageError as e:
+        print(f"S3 exists check failed for {key}: {e}")
+    return upload_to_s3(image_bytes, key, content_type)
+
+
 def search_and_upload_suggestions(product_id: int, query: str, num_images: int = 5, is_custom_query: bool = False) -> list[str]:
     """
     Search for images and upload them to S3.
 
+    Candidates are fetched and validated concurrently; collection stops as
+    soon as num_images distinct images are in hand (or SUGGESTION_DEADLINE
+    passes), so one slow host no longer holds up the whole request.
+
     Args:
-        product_id: Product ID for organizing S3 paths
+        product_id: Product ID (for logging; suggestions are stored by content hash)
         query: Search query (product title)
         num_images: Number of images to fetch
         is_custom_query: If True, don't modify the query (user provided it manually)
 
     Returns:
-        List of S3 paths for successfully uploaded images
+        List of S3 paths for successfully uploaded images, in search rank order
     """
-    # Search for images
-    image_urls = search_duckduckgo_images(query, num_images + 3, is_custom_query=is_custom_query)  # Get extra in case some fail
+    # Over-fetch candidates: fetching is concurrent, so spares are cheap
+    image_urls = search_duckduckgo_images(query, num_images * 2, is_custom_query=is_custom_query)
 
     if not image_urls:
         return []
 
-    uploaded_paths = []
+    executor = get_fetch_executor()
+    futures = {executor.submit(fetch_candidate, url): rank for rank, url in enumerate(image_urls)}
 
-    for i, url in enumerate(image_urls):
-        if len(uploaded_paths) >= num_images:
-            break
-
-        result = download_image(url)
-        if not result:
-            continue
-
-        image_bytes, content_type = result
-        ext = get_extension_from_content_type(content_type)
-
-        # S3 path: popust/suggestions/<product_id>/<index><ext>
-        s3_path = f"popust/suggestions/{product_id}/{len(uploaded_paths) + 1}{ext}"
+    chosen = {}  # rank -> (image_bytes, content_type, content_hash)
+    seen_hashes = set()
+    try:
+        for future in as_completed(futures, timeout=SUGGESTION_DEADLINE):
+            candidate = future.result()
+            if not candidate or candidate[2] in seen_hashes:
+                continue
+            seen_hashes.add(candidate[2])
+            chosen[futures[future]] = candidate
+            if len(chosen) >= num_images:
+                break
+    except FuturesTimeout:
+        print(f"Image suggestions for product {product_id}: deadline reached with {len(chosen)} images")
+    finally:
+        # Drop candidates that have not started; in-flight ones finish and are ignored
+        for future in futures:
+            future.cancel()
+
+    if not chosen:
+        return []
 
-        uploaded = upload_to_s3(image_bytes, s3_path, content_type)
-        if uploaded:
-            uploaded_paths.append(uploaded)
+    ranked = [chosen[rank] for rank in sorted(chosen)]
+    stored = list(get_storage_executor().map(
+        lambda candidate: store_suggestion(candidate[0], candidate[2], candidate[1]),
+        ranked
+    ))
 
-    return uploaded_paths
+    return [path for path in stored if path]
 
 
 def delete_suggestions_from_s3(product_id: int):
-    """Delete all suggested images for a product from S3."""
+    """
+    Delete per-product suggested images from S3.
+
+    Only the legacy popust/suggestions/<product_id>/ prefix is removed;
+    content-addressed suggestions may be shared with other products (or be
+    a product's selected image) and are left in place.
+    """
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        prefix = f"popust/suggestions/{product_id}/"
-
-        # List and delete objects
-        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-
-        if 'Contents' in response:
-            objects = [{'Key': obj['Key']} for obj in response['Contents']]
-            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+        delete_prefix(f"popust/suggestions/{product_id}/")
 
     except Exception as e:
         print(f"Error deleting S3 suggestions: {e}")
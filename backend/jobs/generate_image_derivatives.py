@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Backfill product image derivatives (small/medium WebP + JPEG renditions).
+
+Walks products with an image_path whose image_variants are missing or were
+built from a different image, renders the renditions on a worker pool
+(download, resize and upload overlap across products) and writes the
+results back with one bulk UPDATE per batch.
+
+Schedule: Nightly at 4 AM UTC (0 4 * * *) - catches anything the upload
+hooks missed; run manually once after deploying the derivative pipeline.
+Command: python jobs/generate_image_derivatives.py [--business-id N] [--limit N] [--workers 8] [--force]
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import update
+
+from app import app, db
+from models import Product, JobRun
+from image_derivatives import build_derivatives, variants_for
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+DEFAULT_WORKERS = 8
+
+
+def find_stale_products(after_id, business_id=None, force=False):
+    """Next batch of (id, image_path) needing derivatives, keyset-paginated by id"""
+    query = db.session.query(Product.id, Product.image_path, Product.image_variants).filter(
+        Product.id > after_id,
+        Product.image_path.isnot(None),
+        Product.image_path != ''
+    )
+    if business_id:
+        query = query.filter(Product.business_id == business_id)
+    rows = query.order_by(Product.id).limit(BATCH_SIZE).all()
+
+    last_id = rows[-1].id if rows else None
+    stale = [
+        (row.id, row.image_path) for row in rows
+        if force or variants_for(row.image_path, row.image_variants) is None
+    ]
+    return stale, last_id
+
+
+def backfill_derivatives(business_id=None, limit=None, workers=DEFAULT_WORKERS, force=False):
+    """Generate derivatives for every product that needs them"""
+    with app.app_context():
+        job_run = JobRun.start('image_derivatives')
+        processed = failed = 0
+        after_id = 0
+        start = time.time()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while True:
+                    batch, last_id = find_stale_products(after_id, business_id, force)
+                    if last_id is None:
+                        break
+                    after_id = last_id
+                    if limit:
+                        batch = batch[:max(0, limit - processed - failed)]
+                    if not batch:
+                        if limit and processed + failed >= limit:
+                            break
+                        continue
+
+                    results = list(executor.map(lambda item: (item[0], item[1], build_derivatives(*item)), batch))
+
+                    # Bulk UPDATE by primary key, skipping products whose image
+                    # was replaced while we were rendering the old one
+                    built = {product_id: image_path for product_id, image_path, variants in results if variants}
+                    current = dict(db.session.query(Product.id, Product.image_path).filter(
+                        Product.id.in_(list(built))
+                    ).all()) if built else {}
+                    rows = [
+                        {'id': product_id, 'image_variants': variants}
+                        for product_id, image_path, variants in results
+                        if variants and current.get(product_id) == image_path
+                    ]
+                    if rows:
+                        db.session.execute(update(Product), rows)
+                    db.session.commit()
+
+                    processed += len(rows)
+                    failed += len(batch) - len(rows)
+                    logger.info(f"Derivatives: {processed} done, {failed} failed (up to product {after_id})")
+
+                    if limit and processed + failed >= limit:
+                        break
+
+            elapsed = time.time() - start
+            logger.info(f"Derivative backfill complete: {processed} products in {elapsed:.1f}s, {failed} failed")
+            job_run.complete(
+                records_processed=processed + failed,
+                records_success=processed,
+                records_failed=failed
+            )
+            return processed, failed
+
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Derivative backfill failed: {e}")
+            job_run.fail(str(e))
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill product image derivatives')
+    parser.add_argument('--business-id', type=int)
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('DERIVATIVE_BACKFILL_WORKERS', DEFAULT_WORKERS)))
+    parser.add_argument('--force', action='store_true', help='Regenerate even if variants are up to date')
+    args = parser.parse_args()
+
+    backfill_derivatives(args.business_id, args.limit, args.workers, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Index catalog product images in the perceptual-hash table (image_hashes).
+
+Hashes every product whose image is not yet indexed, or whose image_path
+changed since it was hashed, so camera searches and user product images of
+known products resolve without a Vision API call (see image_hash_index.py).
+The small derivative is hashed when available - pHash/dHash work on a 32x32
+thumbnail, so the original adds nothing but download time. Also prunes
+camera/user snapshot hashes past their matchable age.
+
+Schedule: Nightly at 4:30 AM UTC (30 4 * * *) - after image derivatives
+Command: python jobs/index_image_hashes.py [--business-id N] [--limit N] [--workers 8]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert
+
+from app import app, db
+from models import Product, ImageHash, JobRun
+from image_derivatives import load_source_image, variants_for
+from image_hash_index import SNAPSHOT_SOURCES, SNAPSHOT_TTL_DAYS, hash_image_bytes, to_signed64
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+DEFAULT_WORKERS = 8
+
+
+def find_unindexed_products(after_id, business_id=None):
+    """Next batch of (id, image_path, hash source url) needing a hash, keyset-paginated by id"""
+    query = db.session.query(Product.id, Product.image_path, Product.image_variants).filter(
+        Product.id > after_id,
+        Product.image_path.isnot(None),
+        Product.image_path != ''
+    )
+    if business_id:
+        query = query.filter(Product.business_id == business_id)
+    rows = query.order_by(Product.id).limit(BATCH_SIZE).all()
+    if not rows:
+        return [], None
+
+    indexed = dict(db.session.query(ImageHash.product_id, ImageHash.image_url).filter(
+        ImageHash.source == 'product',
+        ImageHash.product_id.in_([row.id for row in rows])
+    ).all())
+
+    pending = []
+    for row in rows:
+        if indexed.get(row.id) == row.image_path:
+            continue
+        variants = variants_for(row.image_path, row.image_variants)
+        fetch_url = variants['small']['jpg'] if variants and 'small' in variants else row.image_path
+        pending.append((row.id, row.image_path, fetch_url))
+    return pending, rows[-1].id
+
+
+def hash_product_image(item):
+    product_id, image_path, fetch_url = item
+    try:
+        return product_id, image_path, hash_image_bytes(load_source_image(fetch_url))
+    except Exception as e:
+        logger.warning(f"Could not hash image of product {product_id}: {e}")
+        return product_id, image_path, None
+
+
+def prune_snapshot_hashes():
+    """Delete camera/user snapshot hashes that are no longer matchable"""
+    cutoff = datetime.now() - timedelta(days=SNAPSHOT_TTL_DAYS)
+    deleted = ImageHash.query.filter(
+        ImageHash.source.in_(SNAPSHOT_SOURCES),
+        ImageHash.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def index_product_images(business_id=None, limit=None, workers=DEFAULT_WORKERS):
+    """Hash every catalog product image that is not indexed yet"""
+    with app.app_context():
+        job_run = JobRun.start('image_hash_index')
+        indexed = failed = 0
+        after_id = 0
+        start = time.time()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while True:
+                    batch, last_id = find_unindexed_products(after_id, business_id)
+                    if last_id is None:
+                        break
+                    after_id = last_id
+                    if limit:
+                        batch = batch[:max(0, limit - indexed - failed)]
+                    if not batch:
+                        if limit and indexed + failed >= limit:
+                            break
+                        continue
+
+                    results = list(executor.map(hash_product_image, batch))
+                    rows = [
+                        {
+                            'phash': to_signed64(hashes[0]),
+                            'dhash': to_signed64(hashes[1]),
+                            'source': 'product',
+                            'product_id': product_id,
+                            'image_url': image_path,
+                            'created_at': datetime.now(),
+                            'hit_count': 0
+                        }
+                        for product_id, image_path, hashes in results if hashes
+                    ]
+
+                    # Replace stale hashes of these products in one statement, then bulk insert
+                    if rows:
+                        ImageHash.query.filter(
+                            ImageHash.source == 'product',
+                            ImageHash.product_id.in_([row['product_id'] for row in rows])
+                        ).delete(synchronize_session=False)
+                        db.session.execute(insert(ImageHash), rows)
+                    db.session.commit()
+
+                    indexed += len(rows)
+                    failed += len(batch) - len(rows)
+                    logger.info(f"Image hashes: {indexed} indexed, {failed} failed (up to product {after_id})")
+
+                    if limit and indexed + failed >= limit:
+                        break
+
+            pruned = prune_snapshot_hashes()
+            elapsed = time.time() - start
+            logger.info(f"Image hash indexing complete: {indexed} products in {elapsed:.1f}s, "
+                        f"{failed} failed, {pruned} expired snapshots pruned")
+            job_run.complete(
+                records_processed=indexed + failed,
+                records_success=indexed,
+                records_failed=failed
+            )
+            return indexed, failed
+
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Image hash indexing failed: {e}")
+            job_run.fail(str(e))
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index product images by perceptual hash')
+    parser.add_argument('--business-id', type=int)
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('IMAGE_HASH_WORKERS', DEFAULT_WORKERS)))
+    args = parser.parse_args()
+
+    index_product_images(args.business_id, args.limit, args.workers)
+
+
+if __name__ == '__main__':
+    main()
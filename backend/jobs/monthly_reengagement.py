@@ -10,26 +10,21 @@ Command: python jobs/monthly_reengagement.py
 
 import os
 import sys
-import time
 from datetime import datetime
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app, db
-from models import User, UserTrackedProduct, Product, Business, JobRun, EmailNotification
-from sendgrid_utils import send_reengagement_email
+from models import User, UserTrackedProduct, Product, Business, JobRun
+from sendgrid_utils import render_reengagement_email
+from bulk_email import BulkEmailDispatcher, Recipient, SharedTemplate
 from sqlalchemy import func, desc
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configuration
-EMAIL_BATCH_SIZE = 10  # Log progress every N emails
-DELAY_BETWEEN_EMAILS = 0.5  # Seconds between emails
-
-
 def get_popular_tracked_terms(limit: int = 10) -> list:
     """Get most popular search terms that users are tracking."""
     results = db.session.query(
@@ -166,58 +161,25 @@ def run_reengagement_emails():
                 'total_users_tracking': total_users_tracking
             }
 
-            sent_count = 0
-            failed_count = 0
-            processed_count = 0
-
-            for user in users:
-                processed_count += 1
-
-                try:
-                    user_name = user.first_name or user.email.split('@')[0]
-
-                    if send_reengagement_email(user.email, user_name, email_data):
-                        sent_count += 1
-
-                        # Log the email
-                        EmailNotification.log_email(
-                            email=user.email,
-                            email_type='monthly_reengagement',
-                            subject="Ne propustite najbolje ponude - postavite pracenje!",
-                            user_id=user.id,
-                            status='sent',
-                            extra_data={
-                                'popular_terms_count': len(popular_terms),
-                                'deals_count': len(best_deals)
-                            }
-                        )
-
-                        # Rate limit
-                        time.sleep(DELAY_BETWEEN_EMAILS)
-                    else:
-                        failed_count += 1
-                except Exception as e:
-                    logger.error(f"Error sending email to user {user.id}: {e}")
-                    failed_count += 1
-
-                    EmailNotification.log_email(
-                        email=user.email if user.email else 'unknown',
-                        email_type='monthly_reengagement',
-                        user_id=user.id,
-                        status='failed',
-                        error_message=str(e)
-                    )
-
-                # Log progress
-                if processed_count % EMAIL_BATCH_SIZE == 0:
-                    logger.info(f"Progress: {processed_count}/{len(users)} processed, {sent_count} sent")
-
-            logger.info(f"Reengagement job complete: {sent_count} sent, {failed_count} failed")
+            # Same content for everyone - rendered once, sent in personalization batches
+            extra_data = {
+                'popular_terms_count': len(popular_terms),
+                'deals_count': len(best_deals)
+            }
+            recipients = [
+                Recipient(user.email, user.first_name or user.email.split('@')[0], user.id, extra_data)
+                for user in users
+            ]
+            result = BulkEmailDispatcher('monthly_reengagement').send_shared(
+                SharedTemplate(render_reengagement_email, email_data), recipients
+            )
+
+            logger.info(f"Reengagement job complete: {result.sent} sent, {result.failed} failed")
 
             job_run.complete(
                 records_processed=len(users),
-                records_success=sent_count,
-                records_failed=failed_count
+                records_success=result.sent,
+                records_failed=result.failed
             )
 
         except Exception as e:
@@ -3,34 +3,84 @@
 Process user-uploaded product images using AI Vision.
 Extracts product names and adds them to user preferences.
 
-Schedule: Every 5 minutes
-Command: python jobs/process_product_images.py
+Pending images are claimed in batches with FOR UPDATE SKIP LOCKED, so
+several runs (or a run and the upload thread) never process the same image.
+A claim is a lease: images left in 'processing' for longer than
+PRODUCT_IMAGE_LEASE_MINUTES (the claimer crashed) are claimed again.
+Each batch downloads concurrently, identifies each distinct image (by
+content hash) once on a bounded pool with a Vision rate limit, writes the
+image rows with one bulk UPDATE and applies tracked products/preferences
+once per user.
+
+Schedule: Every 5 minutes (drains the queue up to --max-images)
+Command: python jobs/process_product_images.py [--worker] [--max-images N] [--workers N]
+    --worker    Keep running and poll for new uploads instead of exiting
 """
 
 import os
 import sys
-import base64
-import requests
-from datetime import datetime
+import time
+import hashlib
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import logging
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app, db
-from models import User, UserProductImage, UserTrackedProduct
+from models import User, UserProductImage, UserTrackedProduct, Product
+from image_hash_index import get_image_hash_index, hash_image_bytes
+from llm_usage import record_cache_hit, usage_context
+from image_derivatives import load_source_image
+from sqlalchemy import text, update
 from sqlalchemy.orm.attributes import flag_modified
-from openai import OpenAI
+from llm_clients import get_openai_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # OpenAI client
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+openai_client = get_openai_client() if OPENAI_API_KEY else None
+
+# Max images to process per run (one-shot mode)
+MAX_IMAGES_PER_RUN = int(os.environ.get('PRODUCT_IMAGE_MAX_PER_RUN', '500'))
+# Images claimed per batch
+BATCH_SIZE = int(os.environ.get('PRODUCT_IMAGE_BATCH_SIZE', '50'))
+# Concurrent downloads / Vision calls
+DEFAULT_WORKERS = int(os.environ.get('PRODUCT_IMAGE_WORKERS', '4'))
+# Vision calls per minute per process (0 = unlimited)
+VISION_RATE_PER_MINUTE = int(os.environ.get('VISION_RATE_PER_MINUTE', '120'))
+# Minutes before an image stuck in 'processing' may be claimed again
+LEASE_MINUTES = int(os.environ.get('PRODUCT_IMAGE_LEASE_MINUTES', '15'))
+# Worker mode: seconds to sleep when the queue is empty
+POLL_SECONDS = 15
+
+
+class RateLimiter:
+    """Spaces calls evenly to stay under a per-minute budget (thread-safe)"""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
 
-# Max images to process per run
-MAX_IMAGES_PER_RUN = 10
+vision_rate_limiter = RateLimiter(VISION_RATE_PER_MINUTE)
 
 
 def extract_product_name_from_image(image_url: str) -> dict:
@@ -47,6 +97,7 @@ def extract_product_name_from_image(image_url: str) -> dict:
         logger.error("OpenAI API key not configured")
         return None
 
+    vision_rate_limiter.acquire()
     try:
         response = openai_client.chat.completions.create(
             model="gpt-4o-mini",
@@ -113,6 +164,58 @@ Rules:
         return None
 
 
+@usage_context(feature='product_image_vision')
+def identify_product_image(image_url: str, image_bytes: bytes = None) -> dict:
+    """
+    Identify the product in a user image, reusing earlier results when possible.
+
+    The image is perceptually hashed first; a near-identical catalog image or
+    previously identified user image resolves without a Vision API call.
+    Newly identified images are added to the hash index. Pass image_bytes
+    when the caller already has the image to skip downloading it.
+
+    Returns:
+        Same shape as extract_product_name_from_image (plus
+        'matched_product_id' on a catalog hit), or None
+    """
+    image_hashes = None
+    try:
+        image_hashes = hash_image_bytes(image_bytes if image_bytes is not None else load_source_image(image_url))
+    except Exception as e:
+        logger.warning(f"Could not load image for hashing {image_url}: {e}")
+
+    index = get_image_hash_index()
+    if image_hashes:
+        match = index.lookup(image_hashes, sources=('user_image', 'product'))
+        if match and match.source == 'product' and match.product_id:
+            product = db.session.get(Product, match.product_id)
+            if product:
+                logger.info(f"Hash hit on catalog product {product.id} for {image_url}")
+                record_cache_hit('gpt-4o-mini')
+                return {
+                    'product_name': product.title,
+                    'price': None,
+                    'confidence': 'high',
+                    'category': product.category_group,
+                    'matched_product_id': product.id
+                }
+        elif match and match.result and match.result.get('product_name'):
+            logger.info(f"Hash hit on user image #{match.id} for {image_url}")
+            record_cache_hit('gpt-4o-mini')
+            return dict(match.result)
+
+    result = extract_product_name_from_image(image_url)
+
+    if image_hashes and result and result.get('product_name'):
+        try:
+            index.record(image_hashes, 'user_image', result=result, image_url=image_url)
+        except Exception as e:
+            logger.error(f"Failed to index user image {image_url}: {e}")
+            db.session.rollback()
+
+    return result
+
+
 def trigger_user_scan(user_id: str):
     """
     Trigger a product scan for a specific user after adding a new tracked product.
@@ -147,6 +250,19 @@ def add_to_user_preferences(user_id: str, product_name: str) -> bool:
         user_id: User ID
         product_name: Product name to add
 
+    Returns:
+        True if successful
+    """
+    return apply_user_results(user_id, [product_name])
+
+
+def apply_user_results(user_id: str, product_names: list) -> bool:
+    """
+    Add several identified product names to one user in a single transaction.
+
+    Merges them into grocery_interests and inserts the missing
+    UserTrackedProduct rows (one lookup for all names).
+
     Returns:
         True if successful
     """
@@ -156,42 +272,49 @@ def add_to_user_preferences(user_id: str, product_name: str) -> bool:
             logger.error(f"User {user_id} not found")
             return False
 
-        product_clean = product_name.strip()
-        product_lower = product_clean.lower()
+        # lower -> cleaned name, first occurrence wins
+        names = {}
+        for name in product_names:
+            if name and name.strip():
+                names.setdefault(name.strip().lower(), name.strip())
+        if not names:
+            return True
 
         # 1. Add to grocery_interests preferences
-        if not user.preferences:
-            user.preferences = {}
-        elif not isinstance(user.preferences, dict):
+        if not user.preferences or not isinstance(user.preferences, dict):
             user.preferences = {}
 
         interests = user.preferences.get('grocery_interests', [])
         if not isinstance(interests, list):
             interests = []
 
-        existing_lower = [i.lower().strip() for i in interests]
-        if product_lower not in existing_lower:
-            interests.append(product_clean)
-            user.preferences['grocery_interests'] = interests
+        existing_lower = {i.lower().strip() for i in interests if isinstance(i, str)}
+        added = [clean for lower, clean in names.items() if lower not in existing_lower]
+        if added:
+            user.preferences['grocery_interests'] = interests + added
             flag_modified(user, 'preferences')
-            logger.info(f"Added '{product_clean}' to user {user_id} preferences")
+            logger.info(f"Added {added} to user {user_id} preferences")
 
         # 2. Add to tracked products (for /moji-proizvodi)
-        existing_tracked = UserTrackedProduct.query.filter_by(
-            user_id=user_id,
-            search_term=product_lower
-        ).first()
-
-        if not existing_tracked:
-            tracked = UserTrackedProduct(
+        existing_tracked = {
+            term for (term,) in db.session.query(UserTrackedProduct.search_term).filter(
+                UserTrackedProduct.user_id == user_id,
+                UserTrackedProduct.search_term.in_(list(names))
+            ).all()
+        }
+        new_tracked = [
+            UserTrackedProduct(
                 user_id=user_id,
-                search_term=product_lower,
-                original_text=product_clean,
+                search_term=lower,
+                original_text=clean,
                 source='product_image',
                 is_active=True
             )
-            db.session.add(tracked)
-            logger.info(f"Added '{product_clean}' to user {user_id} tracked products")
+            for lower, clean in names.items() if lower not in existing_tracked
+        ]
+        if new_tracked:
+            db.session.add_all(new_tracked)
+            logger.info(f"Added {len(new_tracked)} tracked products for user {user_id}")
 
         db.session.commit()
         return True
@@ -202,80 +325,185 @@ def add_to_user_preferences(user_id: str, product_name: str) -> bool:
         return False
 
 
-def process_pending_images():
+def claim_pending_images(limit: int = BATCH_SIZE, image_ids: list = None) -> list:
     """
-    Process all pending product images.
+    Atomically move pending images to 'processing' and return them.
+
+    Uses FOR UPDATE SKIP LOCKED, so concurrent claimers (other job runs, the
+    upload thread) get disjoint sets and never block each other. Images whose
+    lease (claimed_at) is older than LEASE_MINUTES are reclaimed as well.
+
+    Returns:
+        List of rows with id, user_id, image_url
     """
+    id_filter = "AND id = ANY(:ids)" if image_ids else ""
+    now = datetime.now()
+    params = {'limit': limit, 'now': now, 'lease_cutoff': now - timedelta(minutes=LEASE_MINUTES)}
+    if image_ids:
+        params['ids'] = list(image_ids)
+
+    rows = db.session.execute(text(f"""
+        UPDATE user_product_images SET status = 'processing', claimed_at = :now
+        WHERE id IN (
+            SELECT id FROM user_product_images
+            WHERE (
+                status = 'pending'
+                -- Claimed before claimed_at existed: fall back to the upload time
+                OR (status = 'processing' AND COALESCE(claimed_at, created_at) < :lease_cutoff)
+            ) {id_filter}
+            ORDER BY created_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, image_url
+    """), params).fetchall()
+    db.session.commit()
+    return rows
+
+
+def _download(image_url: str):
+    try:
+        return load_source_image(image_url)
+    except Exception as e:
+        logger.warning(f"Could not download {image_url}: {e}")
+        return None
+
+
+def _identify_in_context(image_url: str, image_bytes: bytes):
+    """identify_product_image on a pool thread (own app context / session)"""
     with app.app_context():
-        logger.info("Starting product image processing")
+        try:
+            return identify_product_image(image_url, image_bytes)
+        except Exception as e:
+            logger.error(f"Error identifying {image_url}: {e}")
+            return {'error': str(e)}
 
-        # Get pending images
-        pending_images = UserProductImage.query.filter_by(
-            status='pending'
-        ).order_by(UserProductImage.created_at.asc()).limit(MAX_IMAGES_PER_RUN).all()
 
-        if not pending_images:
-            logger.info("No pending images to process")
-            return 0, 0
+def process_claimed_batch(claimed: list, executor: ThreadPoolExecutor) -> tuple:
+    """
+    Identify a batch of claimed images and persist the results.
 
-        logger.info(f"Found {len(pending_images)} pending images")
+    Returns:
+        (processed, failed)
+    """
+    # 1. Download concurrently and group identical images by content hash
+    contents = list(executor.map(_download, [row.image_url for row in claimed]))
+    groups = defaultdict(list)
+    for row, content in zip(claimed, contents):
+        key = hashlib.sha256(content).hexdigest() if content else f"url:{row.id}"
+        groups[key].append((row, content))
+
+    # 2. One identification per distinct image, bounded by the pool size
+    futures = {
+        key: executor.submit(_identify_in_context, members[0][0].image_url, members[0][1])
+        for key, members in groups.items()
+    }
+    if len(groups) < len(claimed):
+        logger.info(f"Batch of {len(claimed)} images has {len(groups)} distinct images")
+
+    # 3. Bulk-update image rows; collect names per user
+    now = datetime.now()
+    updates = []
+    names_by_user = defaultdict(list)
+    for key, members in groups.items():
+        result = futures[key].result()
+        identified = bool(result and result.get('product_name'))
+        if identified or (result and result.get('error')):
+            extracted_data = result
+        else:
+            extracted_data = {'error': 'Could not identify product'}
+        for row, _ in members:
+            updates.append({
+                'id': row.id,
+                'status': 'processed' if identified else 'failed',
+                'extracted_name': result['product_name'] if identified else None,
+                'extracted_price': result.get('price') if identified else None,
+                'extracted_data': extracted_data,
+                'matched_product_id': result.get('matched_product_id') if identified else None,
+                'processed_at': now,
+            })
+            if identified:
+                names_by_user[row.user_id].append(result['product_name'])
+            else:
+                logger.warning(f"Could not identify product in image {row.id}")
+
+    db.session.execute(update(UserProductImage), updates)
+    db.session.commit()
+
+    # 4. Preferences/tracked products and one scan per user
+    for user_id, names in names_by_user.items():
+        if apply_user_results(user_id, names):
+            trigger_user_scan(user_id)
+
+    processed = sum(1 for u in updates if u['status'] == 'processed')
+    return processed, len(updates) - processed
+
+
+def process_pending_images(max_images: int = MAX_IMAGES_PER_RUN, workers: int = DEFAULT_WORKERS):
+    """
+    Process pending product images until the queue is empty or max_images is reached.
+
+    Returns:
+        (processed, failed)
+    """
+    with app.app_context():
+        logger.info("Starting product image processing")
 
         processed = 0
         failed = 0
 
-        for image in pending_images:
-            try:
-                # Mark as processing
-                image.status = 'processing'
-                db.session.commit()
-
-                logger.info(f"Processing image {image.id} for user {image.user_id}")
-
-                # Extract product info using AI Vision
-                result = extract_product_name_from_image(image.image_url)
-
-                if result and result.get('product_name'):
-                    product_name = result['product_name']
-
-                    # Update image record
-                    image.extracted_name = product_name
-                    if result.get('price'):
-                        image.extracted_price = result['price']
-                    image.extracted_data = result
-                    image.status = 'processed'
-                    image.processed_at = datetime.now()
-
-                    # Add to user preferences
-                    add_to_user_preferences(image.user_id, product_name)
-
-                    # Trigger a scan for this user to find matching products
-                    trigger_user_scan(image.user_id)
-
-                    processed += 1
-                    logger.info(f"Successfully processed image {image.id}: {product_name}")
-                else:
-                    # Could not extract product name
-                    image.status = 'failed'
-                    image.extracted_data = {'error': 'Could not identify product'}
-                    image.processed_at = datetime.now()
-                    failed += 1
-                    logger.warning(f"Could not identify product in image {image.id}")
-
-                db.session.commit()
-
-            except Exception as e:
-                logger.error(f"Error processing image {image.id}: {e}")
-                image.status = 'failed'
-                image.extracted_data = {'error': str(e)}
-                image.processed_at = datetime.now()
-                db.session.commit()
-                failed += 1
-
-        logger.info(f"Image processing complete: {processed} processed, {failed} failed")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='product-images') as executor:
+            while processed + failed < max_images:
+                claimed = claim_pending_images(min(BATCH_SIZE, max_images - processed - failed))
+                if not claimed:
+                    break
+
+                logger.info(f"Claimed {len(claimed)} pending images")
+                try:
+                    batch_processed, batch_failed = process_claimed_batch(claimed, executor)
+                except Exception as e:
+                    logger.error(f"Error processing batch: {e}")
+                    db.session.rollback()
+                    UserProductImage.query.filter(
+                        UserProductImage.id.in_([row.id for row in claimed]),
+                        UserProductImage.status == 'processing'
+                    ).update({
+                        'status': 'failed',
+                        'extracted_data': {'error': str(e)},
+                        'processed_at': datetime.now()
+                    }, synchronize_session=False)
+                    db.session.commit()
+                    batch_processed, batch_failed = 0, len(claimed)
+
+                processed += batch_processed
+                failed += batch_failed
+
+        if processed + failed == 0:
+            logger.info("No pending images to process")
+        else:
+            logger.info(f"Image processing complete: {processed} processed, {failed} failed")
         return processed, failed
 
 
+def run_worker(workers: int = DEFAULT_WORKERS, poll_seconds: int = POLL_SECONDS):
+    """Keep draining the queue, sleeping when it is empty"""
+    logger.info(f"Product image worker started ({workers} workers, {VISION_RATE_PER_MINUTE}/min Vision budget)")
+    while True:
+        processed, failed = process_pending_images(MAX_IMAGES_PER_RUN, workers)
+        if processed + failed == 0:
+            time.sleep(poll_seconds)
+
+
 if __name__ == '__main__':
-    logger.info("Running product image processor")
-    processed, failed = process_pending_images()
-    logger.info(f"Done: {processed} processed, {failed} failed")
+    parser = argparse.ArgumentParser(description='Process user-uploaded product images')
+    parser.add_argument('--worker', action='store_true', help='Run continuously, polling for new images')
+    parser.add_argument('--max-images', type=int, default=MAX_IMAGES_PER_RUN)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.workers)
+    else:
+        logger.info("Running product image processor")
+        processed, failed = process_pending_images(args.max_images, args.workers)
+        logger.info(f"Done: {processed} processed, {failed} failed")
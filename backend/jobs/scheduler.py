@@ -19,6 +19,8 @@ import logging
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from llm_usage import usage_context
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -121,7 +123,8 @@ class Job:
                 logger.info(f"Starting job: {self.name}")
                 start_time = time.time()
 
-                self.func()
+                with usage_context(endpoint=f"job:{self.name}"):
+                    self.func()
 
                 elapsed = time.time() - start_time
                 logger.info(f"Completed job: {self.name} in {elapsed:.1f}s")
@@ -235,6 +238,24 @@ def run_social_media_publisher_job():
     publish_due_posts()
 
 
+def run_image_derivatives_job():
+    """Backfill small/medium product image renditions."""
+    from jobs.generate_image_derivatives import backfill_derivatives
+    backfill_derivatives()
+
+
+def run_image_hash_index_job():
+    """Hash new/changed catalog product images for camera search lookups."""
+    from jobs.index_image_hashes import index_product_images
+    index_product_images()
+
+
+def run_vector_shards_job():
+    """Create/rebuild/drop per-store vector indexes for store-filtered search."""
+    from jobs.sync_vector_shards import sync_vector_shards
+    sync_vector_shards()
+
+
 # Define all scheduled jobs
 JOBS = [
     # Product scan - runs at 6:00 AM UTC daily
@@ -252,6 +273,16 @@ JOBS = [
     # For users WITHOUT tracked products, showing example savings to encourage adoption
     Job("weekly_activation", hour=8, minute=30, func=run_weekly_activation_job),
 
+    # Image derivatives - runs at 4:00 AM UTC daily
+    # Builds renditions for products the upload hooks missed (CSV imports, scraper updates)
+    Job("image_derivatives", hour=4, minute=0, func=run_image_derivatives_job),
+
+    # Image hash index - runs at 4:30 AM UTC daily (after derivatives, hashes the small renditions)
+    Job("image_hash_index", hour=4, minute=30, func=run_image_hash_index_job),
+
+    # Vector shards - runs at 5:00 AM UTC daily (quiet hours; index builds are CONCURRENTLY)
+    Job("vector_shards", hour=5, minute=0, func=run_vector_shards_job),
+
     # Monthly credits - runs at 0:05 AM UTC on 1st of month
     Job("monthly_credits", hour=0, minute=5, func=run_monthly_credits_job),
 
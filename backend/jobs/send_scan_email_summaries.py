@@ -15,15 +15,19 @@ Command: python jobs/send_scan_email_summaries.py
 
 import os
 import sys
-import time
 from datetime import date
+from itertools import groupby
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app, db
-from models import User, UserProductScan, UserScanResult, UserTrackedProduct, JobRun, EmailNotification
-from sendgrid_utils import send_scan_summary_email as sendgrid_scan_summary, plural_bs
+from models import User, UserProductScan, JobRun, EmailNotification
+from sendgrid_utils import (
+    send_scan_summary_email as sendgrid_scan_summary, render_scan_summary_email, plural_bs
+)
+from bulk_email import BulkEmailDispatcher, OutgoingEmail
+from sqlalchemy import text
 from preference_config import EMAIL_MATCH_THRESHOLD
 import logging
 
@@ -32,136 +36,129 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 BASE_URL = os.environ.get("BASE_URL", "https://popust.ba")
-EMAIL_BATCH_SIZE = 10  # Log progress every N emails
-DELAY_BETWEEN_EMAILS = 0.5  # Seconds to wait between emails (avoid rate limits)
 
 
-def get_scan_summary_for_user(user_id: int, scan_date: date) -> dict:
-    """
-    Get detailed scan summary grouped by tracked product term.
-
-    Returns dict with:
-    - total_products: int
-    - new_products: int
-    - new_discounts: int
-    - terms: list of term summaries
-    """
-    scan = UserProductScan.query.filter_by(
-        user_id=user_id,
-        scan_date=scan_date,
-        status='completed'
-    ).first()
-
-    if not scan:
-        return None
-
-    # Get all results grouped by tracked product
-    results = UserScanResult.query.filter_by(scan_id=scan.id).all()
-
-    # Filter to only include exact matches (100% similarity) for email reports
-    # This prevents showing wrong products (e.g., "Cherry Vanilla" for "Original Taste")
-    results = [r for r in results if (r.similarity_score or 0) >= EMAIL_MATCH_THRESHOLD]
-
-    # Group by tracked product
-    term_groups = {}
-    for result in results:
-        tracked = UserTrackedProduct.query.get(result.tracked_product_id)
-        if not tracked:
-            continue
-
-        term = tracked.search_term
-        if term not in term_groups:
-            term_groups[term] = {
-                'search_term': term,
-                'original_text': tracked.original_text,
-                'products': [],
-                'new_count': 0,
-                'discount_count': 0
-            }
-
-        term_groups[term]['products'].append({
-            'title': result.product_title,
-            'business': result.business_name,
-            'base_price': result.base_price,
-            'discount_price': result.discount_price,
-            'is_new': result.is_new_today,
-            'price_dropped': result.price_dropped_today
-        })
-
-        if result.is_new_today:
-            term_groups[term]['new_count'] += 1
-        if result.price_dropped_today:
-            term_groups[term]['discount_count'] += 1
-
-    # Calculate stats per term
+SUMMARY_CHUNK_SIZE = 500  # Users per summary query
+
+# Per (user, term): the cheapest exact-match result plus the term's counts,
+# best saving and most expensive store, for a chunk of users - computed with
+# window functions over the day's user_scan_results. Users whose scan has no
+# priced exact matches come back as a single row with term NULL.
+SCAN_SUMMARY_SQL = text("""
+WITH scans AS (
+    SELECT DISTINCT ON (user_id) id, user_id, total_products_found, new_products_count, new_discounts_count
+    FROM user_product_scans
+    WHERE user_id = ANY(:user_ids) AND scan_date = :scan_date AND status = 'completed'
+    ORDER BY user_id, id
+),
+results AS (
+    SELECT s.user_id, r.id, t.search_term AS term, t.original_text, r.product_title, r.business_name,
+           r.base_price, r.discount_price, r.is_new_today, r.price_dropped_today,
+           COALESCE(NULLIF(r.discount_price, 0), NULLIF(r.base_price, 0)) AS effective_price
+    FROM scans s
+    JOIN user_scan_results r ON r.scan_id = s.id
+    JOIN user_tracked_products t ON t.id = r.tracked_product_id
+    WHERE COALESCE(r.similarity_score, 0) >= :threshold
+),
+ranked AS (
+    SELECT r.*,
+           ROW_NUMBER() OVER (PARTITION BY r.user_id, r.term ORDER BY r.effective_price NULLS LAST, r.id) AS price_rank,
+           FIRST_VALUE(r.original_text) OVER (PARTITION BY r.user_id, r.term ORDER BY r.id) AS term_original_text,
+           FIRST_VALUE(r.business_name) OVER (
+               PARTITION BY r.user_id, r.term ORDER BY r.effective_price DESC NULLS LAST, r.id DESC
+           ) AS highest_store,
+           MAX(r.effective_price) OVER w_term AS highest_price,
+           COUNT(*) OVER w_term AS term_products,
+           COUNT(*) FILTER (WHERE r.is_new_today) OVER w_term AS new_count,
+           COUNT(*) FILTER (WHERE r.price_dropped_today) OVER w_term AS discount_count,
+           MAX(GREATEST(r.base_price - r.discount_price, 0))
+               FILTER (WHERE r.discount_price <> 0 AND r.base_price <> 0) OVER w_term AS best_saving
+    FROM results r
+    WINDOW w_term AS (PARTITION BY r.user_id, r.term)
+)
+SELECT s.user_id, s.total_products_found, s.new_products_count, s.new_discounts_count,
+       k.term, k.term_original_text, k.term_products, k.new_count, k.discount_count,
+       k.effective_price, k.business_name, k.product_title, k.base_price, k.discount_price,
+       k.best_saving, k.highest_price, k.highest_store
+FROM scans s
+LEFT JOIN ranked k ON k.user_id = s.user_id AND k.price_rank = 1 AND k.effective_price IS NOT NULL
+ORDER BY s.user_id
+""")
+
+
+def _build_scan_summary(rows: list) -> dict:
+    """Summary dict for one user from their SCAN_SUMMARY_SQL rows"""
     terms = []
-    for term, data in term_groups.items():
-        products = data['products']
-        if not products:
+    for r in rows:
+        if r.term is None:
             continue
 
-        # Get effective prices (discount or base) and calculate actual savings
-        prices_with_store = []
-        for p in products:
-            effective_price = p['discount_price'] if p['discount_price'] else p['base_price']
-            if effective_price:
-                # Calculate actual discount savings (base_price - discount_price)
-                actual_saving = 0.0
-                if p['discount_price'] and p['base_price']:
-                    actual_saving = float(p['base_price']) - float(p['discount_price'])
-                    if actual_saving < 0:
-                        actual_saving = 0.0
-
-                prices_with_store.append({
-                    'price': float(effective_price),
-                    'store': p['business'],
-                    'title': p['title'],
-                    'is_discounted': p['discount_price'] is not None,
-                    'base_price': float(p['base_price']) if p['base_price'] else None,
-                    'discount_price': float(p['discount_price']) if p['discount_price'] else None,
-                    'actual_saving': actual_saving
-                })
-
-        if not prices_with_store:
-            continue
-
-        # Sort by price
-        prices_with_store.sort(key=lambda x: x['price'])
-
-        lowest = prices_with_store[0]
-        highest = prices_with_store[-1]
-
-        # Find the best saving among all discounted products for this term
-        best_saving = max((p['actual_saving'] for p in prices_with_store if p['actual_saving'] > 0), default=0.0)
+        # Actual discount savings of the cheapest product (base_price - discount_price)
+        lowest_actual_saving = 0.0
+        if r.discount_price and r.base_price:
+            lowest_actual_saving = max(0.0, float(r.base_price) - float(r.discount_price))
 
         terms.append({
-            'search_term': term,
-            'original_text': data['original_text'],
-            'total_products': len(products),
-            'new_count': data['new_count'],
-            'discount_count': data['discount_count'],
-            'lowest_price': lowest['price'],
-            'lowest_store': lowest['store'],
-            'lowest_product': lowest['title'],
-            'lowest_is_discounted': lowest['is_discounted'],
-            'lowest_base_price': lowest.get('base_price'),
-            'lowest_actual_saving': lowest.get('actual_saving', 0),
-            'best_saving': best_saving,  # Best savings for this term
-            'highest_price': highest['price'],
-            'highest_store': highest['store']
+            'search_term': r.term,
+            'original_text': r.term_original_text,
+            'total_products': r.term_products,
+            'new_count': r.new_count,
+            'discount_count': r.discount_count,
+            'lowest_price': float(r.effective_price),
+            'lowest_store': r.business_name,
+            'lowest_product': r.product_title,
+            'lowest_is_discounted': r.discount_price is not None,
+            'lowest_base_price': float(r.base_price) if r.base_price else None,
+            'lowest_actual_saving': lowest_actual_saving,
+            'best_saving': float(r.best_saving or 0),  # Best savings for this term
+            'highest_price': float(r.highest_price),
+            'highest_store': r.highest_store
         })
 
     # Sort terms by those with new products/discounts first
     terms.sort(key=lambda x: (-x['new_count'], -x['discount_count'], x['search_term']))
 
+    first = rows[0]
     return {
-        'total_products': scan.total_products_found or 0,
-        'new_products': scan.new_products_count or 0,
-        'new_discounts': scan.new_discounts_count or 0,
+        'total_products': first.total_products_found or 0,
+        'new_products': first.new_products_count or 0,
+        'new_discounts': first.new_discounts_count or 0,
         'terms': terms
     }
 
 
+def iter_scan_summaries(user_ids: list, scan_date: date, chunk_size: int = SUMMARY_CHUNK_SIZE):
+    """
+    Scan summaries grouped by tracked product term, one query per chunk of users.
+
+    Only exact matches (EMAIL_MATCH_THRESHOLD) are included, so emails don't
+    show wrong products (e.g., "Cherry Vanilla" for "Original Taste").
+
+    Yields (user_id, summary) in the order of user_ids; summary is None when
+    the user has no completed scan on scan_date. Summary dict:
+    - total_products: int
+    - new_products: int
+    - new_discounts: int
+    - terms: list of term summaries
+    """
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = list(user_ids[start:start + chunk_size])
+        rows = db.session.execute(SCAN_SUMMARY_SQL, {
+            'user_ids': chunk,
+            'scan_date': scan_date,
+            'threshold': EMAIL_MATCH_THRESHOLD,
+        }).all()
+        by_user = {user_id: list(user_rows) for user_id, user_rows in groupby(rows, key=lambda r: r.user_id)}
+        for user_id in chunk:
+            user_rows = by_user.get(user_id)
+            yield user_id, _build_scan_summary(user_rows) if user_rows else None
+
+
+def get_scan_summary_for_user(user_id: int, scan_date: date) -> dict:
+    """Scan summary for one user (see iter_scan_summaries), or None"""
+    return next(iter_scan_summaries([user_id], scan_date))[1]
+
+
 def generate_scan_email_html(user_name: str, summary: dict) -> str:
     """Generate HTML email for scan summary."""
     logo_url = get_logo_url()
@@ -272,8 +269,8 @@ def generate_scan_email_html(user_name: str, summary: dict) -> str:
     return html_content
 
 
-def send_scan_summary_email(user: User, summary: dict) -> bool:
-    """Send scan summary email to a user."""
+def should_send_scan_summary(user: User, summary: dict) -> bool:
+    """Whether the user wants this email and it has something new in it."""
     if not user.email:
         logger.warning(f"User {user.id} has no email address")
         return False
@@ -297,6 +294,14 @@ def send_scan_summary_email(user: User, summary: dict) -> bool:
         logger.info(f"User {user.id}: no new products or discounts, skipping email")
         return False
 
+    return True
+
+
+def send_scan_summary_email(user: User, summary: dict) -> bool:
+    """Send scan summary email to a user."""
+    if not should_send_scan_summary(user, summary):
+        return False
+
     user_name = user.first_name or user.email.split('@')[0]
 
     # Use SendGrid template
@@ -347,16 +352,17 @@ def run_email_summaries():
             )
             logger.info(f"Found {len(already_emailed_today)} users/{len(already_emailed_addresses)} emails already emailed today")
 
-            sent_count = 0
             skipped_count = 0
-            failed_count = 0
-            emailed_user_ids = set()  # Track users emailed in this run
             emailed_addresses = set()  # Track email addresses emailed in this run
 
-            processed_count = 0
-            for scan in completed_scans:
-                processed_count += 1
-                user = User.query.get(scan.user_id)
+            # One query for all scanned users instead of one per scan (deduplicated,
+            # so each user is considered once per run)
+            scan_user_ids = list(dict.fromkeys(scan.user_id for scan in completed_scans))
+            users_by_id = {user.id: user for user in User.query.filter(User.id.in_(scan_user_ids)).all()}
+
+            candidate_ids = []
+            for user_id in scan_user_ids:
+                user = users_by_id.get(user_id)
                 if not user or not user.email:
                     continue
 
@@ -366,8 +372,6 @@ def run_email_summaries():
                     skipped_count += 1
                     continue
 
-                user_email_lower = user.email.lower()
-
                 # Skip if user already received email today (daily or weekly)
                 if user.id in already_emailed_today:
                     logger.debug(f"User {user.id} already received daily/weekly email today, skipping")
@@ -375,79 +379,60 @@ def run_email_summaries():
                     continue
 
                 # Skip if email address already received email today (handles race conditions)
-                if user_email_lower in already_emailed_addresses:
+                if user.email.lower() in already_emailed_addresses:
                     logger.debug(f"Email {user.email} already received email today, skipping user {user.id}")
                     skipped_count += 1
                     continue
 
-                # Skip if we already emailed this user in this job run
-                if user.id in emailed_user_ids:
-                    logger.debug(f"User {user.id} already processed in this run, skipping")
-                    skipped_count += 1
-                    continue
+                candidate_ids.append(user_id)
 
-                # Skip if we already emailed this email address in this job run
-                if user_email_lower in emailed_addresses:
-                    logger.debug(f"Email {user.email} already processed in this run, skipping user {user.id}")
-                    skipped_count += 1
-                    continue
+            dispatcher = BulkEmailDispatcher('daily_scan')
 
-                # Get summary
-                summary = get_scan_summary_for_user(user.id, today)
-                if not summary or summary['total_products'] == 0:
-                    skipped_count += 1
-                    continue
+            def messages():
+                """Summaries are built chunk by chunk while earlier ones are being sent"""
+                nonlocal skipped_count
+                for user_id, summary in iter_scan_summaries(candidate_ids, today):
+                    user = users_by_id[user_id]
+                    if not summary or summary['total_products'] == 0:
+                        skipped_count += 1
+                        continue
 
-                # Send email
-                try:
-                    if send_scan_summary_email(user, summary):
-                        emailed_user_ids.add(user.id)  # Mark as emailed
-                        emailed_addresses.add(user_email_lower)  # Track email address too
-                        sent_count += 1
-
-                        # Log the email notification
-                        EmailNotification.log_email(
-                            email=user.email,
-                            email_type='daily_scan',
-                            subject=f"Dnevni pregled - {summary['total_products']} proizvoda pronađeno",
-                            user_id=user.id,
-                            status='sent',
-                            extra_data={
-                                'total_products': summary['total_products'],
-                                'new_products': summary['new_products'],
-                                'new_discounts': summary['new_discounts'],
-                                'terms_count': len(summary['terms'])
-                            }
-                        )
-
-                        # Rate limit between emails
-                        time.sleep(DELAY_BETWEEN_EMAILS)
-                    else:
+                    # Skip if we already emailed this email address in this job run
+                    user_email_lower = user.email.lower()
+                    if user_email_lower in emailed_addresses:
+                        logger.debug(f"Email {user.email} already processed in this run, skipping user {user.id}")
                         skipped_count += 1
-                except Exception as e:
-                    logger.error(f"Error sending email to user {user.id}: {e}")
-                    failed_count += 1
+                        continue
+
+                    if not should_send_scan_summary(user, summary):
+                        skipped_count += 1
+                        continue
+
+                    try:
+                        user_name = user.first_name or user.email.split('@')[0]
+                        subject, html = render_scan_summary_email(user_name, summary)
+                    except Exception as e:
+                        logger.error(f"Error building email for user {user.id}: {e}")
+                        dispatcher.fail(user.email, e, user_id=user.id)
+                        continue
 
-                    # Log failed email
-                    EmailNotification.log_email(
-                        email=user.email if user else 'unknown',
-                        email_type='daily_scan',
-                        user_id=user.id if user else None,
-                        status='failed',
-                        error_message=str(e)
-                    )
+                    emailed_addresses.add(user_email_lower)
+                    yield OutgoingEmail(user.email, subject, html, user.id, {
+                        'total_products': summary['total_products'],
+                        'new_products': summary['new_products'],
+                        'new_discounts': summary['new_discounts'],
+                        'terms_count': len(summary['terms'])
+                    })
 
-                # Log progress every N emails
-                if processed_count % EMAIL_BATCH_SIZE == 0:
-                    logger.info(f"Progress: {processed_count}/{len(completed_scans)} processed, {sent_count} sent")
+            result = dispatcher.send_each(messages())
 
-            logger.info(f"Email summary job complete: {sent_count} sent, {skipped_count} skipped, {failed_count} failed")
+            logger.info(f"Email summary job complete: {result.sent} sent, {skipped_count} skipped, {result.failed} failed")
 
             # Complete job tracking
             job_run.complete(
                 records_processed=len(completed_scans),
-                records_success=sent_count,
-                records_failed=failed_count
+                records_success=result.sent,
+                records_failed=result.failed
             )
 
         except Exception as e:
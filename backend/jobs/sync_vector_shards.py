@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Keep the per-store vector indexes (shards) in line with the catalog.
+
+Creates a partial ivfflat index on product_embeddings for each business with
+enough embeddings, rebuilds shards whose size changed enough that their list
+count no longer fits, and drops shards of businesses that shrank (see
+vector_shards.py). Store-filtered searches use the shards to retrieve only
+the selected stores' nearest products.
+
+Schedule: Nightly at 5:00 AM UTC (0 5 * * *) - before the morning product scan
+Command: python jobs/sync_vector_shards.py [--min-products N] [--dry-run]
+"""
+
+import os
+import sys
+import argparse
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from models import JobRun
+from vector_shards import SHARD_MIN_PRODUCTS, sync_shard_indexes
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def sync_vector_shards(min_products=SHARD_MIN_PRODUCTS, dry_run=False):
+    """Create/rebuild/drop shard indexes; returns the sync summary"""
+    with app.app_context():
+        job_run = None if dry_run else JobRun.start('vector_shards')
+        try:
+            summary = sync_shard_indexes(min_products=min_products, dry_run=dry_run)
+            changed = sum(len(ids) for ids in summary.values())
+            logger.info(f"Vector shards{' (dry run)' if dry_run else ''}: "
+                        f"created {summary['created']}, rebuilt {summary['rebuilt']}, dropped {summary['dropped']}")
+            if job_run:
+                job_run.complete(records_processed=changed, records_success=changed)
+            return summary
+
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Vector shard sync failed: {e}")
+            if job_run:
+                job_run.fail(str(e))
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync per-store vector indexes')
+    parser.add_argument('--min-products', type=int, default=SHARD_MIN_PRODUCTS)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    sync_vector_shards(args.min_products, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,26 +14,21 @@ Command: python jobs/weekly_activation.py
 
 import os
 import sys
-import time
 from datetime import datetime, timedelta
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app, db
-from models import User, UserTrackedProduct, UserScanResult, JobRun, EmailNotification
-from sendgrid_utils import send_activation_email
+from models import User, UserTrackedProduct, UserScanResult, JobRun
+from sendgrid_utils import render_activation_email
+from bulk_email import BulkEmailDispatcher, Recipient, SharedTemplate
 from sqlalchemy import func, distinct
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configuration
-EMAIL_BATCH_SIZE = 10
-DELAY_BETWEEN_EMAILS = 0.5
-
-
 def get_users_without_tracking() -> list:
     """Get users who have NO active tracked products but haven't disabled emails."""
     # Get all user IDs that have active tracked products
@@ -176,60 +171,25 @@ def run_activation_emails(force: bool = False):
             example_savings = get_platform_savings_example()
             logger.info(f"Example savings data: avg={example_savings['avg_weekly_savings']:.2f} KM")
 
-            sent_count = 0
-            skipped_count = 0
-            failed_count = 0
-            processed_count = 0
-
-            for user in users:
-                processed_count += 1
-
-                try:
-                    user_name = user.first_name or user.email.split('@')[0]
-
-                    if send_activation_email(user.email, user_name, example_savings):
-                        sent_count += 1
-
-                        # Log the email
-                        EmailNotification.log_email(
-                            email=user.email,
-                            email_type='activation',
-                            subject=f"Uštedjeli biste {example_savings['avg_weekly_savings']:.2f} KM ove sedmice",
-                            user_id=user.id,
-                            status='sent',
-                            extra_data={
-                                'avg_savings': example_savings['avg_weekly_savings'],
-                                'example_products_count': len(example_savings['example_products'])
-                            }
-                        )
-
-                        # Rate limit
-                        time.sleep(DELAY_BETWEEN_EMAILS)
-                    else:
-                        failed_count += 1
-
-                except Exception as e:
-                    logger.error(f"Error sending activation email to user {user.id}: {e}")
-                    failed_count += 1
-
-                    EmailNotification.log_email(
-                        email=user.email if user.email else 'unknown',
-                        email_type='activation',
-                        user_id=user.id,
-                        status='failed',
-                        error_message=str(e)
-                    )
-
-                # Log progress
-                if processed_count % EMAIL_BATCH_SIZE == 0:
-                    logger.info(f"Progress: {processed_count}/{len(users)} processed, {sent_count} sent")
-
-            logger.info(f"Activation email job complete: {sent_count} sent, {skipped_count} skipped, {failed_count} failed")
+            # Same content for everyone - rendered once, sent in personalization batches
+            extra_data = {
+                'avg_savings': example_savings['avg_weekly_savings'],
+                'example_products_count': len(example_savings['example_products'])
+            }
+            recipients = [
+                Recipient(user.email, user.first_name or user.email.split('@')[0], user.id, extra_data)
+                for user in users
+            ]
+            result = BulkEmailDispatcher('activation').send_shared(
+                SharedTemplate(render_activation_email, example_savings), recipients
+            )
+
+            logger.info(f"Activation email job complete: {result.sent} sent, {result.failed} failed")
 
             job_run.complete(
                 records_processed=len(users),
-                records_success=sent_count,
-                records_failed=failed_count
+                records_success=result.sent,
+                records_failed=result.failed
             )
 
         except Exception as e:
@@ -16,27 +16,23 @@ Command: python jobs/weekly_summary.py
 
 import os
 import sys
-import time
 from datetime import datetime, timedelta
+from itertools import groupby
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import app, db
-from models import User, UserProductScan, UserScanResult, UserTrackedProduct, JobRun, EmailNotification
-from sendgrid_utils import send_weekly_summary_email
+from models import User, UserTrackedProduct, JobRun
+from sendgrid_utils import render_weekly_summary_email
+from bulk_email import BulkEmailDispatcher, OutgoingEmail
 from preference_config import EMAIL_MATCH_THRESHOLD
-from sqlalchemy import func, distinct
+from sqlalchemy import distinct, text
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configuration
-EMAIL_BATCH_SIZE = 10  # Log progress every N emails
-DELAY_BETWEEN_EMAILS = 0.5  # Seconds between emails
-
-
 def get_users_with_tracking() -> list:
     """Get users who have active tracked products and weekly emails enabled."""
     # Get user IDs that have tracked products
@@ -77,224 +73,227 @@ def get_users_with_tracking() -> list:
     return eligible_users
 
 
-def get_weekly_summary_for_user(user_id: int) -> dict:
-    """
-    Get comprehensive weekly summary for a user's tracked products.
-
-    Returns dict with:
-    - total_products: Number of tracked terms
-    - total_matches: Total products found
-    - total_savings: Potential savings (sum of ALL discounted products)
-    - best_deals: Top 3 deals by discount percentage
-    - tracked_items: Top 2 products per tracked term
-    - price_drops: Products that dropped in price this week
-    - new_products: New products discovered this week
-    - terms_count: Number of terms with matches
-    - max_price_diff_percent: Highest % price difference found between stores
-    - best_value_category: Category with highest price spread (best to track)
-    - category_insights: List of categories with their max % differences
-    """
-    # Get user's tracked products
-    tracked_products = UserTrackedProduct.query.filter_by(
-        user_id=user_id,
-        is_active=True
-    ).all()
-
-    if not tracked_products:
-        return None
-
-    # Get scans from the past 7 days
-    week_ago = datetime.now().date() - timedelta(days=7)
-
-    scans = UserProductScan.query.filter(
-        UserProductScan.user_id == user_id,
-        UserProductScan.scan_date >= week_ago,
-        UserProductScan.status == 'completed'
-    ).all()
-
-    if not scans:
-        # Try to get the most recent scan
-        latest_scan = UserProductScan.query.filter(
-            UserProductScan.user_id == user_id,
-            UserProductScan.status == 'completed'
-        ).order_by(UserProductScan.scan_date.desc()).first()
-
-        if latest_scan:
-            scans = [latest_scan]
-        else:
-            return None
-
-    scan_ids = [s.id for s in scans]
-
-    # Get all results from these scans
-    results = UserScanResult.query.filter(
-        UserScanResult.scan_id.in_(scan_ids)
-    ).all()
-
-    if not results:
-        return None
-
-    # Group results by tracked product for deduplication
-    # Use the most recent result for each product_id per tracked_product_id
-    product_map = {}  # (tracked_product_id, product_id) -> result
-    for result in results:
-        key = (result.tracked_product_id, result.product_id)
-        if key not in product_map or result.created_at > product_map[key].created_at:
-            product_map[key] = result
-
-    unique_results = list(product_map.values())
-
-    # Calculate statistics
+SUMMARY_CHUNK_SIZE = 500  # Users per summary query
+HERO_MIN_SIMILARITY = 0.9
+
+# One row per (user, term) price leader, best deal, hero candidate, new product
+# and price drop - plus the per-term and per-user aggregates - for a chunk of
+# users. Window functions do what the per-user version did in Python:
+#   chosen:    the user's completed scans from the last 7 days, else their latest one
+#   deduped:   latest result per (tracked product, product)
+#   filtered:  per term, only results at EMAIL_MATCH_THRESHOLD if there are any
+#   ranked:    price rank, best deal, hero deal, savings and price spread per term
+WEEKLY_SUMMARY_SQL = text("""
+WITH tracked AS (
+    SELECT user_id, COUNT(*) AS total_products
+    FROM user_tracked_products
+    WHERE user_id = ANY(:user_ids) AND is_active = true
+    GROUP BY user_id
+),
+scans AS (
+    SELECT s.id, s.user_id, s.scan_date >= :week_ago AS in_week,
+           BOOL_OR(s.scan_date >= :week_ago) OVER (PARTITION BY s.user_id) AS has_week,
+           ROW_NUMBER() OVER (PARTITION BY s.user_id ORDER BY s.scan_date DESC, s.id DESC) AS recency
+    FROM user_product_scans s
+    JOIN tracked ON tracked.user_id = s.user_id
+    WHERE s.status = 'completed'
+),
+chosen AS (
+    SELECT id, user_id FROM scans WHERE in_week OR (NOT has_week AND recency = 1)
+),
+deduped AS (
+    SELECT c.user_id, r.id, r.tracked_product_id, r.product_title, r.business_name, r.similarity_score,
+           r.base_price, r.discount_price, r.is_new_today, r.price_dropped_today,
+           ROW_NUMBER() OVER (
+               PARTITION BY c.user_id, r.tracked_product_id, r.product_id
+               ORDER BY r.created_at DESC NULLS LAST, r.id
+           ) AS dup
+    FROM chosen c
+    JOIN user_scan_results r ON r.scan_id = c.id
+),
+unique_results AS (
+    SELECT d.*, t.search_term AS term,
+           COUNT(*) OVER (PARTITION BY d.user_id) AS total_matches,
+           COALESCE(NULLIF(d.discount_price, 0), NULLIF(d.base_price, 0)) AS effective_price,
+           CASE WHEN d.discount_price > 0 AND d.discount_price < d.base_price
+                THEN d.base_price - d.discount_price END AS savings,
+           BOOL_OR(COALESCE(d.similarity_score, 0) >= :threshold)
+               OVER (PARTITION BY d.user_id, t.search_term) AS term_has_relevant
+    FROM deduped d
+    JOIN user_tracked_products t ON t.id = d.tracked_product_id
+    WHERE d.dup = 1
+),
+filtered AS (
+    SELECT u.*,
+           u.savings IS NOT NULL AND COALESCE(u.similarity_score, 0) >= :hero_similarity AS hero_candidate
+    FROM unique_results u
+    WHERE NOT u.term_has_relevant OR COALESCE(u.similarity_score, 0) >= :threshold
+),
+ranked AS (
+    SELECT f.*,
+           ROW_NUMBER() OVER w_term_by_price AS price_rank,
+           ROW_NUMBER() OVER (
+               PARTITION BY f.user_id, f.term, f.savings IS NOT NULL
+               ORDER BY f.effective_price NULLS LAST, f.id
+           ) AS deal_rank,
+           ROW_NUMBER() OVER (
+               PARTITION BY f.user_id, f.hero_candidate ORDER BY f.savings DESC NULLS LAST, f.id
+           ) AS hero_rank,
+           ROW_NUMBER() OVER (
+               PARTITION BY f.user_id, f.is_new_today ORDER BY f.term, f.effective_price NULLS LAST, f.id
+           ) AS new_rank,
+           ROW_NUMBER() OVER (
+               PARTITION BY f.user_id, f.price_dropped_today ORDER BY f.term, f.effective_price NULLS LAST, f.id
+           ) AS drop_rank,
+           COALESCE(SUM(f.savings) OVER (PARTITION BY f.user_id), 0) AS total_savings,
+           MIN(f.effective_price) OVER w_term AS term_min_price,
+           MAX(f.effective_price) OVER w_term AS term_max_price,
+           COUNT(f.effective_price) OVER w_term AS term_priced
+    FROM filtered f
+    WINDOW w_term AS (PARTITION BY f.user_id, f.term),
+           w_term_by_price AS (PARTITION BY f.user_id, f.term ORDER BY f.effective_price NULLS LAST, f.id)
+)
+SELECT r.*, tracked.total_products
+FROM ranked r
+JOIN tracked ON tracked.user_id = r.user_id
+WHERE r.price_rank <= 2
+   OR (r.savings IS NOT NULL AND r.deal_rank = 1)
+   OR (r.hero_candidate AND r.hero_rank = 1)
+   OR (r.is_new_today AND r.new_rank <= 5)
+   OR (r.price_dropped_today AND r.drop_rank <= 5)
+ORDER BY r.user_id, r.term, r.price_rank
+""")
+
+
+def _build_weekly_summary(rows: list) -> dict:
+    """Summary dict for one user from their WEEKLY_SUMMARY_SQL rows"""
+    first = rows[0]
     best_deals = []
     tracked_items = []
     price_drops = []
     new_products = []
-    total_savings = 0
-    terms_with_matches = set()
-    hero_deal = None  # Track the single best deal with high confidence (90%+ match)
-    category_price_spreads = {}  # Track max price spread per category for insights
+    hero_deal = None  # Single best deal with high confidence (90%+ match)
+    category_price_spreads = []  # Price spread per term for insights
     max_price_diff_percent = 0  # Global max % price difference
 
-    # Group by tracked term
-    term_results = {}
-    for result in unique_results:
-        tracked = UserTrackedProduct.query.get(result.tracked_product_id)
-        if not tracked:
-            continue
-
-        term = tracked.search_term
-        terms_with_matches.add(term)
-
-        if term not in term_results:
-            term_results[term] = []
-        term_results[term].append(result)
-
-    # Process each term
-    for term, results in term_results.items():
-        # Filter out low-relevance results - require 100% match for email reports
-        # This prevents showing wrong products (e.g., "Cherry Vanilla" for "Original Taste")
-        relevant_results = [r for r in results if (r.similarity_score or 0) >= EMAIL_MATCH_THRESHOLD]
-        if relevant_results:
-            results = relevant_results
-
-        # Sort by effective price (discount_price if available, else base_price)
-        def get_effective_price(r):
-            return float(r.discount_price or r.base_price or 999999)
-
-        results.sort(key=get_effective_price)
+    for r in rows:
+        term = r.term
 
         # Top 2 per term for tracked_items
-        for i, result in enumerate(results[:2]):
-            effective_price = result.discount_price or result.base_price
-            if effective_price:
-                tracked_items.append({
-                    'product': f"[{term}] {result.product_title[:40]}..." if len(result.product_title or '') > 40 else f"[{term}] {result.product_title or ''}",
-                    'store': result.business_name or '',
-                    'current_price': float(effective_price),
-                    'price_change': 0  # Would need historical data to calculate
-                })
-
-        # Best deal per term (for best_deals list) and calculate ALL savings
-        best_deal_added = False
-        for result in results:
-            if result.discount_price and result.base_price and result.discount_price < result.base_price:
-                savings = float(result.base_price - result.discount_price)
-                savings_pct = (savings / float(result.base_price)) * 100
-                similarity = result.similarity_score or 0
-
-                # Add ALL discounted products to total_savings
-                total_savings += savings
-
-                # Track hero_deal: highest absolute savings with 90%+ match
-                if similarity >= 0.9:
-                    if hero_deal is None or savings > hero_deal['savings_amount']:
-                        hero_deal = {
-                            'product': result.product_title or '',
-                            'store': result.business_name or '',
-                            'original_price': float(result.base_price),
-                            'discount_price': float(result.discount_price),
-                            'savings_percent': savings_pct,
-                            'savings_amount': savings,
-                            'similarity_score': similarity
-                        }
-
-                # Only add the best deal (first one, lowest price) to best_deals list
-                if not best_deal_added:
-                    best_deals.append({
-                        'product': result.product_title or '',
-                        'store': result.business_name or '',
-                        'original_price': float(result.base_price),
-                        'discount_price': float(result.discount_price),
-                        'savings_percent': savings_pct,
-                        'savings_amount': savings
-                    })
-                    best_deal_added = True
-
-        # Collect price drops and new products
-        for result in results:
-            if result.price_dropped_today:
-                price_drops.append({
-                    'product': result.product_title or '',
-                    'store': result.business_name or '',
-                    'drop_amount': float(result.base_price - (result.discount_price or result.base_price)) if result.base_price else 0
-                })
-
-            if result.is_new_today:
-                effective_price = result.discount_price or result.base_price
-                new_products.append({
-                    'product': result.product_title or '',
-                    'store': result.business_name or '',
-                    'price': float(effective_price) if effective_price else 0
-                })
-
-        # Calculate price spread for this term/category
-        effective_prices = [float(r.discount_price or r.base_price or 0) for r in results if (r.discount_price or r.base_price)]
-        if len(effective_prices) >= 2:
-            min_price = min(effective_prices)
-            max_price = max(effective_prices)
-            if min_price > 0:
-                price_diff_percent = ((max_price - min_price) / min_price) * 100
-                category_price_spreads[term] = {
-                    'term': term,
-                    'min_price': min_price,
-                    'max_price': max_price,
-                    'price_diff_percent': price_diff_percent
-                }
-                if price_diff_percent > max_price_diff_percent:
-                    max_price_diff_percent = price_diff_percent
+        if r.price_rank <= 2 and r.effective_price:
+            title = r.product_title or ''
+            tracked_items.append({
+                'product': f"[{term}] {title[:40]}..." if len(title) > 40 else f"[{term}] {title}",
+                'store': r.business_name or '',
+                'current_price': float(r.effective_price),
+                'price_change': 0  # Would need historical data to calculate
+            })
+
+        if r.savings is not None:
+            savings = float(r.savings)
+            deal = {
+                'product': r.product_title or '',
+                'store': r.business_name or '',
+                'original_price': float(r.base_price),
+                'discount_price': float(r.discount_price),
+                'savings_percent': (savings / float(r.base_price)) * 100,
+                'savings_amount': savings
+            }
+            # Lowest-priced discounted product per term
+            if r.deal_rank == 1:
+                best_deals.append(deal)
+            # Highest absolute savings with 90%+ match
+            if r.hero_candidate and r.hero_rank == 1:
+                hero_deal = {**deal, 'similarity_score': r.similarity_score or 0}
+
+        if r.price_dropped_today and r.drop_rank <= 5:
+            price_drops.append({
+                'product': r.product_title or '',
+                'store': r.business_name or '',
+                'drop_amount': float(r.base_price - (r.discount_price or r.base_price)) if r.base_price else 0
+            })
+
+        if r.is_new_today and r.new_rank <= 5:
+            new_products.append({
+                'product': r.product_title or '',
+                'store': r.business_name or '',
+                'price': float(r.effective_price) if r.effective_price else 0
+            })
+
+        # Price spread for this term/category (once per term)
+        if r.price_rank == 1 and r.term_priced >= 2 and r.term_min_price > 0:
+            min_price, max_price = float(r.term_min_price), float(r.term_max_price)
+            price_diff_percent = ((max_price - min_price) / min_price) * 100
+            category_price_spreads.append({
+                'term': term,
+                'min_price': min_price,
+                'max_price': max_price,
+                'price_diff_percent': price_diff_percent
+            })
+            max_price_diff_percent = max(max_price_diff_percent, price_diff_percent)
 
     # Sort best deals by savings percentage
     best_deals.sort(key=lambda x: x['savings_percent'], reverse=True)
 
     # Find best value category (highest price spread)
-    best_value_category = None
-    category_insights = []
-    if category_price_spreads:
-        sorted_categories = sorted(
-            category_price_spreads.values(),
-            key=lambda x: x['price_diff_percent'],
-            reverse=True
-        )
-        if sorted_categories:
-            best_value_category = sorted_categories[0]['term']
-            category_insights = sorted_categories[:3]  # Top 3 categories by price spread
+    category_insights = sorted(category_price_spreads, key=lambda x: x['price_diff_percent'], reverse=True)[:3]
 
     return {
-        'total_products': len(tracked_products),
-        'total_matches': len(unique_results),
-        'total_savings': total_savings,
+        'total_products': first.total_products,
+        'total_matches': first.total_matches,
+        'total_savings': float(first.total_savings),
         'best_deals': best_deals[:3],
         'tracked_items': tracked_items[:10],
         'price_drops': price_drops[:5],
         'new_products': new_products[:5],
-        'terms_count': len(terms_with_matches),
+        'terms_count': sum(1 for r in rows if r.price_rank == 1),  # Every term has a price leader
         'hero_deal': hero_deal,  # Single best deal with 90%+ match, highest absolute savings
         'max_price_diff_percent': max_price_diff_percent,
-        'best_value_category': best_value_category,
-        'category_insights': category_insights
+        'best_value_category': category_insights[0]['term'] if category_insights else None,
+        'category_insights': category_insights  # Top 3 categories by price spread
     }
 
 
+def iter_weekly_summaries(user_ids: list, chunk_size: int = SUMMARY_CHUNK_SIZE):
+    """
+    Weekly summaries for many users, one query per chunk of users.
+
+    Yields (user_id, summary) in the order of user_ids; summary is None when
+    the user has no active tracked products or no scan results.
+
+    Summary dict:
+    - total_products: Number of tracked terms
+    - total_matches: Total products found
+    - total_savings: Potential savings (sum of ALL discounted products)
+    - best_deals: Top 3 deals by discount percentage
+    - tracked_items: Top 2 products per tracked term
+    - price_drops: Products that dropped in price this week
+    - new_products: New products discovered this week
+    - terms_count: Number of terms with matches
+    - max_price_diff_percent: Highest % price difference found between stores
+    - best_value_category: Category with highest price spread (best to track)
+    - category_insights: List of categories with their max % differences
+    """
+    week_ago = datetime.now().date() - timedelta(days=7)
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = list(user_ids[start:start + chunk_size])
+        rows = db.session.execute(WEEKLY_SUMMARY_SQL, {
+            'user_ids': chunk,
+            'week_ago': week_ago,
+            'threshold': EMAIL_MATCH_THRESHOLD,
+            'hero_similarity': HERO_MIN_SIMILARITY,
+        }).all()
+        by_user = {user_id: list(user_rows) for user_id, user_rows in groupby(rows, key=lambda r: r.user_id)}
+        for user_id in chunk:
+            user_rows = by_user.get(user_id)
+            yield user_id, _build_weekly_summary(user_rows) if user_rows else None
+
+
+def get_weekly_summary_for_user(user_id: int) -> dict:
+    """Weekly summary for one user (see iter_weekly_summaries), or None"""
+    return next(iter_weekly_summaries([user_id]))[1]
+
+
 def run_weekly_summaries(force: bool = False):
     """Send weekly summary emails to all users with tracked products.
 
@@ -320,68 +319,42 @@ def run_weekly_summaries(force: bool = False):
                 job_run.complete(records_processed=0, records_success=0, records_failed=0)
                 return
 
-            sent_count = 0
+            dispatcher = BulkEmailDispatcher('weekly_summary')
             skipped_count = 0
-            failed_count = 0
-            processed_count = 0
 
-            for user in users:
-                processed_count += 1
-
-                try:
-                    # Get weekly summary
-                    summary = get_weekly_summary_for_user(user.id)
+            def messages():
+                """Summaries are built chunk by chunk while earlier ones are being sent"""
+                nonlocal skipped_count
+                users_by_id = {user.id: user for user in users}
+                for user_id, summary in iter_weekly_summaries(list(users_by_id)):
+                    user = users_by_id[user_id]
                     if not summary or summary['total_matches'] == 0:
                         skipped_count += 1
                         continue
 
-                    user_name = user.first_name or user.email.split('@')[0]
-
-                    if send_weekly_summary_email(user.email, user_name, summary):
-                        sent_count += 1
-
-                        # Log the email
-                        EmailNotification.log_email(
-                            email=user.email,
-                            email_type='weekly_summary',
-                            subject=f"Sedmični pregled: {summary['total_products']} artikala",
-                            user_id=user.id,
-                            status='sent',
-                            extra_data={
-                                'total_products': summary['total_products'],
-                                'total_matches': summary['total_matches'],
-                                'best_deals_count': len(summary['best_deals']),
-                                'price_drops_count': len(summary['price_drops'])
-                            }
-                        )
-
-                        # Rate limit
-                        time.sleep(DELAY_BETWEEN_EMAILS)
-                    else:
-                        failed_count += 1
-
-                except Exception as e:
-                    logger.error(f"Error sending weekly summary to user {user.id}: {e}")
-                    failed_count += 1
-
-                    EmailNotification.log_email(
-                        email=user.email if user.email else 'unknown',
-                        email_type='weekly_summary',
-                        user_id=user.id,
-                        status='failed',
-                        error_message=str(e)
-                    )
-
-                # Log progress
-                if processed_count % EMAIL_BATCH_SIZE == 0:
-                    logger.info(f"Progress: {processed_count}/{len(users)} processed, {sent_count} sent")
-
-            logger.info(f"Weekly summary job complete: {sent_count} sent, {skipped_count} skipped, {failed_count} failed")
+                    try:
+                        user_name = user.first_name or user.email.split('@')[0]
+                        subject, html = render_weekly_summary_email(user_name, summary)
+                    except Exception as e:
+                        logger.error(f"Error building weekly summary for user {user.id}: {e}")
+                        dispatcher.fail(user.email, e, user_id=user.id)
+                        continue
+
+                    yield OutgoingEmail(user.email, subject, html, user.id, {
+                        'total_products': summary['total_products'],
+                        'total_matches': summary['total_matches'],
+                        'best_deals_count': len(summary['best_deals']),
+                        'price_drops_count': len(summary['price_drops'])
+                    })
+
+            result = dispatcher.send_each(messages())
+
+            logger.info(f"Weekly summary job complete: {result.sent} sent, {skipped_count} skipped, {result.failed} failed")
 
             job_run.complete(
                 records_processed=len(users),
-                records_success=sent_count,
-                records_failed=failed_count
+                records_success=result.sent,
+                records_failed=result.failed
             )
 
         except Exception as e:
@@ -0,0 +1,211 @@
+"""
+Process-wide OpenAI client registry.
+
+Every LLM and embedding call goes through one client per process:
+- A single pooled httpx transport, so calls from all request threads and
+  worker pools reuse keep-alive TLS connections instead of each module
+  holding its own client and pool.
+- Explicit connect/read timeouts (the SDK default read timeout is 10 minutes).
+- A semaphore per model capping in-flight calls, so a burst (bulk jobs,
+  gthread workers) queues locally instead of stampeding the rate limit.
+- Retry with exponential backoff on 429/5xx/connection errors (honours
+  Retry-After). The SDK's own retries are off: a slot is held per attempt
+  only, so calls sleeping through a 429 backoff don't starve everyone else.
+  Call sites should not add retry loops of their own.
+- Every create() is recorded by llm_usage (model, call site, latency
+  including the wait for a slot, tokens, errors).
+
+The real client is created on first use, so importing a module that grabs
+get_openai_client() at import time is cheap and fork-safe (gunicorn), and
+benchmarks can swap openai.OpenAI before the first call.
+
+Environment:
+    OPENAI_API_KEY            API key
+    OPENAI_TIMEOUT            Read timeout in seconds (default: 60)
+    OPENAI_CONNECT_TIMEOUT    Connect timeout in seconds (default: 5)
+    OPENAI_MAX_RETRIES        Retries with backoff (default: 3)
+    OPENAI_MAX_CONNECTIONS    Pooled HTTP connections (default: 64)
+    OPENAI_CONCURRENCY        Default in-flight calls per model (default: 16)
+    OPENAI_MODEL_CONCURRENCY  Per-model overrides, e.g. "gpt-4o=4,text-embedding-3-small=32"
+    OPENAI_QUEUE_TIMEOUT      Max seconds to wait for a model slot (default: 120)
+"""
+
+import os
+import random
+import threading
+import time
+
+import httpx
+import openai
+
+from llm_usage import record_call, token_usage
+
+
+class LLMBusyError(RuntimeError):
+    """Raised when no concurrency slot for a model frees up in time"""
+
+
+def _parse_model_limits(value):
+    limits = {}
+    for part in (value or '').split(','):
+        if '=' in part:
+            model, limit = part.split('=', 1)
+            try:
+                limits[model.strip()] = int(limit)
+            except ValueError:
+                pass
+    return limits
+
+
+DEFAULT_CONCURRENCY = int(os.environ.get('OPENAI_CONCURRENCY', '16'))
+MODEL_CONCURRENCY = _parse_model_limits(os.environ.get('OPENAI_MODEL_CONCURRENCY'))
+QUEUE_TIMEOUT = float(os.environ.get('OPENAI_QUEUE_TIMEOUT', '120'))
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+RETRY_BASE_DELAY = 0.5      # seconds, doubled per attempt
+RETRY_MAX_DELAY = 8.0
+RETRY_AFTER_MAX = 60.0      # Cap on a server-requested Retry-After
+RETRYABLE_STATUS = (408, 409, 429)
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def model_slot(model):
+    """Semaphore bounding concurrent calls to one model"""
+    semaphore = _semaphores.get(model)
+    if semaphore is None:
+        with _semaphores_lock:
+            semaphore = _semaphores.get(model)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(MODEL_CONCURRENCY.get(model, DEFAULT_CONCURRENCY))
+                _semaphores[model] = semaphore
+    return semaphore
+
+
+def _is_retryable(error):
+    """Same policy as the SDK: connection errors/timeouts, 408, 409, 429 and 5xx"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retry `attempt` (0-based): Retry-After, else jittered backoff"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), RETRY_AFTER_MAX)
+        except ValueError:
+            pass
+    return min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY) * random.uniform(0.75, 1.0)
+
+
+def _limited(create):
+    """
+    Wrap an SDK create() so each attempt holds the model's slot, retryable
+    errors are retried with backoff outside the slot, and the call is logged.
+    """
+    def call(*args, **kwargs):
+        model = kwargs.get('model')
+        semaphore = model_slot(model or 'default')
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            if not semaphore.acquire(timeout=QUEUE_TIMEOUT):
+                error = LLMBusyError(f"Timed out waiting for an OpenAI slot for {model}")
+                record_call('openai', model, (time.perf_counter() - started) * 1000, error=error)
+                raise error
+            try:
+                response = create(*args, **kwargs)
+            except Exception as e:
+                if attempt >= MAX_RETRIES or not _is_retryable(e):
+                    record_call('openai', model, (time.perf_counter() - started) * 1000, error=e)
+                    raise
+                delay = _retry_delay(e, attempt)
+            else:
+                record_call('openai', model, (time.perf_counter() - started) * 1000, *token_usage(response))
+                return response
+            finally:
+                semaphore.release()
+            time.sleep(delay)  # Slot released, so other callers proceed meanwhile
+            attempt += 1
+    return call
+
+
+class _Resource:
+    """Proxy for client.chat.completions / client.embeddings with a limited create()"""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        attr = getattr(self._resolve(), name)
+        return _limited(attr) if name == 'create' else attr
+
+
+class _Chat:
+    def __init__(self, client):
+        self.completions = _Resource(lambda: client.raw.chat.completions)
+
+
+class RegistryClient:
+    """
+    OpenAI client facade used by every call site.
+
+    Supports client.chat.completions.create(...) and
+    client.embeddings.create(...) with per-model limits; any other attribute
+    is passed through to the underlying openai.OpenAI instance.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+        self.chat = _Chat(self)
+        self.embeddings = _Resource(lambda: self.raw.embeddings)
+
+    @property
+    def raw(self):
+        """The underlying openai.OpenAI (created on first use)"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = _build_client()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def _build_client():
+    timeout = httpx.Timeout(
+        float(os.environ.get('OPENAI_TIMEOUT', '60')),
+        connect=float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '5'))
+    )
+    max_connections = int(os.environ.get('OPENAI_MAX_CONNECTIONS', '64'))
+    http_client = httpx.Client(
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+    # openai.OpenAI looked up at call time so benchmarks can substitute a fake.
+    # Retries happen in _limited, outside the model slot.
+    return openai.OpenAI(
+        api_key=os.environ.get('OPENAI_API_KEY'),
+        timeout=timeout,
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+_registry_client = RegistryClient()
+
+
+def get_openai_client():
+    """Get the process-wide OpenAI client (safe to call at import time)"""
+    return _registry_client
+
+
+def is_configured():
+    """Whether an API key is available"""
+    return bool(os.environ.get('OPENAI_API_KEY'))
@@ -0,0 +1,219 @@
+"""
+Usage and latency log for LLM and embedding calls.
+
+Every call made through llm_clients (and the Anthropic receipt OCR path) is
+recorded in api_usage_logs: model, call site, the endpoint or job it served,
+latency, prompt/completion tokens and estimated cost. Cache hits that
+replaced a call (OCR result cache, image hash index) are recorded as well,
+with zero latency and cost, so hit rates show up next to the calls they save.
+
+Records are buffered in memory and written by a background thread as one
+multi-row INSERT every FLUSH_SECONDS (or as soon as FLUSH_SIZE records are
+waiting), so the request path never waits on the log. If the database is
+unavailable the batch is dropped with a warning - usage logging never fails
+the call it describes.
+
+Attribution:
+- call_site: first stack frame outside the client wrappers ("module.function")
+- feature: usage_context(feature=...) when set, otherwise the call site
+- endpoint: usage_context(endpoint=...), else the Flask endpoint of the
+  current request, else "job:<script>" for jobs/*.py, else "background"
+
+usage_context() is backed by a ContextVar. Thread pools do not inherit it;
+submit work with contextvars.copy_context().run to keep the attribution.
+
+Environment:
+    LLM_USAGE_LOGGING        '0' disables recording (default: '1')
+    LLM_USAGE_FLUSH_SECONDS  Max seconds a record waits in the buffer (default: 5)
+    LLM_USAGE_FLUSH_SIZE     Buffered records that trigger an early flush (default: 200)
+    LLM_USAGE_MAX_BUFFER     Max records waiting for a flush; oldest dropped beyond it (default: 10000)
+"""
+
+import atexit
+import contextvars
+import logging
+import os
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('LLM_USAGE_LOGGING', '1') != '0'
+FLUSH_SECONDS = float(os.environ.get('LLM_USAGE_FLUSH_SECONDS', '5'))
+FLUSH_SIZE = int(os.environ.get('LLM_USAGE_FLUSH_SIZE', '200'))
+MAX_BUFFER = int(os.environ.get('LLM_USAGE_MAX_BUFFER', '10000'))
+
+# Frames from these modules/packages are wrappers, not call sites
+_WRAPPER_MODULES = (
+    'llm_usage', 'llm_clients', 'agents.common.llm_utils',
+    'openai', 'httpx', 'anthropic', 'contextlib', 'concurrent', 'threading',
+)
+
+_scope = contextvars.ContextVar('llm_usage_scope', default={})
+
+
+@contextmanager
+def usage_context(**fields):
+    """
+    Attribute calls made inside the block.
+
+    Accepts feature, endpoint, receipt_id and user_id; None values keep the
+    enclosing scope's value.
+    """
+    scope = dict(_scope.get())
+    scope.update({key: value for key, value in fields.items() if value is not None})
+    token = _scope.set(scope)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not any(module == name or module.startswith(name + '.') for name in _WRAPPER_MODULES):
+            if module == '__main__':
+                module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+            return f"{module}.{frame.f_code.co_name}"[:100]
+        frame = frame.f_back
+    return 'unknown'
+
+
+def _endpoint(scope):
+    if scope.get('endpoint'):
+        return scope['endpoint']
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            return request.endpoint or request.path
+    except ImportError:
+        pass
+    # Standalone job scripts (python jobs/<name>.py)
+    script = getattr(sys.modules.get('__main__'), '__file__', None) or ''
+    if os.path.basename(os.path.dirname(script)) == 'jobs':
+        return f"job:{os.path.splitext(os.path.basename(script))[0]}"
+    return 'background'
+
+
+def token_usage(response):
+    """(prompt_tokens, completion_tokens) from an OpenAI response (embeddings have no completion)"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return 0, 0
+    return getattr(usage, 'prompt_tokens', 0) or 0, getattr(usage, 'completion_tokens', 0) or 0
+
+
+def _record(provider, model, response_time_ms, input_tokens, output_tokens, error, cache_hit, call_site):
+    if not ENABLED:
+        return
+    scope = _scope.get()
+    call_site = call_site or _call_site()
+    _buffer.add({
+        'provider': provider,
+        'model': model or 'unknown',
+        'feature': (scope.get('feature') or call_site)[:100],
+        'call_site': call_site,
+        'endpoint': _endpoint(scope)[:200],
+        'receipt_id': scope.get('receipt_id'),
+        'user_id': scope.get('user_id'),
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': input_tokens + output_tokens,
+        'success': error is None,
+        'error_message': str(error)[:1000] if error is not None else None,
+        'response_time_ms': int(response_time_ms),
+        'cache_hit': cache_hit,
+        'created_at': datetime.now(),
+    })
+
+
+def record_call(provider, model, response_time_ms, input_tokens=0, output_tokens=0, error=None, call_site=None):
+    """Record one API call (error set for failed calls)"""
+    _record(provider, model, response_time_ms, input_tokens, output_tokens, error, False, call_site)
+
+
+def record_cache_hit(model, provider='openai', call_site=None):
+    """Record a call that was answered from a cache instead of the API"""
+    _record(provider, model, 0, 0, 0, None, True, call_site)
+
+
+def _write(rows):
+    from sqlalchemy import insert
+    from app import app, db
+    from models import APIUsageLog
+
+    for row in rows:
+        cost = None if row['cache_hit'] else APIUsageLog.calculate_cost(
+            row['provider'], row['model'], row['input_tokens'], row['output_tokens']
+        )
+        row['estimated_cost_cents'] = Decimal(str(cost)) if cost else None
+
+    with app.app_context():
+        try:
+            db.session.execute(insert(APIUsageLog), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+class UsageBuffer:
+    """Thread-safe record buffer drained by a per-process flusher thread"""
+
+    def __init__(self):
+        self._rows = deque(maxlen=MAX_BUFFER)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            pending = len(self._rows)
+            # Started lazily and restarted after fork (threads don't survive it)
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='llm-usage-flush', daemon=True)
+                self._thread.start()
+        if pending >= FLUSH_SIZE:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(FLUSH_SECONDS)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered; returns the number of records written"""
+        with self._lock:
+            rows = list(self._rows)
+            self._rows.clear()
+        if not rows:
+            return 0
+        try:
+            _write(rows)
+        except Exception as e:
+            logger.warning(f"Dropped {len(rows)} LLM usage records: {e}")
+            return 0
+        return len(rows)
+
+
+_buffer = UsageBuffer()
+
+
+def flush():
+    """Write buffered records now (job scripts call this before exiting)"""
+    return _buffer.flush()
+
+
+atexit.register(flush)
@@ -15,6 +15,7 @@ from sendgrid_webhook import sendgrid_webhook_bp
 from coupon_routes import coupon_bp
 from submission_routes import submissions_bp
 from receipt_routes import receipts_bp
+from admin_performance_routes import admin_performance_bp
 from app import csrf
 
 # Disable CSRF for agents API endpoints (JWT-based)
@@ -29,6 +30,7 @@ csrf.exempt(sendgrid_webhook_bp)
 csrf.exempt(coupon_bp)
 csrf.exempt(submissions_bp)
 csrf.exempt(receipts_bp)
+csrf.exempt(admin_performance_bp)
 
 # Register API blueprints
 app.register_blueprint(agents_api_bp)
@@ -42,6 +44,7 @@ app.register_blueprint(sendgrid_webhook_bp)
 app.register_blueprint(coupon_bp)
 app.register_blueprint(submissions_bp)
 app.register_blueprint(receipts_bp)
+app.register_blueprint(admin_performance_bp)
 
 print("🤖 AI Agents System initialized (LangGraph with Supervisor)")
 print("📧 SendGrid Webhook initialized")
@@ -52,6 +55,16 @@ print("📱 Social Media API initialized")
 print("📷 Camera Button Analytics API initialized")
 print("🎟️ Exclusive Coupons API initialized")
 
+# Resume receipts whose upload was spooled but not processed before a restart
+if os.environ.get("RECEIPT_RESUME_ON_START", "true").lower() == "true":
+    try:
+        from receipt_routes import resume_spooled_receipts
+        resumed = resume_spooled_receipts(app)
+        if resumed:
+            print(f"🧾 Resumed {resumed} spooled receipt(s)")
+    except Exception as e:
+        print(f"⚠️ Could not resume spooled receipts: {e}")
+
 # Add helper functions to Jinja context after routes import
 from routes import user_has_business_role
 
@@ -3,7 +3,7 @@ from datetime import datetime, date
 from app import db
 from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, JSON
+from sqlalchemy import UniqueConstraint, JSON, insert
 from pgvector.sqlalchemy import Vector
 import json
 import hashlib
@@ -455,6 +455,7 @@ class Product(db.Model):
     image_path = db.Column(db.String, nullable=True)
     original_image_path = db.Column(db.String, nullable=True)  # First uploaded image (immutable)
     suggested_images = db.Column(JSON, nullable=True)  # Array of S3 paths for AI-suggested images
+    image_variants = db.Column(JSON, nullable=True)  # Resized renditions: {'source': image_path, 'small': {'webp': url, 'jpg': url}, 'medium': {...}}
     product_url = db.Column(db.String, nullable=True)
     views = db.Column(db.Integer, default=0)
     content_hash = db.Column(db.String, nullable=True)  # Hash to detect content changes for embeddings
@@ -556,6 +557,7 @@ class ProductEmbedding(db.Model):
     embedding_text = db.Column(db.Text, nullable=True)  # Text that was embedded
     model_version = db.Column(db.String, nullable=True)  # e.g., 'text-embedding-3-small'
     content_hash = db.Column(db.String, nullable=True)  # Hash to detect when product content changes
+    business_id = db.Column(db.Integer, nullable=True, index=True)  # Copy of products.business_id (set by trigger) for per-store vector indexes
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -1808,6 +1810,31 @@ class EmailNotification(db.Model):
         db.session.commit()
         return notification
 
+    @classmethod
+    def log_emails(cls, rows: list):
+        """
+        Log many emails with one multi-row INSERT (bulk campaigns)
+
+        Args:
+            rows: dicts with log_email's fields (email, email_type, subject,
+                user_id, status, error_message, extra_data); sent_at defaults to now
+        """
+        if not rows:
+            return 0
+        now = datetime.now()
+        db.session.execute(insert(cls), [{
+            'email': row['email'],
+            'email_type': row['email_type'],
+            'subject': row.get('subject'),
+            'user_id': row.get('user_id'),
+            'status': row.get('status', 'sent'),
+            'error_message': row.get('error_message'),
+            'extra_data': row.get('extra_data'),
+            'sent_at': row.get('sent_at') or now,
+        } for row in rows])
+        db.session.commit()
+        return len(rows)
+
     @classmethod
     def get_user_email_history(cls, user_id: str, limit: int = 50):
         """Get email history for a user"""
@@ -1897,6 +1924,7 @@ class UserProductImage(db.Model):
 
     # Tracking
     created_at = db.Column(db.DateTime, default=datetime.now)
+    claimed_at = db.Column(db.DateTime, nullable=True)  # Lease start of the current 'processing' claim
     processed_at = db.Column(db.DateTime, nullable=True)
 
     # Relationships
@@ -2245,7 +2273,7 @@ class Receipt(db.Model):
     receipt_date = db.Column(db.DateTime, nullable=True, index=True)
     total_amount = db.Column(db.Numeric(10, 2), nullable=True)
 
-    # Processing status: pending, processing, completed, failed, duplicate
+    # Processing status: pending (queued), preparing (image prep + uploads), processing (OCR), completed, failed, duplicate
     processing_status = db.Column(db.String(20), nullable=False, default='pending', index=True)
     processing_error = db.Column(db.Text, nullable=True)
 
@@ -2350,6 +2378,93 @@ class ReceiptItem(db.Model):
         }
 
 
+class OCRResultCache(db.Model):
+    """
+    Content-addressed cache of vision/OCR responses.
+    Keyed by SHA-256 of the exact prepared image bytes, the model and a hash of
+    the prompts, so duplicate uploads and reprocessing with the same model
+    don't repeat the API call. Changing a prompt naturally invalidates entries.
+    """
+    __tablename__ = 'ocr_result_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_hash = db.Column(db.String(64), nullable=False)  # sha256 hex of prepared image bytes
+    model = db.Column(db.String(100), nullable=False)
+    prompt_hash = db.Column(db.String(64), nullable=False)  # sha256 hex of system + user prompt
+
+    # Raw model response (JSON text) and the usage of the original call
+    result_text = db.Column(db.Text, nullable=False)
+    input_tokens = db.Column(db.Integer, nullable=True)
+    output_tokens = db.Column(db.Integer, nullable=True)
+
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_hit_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('image_hash', 'model', 'prompt_hash', name='uq_ocr_result_cache_key'),
+        db.Index('ix_ocr_result_cache_created_at', 'created_at'),
+    )
+
+
+class GeocodeCache(db.Model):
+    """
+    Geocoding results keyed by normalized address + city (geocoding.py).
+    Rows without coordinates record a lookup that found nothing; they expire
+    after GEOCODE_NEGATIVE_TTL_DAYS so fixed provider data gets picked up.
+    """
+    __tablename__ = 'geocode_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    address_key = db.Column(db.String(500), nullable=False)  # '' when only the city is known
+    city_key = db.Column(db.String(100), nullable=False)
+
+    latitude = db.Column(db.Float, nullable=True)  # NULL: not found
+    longitude = db.Column(db.Float, nullable=True)
+    source = db.Column(db.String(20), nullable=True)  # 'google' or 'nominatim'
+    display_name = db.Column(db.String(500), nullable=True)
+
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_hit_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('address_key', 'city_key', name='uq_geocode_cache_key'),
+    )
+
+
+class ImageHash(db.Model):
+    """
+    Perceptual hashes (64-bit pHash + dHash) of product images, camera search
+    snapshots and user product images, with the identification result that
+    was produced for them. Loaded into an in-memory BK-tree
+    (image_hash_index.py) so near-identical photos resolve without a vision
+    API call.
+    """
+    __tablename__ = 'image_hashes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    phash = db.Column(db.BigInteger, nullable=False)  # signed 64-bit
+    dhash = db.Column(db.BigInteger, nullable=False)  # signed 64-bit
+
+    # 'product' (catalog image), 'camera' (camera search snapshot) or 'user_image'
+    source = db.Column(db.String(20), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=True)
+    image_url = db.Column(db.String, nullable=True)  # Hashed image (product.image_path for catalog rows)
+
+    # Vision result for camera / user_image rows (catalog rows resolve to the product)
+    result = db.Column(JSON, nullable=True)
+
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_hit_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_image_hashes_source_created', 'source', 'created_at'),
+        db.Index('ix_image_hashes_product_id', 'product_id'),
+    )
+
+
 class APIUsageLog(db.Model):
     """
     Tracks API usage for LLM calls (OpenAI, Anthropic)
@@ -2365,6 +2480,8 @@ class APIUsageLog(db.Model):
 
     # Usage context
     feature = db.Column(db.String(100), nullable=False, index=True)  # 'receipt_ocr', 'product_search', etc.
+    call_site = db.Column(db.String(100), nullable=True)  # 'semantic_search.get_embedding' (module.function)
+    endpoint = db.Column(db.String(200), nullable=True, index=True)  # Flask endpoint or 'job:<name>' / 'background'
     receipt_id = db.Column(db.Integer, db.ForeignKey('receipts.id', ondelete='SET NULL'), nullable=True)
     user_id = db.Column(db.String, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
 
@@ -2380,6 +2497,7 @@ class APIUsageLog(db.Model):
     success = db.Column(db.Boolean, default=True)
     error_message = db.Column(db.Text, nullable=True)
     response_time_ms = db.Column(db.Integer, nullable=True)  # How long the API call took
+    cache_hit = db.Column(db.Boolean, nullable=False, default=False, server_default='false')  # Served from a cache, no API call
 
     # Timestamps
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
@@ -2391,6 +2509,8 @@ class APIUsageLog(db.Model):
             'provider': self.provider,
             'model': self.model,
             'feature': self.feature,
+            'call_site': self.call_site,
+            'endpoint': self.endpoint,
             'receipt_id': self.receipt_id,
             'user_id': self.user_id,
             'input_tokens': self.input_tokens,
@@ -2400,6 +2520,7 @@ class APIUsageLog(db.Model):
             'success': self.success,
             'error_message': self.error_message,
             'response_time_ms': self.response_time_ms,
+            'cache_hit': self.cache_hit,
             'created_at': self.created_at.isoformat() if self.created_at else None,
         }
 
@@ -2414,6 +2535,8 @@ class APIUsageLog(db.Model):
             # OpenAI
             'gpt-4o-mini': (0.15, 0.60),
             'gpt-4o': (2.50, 10.00),
+            'text-embedding-3-small': (0.02, 0.0),
+            'text-embedding-3-large': (0.13, 0.0),
             # Anthropic Claude 3
             'claude-3-haiku-20240307': (0.25, 1.25),
             'claude-sonnet-4-20250514': (3.00, 15.00),
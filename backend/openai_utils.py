@@ -4,14 +4,14 @@ import os
 import re
 import unicodedata
 from datetime import datetime, date
-from openai import OpenAI
+from llm_clients import get_openai_client
 
 # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
 # do not change this unless explicitly requested by the user
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL",
                               "gpt-4o-mini")  # Faster and cheaper than GPT-5
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client = get_openai_client()
 
 
 def extract_search_intent(user_query):
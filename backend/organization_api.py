@@ -6,7 +6,6 @@ from flask import Blueprint, jsonify, request
 from functools import wraps
 import logging
 from datetime import datetime
-import os
 import uuid
 from PIL import Image
 import io
@@ -455,7 +454,8 @@ def upload_product_images():
     Accepts multiple image files, processes them in parallel, and returns extracted product info
     """
     from concurrent.futures import ThreadPoolExecutor, as_completed
-    from s3_utils import upload_to_s3
+    from image_search import upload_to_s3
+    from storage import get_storage
     import base64
 
     user = request.jwt_user
@@ -557,7 +557,7 @@ def upload_product_images():
                 return {'success': False, 'filename': filename, 'error': 'Failed to upload to storage'}
 
             # Full S3 URL for consistency
-            s3_url = f"https://aipijaca.s3.eu-central-1.amazonaws.com/{uploaded_path}"
+            s3_url = get_storage().url(uploaded_path)
 
             # Process with LLM to extract product info
             product_info = process_image_with_llm(processed_data, filename)
@@ -601,10 +601,10 @@ def process_image_with_llm(image_data, filename):
     Process an image with LLM to extract product information
     """
     import base64
-    from openai import OpenAI
+    from llm_clients import get_openai_client
 
     try:
-        client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+        client = get_openai_client()
 
         # Encode image as base64
         base64_image = base64.b64encode(image_data).decode('utf-8')
@@ -741,20 +741,26 @@ def upload_product_image(product_id):
         processed_data = buffer.read()
 
         # Upload to S3
-        from s3_utils import upload_to_s3
+        from image_search import upload_to_s3
+        from storage import get_storage
 
         unique_filename = f"{uuid.uuid4()}.jpg"
         s3_path = f"assets/images/product_images/{business.id}/{product_id}/{unique_filename}"
 
-        s3_url = upload_to_s3(processed_data, s3_path, content_type='image/jpeg')
+        uploaded_path = upload_to_s3(processed_data, s3_path, content_type='image/jpeg')
 
-        if not s3_url:
+        if not uploaded_path:
             return jsonify({'error': 'Failed to upload image'}), 500
 
+        s3_url = get_storage().url(uploaded_path)
+
         # Update product
         product.image_path = s3_url
         db.session.commit()
 
+        from image_derivatives import enqueue_product_derivatives
+        enqueue_product_derivatives(product.id, processed_data)
+
         logger.info(f"Image uploaded for product {product_id} by user {user.email}")
 
         return jsonify({
@@ -0,0 +1,299 @@
+"""
+Opt-in per-request SQL profiler.
+
+When QUERY_PROFILING=true, SQLAlchemy cursor events count every statement a
+request issues and time it. After each request the totals are folded into
+per-endpoint stats (requests, queries per request, DB time, budget breaches,
+repeated statements and slow statements), which admin_performance_routes
+serves. Requests over the query-count or DB-time budget are logged with the
+statements they repeated most - the usual signature of an N+1 loop
+(product_to_dict history lookups, Business.query.get per row, ...).
+
+Slow SELECTs are sampled for EXPLAIN on a background thread, on a separate
+connection with the original parameters, so the request never waits on it.
+
+Stats are kept in memory per process (each gunicorn worker has its own).
+With QUERY_PROFILING_HEADERS (defaults to app.debug) responses carry
+X-DB-Query-Count and X-DB-Time-Ms.
+
+Environment:
+    QUERY_PROFILING            'true' enables the profiler (default: false)
+    QUERY_PROFILING_HEADERS    'true'/'false' to force the debug headers
+    QUERY_BUDGET_COUNT         Statements per request before it is flagged (default: 30)
+    QUERY_BUDGET_MS            DB milliseconds per request before it is flagged (default: 500)
+    SLOW_QUERY_MS              Statement time that counts as slow (default: 100)
+    QUERY_EXPLAIN_SAMPLE_RATE  Fraction of slow SELECTs to EXPLAIN (default: 0.1)
+"""
+
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+QUERY_BUDGET_COUNT = int(os.environ.get('QUERY_BUDGET_COUNT', '30'))
+QUERY_BUDGET_MS = float(os.environ.get('QUERY_BUDGET_MS', '500'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('QUERY_EXPLAIN_SAMPLE_RATE', '0.1'))
+
+REPEAT_THRESHOLD = 5        # Same statement this often in one request = likely N+1
+MAX_SLOW_PER_ENDPOINT = 20  # Distinct slow statements kept per endpoint
+MAX_REPEATED_PER_ENDPOINT = 20
+MAX_STATEMENT_CHARS = 2000
+
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """Statement with literals and expanded IN lists collapsed, for grouping"""
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER_LIST.sub('(...)', statement)
+    statement = _NUMBER.sub('N', statement)
+    return _WHITESPACE.sub(' ', statement).strip()[:MAX_STATEMENT_CHARS]
+
+
+class RequestProfile:
+    """Statements issued while serving one request"""
+
+    __slots__ = ('count', 'db_ms', 'statements', 'slow')
+
+    def __init__(self):
+        self.count = 0
+        self.db_ms = 0.0
+        self.statements = Counter()
+        self.slow = []  # (fingerprint, ms, statement, parameters)
+
+    def add(self, statement, parameters, elapsed_ms):
+        key = fingerprint(statement)
+        self.count += 1
+        self.db_ms += elapsed_ms
+        self.statements[key] += 1
+        if elapsed_ms >= SLOW_QUERY_MS:
+            self.slow.append((key, elapsed_ms, statement, parameters))
+
+
+class EndpointStats:
+    """Aggregates for one endpoint since startup (or the last reset)"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_ms = 0.0
+        self.max_db_ms = 0.0
+        self.over_budget = 0
+        self.repeated = {}  # fingerprint -> {'requests', 'max_per_request'}
+        self.slow = {}      # fingerprint -> {'count', 'max_ms', 'total_ms', 'explain'}
+
+    def add(self, profile):
+        self.requests += 1
+        self.queries += profile.count
+        self.max_queries = max(self.max_queries, profile.count)
+        self.db_ms += profile.db_ms
+        self.max_db_ms = max(self.max_db_ms, profile.db_ms)
+        if profile.count > QUERY_BUDGET_COUNT or profile.db_ms > QUERY_BUDGET_MS:
+            self.over_budget += 1
+
+        for key, count in profile.statements.items():
+            if count < REPEAT_THRESHOLD:
+                continue
+            entry = self.repeated.get(key)
+            if entry is None:
+                if len(self.repeated) >= MAX_REPEATED_PER_ENDPOINT:
+                    continue
+                entry = self.repeated[key] = {'requests': 0, 'max_per_request': 0}
+            entry['requests'] += 1
+            entry['max_per_request'] = max(entry['max_per_request'], count)
+
+        for key, elapsed_ms, _, _ in profile.slow:
+            entry = self.slow.get(key)
+            if entry is None:
+                if len(self.slow) >= MAX_SLOW_PER_ENDPOINT:
+                    continue
+                entry = self.slow[key] = {'count': 0, 'max_ms': 0.0, 'total_ms': 0.0, 'explain': None}
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+
+    def to_dict(self):
+        return {
+            'endpoint': self.endpoint,
+            'requests': self.requests,
+            'avg_queries': round(self.queries / self.requests, 1) if self.requests else 0,
+            'max_queries': self.max_queries,
+            'avg_db_ms': round(self.db_ms / self.requests, 1) if self.requests else 0,
+            'max_db_ms': round(self.max_db_ms, 1),
+            'total_db_ms': round(self.db_ms, 1),
+            'over_budget': self.over_budget,
+            'repeated_statements': sorted(
+                ({'statement': key, **entry} for key, entry in self.repeated.items()),
+                key=lambda e: e['max_per_request'], reverse=True
+            ),
+            'slow_statements': sorted(
+                ({'statement': key, 'count': entry['count'], 'max_ms': round(entry['max_ms'], 1),
+                  'avg_ms': round(entry['total_ms'] / entry['count'], 1), 'explain': entry['explain']}
+                 for key, entry in self.slow.items()),
+                key=lambda e: e['max_ms'], reverse=True
+            ),
+        }
+
+
+class QueryProfiler:
+    """Hooks SQLAlchemy and Flask; holds the per-endpoint stats"""
+
+    def __init__(self, app, db, headers=None):
+        self.app = app
+        self.db = db
+        self.headers = headers  # None: follow app.debug
+        self.started_at = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._explain_executor = None
+
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    # SQLAlchemy events (only statements issued on a profiled request thread count)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None and has_request_context() and g.get('query_profile') is not None:
+            context._query_profiler_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_query_profiler_start', None)
+        if started is None or not has_request_context():
+            return
+        profile = g.get('query_profile')
+        if profile is not None:
+            profile.add(statement, None if executemany else parameters, (time.perf_counter() - started) * 1000)
+
+    # Flask hooks
+
+    def _start_request(self):
+        g.query_profile = RequestProfile()
+
+    def _finish_request(self, response):
+        profile = g.pop('query_profile', None)
+        if profile is None:
+            return response
+        endpoint = request.endpoint or request.path
+
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats(endpoint)
+            stats.add(profile)
+
+        if profile.count > QUERY_BUDGET_COUNT or profile.db_ms > QUERY_BUDGET_MS:
+            repeated = ', '.join(
+                f"{count}x {key[:80]}" for key, count in profile.statements.most_common(3) if count > 1
+            )
+            logger.warning(
+                f"Query budget exceeded on {endpoint}: {profile.count} statements, "
+                f"{profile.db_ms:.0f}ms DB{f' (repeated: {repeated})' if repeated else ''}"
+            )
+
+        for key, elapsed_ms, statement, parameters in profile.slow:
+            self._maybe_explain(endpoint, key, statement, parameters)
+
+        if self.headers or (self.headers is None and self.app.debug):
+            response.headers['X-DB-Query-Count'] = str(profile.count)
+            response.headers['X-DB-Time-Ms'] = f"{profile.db_ms:.1f}"
+        return response
+
+    # EXPLAIN sampling
+
+    def _maybe_explain(self, endpoint, key, statement, parameters):
+        if parameters is None or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return
+        if random.random() >= EXPLAIN_SAMPLE_RATE:
+            return
+        with self._lock:
+            stats = self._stats.get(endpoint)  # A reset() may have dropped it meanwhile
+            if stats is None:
+                return
+            entry = stats.slow.get(key)
+            if entry is None or entry['explain'] is not None:
+                return
+            entry['explain'] = 'pending'
+        self._get_explain_executor().submit(self._explain, endpoint, key, statement, parameters)
+
+    def _get_explain_executor(self):
+        if self._explain_executor is None:
+            with self._lock:
+                if self._explain_executor is None:
+                    self._explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-explain')
+        return self._explain_executor
+
+    def _explain(self, endpoint, key, statement, parameters):
+        try:
+            with self.app.app_context():
+                engine = self.db.engine
+                if engine.dialect.name != 'postgresql':
+                    plan = None
+                else:
+                    with engine.connect() as conn:
+                        rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).fetchall()
+                    plan = '\n'.join(row[0] for row in rows)
+        except Exception as e:
+            logger.warning(f"EXPLAIN failed for slow statement on {endpoint}: {e}")
+            plan = None
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            entry = stats.slow.get(key) if stats else None
+            if entry is not None:
+                entry['explain'] = plan
+
+    # Reporting
+
+    def snapshot(self, sort='total_db_ms', limit=50):
+        """Per-endpoint stats, heaviest first"""
+        with self._lock:
+            rows = [stats.to_dict() for stats in self._stats.values()]
+        rows.sort(key=lambda row: row.get(sort, 0), reverse=True)
+        return {
+            'pid': os.getpid(),
+            'since': self.started_at,
+            'budget': {'queries': QUERY_BUDGET_COUNT, 'db_ms': QUERY_BUDGET_MS, 'slow_query_ms': SLOW_QUERY_MS},
+            'endpoints': rows[:limit],
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.started_at = time.time()
+
+
+_profiler = None
+
+
+def init_query_profiler(app, db):
+    """Install the profiler when QUERY_PROFILING is on; returns it (or None)"""
+    global _profiler
+    if os.environ.get('QUERY_PROFILING', 'false').lower() != 'true':
+        return None
+    headers_env = os.environ.get('QUERY_PROFILING_HEADERS')
+    headers = headers_env.lower() == 'true' if headers_env else None
+    _profiler = QueryProfiler(app, db, headers=headers)
+    logger.info(f"Query profiler enabled (budget: {QUERY_BUDGET_COUNT} statements / {QUERY_BUDGET_MS:.0f}ms)")
+    return _profiler
+
+
+def get_query_profiler():
+    """The installed profiler, or None when profiling is off"""
+    return _profiler
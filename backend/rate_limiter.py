@@ -107,6 +107,12 @@ def init_limiter(app):
     # Get storage URL from environment (Redis for production, memory for dev)
     storage_url = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
 
+    # Allow disabling limits for local load tests (benchmarks/load_test.py)
+    app.config.setdefault(
+        'RATELIMIT_ENABLED',
+        os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true'
+    )
+
     limiter = Limiter(
         key_func=get_rate_limit_key,
         app=app,
@@ -3,22 +3,27 @@ Receipt Upload & Purchase Analytics API Routes
 Handles user receipt photo uploads, OCR processing, and purchase statistics
 """
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, has_app_context
 from datetime import datetime, date, timedelta
 from functools import wraps
 from decimal import Decimal
-import boto3
 import uuid
 import os
 import json
+import hashlib
 import threading
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageOps
 import io
 import base64
 
 from app import db
-from models import User, Business, Receipt, ReceiptItem, APIUsageLog
+from models import User, Business, Receipt, ReceiptItem, APIUsageLog, OCRResultCache
 from auth_api import require_jwt_auth
+from storage import delete_many, get_storage
+from llm_usage import record_cache_hit, record_call, usage_context
 import time
 
 receipts_bp = Blueprint('receipts', __name__)
@@ -36,14 +41,10 @@ def login_required(f):
     return decorated_function
 
 
-def get_s3_client():
-    """Get configured S3 client"""
-    return boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-    )
+def receipt_image_keys(user_id, receipt_id):
+    """Storage keys of the original receipt image and its debug images"""
+    base = f"receipts/{user_id}/{receipt_id}"
+    return [f"{base}.jpg", f"{base}_cropped.jpg", f"{base}_top.jpg", f"{base}_bottom.jpg"]
 
 
 def upload_receipt_image(file_data, user_id, receipt_id):
@@ -51,9 +52,6 @@ def upload_receipt_image(file_data, user_id, receipt_id):
     Upload receipt image to S3 with resizing to 600px
     Returns the S3 URL
     """
-    s3 = get_s3_client()
-    bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
     # Path: /receipts/{user_id}/{receipt_id}.jpg
     filename = f"receipts/{user_id}/{receipt_id}.jpg"
 
@@ -84,17 +82,11 @@ def upload_receipt_image(file_data, user_id, receipt_id):
     buffer.seek(0)
 
     # Upload to S3
-    s3.upload_fileobj(
-        buffer,
-        bucket,
-        filename,
-        ExtraArgs={
-            'ContentType': 'image/jpeg'
-        }
-    )
+    storage = get_storage()
+    storage.put(filename, buffer.getvalue(), 'image/jpeg')
 
     # Return full URL
-    return f"https://{bucket}.s3.eu-central-1.amazonaws.com/{filename}"
+    return storage.url(filename)
 
 
 def upload_cropped_receipt_image(image_bytes, user_id, receipt_id):
@@ -103,24 +95,15 @@ def upload_cropped_receipt_image(image_bytes, user_id, receipt_id):
     This shows exactly what the OCR model is analyzing
     Returns the S3 URL
     """
-    s3 = get_s3_client()
-    bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
     # Path: /receipts/{user_id}/{receipt_id}_cropped.jpg
     filename = f"receipts/{user_id}/{receipt_id}_cropped.jpg"
 
     # Upload to S3
-    s3.upload_fileobj(
-        io.BytesIO(image_bytes),
-        bucket,
-        filename,
-        ExtraArgs={
-            'ContentType': 'image/jpeg'
-        }
-    )
+    storage = get_storage()
+    storage.put(filename, image_bytes, 'image/jpeg')
 
     # Return full URL
-    return f"https://{bucket}.s3.eu-central-1.amazonaws.com/{filename}"
+    return storage.url(filename)
 
 
 def upload_split_part_image(image_bytes, user_id, receipt_id, part_name):
@@ -135,24 +118,15 @@ def upload_split_part_image(image_bytes, user_id, receipt_id, part_name):
 
     Returns the S3 URL
     """
-    s3 = get_s3_client()
-    bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
     # Path: /receipts/{user_id}/{receipt_id}_{part_name}.jpg
     filename = f"receipts/{user_id}/{receipt_id}_{part_name}.jpg"
 
     # Upload to S3
-    s3.upload_fileobj(
-        io.BytesIO(image_bytes),
-        bucket,
-        filename,
-        ExtraArgs={
-            'ContentType': 'image/jpeg'
-        }
-    )
+    storage = get_storage()
+    storage.put(filename, image_bytes, 'image/jpeg')
 
     # Return full URL
-    return f"https://{bucket}.s3.eu-central-1.amazonaws.com/{filename}"
+    return storage.url(filename)
 
 
 def resize_image_for_ocr(file_data, use_precrop=True, return_bytes=False):
@@ -410,6 +384,24 @@ def detect_receipt_bounds(image_base64):
     """
     from openai_utils import openai_client
 
+    # Same detection image -> same bounds; keeps image preparation deterministic
+    # so the OCR cache also hits on reprocessing
+    cache_key = None
+    if has_app_context():
+        cache_key = ocr_cache_key(image_base64, 'gpt-4o-mini', 'receipt_bounds', 'v1')
+        cached = get_cached_ocr_result(cache_key[0], 'gpt-4o-mini', cache_key[1])
+        if cached:
+            record_cache_hit('gpt-4o-mini')
+            result = json.loads(cached[0])
+            if not result.get('found', False):
+                return None
+            return (
+                result.get('left', 0),
+                result.get('top', 0),
+                result.get('right', 100),
+                result.get('bottom', 100)
+            )
+
     try:
         response = openai_client.chat.completions.create(
             model="gpt-4o-mini",
@@ -449,7 +441,15 @@ If no receipt found, return {"found": false}"""
             temperature=0
         )
 
-        result = json.loads(response.choices[0].message.content)
+        result_text = response.choices[0].message.content
+        result = json.loads(result_text)
+
+        if cache_key:
+            usage = response.usage
+            store_cached_ocr_result(
+                cache_key[0], 'gpt-4o-mini', cache_key[1], result_text,
+                usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None
+            )
 
         if not result.get('found', False):
             return None
@@ -583,6 +583,109 @@ def match_business_by_name(store_name):
     return None
 
 
+# ==================== OCR RESULT CACHE ====================
+# Vision responses are cached by SHA-256 of the exact prepared image bytes,
+# the model and the prompts. Image preparation is deterministic for the same
+# input (bounds detection is cached the same way), so duplicate uploads and
+# reprocessing with the same model skip the API call entirely.
+
+def ocr_cache_key(image_base64, model, system_prompt, user_prompt):
+    """Return (image_hash, prompt_hash) for the OCR result cache"""
+    image_hash = hashlib.sha256(base64.b64decode(image_base64)).hexdigest()
+    prompt_hash = hashlib.sha256(f"{system_prompt}\n\n{user_prompt}".encode('utf-8')).hexdigest()
+    return image_hash, prompt_hash
+
+
+def get_cached_ocr_result(image_hash, model, prompt_hash):
+    """
+    Look up a cached OCR response.
+    Returns (result_text, input_tokens, output_tokens) or None.
+    """
+    try:
+        entry = OCRResultCache.query.filter_by(
+            image_hash=image_hash, model=model, prompt_hash=prompt_hash
+        ).first()
+        if not entry:
+            return None
+        entry.hit_count = (entry.hit_count or 0) + 1
+        entry.last_hit_at = datetime.now()
+        db.session.commit()
+        return entry.result_text, entry.input_tokens or 0, entry.output_tokens or 0
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f"OCR cache lookup failed: {e}")
+        return None
+
+
+def store_cached_ocr_result(image_hash, model, prompt_hash, result_text, input_tokens, output_tokens):
+    """Store a successful OCR response (only valid JSON is cached)"""
+    try:
+        json.loads(result_text)
+    except (TypeError, ValueError):
+        return
+    try:
+        db.session.add(OCRResultCache(
+            image_hash=image_hash,
+            model=model,
+            prompt_hash=prompt_hash,
+            result_text=result_text,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        ))
+        db.session.commit()
+    except Exception as e:
+        # Unique violation when a concurrent worker stored it first - fine
+        db.session.rollback()
+        current_app.logger.debug(f"OCR cache store skipped: {e}")
+
+
+def run_ocr_parts(parts, system_prompt, model, is_claude):
+    """
+    OCR several images concurrently, serving cache hits from the database.
+
+    Args:
+        parts: list of (image_base64, user_prompt) tuples
+        system_prompt: Shared system prompt
+        model: OCR model name
+        is_claude: True for Anthropic models
+
+    Returns:
+        list of (result_text, input_tokens, output_tokens, response_time_ms, cached)
+        in the same order as parts. Cached entries report zero response time.
+    """
+    results = [None] * len(parts)
+    misses = []
+
+    # Cache lookups happen on this thread (it owns the app context / DB session)
+    for idx, (image_base64, user_prompt) in enumerate(parts):
+        image_hash, prompt_hash = ocr_cache_key(image_base64, model, system_prompt, user_prompt)
+        cached = get_cached_ocr_result(image_hash, model, prompt_hash)
+        if cached:
+            result_text, in_tokens, out_tokens = cached
+            results[idx] = (result_text, in_tokens, out_tokens, 0, True)
+            record_cache_hit(model, provider='anthropic' if is_claude else 'openai')
+        else:
+            misses.append((idx, image_hash, prompt_hash))
+
+    if misses:
+        # Vision calls are network-bound - run all parts at once (each in a copy
+        # of this context so the calls keep the caller's usage attribution)
+        with ThreadPoolExecutor(max_workers=len(misses)) as executor:
+            futures = {
+                idx: executor.submit(
+                    contextvars.copy_context().run,
+                    call_ocr_api, parts[idx][0], system_prompt, parts[idx][1], model, is_claude
+                )
+                for idx, _, _ in misses
+            }
+            for idx, image_hash, prompt_hash in misses:
+                result_text, in_tokens, out_tokens, resp_time = futures[idx].result()
+                results[idx] = (result_text, in_tokens, out_tokens, resp_time, False)
+                store_cached_ocr_result(image_hash, model, prompt_hash, result_text, in_tokens, out_tokens)
+
+    return results
+
+
 def call_ocr_api(image_base64, system_prompt, user_prompt, model, is_claude):
     """
     Helper function to call OCR API (OpenAI or Claude).
@@ -601,34 +704,40 @@ def call_ocr_api(image_base64, system_prompt, user_prompt, model, is_claude):
         }
         claude_model = claude_model_map.get(model, 'claude-3-haiku-20240307')
 
-        response = anthropic_client.messages.create(
-            model=claude_model,
-            max_tokens=4000,
-            system=system_prompt,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": image_base64
+        # Not an OpenAI call, so llm_clients doesn't log it - record it here
+        try:
+            response = anthropic_client.messages.create(
+                model=claude_model,
+                max_tokens=4000,
+                system=system_prompt,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": "image/jpeg",
+                                    "data": image_base64
+                                }
+                            },
+                            {
+                                "type": "text",
+                                "text": user_prompt
                             }
-                        },
-                        {
-                            "type": "text",
-                            "text": user_prompt
-                        }
-                    ]
-                }
-            ]
-        )
+                        ]
+                    }
+                ]
+            )
+        except Exception as e:
+            record_call('anthropic', claude_model, (time.time() - start_time) * 1000, error=e)
+            raise
         result_text = response.content[0].text.strip()
         if hasattr(response, 'usage'):
             input_tokens = response.usage.input_tokens
             output_tokens = response.usage.output_tokens
+        record_call('anthropic', claude_model, (time.time() - start_time) * 1000, input_tokens, output_tokens)
         if result_text.startswith('```'):
             result_text = result_text.split('```')[1]
             if result_text.startswith('json'):
@@ -930,11 +1039,9 @@ Return JSON:
 }"""
 
             # Call appropriate API based on model
-            # Track timing and usage for logging
-            total_input_tokens = 0
-            total_output_tokens = 0
-            total_response_time_ms = 0
-            actual_model = model
+            # (every API call and cache hit is logged by llm_usage under this scope)
+            usage_scope = {'feature': 'receipt_ocr', 'receipt_id': receipt_id, 'user_id': receipt.user_id}
+            cache_hits = 0
 
             # Handle split vs single image
             if is_split and isinstance(image_data, dict) and image_data.get('is_split'):
@@ -982,20 +1089,24 @@ Focus on: items in this portion and the total_amount (from TOTAL: line!).
 
 Return ONLY valid JSON with items array and total_amount."""
 
+                images = image_data.get('images', [])
+                ocr_parts = [
+                    (img_base64, top_prompt if i == 0 else bottom_prompt)
+                    for i, img_base64 in enumerate(images)
+                ]
+
+                with usage_context(**usage_scope):
+                    ocr_results = run_ocr_parts(ocr_parts, system_prompt, model, is_claude)
+
                 parts_results = []
-                for i, img_base64 in enumerate(image_data.get('images', [])):
-                    part_prompt = top_prompt if i == 0 else bottom_prompt
-                    result_text, in_tokens, out_tokens, resp_time = call_ocr_api(
-                        img_base64, system_prompt, part_prompt, model, is_claude
-                    )
-                    total_input_tokens += in_tokens
-                    total_output_tokens += out_tokens
-                    total_response_time_ms += resp_time
+                for i, (result_text, in_tokens, out_tokens, resp_time, cached) in enumerate(ocr_results):
+                    if cached:
+                        cache_hits += 1
 
                     # Parse result
                     part_result = json.loads(result_text)
                     parts_results.append(part_result)
-                    current_app.logger.info(f"Part {i+1}: {len(part_result.get('items', []))} items extracted")
+                    current_app.logger.info(f"Part {i+1}: {len(part_result.get('items', []))} items extracted{' (cached)' if cached else ''}")
 
                 # Merge results
                 if len(parts_results) >= 2:
@@ -1008,34 +1119,16 @@ Return ONLY valid JSON with items array and total_amount."""
                 image_base64 = image_data if isinstance(image_data, str) else image_data.get('images', [''])[0]
                 user_prompt = "Extract all data from this receipt image. Return ONLY valid JSON, no markdown formatting."
 
-                result_text, total_input_tokens, total_output_tokens, total_response_time_ms = call_ocr_api(
-                    image_base64, system_prompt, user_prompt, model, is_claude
-                )
+                with usage_context(**usage_scope):
+                    result_text, in_tokens, out_tokens, resp_time, cached = run_ocr_parts(
+                        [(image_base64, user_prompt)], system_prompt, model, is_claude
+                    )[0]
+                if cached:
+                    cache_hits += 1
                 result = json.loads(result_text)
 
-            # Log API usage (total across all parts if split)
-            try:
-                provider = 'anthropic' if is_claude else 'openai'
-                estimated_cost = APIUsageLog.calculate_cost(
-                    provider, actual_model, total_input_tokens, total_output_tokens
-                )
-                usage_log = APIUsageLog(
-                    provider=provider,
-                    model=actual_model,
-                    feature='receipt_ocr',
-                    receipt_id=receipt_id,
-                    user_id=receipt.user_id,
-                    input_tokens=total_input_tokens,
-                    output_tokens=total_output_tokens,
-                    total_tokens=total_input_tokens + total_output_tokens,
-                    estimated_cost_cents=Decimal(str(estimated_cost)) if estimated_cost else None,
-                    success=True,
-                    response_time_ms=total_response_time_ms
-                )
-                db.session.add(usage_log)
-                db.session.commit()
-            except Exception as log_error:
-                current_app.logger.warning(f"Failed to log API usage: {log_error}")
+            if cache_hits:
+                current_app.logger.info(f"Receipt {receipt_id}: {cache_hits} OCR part(s) served from cache")
 
             # Update receipt with extracted data
             if result.get('store_name'):
@@ -1121,6 +1214,258 @@ Return ONLY valid JSON with items array and total_amount."""
             current_app.logger.error(f"Error processing receipt {receipt_id}: {e}")
 
 
+# ==================== BACKGROUND PIPELINE ====================
+# Upload requests only spool the raw bytes and enqueue the receipt.
+# Image preparation (EXIF fix, pre-crop detection, LANCZOS resize, split),
+# S3 uploads and OCR run in a bounded worker pool.
+# Progress is exposed via Receipt.processing_status:
+#   pending (queued) -> preparing (image prep + uploads) -> processing (OCR) -> completed/failed/duplicate
+
+RECEIPT_WORKERS = int(os.environ.get('RECEIPT_WORKERS', 2))
+RECEIPT_UPLOAD_WORKERS = int(os.environ.get('RECEIPT_UPLOAD_WORKERS', 4))
+RECEIPT_SPOOL_DIR = os.environ.get(
+    'RECEIPT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'receipt_spool')
+)
+# A receipt still 'preparing' this long after upload lost its worker (crash, recycle)
+RECEIPT_PREPARING_TIMEOUT_MINUTES = int(os.environ.get('RECEIPT_PREPARING_TIMEOUT_MINUTES', 15))
+
+_receipt_executor = None
+_receipt_upload_executor = None
+_receipt_executor_lock = threading.Lock()
+
+
+def get_receipt_executors():
+    """Lazily create the process-wide receipt worker and upload pools"""
+    global _receipt_executor, _receipt_upload_executor
+    if _receipt_executor is None:
+        with _receipt_executor_lock:
+            if _receipt_executor is None:
+                _receipt_upload_executor = ThreadPoolExecutor(
+                    max_workers=RECEIPT_UPLOAD_WORKERS, thread_name_prefix='receipt-upload'
+                )
+                _receipt_executor = ThreadPoolExecutor(
+                    max_workers=RECEIPT_WORKERS, thread_name_prefix='receipt-worker'
+                )
+    return _receipt_executor, _receipt_upload_executor
+
+
+def spool_path(receipt_id):
+    """Local path where raw upload bytes wait for the worker"""
+    return os.path.join(RECEIPT_SPOOL_DIR, f"{receipt_id}.bin")
+
+
+def spool_receipt_bytes(receipt_id, file_data):
+    """Persist raw upload bytes so the request can return immediately"""
+    os.makedirs(RECEIPT_SPOOL_DIR, exist_ok=True)
+    path = spool_path(receipt_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(file_data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _is_stuck_preparing(receipt):
+    """True for a receipt left in 'preparing' by a worker that died before its upload finished"""
+    return (
+        receipt.processing_status == 'preparing'
+        and receipt.created_at < datetime.now() - timedelta(minutes=RECEIPT_PREPARING_TIMEOUT_MINUTES)
+    )
+
+
+def _can_reprocess_from_spool(receipt):
+    """
+    A receipt without a stored image can still be reprocessed from its spooled
+    bytes - unless a live worker may still be preparing it.
+    """
+    if not os.path.exists(spool_path(receipt.id)):
+        return False
+    return receipt.processing_status not in ('pending', 'preparing') or _is_stuck_preparing(receipt)
+
+
+def _claim_receipt(receipt_id):
+    """
+    Atomically move a receipt from pending to preparing.
+    Returns False if another worker (or process) already claimed it.
+    """
+    claimed = Receipt.query.filter(
+        Receipt.id == receipt_id,
+        Receipt.processing_status == 'pending'
+    ).update({'processing_status': 'preparing'}, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def _set_receipt_status(receipt_id, status, error=None):
+    receipt = Receipt.query.get(receipt_id)
+    if not receipt:
+        return None
+    receipt.processing_status = status
+    if error is not None:
+        receipt.processing_error = error[:500]
+    db.session.commit()
+    return receipt
+
+
+def run_receipt_pipeline(app, receipt_id, user_id, model='gpt-4o', source_url=None):
+    """
+    Worker task: prepare images, upload to S3 in parallel, then run OCR.
+
+    Args:
+        app: Flask app (for a fresh app context in the worker thread)
+        receipt_id: Receipt to process
+        user_id: Owner (used for S3 paths)
+        model: OCR model
+        source_url: For reprocessing - download the stored original instead of reading the spool
+    """
+    _, upload_executor = get_receipt_executors()
+
+    with app.app_context():
+        try:
+            if not _claim_receipt(receipt_id):
+                return
+
+            if source_url:
+                # Our own objects are read through the pooled storage client
+                storage = get_storage()
+                source_key = storage.key_from_url(source_url)
+                if source_key:
+                    file_data = storage.get(source_key)
+                else:
+                    import urllib.request
+                    with urllib.request.urlopen(source_url, timeout=30) as response:
+                        file_data = response.read()
+            else:
+                with open(spool_path(receipt_id), 'rb') as f:
+                    file_data = f.read()
+
+            # Original (resized to 2000px) uploads while we prepare OCR images
+            original_future = None
+            if not source_url:
+                original_future = upload_executor.submit(upload_receipt_image, file_data, user_id, receipt_id)
+
+            image_prep = prepare_images_for_ocr(file_data)
+            is_split = image_prep.get('is_split', False)
+
+            # Debug images (what OCR analyzes) upload concurrently with OCR
+            debug_futures = {
+                'cropped_image_url': upload_executor.submit(
+                    upload_cropped_receipt_image, image_prep['combined_bytes'], user_id, receipt_id
+                )
+            }
+            if is_split:
+                for part in image_prep.get('parts', []):
+                    if part['position'] in ('top', 'bottom'):
+                        debug_futures[f"cropped_{part['position']}_url"] = upload_executor.submit(
+                            upload_split_part_image, part['bytes'], user_id, receipt_id, part['position']
+                        )
+
+            # The original must be stored before OCR so the receipt is viewable/reprocessable
+            if original_future is not None:
+                image_url = original_future.result()
+                receipt = Receipt.query.get(receipt_id)
+                receipt.receipt_image_url = image_url
+                db.session.commit()
+                try:
+                    os.remove(spool_path(receipt_id))
+                except OSError:
+                    pass
+
+            current_app.logger.info(f"Receipt {receipt_id}: is_split={is_split}, parts={len(image_prep.get('images', []))}")
+
+            process_receipt_ocr(receipt_id, image_prep, app.app_context(), model, is_split=is_split)
+
+            # Persist debug image URLs (uploads ran alongside OCR)
+            debug_urls = {}
+            for field, future in debug_futures.items():
+                try:
+                    debug_urls[field] = future.result()
+                except Exception as upload_error:
+                    current_app.logger.warning(f"Receipt {receipt_id}: failed to upload {field}: {upload_error}")
+            if debug_urls:
+                receipt = Receipt.query.get(receipt_id)
+                if receipt:
+                    for field, url in debug_urls.items():
+                        setattr(receipt, field, url)
+                    db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            _set_receipt_status(receipt_id, 'failed', error=str(e))
+            current_app.logger.error(f"Receipt pipeline failed for {receipt_id}: {e}")
+        finally:
+            db.session.remove()
+
+
+def enqueue_receipt_processing(receipt_id, user_id, model='gpt-4o', source_url=None):
+    """Submit a receipt to the worker pool (call after the receipt row is committed)"""
+    executor, _ = get_receipt_executors()
+    app = current_app._get_current_object()
+    return executor.submit(run_receipt_pipeline, app, receipt_id, user_id, model, source_url)
+
+
+def resume_spooled_receipts(app):
+    """
+    Re-enqueue receipts whose raw bytes are still spooled (e.g. after a restart).
+    Safe to call from every worker at startup: receipts are claimed atomically,
+    and spool files of finished/deleted receipts are cleaned up. Receipts stuck
+    in 'preparing' past RECEIPT_PREPARING_TIMEOUT_MINUTES are reset to pending
+    and re-enqueued; younger ones may still be running in another worker.
+    """
+    if not os.path.isdir(RECEIPT_SPOOL_DIR):
+        return 0
+
+    executor, _ = get_receipt_executors()
+    resumed = 0
+    with app.app_context():
+        for name in os.listdir(RECEIPT_SPOOL_DIR):
+            if not name.endswith('.bin'):
+                continue
+            try:
+                receipt_id = int(name[:-4])
+            except ValueError:
+                continue
+            receipt = Receipt.query.get(receipt_id)
+            if not receipt or receipt.processing_status not in ('pending', 'preparing'):
+                try:
+                    os.remove(os.path.join(RECEIPT_SPOOL_DIR, name))
+                except OSError:
+                    pass
+                continue
+            if receipt.processing_status == 'preparing':
+                if not _is_stuck_preparing(receipt):
+                    continue
+                # Interrupted mid-pipeline - reclaim it (atomically, other workers run this too)
+                reclaimed = Receipt.query.filter(
+                    Receipt.id == receipt.id,
+                    Receipt.processing_status == 'preparing'
+                ).update({'processing_status': 'pending'}, synchronize_session=False)
+                db.session.commit()
+                if not reclaimed:
+                    continue
+            executor.submit(run_receipt_pipeline, app, receipt.id, receipt.user_id)
+            resumed += 1
+    return resumed
+
+
+def reset_receipt_for_reprocess(receipt):
+    """Clear OCR-derived fields and items so a receipt can be processed again"""
+    ReceiptItem.query.filter(ReceiptItem.receipt_id == receipt.id).delete()
+
+    receipt.processing_status = 'pending'
+    receipt.processing_error = None
+    receipt.store_name = None
+    receipt.store_address = None
+    receipt.jib = None
+    receipt.pib = None
+    receipt.ibfm = None
+    receipt.receipt_serial_number = None
+    receipt.receipt_date = None
+    receipt.total_amount = None
+    receipt.business_id = None
+    db.session.commit()
+
+
 # ==================== USER ENDPOINTS ====================
 
 @receipts_bp.route('/api/receipts/upload', methods=['POST'])
@@ -1128,7 +1473,8 @@ Return ONLY valid JSON with items array and total_amount."""
 def upload_receipt(user):
     """
     Upload a receipt image
-    Returns immediately with receipt ID, processes OCR in background
+    Returns immediately with receipt ID. Raw bytes are spooled and the
+    worker pool handles image preparation, S3 uploads and OCR.
     """
     if 'image' not in request.files:
         return jsonify({'error': 'No image provided'}), 400
@@ -1148,6 +1494,7 @@ def upload_receipt(user):
     if len(file_data) > 10 * 1024 * 1024:
         return jsonify({'error': 'File too large. Maximum 10MB allowed'}), 400
 
+    receipt_id = None
     try:
         # Create receipt record first to get ID
         receipt = Receipt(
@@ -1156,52 +1503,23 @@ def upload_receipt(user):
             processing_status='pending'
         )
         db.session.add(receipt)
-        db.session.flush()  # Get the ID
-
-        # Upload to S3 with proper path
-        image_url = upload_receipt_image(file_data, user.id, receipt.id)
-        receipt.receipt_image_url = image_url
-
-        # Prepare image(s) for OCR - splits tall images into top/bottom halves
-        image_prep = prepare_images_for_ocr(file_data)
-        is_split = image_prep.get('is_split', False)
-
-        # Upload combined/cropped image to S3 for debugging (shows what OCR analyzes)
-        cropped_url = upload_cropped_receipt_image(image_prep['combined_bytes'], user.id, receipt.id)
-        receipt.cropped_image_url = cropped_url
-
-        # If split, upload individual parts for admin debugging
-        if is_split and 'parts' in image_prep:
-            for part in image_prep['parts']:
-                if part['position'] == 'top':
-                    top_url = upload_split_part_image(part['bytes'], user.id, receipt.id, 'top')
-                    receipt.cropped_top_url = top_url
-                elif part['position'] == 'bottom':
-                    bottom_url = upload_split_part_image(part['bytes'], user.id, receipt.id, 'bottom')
-                    receipt.cropped_bottom_url = bottom_url
-
         db.session.commit()
+        receipt_id = receipt.id
 
-        current_app.logger.info(f"Receipt {receipt.id}: is_split={is_split}, parts={len(image_prep.get('images', []))}")
-
-        # Start background processing
-        app_context = current_app._get_current_object().app_context()
-        thread = threading.Thread(
-            target=process_receipt_ocr,
-            args=(receipt.id, image_prep, app_context),
-            kwargs={'is_split': is_split}
-        )
-        thread.daemon = True
-        thread.start()
+        # Persist raw bytes and hand off to the worker pool
+        spool_receipt_bytes(receipt.id, file_data)
+        enqueue_receipt_processing(receipt.id, user.id)
 
         return jsonify({
             'success': True,
             'receipt': receipt.to_dict(),
-            'message': 'Receipt uploaded, processing started'
+            'message': 'Receipt uploaded, processing queued'
         }), 201
 
     except Exception as e:
         db.session.rollback()
+        if receipt_id:
+            _set_receipt_status(receipt_id, 'failed', error=str(e))
         current_app.logger.error(f"Error uploading receipt: {e}")
         return jsonify({'error': 'Failed to upload receipt'}), 500
 
@@ -1262,10 +1580,7 @@ def delete_receipt(user, receipt_id):
 
     # Delete from S3
     try:
-        s3 = get_s3_client()
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        key = f"receipts/{user.id}/{receipt_id}.jpg"
-        s3.delete_object(Bucket=bucket, Key=key)
+        delete_many(receipt_image_keys(user.id, receipt_id))
     except Exception as e:
         current_app.logger.warning(f"Failed to delete S3 object: {e}")
 
@@ -1287,42 +1602,16 @@ def reprocess_receipt(user, receipt_id):
     if not receipt:
         return jsonify({'error': 'Receipt not found'}), 404
 
-    # Delete existing items
-    ReceiptItem.query.filter(ReceiptItem.receipt_id == receipt_id).delete()
+    # Without a stored image (worker died before the upload) run from the spooled bytes
+    if not receipt.receipt_image_url and not _can_reprocess_from_spool(receipt):
+        return jsonify({'error': 'Receipt image is still being uploaded'}), 409
+    source_url = receipt.receipt_image_url or None
 
-    # Reset receipt
-    receipt.processing_status = 'pending'
-    receipt.processing_error = None
-    receipt.store_name = None
-    receipt.store_address = None
-    receipt.jib = None
-    receipt.pib = None
-    receipt.ibfm = None
-    receipt.receipt_serial_number = None
-    receipt.receipt_date = None
-    receipt.total_amount = None
-    receipt.business_id = None
-    db.session.commit()
+    reset_receipt_for_reprocess(receipt)
 
-    # Download image from S3 and reprocess
+    # Download, preparation and OCR run in the worker pool
     try:
-        import urllib.request
-        with urllib.request.urlopen(receipt.receipt_image_url) as response:
-            image_data = response.read()
-
-        # Prepare image(s) for OCR - splits tall images
-        image_prep = prepare_images_for_ocr(image_data)
-        is_split = image_prep.get('is_split', False)
-
-        # Start background processing
-        app_context = current_app._get_current_object().app_context()
-        thread = threading.Thread(
-            target=process_receipt_ocr,
-            args=(receipt.id, image_prep, app_context),
-            kwargs={'is_split': is_split}
-        )
-        thread.daemon = True
-        thread.start()
+        enqueue_receipt_processing(receipt.id, receipt.user_id, source_url=source_url)
 
         return jsonify({
             'success': True,
@@ -1714,10 +2003,7 @@ def admin_delete_receipt(receipt_id):
 
     # Delete from S3
     try:
-        s3 = get_s3_client()
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        key = f"receipts/{receipt.user_id}/{receipt_id}.jpg"
-        s3.delete_object(Bucket=bucket, Key=key)
+        delete_many(receipt_image_keys(receipt.user_id, receipt_id))
     except Exception as e:
         current_app.logger.warning(f"Failed to delete S3 object: {e}")
 
@@ -1788,42 +2074,16 @@ def admin_reprocess_receipt(receipt_id):
     if model not in allowed_models:
         return jsonify({'error': f'Invalid model. Allowed: {allowed_models}'}), 400
 
-    # Delete existing items
-    ReceiptItem.query.filter(ReceiptItem.receipt_id == receipt_id).delete()
+    # Without a stored image (worker died before the upload) run from the spooled bytes
+    if not receipt.receipt_image_url and not _can_reprocess_from_spool(receipt):
+        return jsonify({'error': 'Receipt image is still being uploaded'}), 409
+    source_url = receipt.receipt_image_url or None
 
-    # Reset receipt
-    receipt.processing_status = 'pending'
-    receipt.processing_error = None
-    receipt.store_name = None
-    receipt.store_address = None
-    receipt.jib = None
-    receipt.pib = None
-    receipt.ibfm = None
-    receipt.receipt_serial_number = None
-    receipt.receipt_date = None
-    receipt.total_amount = None
-    receipt.business_id = None
-    db.session.commit()
+    reset_receipt_for_reprocess(receipt)
 
-    # Download image from S3 and reprocess
+    # Download, preparation and OCR run in the worker pool with the specified model
     try:
-        import urllib.request
-        with urllib.request.urlopen(receipt.receipt_image_url) as response:
-            image_data = response.read()
-
-        # Prepare image(s) for OCR - splits tall images
-        image_prep = prepare_images_for_ocr(image_data)
-        is_split = image_prep.get('is_split', False)
-
-        # Start background processing with specified model
-        app_context = current_app._get_current_object().app_context()
-        thread = threading.Thread(
-            target=process_receipt_ocr,
-            args=(receipt.id, image_prep, app_context, model),
-            kwargs={'is_split': is_split}
-        )
-        thread.daemon = True
-        thread.start()
+        enqueue_receipt_processing(receipt.id, receipt.user_id, model=model, source_url=source_url)
 
         return jsonify({
             'success': True,
@@ -1879,6 +2139,7 @@ def admin_get_api_usage_stats():
     days = request.args.get('days', 30, type=int)
     start_date = datetime.now() - timedelta(days=days)
 
+    # Cache hits (logged with cache_hit=True) are not API calls - see /latency for hit rates
     # Total calls and tokens
     totals = db.session.query(
         func.count(APIUsageLog.id).label('total_calls'),
@@ -1888,7 +2149,8 @@ def admin_get_api_usage_stats():
         func.sum(APIUsageLog.estimated_cost_cents).label('total_cost_cents'),
         func.avg(APIUsageLog.response_time_ms).label('avg_response_time')
     ).filter(
-        APIUsageLog.created_at >= start_date
+        APIUsageLog.created_at >= start_date,
+        APIUsageLog.cache_hit == False
     ).first()
 
     # By provider
@@ -1898,7 +2160,8 @@ def admin_get_api_usage_stats():
         func.sum(APIUsageLog.total_tokens).label('tokens'),
         func.sum(APIUsageLog.estimated_cost_cents).label('cost_cents')
     ).filter(
-        APIUsageLog.created_at >= start_date
+        APIUsageLog.created_at >= start_date,
+        APIUsageLog.cache_hit == False
     ).group_by(APIUsageLog.provider).all()
 
     # By model
@@ -1910,7 +2173,8 @@ def admin_get_api_usage_stats():
         func.sum(APIUsageLog.estimated_cost_cents).label('cost_cents'),
         func.avg(APIUsageLog.response_time_ms).label('avg_response_time')
     ).filter(
-        APIUsageLog.created_at >= start_date
+        APIUsageLog.created_at >= start_date,
+        APIUsageLog.cache_hit == False
     ).group_by(APIUsageLog.model, APIUsageLog.provider).all()
 
     # Daily breakdown
@@ -1920,12 +2184,14 @@ def admin_get_api_usage_stats():
         func.sum(APIUsageLog.total_tokens).label('tokens'),
         func.sum(APIUsageLog.estimated_cost_cents).label('cost_cents')
     ).filter(
-        APIUsageLog.created_at >= start_date
+        APIUsageLog.created_at >= start_date,
+        APIUsageLog.cache_hit == False
     ).group_by(func.date(APIUsageLog.created_at)).order_by(func.date(APIUsageLog.created_at)).all()
 
     # Success rate
     success_count = APIUsageLog.query.filter(
         APIUsageLog.created_at >= start_date,
+        APIUsageLog.cache_hit == False,
         APIUsageLog.success == True
     ).count()
     total_count = totals.total_calls or 0
@@ -1976,3 +2242,85 @@ def admin_get_api_usage_stats():
         ]
     })
 
+
+@receipts_bp.route('/api/admin/api-usage/latency', methods=['GET'])
+@jwt_admin_required
+def admin_get_api_usage_latency():
+    """Admin: LLM/embedding time per endpoint, broken down by feature and model"""
+    from sqlalchemy import func, case
+
+    days = request.args.get('days', 7, type=int)
+    endpoint_filter = request.args.get('endpoint')
+    start_date = datetime.now() - timedelta(days=days)
+
+    # Cache hits count separately; latency stats cover real API calls only
+    # (percentile_cont/avg skip the NULLs the CASE yields for hits)
+    api_time = case((APIUsageLog.cache_hit == False, APIUsageLog.response_time_ms))
+
+    query = db.session.query(
+        func.coalesce(APIUsageLog.endpoint, 'unknown').label('endpoint'),
+        APIUsageLog.feature,
+        APIUsageLog.model,
+        func.count(api_time).label('calls'),
+        func.sum(case((APIUsageLog.cache_hit == True, 1), else_=0)).label('cache_hits'),
+        func.sum(case((APIUsageLog.success == False, 1), else_=0)).label('errors'),
+        func.avg(api_time).label('avg_ms'),
+        func.percentile_cont(0.5).within_group(api_time).label('p50_ms'),
+        func.percentile_cont(0.95).within_group(api_time).label('p95_ms'),
+        func.max(api_time).label('max_ms'),
+        func.sum(api_time).label('total_ms'),
+        func.sum(APIUsageLog.total_tokens).label('tokens'),
+        func.sum(APIUsageLog.estimated_cost_cents).label('cost_cents')
+    ).filter(
+        APIUsageLog.created_at >= start_date
+    )
+    if endpoint_filter:
+        query = query.filter(APIUsageLog.endpoint == endpoint_filter)
+    rows = query.group_by(
+        func.coalesce(APIUsageLog.endpoint, 'unknown'), APIUsageLog.feature, APIUsageLog.model
+    ).all()
+
+    endpoints = {}
+    for r in rows:
+        entry = endpoints.setdefault(r.endpoint, {
+            'endpoint': r.endpoint,
+            'calls': 0,
+            'cache_hits': 0,
+            'total_ms': 0,
+            'cost_cents': 0.0,
+            'breakdown': []
+        })
+        total_ms = int(r.total_ms or 0)
+        cache_hits = int(r.cache_hits or 0)
+        lookups = r.calls + cache_hits  # calls skips rows without response_time_ms
+        entry['calls'] += r.calls
+        entry['cache_hits'] += cache_hits
+        entry['total_ms'] += total_ms
+        entry['cost_cents'] += float(r.cost_cents or 0)
+        entry['breakdown'].append({
+            'feature': r.feature,
+            'model': r.model,
+            'calls': r.calls,
+            'cache_hits': cache_hits,
+            'cache_hit_rate': round(cache_hits / lookups * 100, 1) if lookups else 0,
+            'errors': int(r.errors or 0),
+            'avg_ms': int(r.avg_ms or 0),
+            'p50_ms': int(r.p50_ms or 0),
+            'p95_ms': int(r.p95_ms or 0),
+            'max_ms': int(r.max_ms or 0),
+            'total_ms': total_ms,
+            'tokens': int(r.tokens or 0),
+            'cost_cents': float(r.cost_cents or 0)
+        })
+
+    for entry in endpoints.values():
+        entry['breakdown'].sort(key=lambda b: b['total_ms'], reverse=True)
+        for b in entry['breakdown']:
+            b['share_pct'] = round(b['total_ms'] / entry['total_ms'] * 100, 1) if entry['total_ms'] else 0
+        entry['cost_cents'] = round(entry['cost_cents'], 4)
+
+    return jsonify({
+        'period_days': days,
+        'endpoints': sorted(endpoints.values(), key=lambda e: e['total_ms'], reverse=True)
+    })
+
@@ -19,9 +19,11 @@ from datetime import datetime
 
 import psycopg
 from psycopg.rows import dict_row
-from openai import OpenAI, APIError, RateLimitError, APIConnectionError
+from openai import APIError, RateLimitError, APIConnectionError
 from dotenv import load_dotenv
 
+from llm_clients import get_openai_client
+
 # Load environment variables
 load_dotenv()
 
@@ -42,8 +44,6 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 EMBEDDING_MODEL = "text-embedding-3-small"
 EMBEDDING_DIMENSION = 1536
 BATCH_SIZE = 100
-MAX_RETRIES = 3
-RETRY_DELAY = 2  # seconds
 
 # Validate environment variables
 if not OPENAI_API_KEY:
@@ -54,8 +54,8 @@ if not DATABASE_URL:
     logger.error("DATABASE_URL environment variable is not set")
     sys.exit(1)
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Shared OpenAI client (pooled transport, timeouts, per-model limits)
+openai_client = get_openai_client()
 
 
 def enrich_product_data(product: Dict) -> Dict[str, str]:
@@ -143,52 +143,39 @@ def enrich_product_data(product: Dict) -> Dict[str, str]:
         }
 
 
-def generate_embedding_with_retry(text: str, retries: int = MAX_RETRIES) -> Optional[List[float]]:
+def generate_embedding_with_retry(text: str) -> Optional[List[float]]:
     """
-    Generate embedding with retry logic for transient errors.
+    Generate embedding; transient errors (429, 5xx, connection) are retried
+    with backoff by the shared client (llm_clients).
 
     Args:
         text: Text to generate embedding for
-        retries: Number of retry attempts
 
     Returns:
-        List of floats representing the embedding vector, or None if all retries fail
+        List of floats representing the embedding vector, or None if it failed
     """
-    for attempt in range(retries):
-        try:
-            response = openai_client.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=text
-            )
-            return response.data[0].embedding
-
-        except RateLimitError as e:
-            logger.warning(f"Rate limit error (attempt {attempt + 1}/{retries}): {e}")
-            if attempt < retries - 1:
-                sleep_time = RETRY_DELAY * (2 ** attempt)  # Exponential backoff
-                logger.info(f"Waiting {sleep_time} seconds before retry...")
-                time.sleep(sleep_time)
-            else:
-                logger.error("Max retries reached for rate limit error")
-                return None
-
-        except APIConnectionError as e:
-            logger.warning(f"API connection error (attempt {attempt + 1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(RETRY_DELAY)
-            else:
-                logger.error("Max retries reached for connection error")
-                return None
-
-        except APIError as e:
-            logger.error(f"OpenAI API error: {e}")
-            return None
+    try:
+        response = openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text
+        )
+        return response.data[0].embedding
 
-        except Exception as e:
-            logger.error(f"Unexpected error generating embedding: {e}")
-            return None
+    except RateLimitError as e:
+        logger.error(f"Rate limit error after retries: {e}")
+        return None
+
+    except APIConnectionError as e:
+        logger.error(f"API connection error after retries: {e}")
+        return None
 
-    return None
+    except APIError as e:
+        logger.error(f"OpenAI API error: {e}")
+        return None
+
+    except Exception as e:
+        logger.error(f"Unexpected error generating embedding: {e}")
+        return None
 
 
 def refresh_product_embeddings(full_rebuild: bool = False, product_ids: List[int] = None) -> Dict[str, int]:
@@ -20,6 +20,7 @@ from replit_auth import make_replit_blueprint, require_login
 from openai_utils import (parse_user_preferences, parse_product_text,
                           generate_single_ai_response,
                           normalize_text_for_search, extract_search_intent, match_products_by_tags, smart_rank_products, generate_bulk_product_tags, generate_enriched_description)
+from image_derivatives import variants_for, enqueue_product_derivatives
 from sendgrid_utils import send_contact_email, send_welcome_email, send_verification_email, generate_verification_token, send_invitation_email, send_password_reset_email, plural_bs
 from models import SavingsStatistics
 # Temporarily commenting PDF imports to fix server
@@ -552,6 +553,7 @@ def product_to_dict(product, include_price_history=True):
         'id': safe_get(product, 'id'),
         'title': safe_get(product, 'title'),
         'image_path': safe_get(product, 'image_path'),
+        'image_variants': variants_for(safe_get(product, 'image_path'), safe_get(product, 'image_variants')),
         'base_price': float(base_price) if base_price else 0,
         'discount_price': float(discount_price) if show_discount_info else None,
         'discount_starts': discount_starts_iso if show_discount_info else None,
@@ -1474,6 +1476,46 @@ def api_businesses():
         return jsonify({'error': 'Failed to load businesses'}), 500
 
 
+@app.route('/api/locations/nearby')
+def api_nearby_locations():
+    """
+    Store locations nearest to a point.
+
+    Query params:
+        - lat, lon: Point to search around (required)
+        - k: Number of locations (default 10, max 200)
+        - radius_km: Only locations within this distance
+        - business_ids: Comma-separated business IDs to restrict to
+    """
+    from geo_index import get_location_index, valid_coordinates, MAX_RESULTS
+
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not valid_coordinates(lat, lon):
+        return jsonify({'error': 'Valid lat and lon are required'}), 400
+
+    k = max(1, min(request.args.get('k', 10, type=int), MAX_RESULTS))
+    radius_km = request.args.get('radius_km', type=float)
+    if radius_km is not None and radius_km <= 0:
+        return jsonify({'error': 'radius_km must be positive'}), 400
+
+    business_ids = None
+    if request.args.get('business_ids'):
+        try:
+            business_ids = [int(b) for b in request.args['business_ids'].split(',') if b.strip()]
+        except ValueError:
+            return jsonify({'error': 'Invalid business_ids'}), 400
+
+    try:
+        nearest = get_location_index().nearest(lat, lon, k=k, max_km=radius_km, business_ids=business_ids)
+        return jsonify({
+            'locations': [location.to_dict(distance_km) for distance_km, location in nearest]
+        })
+    except Exception as e:
+        app.logger.error(f"Error in nearby locations API: {e}")
+        return jsonify({'error': 'Failed to load locations'}), 500
+
+
 @app.route('/api/store-discounts-freshness')
 def api_store_discounts_freshness():
     """Get the soonest discount expiration date per store for freshness ticker"""
@@ -2202,9 +2244,8 @@ def api_my_businesses():
 def api_upload_business_logo(business_id):
     """Upload business logo with JWT auth to S3"""
     try:
-        import boto3
+        from storage import delete_url, get_storage
         import uuid
-        import re
 
         business = Business.query.get_or_404(business_id)
 
@@ -2232,24 +2273,14 @@ def api_upload_business_logo(business_id):
                 'error': f'Dozvoljen tip fajla: {", ".join(allowed_extensions)}'
             }), 400
 
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket_name = os.environ.get('AWS_S3_BUCKET', 'aipijaca')
+        storage = get_storage()
 
         # Delete old logo from S3 if it exists
-        if business.logo_path and 'amazonaws.com' in business.logo_path:
+        if business.logo_path:
             try:
-                match = re.search(r'amazonaws\.com/(.+)$', business.logo_path)
-                if match:
-                    old_s3_key = match.group(1)
-                    app.logger.info(f"Deleting old logo from S3: {old_s3_key}")
-                    s3_client.delete_object(Bucket=bucket_name, Key=old_s3_key)
+                old_s3_key = delete_url(business.logo_path)
+                if old_s3_key:
+                    app.logger.info(f"Deleted old logo from S3: {old_s3_key}")
             except Exception as e:
                 app.logger.warning(f"Failed to delete old logo from S3: {e}")
 
@@ -2258,17 +2289,10 @@ def api_upload_business_logo(business_id):
         s3_key = f"assets/images/business_logos/{business_id}/{unique_filename}"
 
         # Upload to S3
-        s3_client.upload_fileobj(
-            file,
-            bucket_name,
-            s3_key,
-            ExtraArgs={
-                'ContentType': file.content_type
-            }
-        )
+        storage.put(s3_key, file, file.content_type)
 
         # Generate S3 URL
-        logo_url = f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION', 'eu-central-1')}.amazonaws.com/{s3_key}"
+        logo_url = storage.url(s3_key)
 
         # Update business record
         business.logo_path = logo_url
@@ -3703,8 +3727,7 @@ def upload_business_logo(business_id):
     from PIL import Image
     import io
     import uuid
-    import boto3
-    import re
+    from storage import delete_url, get_storage
 
     business = Business.query.get_or_404(business_id)
 
@@ -3766,24 +3789,14 @@ def upload_business_logo(business_id):
                 'error': 'Datoteka nije validna slika'
             })
 
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket_name = os.environ.get('AWS_S3_BUCKET', 'aipijaca')
+        storage = get_storage()
 
         # Delete old logo from S3 if it exists
-        if business.logo_path and 'amazonaws.com' in business.logo_path:
+        if business.logo_path:
             try:
-                match = re.search(r'amazonaws\.com/(.+)$', business.logo_path)
-                if match:
-                    old_s3_key = match.group(1)
-                    app.logger.info(f"Deleting old logo from S3: {old_s3_key}")
-                    s3_client.delete_object(Bucket=bucket_name, Key=old_s3_key)
+                old_s3_key = delete_url(business.logo_path)
+                if old_s3_key:
+                    app.logger.info(f"Deleted old logo from S3: {old_s3_key}")
             except Exception as e:
                 app.logger.warning(f"Failed to delete old logo from S3: {e}")
 
@@ -3798,17 +3811,10 @@ def upload_business_logo(business_id):
         buffer.seek(0)
 
         # Upload to S3
-        s3_client.upload_fileobj(
-            buffer,
-            bucket_name,
-            s3_key,
-            ExtraArgs={
-                'ContentType': 'image/png'
-            }
-        )
+        storage.put(s3_key, buffer.getvalue(), 'image/png')
 
         # Generate S3 URL
-        logo_url = f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION', 'eu-central-1')}.amazonaws.com/{s3_key}"
+        logo_url = storage.url(s3_key)
 
         # Update business record
         business.logo_path = logo_url
@@ -4668,10 +4674,9 @@ def delete_single_product(business_id, product_id):
 def upload_product_image(business_id, product_id):
     """Upload product image to S3 and update product"""
     try:
-        import boto3
+        from storage import delete_url, get_storage
         import uuid
         from werkzeug.utils import secure_filename
-        import re
 
         business = Business.query.get_or_404(business_id)
 
@@ -4712,26 +4717,14 @@ def upload_product_image(business_id, product_id):
                 'error': 'Nedozvoljeni tip fajla. Koristite JPG, PNG, GIF ili WEBP'
             }), 400
 
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-        )
-
-        bucket_name = os.environ.get('AWS_S3_BUCKET', 'aipijaca')
+        storage = get_storage()
 
         # Delete old image from S3 if it exists
         if product.image_path:
             try:
-                # Extract S3 key from URL
                 # URL format: https://aipijaca.s3.eu-central-1.amazonaws.com/products/123/filename.jpg
-                match = re.search(r'amazonaws\.com/(.+)$', product.image_path)
-                if match:
-                    old_s3_key = match.group(1)
-                    app.logger.info(f"Deleting old image from S3: {old_s3_key}")
-                    s3_client.delete_object(Bucket=bucket_name, Key=old_s3_key)
+                old_s3_key = delete_url(product.image_path)
+                if old_s3_key:
                     app.logger.info(f"Successfully deleted old image: {old_s3_key}")
             except Exception as e:
                 # Log error but continue with upload - don't fail if old image can't be deleted
@@ -4742,22 +4735,19 @@ def upload_product_image(business_id, product_id):
         s3_key = f"products/{business_id}/{unique_filename}"
 
         # Upload new image to S3
-        s3_client.upload_fileobj(
-            file,
-            bucket_name,
-            s3_key,
-            ExtraArgs={
-                'ContentType': file.content_type
-            }
-        )
+        image_bytes = file.read()
+        storage.put(s3_key, image_bytes, file.content_type)
 
         # Generate S3 URL
-        image_url = f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION', 'eu-central-1')}.amazonaws.com/{s3_key}"
+        image_url = storage.url(s3_key)
 
         # Update product
         product.image_path = image_url
         db.session.commit()
 
+        # Small/medium renditions for listings are built in the background
+        enqueue_product_derivatives(product.id, image_bytes)
+
         app.logger.info(f"Image uploaded for product {product_id}: {image_url}")
 
         return jsonify({
@@ -5221,6 +5211,7 @@ def import_product_images(business_id):
         updated_count = 0
         skipped_count = 0
         errors = []
+        updated_product_ids = []
 
         for idx, row in enumerate(csv_reader, start=2):  # start=2 because row 1 is header
             try:
@@ -5257,6 +5248,7 @@ def import_product_images(business_id):
                     # Update product record with S3 URL
                     old_image = product.image_path
                     product.image_path = image_url
+                    updated_product_ids.append(product.id)
 
                     # Explicitly mark as modified and add to session
                     db.session.add(product)
@@ -5282,6 +5274,10 @@ def import_product_images(business_id):
         db.session.commit()
         app.logger.info(f"Committed {updated_count} product image updates")
 
+        # Renditions are fetched and built by the background derivative workers
+        for updated_id in updated_product_ids:
+            enqueue_product_derivatives(updated_id)
+
         response = {
             'success': True,
             'updated_count': updated_count,
@@ -8043,9 +8039,8 @@ def api_admin_select_image(product_id):
             return jsonify({'error': 'Invalid image path'}), 400
 
         # Build the full S3 URL
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        region = os.environ.get('AWS_REGION', 'eu-central-1')
-        full_url = f"https://{bucket}.s3.{region}.amazonaws.com/{selected_path}"
+        from storage import get_storage
+        full_url = get_storage().url(selected_path)
 
         # Store original image path if not already stored and current image exists
         if not product.original_image_path and product.image_path:
@@ -8055,6 +8050,8 @@ def api_admin_select_image(product_id):
         product.image_path = full_url
         db.session.commit()
 
+        enqueue_product_derivatives(product.id)
+
         return jsonify({
             'success': True,
             'image_path': product.image_path,
@@ -8102,6 +8099,8 @@ def api_admin_revert_image(product_id):
         product.image_path = product.original_image_path
         db.session.commit()
 
+        enqueue_product_derivatives(product.id)
+
         return jsonify({
             'success': True,
             'image_path': product.image_path
@@ -8118,8 +8117,7 @@ def api_admin_revert_image(product_id):
 def api_admin_upload_cropped_image(product_id):
     """Upload a cropped image for a product"""
     from auth_api import decode_jwt_token
-    import boto3
-    from botocore.exceptions import ClientError
+    from storage import StorageError, get_storage
     import uuid
 
     # Check JWT authentication
@@ -8160,37 +8158,24 @@ def api_admin_upload_cropped_image(product_id):
         s3_path = f"popust/products/{product_id}/cropped_{unique_id}.jpg"
 
         # Upload to S3
-        bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-        region = os.environ.get('AWS_REGION', 'eu-central-1')
-
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-            region_name=region
-        )
-
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=s3_path,
-            Body=image_data,
-            ContentType='image/jpeg',
-            CacheControl='max-age=31536000'
-        )
+        storage = get_storage()
+        storage.put(s3_path, image_data, 'image/jpeg', cache_control='max-age=31536000')
 
         # Build full URL
-        full_url = f"https://{bucket}.s3.{region}.amazonaws.com/{s3_path}"
+        full_url = storage.url(s3_path)
 
         # Update product
         product.image_path = full_url
         db.session.commit()
 
+        enqueue_product_derivatives(product.id, image_data)
+
         return jsonify({
             'success': True,
             'image_path': full_url
         }), 200
 
-    except ClientError as e:
+    except StorageError as e:
         app.logger.error(f"S3 upload error: {e}")
         return jsonify({'error': 'Failed to upload image'}), 500
     except Exception as e:
@@ -8481,9 +8466,10 @@ def api_admin_ai_match_images(product_id):
 
         # If we have suggestions, verify at least some exist in S3
         if suggested_images and not force_refresh:
-            from image_matcher import check_image_exists
-            # Check first 3 images - if none exist, we need to refresh
-            existing = [p for p in suggested_images[:3] if check_image_exists(p)]
+            from image_matcher import check_images_exist
+            # Check first 3 images (one prefix listing) - if none exist, we need to refresh
+            exists = check_images_exist(suggested_images[:3])
+            existing = [p for p in suggested_images[:3] if exists.get(p)]
             if not existing:
                 app.logger.info(f"Suggested images for product {product_id} no longer exist in S3, refreshing...")
                 suggested_images = []
@@ -8527,6 +8513,89 @@ def api_admin_ai_match_images(product_id):
         return jsonify({'error': 'Internal server error'}), 500
 
 
+# Products per synchronous batch request: suggestion fetches (up to
+# IMAGE_SUGGESTION_DEADLINE each, 8 at a time) plus the Vision requests must
+# finish well inside the gunicorn timeout (120s). The admin UI sends 10.
+AI_MATCH_BATCH_LIMIT = 10
+
+
+@app.route('/api/admin/products/ai-match-images/batch', methods=['POST'])
+@csrf.exempt
+def api_admin_ai_match_images_batch():
+    """Run AI image matching for several products with batched Vision requests"""
+    from concurrent.futures import ThreadPoolExecutor
+    from auth_api import decode_jwt_token
+    from image_search import search_and_upload_suggestions
+    from image_matcher import check_images_exist, match_products_batch
+
+    # Check JWT authentication
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        token = auth_header.split(' ')[1] if ' ' in auth_header else auth_header
+        payload = decode_jwt_token(token)
+
+        if not payload:
+            return jsonify({'error': 'Invalid or expired token'}), 401
+
+        # Get user and check if admin
+        admin_user = User.query.filter_by(id=payload['user_id']).first()
+        if not admin_user or not admin_user.is_admin:
+            return jsonify({'error': 'Access denied'}), 403
+
+        data = request.get_json() or {}
+        product_ids = data.get('product_ids') or []
+        force_refresh = bool(data.get('force_refresh', False))
+        if not isinstance(product_ids, list) or not product_ids:
+            return jsonify({'error': 'product_ids is required'}), 400
+        if len(product_ids) > AI_MATCH_BATCH_LIMIT:
+            return jsonify({'error': f'Maximum {AI_MATCH_BATCH_LIMIT} products per batch'}), 400
+
+        products = Product.query.filter(Product.id.in_([int(pid) for pid in product_ids])).all()
+
+        # Suggestions that are still stored (one prefix listing for the whole batch)
+        exists = check_images_exist([p for product in products for p in (product.suggested_images or [])[:3]])
+        needs_suggestions = [
+            product for product in products
+            if force_refresh or not any(exists.get(p) for p in (product.suggested_images or [])[:3])
+        ]
+
+        # Fetch missing suggestions concurrently (no DB access in the workers)
+        if needs_suggestions:
+            with ThreadPoolExecutor(max_workers=min(8, len(needs_suggestions))) as executor:
+                fetched = list(executor.map(
+                    lambda item: search_and_upload_suggestions(item[0], item[1], num_images=10, is_custom_query=False),
+                    [(product.id, product.title) for product in needs_suggestions]
+                ))
+            for product, suggestions in zip(needs_suggestions, fetched):
+                if suggestions:
+                    product.suggested_images = suggestions
+            db.session.commit()
+
+        results = match_products_batch([
+            {
+                'id': product.id,
+                'title': product.title,
+                'original_image_path': product.original_image_path,
+                'suggested_image_paths': product.suggested_images or [],
+            }
+            for product in products
+        ])
+
+        return jsonify({
+            'results': {str(product_id): result for product_id, result in results.items()},
+            'missing': [pid for pid in product_ids if int(pid) not in results]
+        }), 200
+
+    except Exception as e:
+        app.logger.error(f"AI batch image match error: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 # Valid category groups for products
 VALID_CATEGORY_GROUPS = [
     'meso', 'mlijeko', 'pica', 'voce_povrce', 'kuhinja', 'ves', 'ciscenje',
@@ -8689,27 +8758,14 @@ Use ALL available info (title + category + tags) to determine the fields."""
                         {"role": "user", "content": user_prompt}
                     ]
 
-                    # Retry with exponential backoff for rate limits
-                    max_retries = 3
-                    for retry in range(max_retries):
-                        try:
-                            response = openai_client.chat.completions.create(
-                                model="gpt-4o-mini",
-                                messages=messages,
-                                response_format={"type": "json_object"},
-                                temperature=0.2,
-                                max_tokens=4000
-                            )
-                            break
-                        except Exception as api_error:
-                            if 'rate_limit' in str(api_error).lower() or '429' in str(api_error):
-                                wait_time = (2 ** retry) * 5  # 5s, 10s, 20s
-                                app.logger.warning(f"Rate limit hit, waiting {wait_time}s before retry {retry + 1}/{max_retries}")
-                                time_module.sleep(wait_time)
-                                if retry == max_retries - 1:
-                                    raise
-                            else:
-                                raise
+                    # Rate limits are retried with backoff by the shared client (llm_clients)
+                    response = openai_client.chat.completions.create(
+                        model="gpt-4o-mini",
+                        messages=messages,
+                        response_format={"type": "json_object"},
+                        temperature=0.2,
+                        max_tokens=4000
+                    )
 
                     result_text = response.choices[0].message.content.strip()
                     app.logger.info(f"Background job {job_id}: AI response: {result_text[:500]}")
@@ -2,19 +2,20 @@
 Semantic Search using Vector Embeddings
 Uses OpenAI embeddings and PostgreSQL pgvector for similarity search
 """
-import os
 import logging
 from datetime import date
 from typing import List, Dict, Any, Optional
-from openai import OpenAI
 from sqlalchemy import text
 from app import db
 from models import Product, ProductEmbedding, Business
+from image_derivatives import variants_for
+from llm_clients import get_openai_client
+from vector_shards import shard_candidates_cte
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Shared OpenAI client (pooled transport, timeouts, per-model limits)
+openai_client = get_openai_client()
 
 
 def semantic_search(
@@ -101,6 +102,7 @@ def semantic_search(
                 p.tags,
                 p.city,
                 p.image_path,
+                p.image_variants,
                 p.product_url,
                 p.views,
                 p.enriched_description,
@@ -137,23 +139,40 @@ def semantic_search(
         }
 
         # Add filters
+        product_filters = []
         if price_max is not None:
-            sql_parts.append("AND COALESCE(p.discount_price, p.base_price) <= :price_max")
+            product_filters.append("COALESCE(p.discount_price, p.base_price) <= :price_max")
             params['price_max'] = price_max
 
         if price_min is not None:
-            sql_parts.append("AND COALESCE(p.discount_price, p.base_price) >= :price_min")
+            product_filters.append("COALESCE(p.discount_price, p.base_price) >= :price_min")
             params['price_min'] = price_min
 
         if category is not None:
-            sql_parts.append("AND p.category = :category")
+            product_filters.append("p.category = :category")
             params['category'] = category
 
+        sql_parts.extend(f"AND {condition}" for condition in product_filters)
+
         # Filter by business IDs if provided
         if business_ids is not None and len(business_ids) > 0:
             sql_parts.append("AND p.business_id = ANY(:business_ids)")
             params['business_ids'] = business_ids
 
+            # Take candidates from the selected stores' own vector indexes
+            # instead of post-filtering the global one (see vector_shards)
+            shard_cte = shard_candidates_cte(
+                db.session, business_ids, f"'{embedding_str}'::vector", max(k * 10, 100),
+                filter_sql=" AND ".join(product_filters) or None,
+                text_match=(
+                    f"LOWER(p.title) LIKE '%{query_stem}%'",
+                    f"CASE WHEN LOWER(p.title) LIKE '%{query_escaped}%' THEN 1 ELSE 0 END",
+                ),
+            )
+            if shard_cte:
+                sql_parts.insert(0, f"WITH {shard_cte}")
+                sql_parts.append("AND p.id IN (SELECT product_id FROM shard_candidates)")
+
         # Add similarity threshold and ordering
         sql_parts.append(f"""
             AND (1 - (pe.embedding <=> '{embedding_str}'::vector)) >= :min_similarity
@@ -184,6 +203,7 @@ def semantic_search(
                 'tags': row.tags,
                 'city': row.city,
                 'image_url': row.image_path,
+                'image_variants': variants_for(row.image_path, row.image_variants),
                 'product_url': row.product_url,
                 'views': row.views,
                 'enriched_description': row.enriched_description,
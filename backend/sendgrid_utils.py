@@ -4,7 +4,10 @@ Clean, minimalistic templates with white background and logo.
 """
 import os
 import logging
+import random
 import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Content
 
@@ -21,6 +24,9 @@ SENDGRID_ENABLED = bool(SENDGRID_API_KEY)
 if not SENDGRID_ENABLED:
     logger.warning("SendGrid API key not configured. Emails will be logged only.")
 
+# Background sender for emails that shouldn't hold up a request
+EMAIL_QUEUE_WORKERS = int(os.environ.get("EMAIL_QUEUE_WORKERS", "2"))
+
 # Base URL
 BASE_URL = os.environ.get("BASE_URL", "https://popust.ba")
 LOGO_URL = "https://popust.ba/logo.png"
@@ -211,6 +217,20 @@ def get_button(text: str, url: str, color: str = "#7C3AED", campaign: str = None
 </tr></table>'''
 
 
+_sendgrid_client = None
+_sendgrid_client_lock = threading.Lock()
+
+
+def get_sendgrid_client() -> SendGridAPIClient:
+    """Process-wide SendGrid client (built once, shared by all senders)"""
+    global _sendgrid_client
+    if _sendgrid_client is None:
+        with _sendgrid_client_lock:
+            if _sendgrid_client is None:
+                _sendgrid_client = SendGridAPIClient(SENDGRID_API_KEY)
+    return _sendgrid_client
+
+
 def send_email(to_email: str, subject: str, html_content: str) -> bool:
     """
     Send email via SendGrid API
@@ -237,8 +257,7 @@ def send_email(to_email: str, subject: str, html_content: str) -> bool:
             html_content=Content("text/html", html_content)
         )
 
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
+        response = get_sendgrid_client().send(message)
 
         if response.status_code in [200, 202]:
             logger.info(f"Email sent successfully to {to_email}")
@@ -252,6 +271,39 @@ def send_email(to_email: str, subject: str, html_content: str) -> bool:
         return False
 
 
+_email_executor = None
+_email_executor_lock = threading.Lock()
+
+
+def _get_email_executor():
+    global _email_executor
+    if _email_executor is None:
+        with _email_executor_lock:
+            if _email_executor is None:
+                _email_executor = ThreadPoolExecutor(
+                    max_workers=EMAIL_QUEUE_WORKERS, thread_name_prefix='email-sender'
+                )
+    return _email_executor
+
+
+def _send_queued(send_func, args, kwargs):
+    try:
+        if not send_func(*args, **kwargs):
+            logger.error(f"Queued email {send_func.__name__} was not sent")
+    except Exception as e:
+        logger.error(f"Queued email {send_func.__name__} failed: {e}")
+
+
+def queue_email(send_func, *args, **kwargs):
+    """
+    Send an email on the background sender instead of the calling thread.
+
+    send_func is one of the send_* helpers; pass plain data (not ORM objects),
+    it runs after the request's session is gone. Failures are logged.
+    """
+    _get_email_executor().submit(_send_queued, send_func, args, kwargs)
+
+
 def send_verification_email(user_email: str, user_name: str, verification_token: str, base_url: str = None) -> bool:
     """Send email verification to new users"""
     base = base_url or BASE_URL
@@ -414,10 +466,8 @@ def send_contact_email(user_name: str, user_email: str, message: str) -> bool:
     return send_email(admin_email, subject, html)
 
 
-def send_scan_summary_email(user_email: str, user_name: str, summary: dict, user_id: str = None) -> bool:
-    """Send daily product scan summary email with optional magic link authentication"""
-    import random
-
+def render_scan_summary_email(user_name: str, summary: dict, user_id: str = None) -> tuple:
+    """Render the daily product scan summary email (subject, html) with optional magic link authentication"""
     total = summary.get('total_products', 0)
     new_products = summary.get('new_products', 0)
     new_discounts = summary.get('new_discounts', 0)
@@ -532,13 +582,17 @@ Vi dobijate ovaj email jer ste aktivirali praćenje proizvoda na Popust.ba.
 </div>
 '''
 
-    html = get_base_template(content, "#7C3AED")
-    return send_email(user_email, subject, html)
+    return subject, get_base_template(content, "#7C3AED")
 
 
-def send_weekly_summary_email(user_email: str, user_name: str, summary: dict) -> bool:
+def send_scan_summary_email(user_email: str, user_name: str, summary: dict, user_id: str = None) -> bool:
+    """Send the daily product scan summary email (see render_scan_summary_email)"""
+    return send_email(user_email, *render_scan_summary_email(user_name, summary, user_id))
+
+
+def render_weekly_summary_email(user_name: str, summary: dict) -> tuple:
     """
-    Send weekly comprehensive summary email with all tracked products.
+    Render the weekly comprehensive summary email (subject, html) with all tracked products.
 
     Features behavioral psychology:
     - Savings Framing: >= 10 KM uses direct savings, < 10 KM reframes as "avoided overpaying"
@@ -794,8 +848,12 @@ Primate ovaj email jednom sedmično jer imate aktivno praćenje proizvoda na Pop
     else:
         subject = f"Sedmični pregled Vaših praćenih proizvoda"
 
-    html = get_base_template(content, "#7C3AED")
-    return send_email(user_email, subject, html)
+    return subject, get_base_template(content, "#7C3AED")
+
+
+def send_weekly_summary_email(user_email: str, user_name: str, summary: dict) -> bool:
+    """Send the weekly summary email (see render_weekly_summary_email)"""
+    return send_email(user_email, *render_weekly_summary_email(user_name, summary))
 
 
 def send_bonus_credits_email(user_email: str, user_name: str, credits_amount: int, reason: str, admin_message: str = None) -> bool:
@@ -1358,9 +1416,9 @@ Hvala što koristite Popust.ba ekskluzivne ponude!
     return send_email(user_email, subject, html)
 
 
-def send_reengagement_email(user_email: str, user_name: str, data: dict) -> bool:
+def render_reengagement_email(user_name: str, data: dict) -> tuple:
     """
-    Send monthly re-engagement email to users without tracked products.
+    Render the monthly re-engagement email (subject, html) for users without tracked products.
     Shows popular items others are tracking and best current deals.
 
     data should contain:
@@ -1368,8 +1426,6 @@ def send_reengagement_email(user_email: str, user_name: str, data: dict) -> bool
     - best_deals: list of dicts [{title, store, discount_price, discount_percent}]
     - total_users_tracking: int (how many users are tracking products)
     """
-    import random
-
     greeting = f" {user_name}" if user_name else ""
 
     popular_terms = data.get('popular_terms', [])
@@ -1462,8 +1518,12 @@ Ovaj email primate jednom mjesečno. Za upravljanje obavještenjima posjetite <a
         "Postavite praćenje za artikle koje već kupujete",
     ]
     subject = random.choice(subject_options)
-    html = get_base_template(content, "#7C3AED")
-    return send_email(user_email, subject, html)
+    return subject, get_base_template(content, "#7C3AED")
+
+
+def send_reengagement_email(user_email: str, user_name: str, data: dict) -> bool:
+    """Send the re-engagement email (see render_reengagement_email)"""
+    return send_email(user_email, *render_reengagement_email(user_name, data))
 
 
 def send_new_rating_notification_email(recipient_email: str, recipient_name: str, rating_data: dict, is_business: bool = False) -> bool:
@@ -1551,9 +1611,9 @@ def send_new_rating_notification_email(recipient_email: str, recipient_name: str
 # ACTIVATION / WIN-BACK EMAIL FOR INACTIVE USERS
 # =============================================================================
 
-def send_activation_email(user_email: str, user_name: str, example_savings: dict = None) -> bool:
+def render_activation_email(user_name: str, example_savings: dict = None) -> tuple:
     """
-    Send weekly activation email to users WITHOUT tracked products.
+    Render the weekly activation email (subject, html) for users WITHOUT tracked products.
     Shows example savings they could achieve to encourage feature adoption.
 
     example_savings should contain real platform data:
@@ -1658,5 +1718,9 @@ Primate ovaj email jer ste registrovani na Popust.ba.
         f"Ovo je najlakša ušteda ove sedmice: {avg_savings:.2f} KM",
     ]
     subject = random.choice(subject_options)
-    html = get_base_template(content, "#10B981")
-    return send_email(user_email, subject, html)
+    return subject, get_base_template(content, "#10B981")
+
+
+def send_activation_email(user_email: str, user_name: str, example_savings: dict = None) -> bool:
+    """Send the activation email (see render_activation_email)"""
+    return send_email(user_email, *render_activation_email(user_name, example_savings))
@@ -7,15 +7,164 @@ To configure in SendGrid:
 2. Set HTTP Post URL to: https://popust.ba/api/webhooks/sendgrid
 3. Enable events: Opened, Clicked, Delivered, Bounced, Dropped
 4. Save
+
+A POST carries up to a few thousand events. They are ingested as a batch:
+one query resolves every email to a user id, and the rows go in as multi-row
+INSERT ... ON CONFLICT (sg_event_id) DO NOTHING, so SendGrid retries of
+events we already stored are dropped by the database instead of being looked
+up one by one.
+
+With SENDGRID_WEBHOOK_ASYNC=true the batch is handed to a background thread
+and the request returns 200 straight away, so a slow database never makes
+SendGrid time out and resend the whole batch. Events queued in a worker that
+dies before ingesting them are lost (SendGrid already got its 200); when the
+queue is full the request ingests synchronously instead.
+
+Environment:
+    SENDGRID_WEBHOOK_ASYNC        'true' defers ingestion to a background thread (default: false)
+    SENDGRID_WEBHOOK_MAX_PENDING  Batches waiting for the background thread before
+                                  requests fall back to synchronous ingestion (default: 100)
 """
 from flask import Blueprint, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
+import os
+import threading
 
 sendgrid_webhook_bp = Blueprint('sendgrid_webhook', __name__, url_prefix='/api/webhooks')
 
 logger = logging.getLogger(__name__)
 
+WEBHOOK_ASYNC = os.environ.get('SENDGRID_WEBHOOK_ASYNC', 'false').lower() == 'true'
+WEBHOOK_MAX_PENDING = int(os.environ.get('SENDGRID_WEBHOOK_MAX_PENDING', '100'))
+INSERT_BATCH_SIZE = 1000  # Rows per INSERT statement
+
+_ingest_executor = None
+_ingest_executor_lock = threading.Lock()
+_ingest_slots = threading.BoundedSemaphore(WEBHOOK_MAX_PENDING)
+
+
+def _parse_events(events):
+    """
+    Validate the payload and build email_events rows.
+
+    Returns (rows, skipped). Events without email/event type are skipped, as
+    are repeats of an sg_event_id within the same payload.
+    """
+    rows = []
+    skipped = 0
+    seen_event_ids = set()
+    now = datetime.now()
+
+    for event in events:
+        if not isinstance(event, dict):
+            skipped += 1
+            continue
+
+        email = event.get('email')
+        event_type = event.get('event')
+        sg_event_id = event.get('sg_event_id')
+        timestamp = event.get('timestamp')
+
+        if not email or not event_type:
+            skipped += 1
+            continue
+
+        if sg_event_id:
+            if sg_event_id in seen_event_ids:
+                skipped += 1
+                continue
+            seen_event_ids.add(sg_event_id)
+
+        event_time = now
+        if timestamp:
+            try:
+                event_time = datetime.fromtimestamp(int(timestamp))
+            except (ValueError, TypeError, OverflowError, OSError):
+                pass
+
+        rows.append({
+            'email': email,
+            'event_type': event_type,
+            'user_id': None,
+            'sg_message_id': event.get('sg_message_id'),
+            'sg_event_id': sg_event_id or None,
+            'url': event.get('url'),  # For click events
+            'user_agent': event.get('useragent'),
+            'ip': event.get('ip'),
+            'timestamp': event_time,
+            'created_at': now,
+        })
+
+    return rows, skipped
+
+
+def ingest_events(events):
+    """
+    Store a webhook payload; returns (processed, skipped).
+
+    processed counts rows actually inserted - events whose sg_event_id is
+    already stored (SendGrid retries) count as skipped. Commits; on error the
+    session is rolled back and the exception re-raised.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+    from app import db
+    from models import EmailEvent, User
+
+    rows, skipped = _parse_events(events)
+    if not rows:
+        return 0, skipped
+
+    try:
+        emails = list({row['email'] for row in rows})
+        user_ids = dict(
+            db.session.query(User.email, User.id).filter(User.email.in_(emails)).all()
+        )
+        for row in rows:
+            row['user_id'] = user_ids.get(row['email'])
+
+        processed = 0
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            stmt = (
+                insert(EmailEvent)
+                .values(rows[start:start + INSERT_BATCH_SIZE])
+                .on_conflict_do_nothing(index_elements=['sg_event_id'])
+                .returning(EmailEvent.id)
+            )
+            processed += len(db.session.execute(stmt).fetchall())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return processed, skipped + len(rows) - processed
+
+
+def _get_ingest_executor():
+    global _ingest_executor
+    if _ingest_executor is None:
+        with _ingest_executor_lock:
+            if _ingest_executor is None:
+                _ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sendgrid-webhook')
+    return _ingest_executor
+
+
+def _ingest_deferred(app, events):
+    from app import db
+
+    try:
+        with app.app_context():
+            try:
+                processed, skipped = ingest_events(events)
+                logger.info(f"SendGrid webhook (deferred): processed {processed}, skipped {skipped}")
+            finally:
+                db.session.remove()
+    except Exception as e:
+        logger.error(f"SendGrid webhook: deferred batch of {len(events)} events failed: {e}", exc_info=True)
+    finally:
+        _ingest_slots.release()
+
 
 @sendgrid_webhook_bp.route('/sendgrid', methods=['POST'])
 def handle_sendgrid_events():
@@ -25,8 +174,7 @@ def handle_sendgrid_events():
     SendGrid sends an array of events in the request body.
     Each event contains: email, event, timestamp, sg_event_id, etc.
     """
-    from app import db
-    from models import EmailEvent, User
+    from flask import current_app
 
     try:
         events = request.get_json()
@@ -35,60 +183,17 @@ def handle_sendgrid_events():
             logger.warning("Invalid SendGrid webhook payload")
             return jsonify({'status': 'error', 'message': 'Invalid payload'}), 400
 
-        processed = 0
-        skipped = 0
-
-        for event in events:
-            try:
-                email = event.get('email')
-                event_type = event.get('event')
-                sg_event_id = event.get('sg_event_id')
-                timestamp = event.get('timestamp')
-
-                if not email or not event_type:
-                    skipped += 1
-                    continue
-
-                # Check for duplicate (SendGrid may retry)
-                if sg_event_id:
-                    existing = EmailEvent.query.filter_by(sg_event_id=sg_event_id).first()
-                    if existing:
-                        skipped += 1
-                        continue
-
-                # Find user by email
-                user = User.query.filter_by(email=email).first()
-
-                # Parse timestamp
-                event_time = datetime.now()
-                if timestamp:
-                    try:
-                        event_time = datetime.fromtimestamp(int(timestamp))
-                    except (ValueError, TypeError):
-                        pass
-
-                # Create email event record
-                email_event = EmailEvent(
-                    email=email,
-                    event_type=event_type,
-                    user_id=user.id if user else None,
-                    sg_message_id=event.get('sg_message_id'),
-                    sg_event_id=sg_event_id,
-                    url=event.get('url'),  # For click events
-                    user_agent=event.get('useragent'),
-                    ip=event.get('ip'),
-                    timestamp=event_time
-                )
-
-                db.session.add(email_event)
-                processed += 1
-
-            except Exception as e:
-                logger.error(f"Error processing event: {e}")
-                skipped += 1
-                continue
-
-        db.session.commit()
+        if WEBHOOK_ASYNC:
+            if _ingest_slots.acquire(blocking=False):
+                try:
+                    _get_ingest_executor().submit(_ingest_deferred, current_app._get_current_object(), events)
+                except Exception:
+                    _ingest_slots.release()
+                    raise
+                return jsonify({'status': 'accepted', 'queued': len(events)})
+            logger.warning("SendGrid webhook queue full, ingesting synchronously")
+
+        processed, skipped = ingest_events(events)
         logger.info(f"SendGrid webhook: processed {processed}, skipped {skipped}")
 
         return jsonify({
@@ -99,5 +204,4 @@ def handle_sendgrid_events():
 
     except Exception as e:
         logger.error(f"SendGrid webhook error: {e}", exc_info=True)
-        db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
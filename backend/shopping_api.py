@@ -581,6 +581,63 @@ def get_shopping_list_sidebar():
         return jsonify({'error': 'Internal server error'}), 500
 
 
+@shopping_api_bp.route('/shopping-list/optimize', methods=['GET'])
+@require_jwt_auth
+def optimize_shopping_list_basket():
+    """
+    Cheapest single-store and best k-store split for the active list.
+
+    Query params:
+        max_stores: Max stores in the split basket (1-4, default 2)
+        substitutes: Allow brand variants ('true'/'false', default 'true')
+        business_ids: Optional comma-separated store whitelist
+    """
+    try:
+        from basket_optimizer import optimize_shopping_list, DEFAULT_MAX_STORES
+
+        user_id = request.current_user_id
+
+        active_list = ShoppingList.query.filter_by(
+            user_id=user_id,
+            status='ACTIVE'
+        ).filter(
+            ShoppingList.expires_at > datetime.now()
+        ).first()
+
+        if not active_list:
+            return jsonify({'list_id': None, 'single_store': None, 'split': None}), 200
+
+        max_stores = request.args.get('max_stores', DEFAULT_MAX_STORES, type=int)
+        max_stores = max(1, min(max_stores, 4))
+        allow_substitutes = request.args.get('substitutes', 'true').lower() != 'false'
+
+        business_ids = None
+        business_ids_param = request.args.get('business_ids', '')
+        if business_ids_param:
+            try:
+                business_ids = [int(bid) for bid in business_ids_param.split(',') if bid.strip()]
+            except ValueError:
+                return jsonify({'error': 'business_ids must be comma-separated integers'}), 400
+
+        result = optimize_shopping_list(
+            active_list.id,
+            max_stores=max_stores,
+            allow_substitutes=allow_substitutes,
+            business_ids=business_ids
+        )
+
+        # Logo paths -> servable URLs
+        for solution in (result.get('single_store'), result.get('split')):
+            for group in (solution or {}).get('stores', []):
+                group['store']['logo'] = format_logo_url(group['store']['logo'])
+
+        return jsonify(result), 200
+
+    except Exception as e:
+        logger.error(f"Error optimizing shopping list: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 @shopping_api_bp.route('/shopping-list/items/<int:item_id>/purchase', methods=['PATCH'])
 @require_jwt_auth
 def mark_item_purchased(item_id):
@@ -0,0 +1,311 @@
+"""
+Object storage for uploaded and generated images.
+
+One process-wide backend instance is shared by every request thread:
+- S3Storage (default): a single boto3 client with a connection pool sized for
+  the gthread workers, so requests reuse TLS connections instead of building
+  a client per upload.
+- LocalStorage (STORAGE_BACKEND=local): files under LOCAL_STORAGE_DIR, for
+  tests and local load runs without AWS credentials.
+
+Multi-object puts run on a shared thread pool (put_many); multi-object
+deletes go out as batched delete_objects calls (delete_many/delete_prefix).
+
+Environment:
+    STORAGE_BACKEND       's3' (default) or 'local'
+    AWS_S3_BUCKET         Bucket name (falls back to S3_BUCKET_NAME, then 'aipijaca')
+    AWS_REGION            Region (default: eu-central-1)
+    S3_MAX_POOL           Max pooled HTTP connections to S3 (default: 32)
+    STORAGE_WORKERS       Threads for put_many/delete_many (default: 8)
+    LOCAL_STORAGE_DIR     Root directory for the local backend
+    LOCAL_STORAGE_URL     Public URL prefix for the local backend
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+S3_DELETE_BATCH = 1000  # delete_objects limit per request
+
+
+class StorageError(Exception):
+    """Raised by storage backends when an object operation fails"""
+
+
+def get_bucket_name():
+    return os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
+
+
+def get_region():
+    return os.environ.get('AWS_REGION', 'eu-central-1')
+
+
+def _read_body(data):
+    """Accept bytes or a file-like object (e.g. werkzeug FileStorage)"""
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return data.read()
+
+
+class S3Storage:
+    """S3 backend sharing one pooled, thread-safe boto3 client"""
+
+    name = 's3'
+
+    def __init__(self, bucket=None, region=None, max_pool_connections=None):
+        self.bucket = bucket or get_bucket_name()
+        self.region = region or get_region()
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            region_name=self.region,
+            config=Config(
+                max_pool_connections=max_pool_connections or int(os.environ.get('S3_MAX_POOL', '32')),
+                retries={'max_attempts': 3, 'mode': 'standard'},
+            )
+        )
+
+    def url(self, key):
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def key_from_url(self, url):
+        """Extract the object key from a stored S3 URL (None if it is not one)"""
+        if not url:
+            return None
+        match = re.search(r'amazonaws\.com/(.+)$', url)
+        return match.group(1) if match else None
+
+    def put(self, key, data, content_type='application/octet-stream', cache_control=None):
+        extra = {'ContentType': content_type}
+        if cache_control:
+            extra['CacheControl'] = cache_control
+        try:
+            if isinstance(data, (bytes, bytearray)):
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(data), **extra)
+            else:
+                # Streams file-like bodies (multipart for large files)
+                self.client.upload_fileobj(data, self.bucket, key, ExtraArgs=extra)
+        except (ClientError, BotoCoreError) as e:
+            raise StorageError(f"S3 put {key} failed: {e}") from e
+        return key
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except (ClientError, BotoCoreError) as e:
+            raise StorageError(f"S3 get {key} failed: {e}") from e
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise StorageError(f"S3 head {key} failed: {e}") from e
+        except BotoCoreError as e:
+            raise StorageError(f"S3 head {key} failed: {e}") from e
+
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+        except (ClientError, BotoCoreError) as e:
+            raise StorageError(f"S3 delete {key} failed: {e}") from e
+
+    def list_keys(self, prefix):
+        keys = []
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        except (ClientError, BotoCoreError) as e:
+            raise StorageError(f"S3 list {prefix} failed: {e}") from e
+        return keys
+
+    def delete_keys(self, keys):
+        """Delete keys with batched delete_objects calls (1000 per request)"""
+        keys = list(keys)
+        try:
+            for i in range(0, len(keys), S3_DELETE_BATCH):
+                batch = keys[i:i + S3_DELETE_BATCH]
+                self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True}
+                )
+        except (ClientError, BotoCoreError) as e:
+            raise StorageError(f"S3 batch delete failed: {e}") from e
+        return len(keys)
+
+
+class LocalStorage:
+    """Filesystem backend with the same interface as S3Storage"""
+
+    name = 'local'
+
+    def __init__(self, root=None, base_url=None):
+        self.root = os.path.abspath(root or os.environ.get('LOCAL_STORAGE_DIR')
+                                    or os.path.join(tempfile.gettempdir(), 'local_storage'))
+        self.base_url = (base_url or os.environ.get('LOCAL_STORAGE_URL') or f"file://{self.root}").rstrip('/')
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Invalid storage key: {key}")
+        return path
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+    def key_from_url(self, url):
+        if not url or not url.startswith(self.base_url + '/'):
+            return None
+        return url[len(self.base_url) + 1:]
+
+    def put(self, key, data, content_type='application/octet-stream', cache_control=None):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent readers never see a partial file
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(_read_body(data))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            raise StorageError(f"Local put {key} failed: {e}") from e
+        return key
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except OSError as e:
+            raise StorageError(f"Local get {key} failed: {e}") from e
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass  # S3 delete_object is idempotent too
+        except OSError as e:
+            raise StorageError(f"Local delete {key} failed: {e}") from e
+
+    def list_keys(self, prefix):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete_keys(self, keys):
+        count = 0
+        for key in keys:
+            self.delete(key)
+            count += 1
+        return count
+
+    def clear(self):
+        """Remove everything (tests and load runs only)"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_storage():
+    """Get the process-wide storage backend (created on first use)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                backend = os.environ.get('STORAGE_BACKEND', 's3').lower()
+                _storage = LocalStorage() if backend == 'local' else S3Storage()
+    return _storage
+
+
+def set_storage(storage):
+    """Swap the backend (tests / load runs); returns the previous one"""
+    global _storage
+    with _storage_lock:
+        previous, _storage = _storage, storage
+    return previous
+
+
+def get_storage_executor():
+    """Shared thread pool for concurrent multi-object operations"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('STORAGE_WORKERS', '8')),
+                    thread_name_prefix='storage'
+                )
+    return _executor
+
+
+def put_many(items, cache_control=None):
+    """
+    Upload several objects concurrently.
+
+    Args:
+        items: Iterable of (key, data, content_type)
+        cache_control: Optional Cache-Control header for every object
+
+    Returns:
+        List of keys in input order; None for objects that failed
+    """
+    storage = get_storage()
+    items = list(items)
+
+    def upload(item):
+        key, data, content_type = item
+        try:
+            return storage.put(key, data, content_type, cache_control)
+        except StorageError as e:
+            print(f"Storage upload error: {e}")
+            return None
+
+    if len(items) <= 1:
+        return [upload(item) for item in items]
+    return list(get_storage_executor().map(upload, items))
+
+
+def delete_many(keys):
+    """Delete several objects (batched on S3); returns the number requested"""
+    keys = [k for k in keys if k]
+    if not keys:
+        return 0
+    return get_storage().delete_keys(keys)
+
+
+def delete_prefix(prefix):
+    """Delete every object under prefix; returns the number deleted"""
+    storage = get_storage()
+    return storage.delete_keys(storage.list_keys(prefix))
+
+
+def delete_url(url):
+    """Delete the object behind a stored URL; no-op for foreign URLs"""
+    storage = get_storage()
+    key = storage.key_from_url(url)
+    if key:
+        storage.delete(key)
+    return key
@@ -6,15 +6,14 @@ Handles user product photo submissions and admin review workflow
 from flask import Blueprint, request, jsonify
 from datetime import datetime
 from functools import wraps
-import boto3
 import uuid
-import os
 from PIL import Image
 import io
 
 from app import db
 from models import User, Business, Product, ProductSubmission
 from auth_api import require_jwt_auth
+from storage import get_storage
 
 submissions_bp = Blueprint('submissions', __name__)
 
@@ -45,24 +44,11 @@ def admin_required(f):
     return decorated_function
 
 
-def get_s3_client():
-    """Get configured S3 client"""
-    return boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.environ.get('AWS_REGION', 'eu-central-1')
-    )
-
-
 def upload_submission_image(file_data, user_id, business_id):
     """
     Upload submission image to S3 with resizing
     Returns the S3 URL
     """
-    s3 = get_s3_client()
-    bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET_NAME', 'aipijaca')
-
     # Generate unique filename
     ext = 'jpg'
     filename = f"submissions/{user_id}/{business_id}/{uuid.uuid4()}.{ext}"
@@ -87,17 +73,11 @@ def upload_submission_image(file_data, user_id, business_id):
     buffer.seek(0)
 
     # Upload to S3
-    s3.upload_fileobj(
-        buffer,
-        bucket,
-        filename,
-        ExtraArgs={
-            'ContentType': 'image/jpeg'
-        }
-    )
+    storage = get_storage()
+    storage.put(filename, buffer.getvalue(), 'image/jpeg')
 
     # Return full URL
-    return f"https://{bucket}.s3.eu-central-1.amazonaws.com/{filename}"
+    return storage.url(filename)
 
 
 # ==================== USER ENDPOINTS ====================
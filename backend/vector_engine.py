@@ -0,0 +1,511 @@
+"""
+In-process exact vector search over a memory-mapped embedding snapshot.
+
+The catalog's embeddings fit in RAM, yet every search paid a pgvector scan
+joined to businesses and users. With VECTOR_ENGINE_ENABLED, search_by_vector
+takes its candidates from this engine instead: a quantized (float16 or int8)
+copy of product_embeddings on local disk, memory-mapped by every worker, so
+the gunicorn workers of a host share one copy through the page cache and a
+recycled worker is ready as soon as it maps the files. Queries are exact
+(blocked matrix-vector products, running top-k); category / price /
+discount / store filters use precomputed per-row arrays. Postgres then only
+hydrates and scores the candidate rows (see engine_candidates_cte), so the
+final ranking keeps the usual hybrid scores at full precision.
+
+Snapshots are versioned directories under VECTOR_ENGINE_DIR:
+
+    manifest.json            current version, dtype, row count, last check
+    <version>/ids.npy        product ids (ascending), one per row
+    <version>/vectors.npy    unit-normalized embeddings, float16 or int8
+    <version>/scales.npy     per-row scale (int8 only)
+    <version>/meta.npz       business_id, category code, price, discount flags, embedding updated_at
+
+Each process runs a refresher thread. Every REFRESH_SECONDS one of them
+(whoever holds the directory's file lock) refreshes the snapshot from the
+database: metadata is reloaded in full (a few scalars per product, including
+the embedding's updated_at), vectors only for rows that are new or whose
+updated_at differs from the snapshot's, deleted products drop out, and
+unchanged rows are copied over. updated_at is compared per row rather than
+against a MAX(updated_at) watermark: the writers stamp it from different
+clocks (the app's, or the database's transaction start), so a rewrite can
+carry a stamp older than a watermark that was already taken.
+A full rebuild runs every FULL_REBUILD_SECONDS. All processes then map the
+newest manifest version. Until a snapshot exists searches go to pgvector as
+before.
+
+Environment:
+    VECTOR_ENGINE_ENABLED          'true' routes search_by_vector through the engine (default: false)
+    VECTOR_ENGINE_DIR              Snapshot directory, local to the host (default: <tmp>/popust-vector-engine)
+    VECTOR_ENGINE_DTYPE            float16 or int8 (default: float16; int8 halves memory, ~1% score error)
+    VECTOR_ENGINE_REFRESH_SECONDS  Seconds between refreshes (default: 60)
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENGINE_ENABLED = os.environ.get('VECTOR_ENGINE_ENABLED', 'false').lower() == 'true'
+ENGINE_DIR = os.environ.get('VECTOR_ENGINE_DIR', os.path.join(tempfile.gettempdir(), 'popust-vector-engine'))
+ENGINE_DTYPE = os.environ.get('VECTOR_ENGINE_DTYPE', 'float16')
+REFRESH_SECONDS = float(os.environ.get('VECTOR_ENGINE_REFRESH_SECONDS', '60'))
+FULL_REBUILD_SECONDS = 6 * 3600  # Compacts and catches writes that did not bump updated_at
+BLOCK_ROWS = 4096                # Rows per matmul block (~25 MB float32 scratch at 1536-d)
+FETCH_BATCH = 1000               # Embeddings per query when loading vectors
+KEEP_VERSIONS = 2                # Older version directories are deleted (mapped files stay readable)
+
+_MANIFEST = 'manifest.json'
+_LOCK_FILE = '.lock'
+
+
+def _quantize(vectors, dtype):
+    """Unit-normalize rows; returns (stored vectors, per-row scales or None)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1.0)
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        safe = np.where(scales > 0, scales, 1.0)[:, None]
+        return np.round(vectors / safe).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(np.float16), None
+
+
+class Snapshot:
+    """One mapped snapshot version (read-only, safe to share across threads)"""
+
+    def __init__(self, directory, manifest):
+        self.manifest = manifest
+        self.version = manifest['version']
+        self.dtype = manifest['dtype']
+        self.full_built_at = manifest.get('full_built_at', 0)
+        self.categories = {name: code for code, name in enumerate(manifest.get('categories', []))}
+
+        path = os.path.join(directory, self.version)
+        self.ids = np.load(os.path.join(path, 'ids.npy'))
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(path, 'scales.npy')) if self.dtype == 'int8' else None
+        with np.load(os.path.join(path, 'meta.npz')) as meta:
+            self.business_ids = meta['business_ids']
+            self.category_codes = meta['category_codes']
+            self.prices = meta['prices']
+            self.has_discount = meta['has_discount']
+            self.expires = meta['expires']  # date.toordinal(), 0 = no expiry
+            # Embedding updated_at in microseconds; None for snapshots written before it was stored
+            self.stamps = meta['stamps'] if 'stamps' in meta.files else None
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    def filter_rows(self, business_ids=None, category=None, max_price=None, only_discounted=False):
+        """Row indexes passing the filters (same semantics as search_by_vector's SQL), or None for all"""
+        mask = None
+
+        def narrow(condition):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+
+        if business_ids:
+            narrow(np.isin(self.business_ids, np.asarray(list(business_ids), dtype=np.int32)))
+        if category:
+            code = self.categories.get(category)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            narrow(self.category_codes == code)
+        if max_price:
+            narrow(self.prices <= max_price)  # NaN (no price) never passes, like SQL NULL
+        if only_discounted:
+            narrow(self.has_discount & ((self.expires == 0) | (self.expires >= date.today().toordinal())))
+        return None if mask is None else np.flatnonzero(mask)
+
+    def top_k(self, query_vector, k, rows=None):
+        """Exact top-k by cosine similarity over `rows` (all rows when None): (product_ids, scores)"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        total = self.size if rows is None else len(rows)
+        k = min(k, total)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            block_rows = np.arange(start, min(start + BLOCK_ROWS, total)) if rows is None else rows[start:start + BLOCK_ROWS]
+            block = self.vectors[start:start + BLOCK_ROWS] if rows is None else self.vectors[block_rows]
+            scores = block.astype(np.float32) @ query
+            if self.scales is not None:
+                scores *= self.scales[block_rows]
+
+            candidate_rows = np.concatenate([best_rows, block_rows])
+            candidate_scores = np.concatenate([best_scores, scores])
+            if len(candidate_scores) > k:
+                keep = np.argpartition(-candidate_scores, k - 1)[:k]
+                candidate_rows, candidate_scores = candidate_rows[keep], candidate_scores[keep]
+            best_rows, best_scores = candidate_rows, candidate_scores
+
+        order = np.argsort(-best_scores, kind='stable')
+        return self.ids[best_rows[order]], best_scores[order]
+
+
+# ==================== BUILDING ====================
+
+def _load_metadata(db_session):
+    """Per-product filter columns and embedding updated_at of every embedded product, ordered by id"""
+    from sqlalchemy import text
+
+    rows = db_session.execute(text("""
+        SELECT p.id, p.business_id, p.category,
+               COALESCE(p.discount_price, p.base_price) AS price,
+               p.discount_price IS NOT NULL AS has_discount,
+               p.expires, pe.updated_at
+        FROM products p
+        INNER JOIN product_embeddings pe ON pe.product_id = p.id
+        ORDER BY p.id
+    """)).all()
+
+    categories = sorted({row.category for row in rows if row.category})
+    codes = {name: code for code, name in enumerate(categories)}
+    meta = {
+        'business_ids': np.array([row.business_id for row in rows], dtype=np.int32),
+        'category_codes': np.array([codes.get(row.category, -1) for row in rows], dtype=np.int32),
+        'prices': np.array([row.price if row.price is not None else np.nan for row in rows], dtype=np.float32),
+        'has_discount': np.array([bool(row.has_discount) for row in rows], dtype=bool),
+        'expires': np.array([row.expires.toordinal() if row.expires else 0 for row in rows], dtype=np.int32),
+        'stamps': np.array([row.updated_at for row in rows], dtype='datetime64[us]').astype(np.int64),
+    }
+    return np.array([row.id for row in rows], dtype=np.int64), meta, categories
+
+
+def _fetch_vectors(db_session, product_ids=None):
+    """Yield (product_id, embedding) for the given ids, or for every row when None"""
+    from models import ProductEmbedding
+
+    query = db_session.query(ProductEmbedding.product_id, ProductEmbedding.embedding)
+    if product_ids is None:
+        yield from query.yield_per(FETCH_BATCH)
+        return
+    product_ids = [int(pid) for pid in product_ids]
+    for start in range(0, len(product_ids), FETCH_BATCH):
+        yield from query.filter(ProductEmbedding.product_id.in_(product_ids[start:start + FETCH_BATCH])).all()
+
+
+def build_snapshot(db_session, directory=ENGINE_DIR, dtype=ENGINE_DTYPE, previous=None, force_full=False):
+    """
+    Write a new snapshot version from the database and point the manifest at it.
+
+    Reuses `previous` (a Snapshot) for vectors that did not change unless a
+    full rebuild is due. Returns the new manifest, or None when nothing changed.
+    Callers must hold the directory lock (see VectorEngine._refresh).
+    """
+    started = time.time()
+    ids, meta, categories = _load_metadata(db_session)
+
+    full = (
+        force_full or previous is None or previous.dtype != dtype or previous.stamps is None
+        or started - previous.full_built_at >= FULL_REBUILD_SECONDS
+    )
+    if full:
+        fetch_ids = None
+        reuse = np.zeros(len(ids), dtype=bool)
+        source_rows = None
+    else:
+        positions = np.searchsorted(previous.ids, ids)
+        positions = np.minimum(positions, max(previous.size - 1, 0))
+        known = (previous.ids[positions] == ids) if previous.size else np.zeros(len(ids), dtype=bool)
+        # Any rewrite changes the row's updated_at, whichever clock stamped it
+        reuse = known & (previous.stamps[positions] == meta['stamps']) if previous.size else known
+        source_rows = positions
+        fetch_ids = ids[~reuse]
+
+        unchanged_meta = (
+            len(ids) == previous.size and reuse.all()
+            and list(categories) == sorted(previous.categories, key=previous.categories.get)
+            and np.array_equal(meta['business_ids'], previous.business_ids)
+            and np.array_equal(meta['category_codes'], previous.category_codes)
+            and np.array_equal(meta['prices'], previous.prices, equal_nan=True)
+            and np.array_equal(meta['has_discount'], previous.has_discount)
+            and np.array_equal(meta['expires'], previous.expires)
+        )
+        if unchanged_meta:
+            _write_manifest(directory, dict(previous.manifest, checked_at=time.time()))
+            return None
+
+    version = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(directory, version)
+    os.makedirs(path)
+    try:
+        np.save(os.path.join(path, 'ids.npy'), ids)
+        np.savez(os.path.join(path, 'meta.npz'), **meta)
+
+        dim = previous.vectors.shape[1] if previous is not None and previous.size else None
+        vectors = scales = None
+        row_of = {int(pid): row for row, pid in enumerate(ids)}
+        filled = reuse.copy()
+
+        def allocate(dimension):
+            nonlocal vectors, scales
+            vectors = np.lib.format.open_memmap(
+                os.path.join(path, 'vectors.npy'), mode='w+',
+                dtype=np.int8 if dtype == 'int8' else np.float16, shape=(len(ids), dimension)
+            )
+            scales = np.zeros(len(ids), dtype=np.float32) if dtype == 'int8' else None
+
+        if dim is not None and not full:
+            allocate(dim)
+            reused_rows = np.flatnonzero(reuse)
+            for start in range(0, len(reused_rows), BLOCK_ROWS):
+                rows = reused_rows[start:start + BLOCK_ROWS]
+                vectors[rows] = previous.vectors[source_rows[rows]]
+                if scales is not None:
+                    scales[rows] = previous.scales[source_rows[rows]]
+
+        batch_rows, batch_vectors = [], []
+
+        def flush():
+            stored, batch_scales = _quantize(batch_vectors, dtype)
+            vectors[batch_rows] = stored
+            if scales is not None:
+                scales[batch_rows] = batch_scales
+            filled[batch_rows] = True
+            batch_rows.clear()
+            batch_vectors.clear()
+
+        fetched = 0
+        for product_id, embedding in _fetch_vectors(db_session, fetch_ids):
+            row = row_of.get(product_id)
+            if row is None:
+                continue  # Embedded after the metadata was read - next refresh picks it up
+            if vectors is None:
+                allocate(len(embedding))
+            batch_rows.append(row)
+            batch_vectors.append(embedding)
+            fetched += 1
+            if len(batch_rows) >= FETCH_BATCH:
+                flush()
+        if batch_rows:
+            flush()
+        if vectors is None:
+            allocate(dim or 1)
+
+        # Rows deleted between the metadata read and the vector read stay zero; never match a filter
+        if not filled.all():
+            meta['business_ids'][~filled] = -1
+            np.savez(os.path.join(path, 'meta.npz'), **meta)
+
+        vectors.flush()
+        if scales is not None:
+            np.save(os.path.join(path, 'scales.npy'), scales)
+
+        manifest = {
+            'version': version,
+            'dtype': dtype,
+            'rows': len(ids),
+            'categories': categories,
+            'full_built_at': started if full else previous.full_built_at,
+            'checked_at': time.time(),
+        }
+        _write_manifest(directory, manifest)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+    logger.info(f"Vector snapshot {version}: {len(ids)} rows ({dtype}), {fetched} vectors fetched, "
+                f"{'full' if full else 'incremental'}, {time.time() - started:.1f}s")
+    _prune_versions(directory, keep=version)
+    return manifest
+
+
+def _write_manifest(directory, manifest):
+    tmp_path = os.path.join(directory, f"{_MANIFEST}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(directory, _MANIFEST))
+
+
+def _prune_versions(directory, keep):
+    versions = sorted(
+        name for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name)) and name != keep
+    )
+    for name in versions[:max(0, len(versions) - (KEEP_VERSIONS - 1))]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+# ==================== ENGINE ====================
+
+class VectorEngine:
+    """Per-process view of the shared snapshot, kept fresh by a background thread"""
+
+    def __init__(self, directory=ENGINE_DIR, dtype=ENGINE_DTYPE):
+        self.directory = directory
+        self.dtype = dtype
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.directory, _MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _map_latest(self):
+        manifest = self._load_manifest()
+        if manifest and (self._snapshot is None or manifest['version'] != self._snapshot.version):
+            try:
+                self._snapshot = Snapshot(self.directory, manifest)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not map vector snapshot {manifest.get('version')}: {e}")
+
+    def _refresh(self):
+        """Rebuild the snapshot if this process wins the lock, then map the newest version"""
+        from app import app, db
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, _LOCK_FILE), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                locked = False  # Another process is building
+            if locked:
+                self._map_latest()  # Build on top of the newest version, even one written by another process
+                manifest = self._load_manifest()
+                if not manifest or time.time() - manifest.get('checked_at', 0) >= REFRESH_SECONDS:
+                    with app.app_context():
+                        try:
+                            build_snapshot(db.session, self.directory, self.dtype, previous=self._snapshot)
+                        finally:
+                            db.session.remove()
+        self._map_latest()
+
+    def build_now(self, force_full=False):
+        """
+        Build the snapshot synchronously (waiting for a build in progress) and
+        map it; for benchmarks and tools that must not start on pgvector.
+
+        Returns:
+            Rows in the mapped snapshot
+        """
+        from app import app, db
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, _LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._map_latest()
+            with app.app_context():
+                try:
+                    build_snapshot(db.session, self.directory, self.dtype, previous=self._snapshot,
+                                   force_full=force_full)
+                finally:
+                    db.session.remove()
+        self._map_latest()
+        return self.size
+
+    def _run(self):
+        while True:
+            try:
+                self._refresh()
+            except Exception as e:
+                logger.warning(f"Vector engine refresh failed: {e}")
+            time.sleep(REFRESH_SECONDS)
+
+    def _ensure_started(self):
+        # Started lazily and restarted after fork (threads don't survive it)
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._map_latest()
+                    self._thread = threading.Thread(target=self._run, name='vector-engine-refresh', daemon=True)
+                    self._thread.start()
+
+    def search(self, query_vector, k, business_ids=None, category=None, max_price=None, only_discounted=False):
+        """
+        Exact top-k products by cosine similarity to query_vector.
+
+        Returns:
+            List of (product_id, similarity), best first, or None while no
+            snapshot is available (callers fall back to pgvector).
+        """
+        self._ensure_started()
+        snapshot = self._snapshot
+        if snapshot is None or not snapshot.size:
+            return None
+        rows = snapshot.filter_rows(business_ids, category, max_price, only_discounted)
+        product_ids, scores = snapshot.top_k(query_vector, k, rows)
+        return list(zip(product_ids.tolist(), scores.tolist()))
+
+    @property
+    def size(self):
+        return self._snapshot.size if self._snapshot is not None else 0
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_vector_engine():
+    """Get the process-wide engine (maps the current snapshot on first use)"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = VectorEngine()
+    return _engine
+
+
+def engine_candidates_cte(query_vector, limit, business_ids=None, category=None, max_price=None,
+                          only_discounted=False, filter_sql=None, text_match=None):
+    """
+    Plan a search's candidate set from the engine.
+
+    Args:
+        query_vector: Query embedding
+        limit: Candidates taken from the engine (and from the lexical match)
+        business_ids, category, max_price, only_discounted: Filters, applied
+            to the snapshot's metadata arrays
+        filter_sql: The same filters as SQL on products `p`, for the lexical match
+        text_match: Optional (condition_sql, rank_sql) on products `p`; the best
+            `limit` lexical matches are added so trigram-only hits are not lost
+
+    Returns:
+        "engine_candidates AS (...)" selecting product_id, or None when the
+        engine is disabled or has no snapshot yet.
+    """
+    if not ENGINE_ENABLED:
+        return None
+    try:
+        found = get_vector_engine().search(query_vector, limit, business_ids, category, max_price, only_discounted)
+    except Exception as e:
+        logger.warning(f"Vector engine search failed, using pgvector: {e}")
+        return None
+    if found is None:
+        return None
+
+    ids_sql = ",".join(str(product_id) for product_id, _ in found)
+    parts = [f"SELECT unnest(ARRAY[{ids_sql}]::integer[]) AS product_id"]
+    if text_match:
+        condition_sql, rank_sql = text_match
+        extra = f" AND {filter_sql}" if filter_sql else ""
+        parts.append(
+            f"""(SELECT p.id AS product_id FROM products p
+                WHERE ({condition_sql}){extra}
+                ORDER BY {rank_sql} DESC
+                LIMIT {int(limit)})"""
+        )
+    return "engine_candidates AS (\n                " + "\n                UNION\n                ".join(parts) + "\n            )"
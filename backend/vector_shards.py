@@ -0,0 +1,225 @@
+"""
+Per-store ANN shards for store-filtered product search.
+
+The product_embeddings ivfflat index covers the whole catalog, so a search
+restricted to a few stores (the selected_stores / preferred_stores case) is
+either an index scan that returns the nearest products of *all* stores and
+then drops most of them - recall collapses for small stores - or a scan of
+every selected row. Businesses with at least SHARD_MIN_PRODUCTS embeddings
+get their own partial ivfflat index instead:
+
+    CREATE INDEX idx_product_embeddings_shard_<business_id> ON product_embeddings
+        USING ivfflat (embedding vector_cosine_ops) WITH (lists = ...)
+        WHERE business_id = <business_id>
+
+(product_embeddings.business_id is a trigger-maintained copy of
+products.business_id). sync_shard_indexes() creates, rebuilds and drops
+these; jobs/sync_vector_shards.py runs it nightly.
+
+For a store-filtered search, shard_candidates_cte() plans the candidate set:
+the top-N of each selected shard from its own index, every row of selected
+stores too small for a shard (exact), and optionally the lexical matches of
+the sharded stores, so trigram-only hits are not lost. The caller joins the
+candidates and ranks them with its usual scoring, which merges the per-shard
+top-N into the global top-k. Searches over all stores are unchanged.
+
+Environment:
+    VECTOR_SHARDS_ENABLED      'false' disables the per-store plan (default: true)
+    VECTOR_SHARD_MIN_PRODUCTS  Embeddings a business needs for its own index (default: 2000)
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+SHARDS_ENABLED = os.environ.get('VECTOR_SHARDS_ENABLED', 'true').lower() == 'true'
+SHARD_MIN_PRODUCTS = int(os.environ.get('VECTOR_SHARD_MIN_PRODUCTS', '2000'))
+SHARD_INDEX_PREFIX = 'idx_product_embeddings_shard_'
+ROWS_PER_LIST = 1000         # pgvector guidance for ivfflat: lists = rows / 1000
+REFRESH_SECONDS = 300        # Pick up shards created/dropped by the sync job
+
+_LISTS_PATTERN = re.compile(r"lists\s*=\s*'?(\d+)")
+
+
+def shard_index_name(business_id):
+    return f"{SHARD_INDEX_PREFIX}{int(business_id)}"
+
+
+def shard_lists(rows):
+    """ivfflat lists for a shard of `rows` embeddings"""
+    return max(1, rows // ROWS_PER_LIST)
+
+
+def _load_shards(connection):
+    """{business_id: (lists, is_valid)} for the shard indexes in the database"""
+    rows = connection.execute(text("""
+        SELECT c.relname, i.indisvalid, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = 'product_embeddings'::regclass
+          AND c.relname LIKE :pattern
+    """), {'pattern': SHARD_INDEX_PREFIX.replace('_', r'\_') + '%'}).all()
+
+    shards = {}
+    for name, is_valid, definition in rows:
+        suffix = name[len(SHARD_INDEX_PREFIX):]
+        if not suffix.isdigit():
+            continue
+        match = _LISTS_PATTERN.search(definition)
+        shards[int(suffix)] = (int(match.group(1)) if match else None, bool(is_valid))
+    return shards
+
+
+class _ShardCatalog:
+    """Process-local set of businesses with a usable shard index"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._businesses = frozenset()
+        self._loaded_at = 0.0
+
+    def businesses(self, db_session):
+        if time.time() - self._loaded_at >= REFRESH_SECONDS:
+            with self._lock:
+                if time.time() - self._loaded_at >= REFRESH_SECONDS:
+                    try:
+                        with db_session.begin_nested():  # A failure must not abort the search transaction
+                            shards = _load_shards(db_session)
+                        self._businesses = frozenset(bid for bid, (_, valid) in shards.items() if valid)
+                    except Exception as e:
+                        logger.warning(f"Could not load vector shards: {e}")
+                    self._loaded_at = time.time()
+        return self._businesses
+
+    def invalidate(self):
+        self._loaded_at = 0.0
+
+
+_catalog = _ShardCatalog()
+
+
+def sharded_businesses(db_session):
+    """Business IDs that currently have a shard index"""
+    return _catalog.businesses(db_session)
+
+
+def shard_candidates_cte(db_session, business_ids, vector_sql, limit, filter_sql=None, text_match=None):
+    """
+    Plan the candidate set of a store-filtered search.
+
+    Args:
+        db_session: SQLAlchemy session (used to load the shard list)
+        business_ids: Selected business IDs
+        vector_sql: SQL literal of the query vector, e.g. "'[0.1,...]'::vector".
+            Must be a constant so the planner can use the partial indexes.
+        limit: Candidates taken from each shard
+        filter_sql: Optional extra condition on products `p` (price, category, ...)
+            applied inside each shard so it does not eat into the shard's top-N
+        text_match: Optional (condition_sql, rank_sql) on products `p`; the best
+            `limit` lexical matches of the sharded stores are added as candidates
+
+    Returns:
+        "shard_candidates AS (...)" selecting product_id, or None when no selected
+        business has a shard (the plain filtered query is then exact and cheap).
+    """
+    if not SHARDS_ENABLED or not business_ids:
+        return None
+
+    selected = sorted({int(bid) for bid in business_ids})
+    available = sharded_businesses(db_session)
+    sharded = [bid for bid in selected if bid in available]
+    if not sharded:
+        return None
+    unsharded = [bid for bid in selected if bid not in available]
+    extra = f" AND {filter_sql}" if filter_sql else ""
+
+    parts = [
+        f"""(SELECT pe.product_id FROM product_embeddings pe
+                INNER JOIN products p ON p.id = pe.product_id
+                WHERE pe.business_id = {bid}{extra}
+                ORDER BY pe.embedding <=> {vector_sql}
+                LIMIT {int(limit)})"""
+        for bid in sharded
+    ]
+    if text_match:
+        condition_sql, rank_sql = text_match
+        parts.append(
+            f"""(SELECT p.id AS product_id FROM products p
+                WHERE p.business_id IN ({",".join(map(str, sharded))}) AND ({condition_sql}){extra}
+                ORDER BY {rank_sql} DESC
+                LIMIT {int(limit)})"""
+        )
+    if unsharded:
+        # Stores below SHARD_MIN_PRODUCTS are scanned exactly (btree on business_id)
+        parts.append(
+            f"""(SELECT pe.product_id FROM product_embeddings pe
+                WHERE pe.business_id IN ({",".join(map(str, unsharded))}))"""
+        )
+
+    return "shard_candidates AS (\n                " + "\n                UNION\n                ".join(parts) + "\n            )"
+
+
+def sync_shard_indexes(min_products=None, dry_run=False):
+    """
+    Bring the shard indexes in line with the catalog.
+
+    Creates an index for every business with at least min_products embeddings,
+    rebuilds one whose list count is off by 2x or more (ivfflat centroids are
+    fixed at build time) or that was left invalid by a failed build, and drops
+    shards of businesses that fell below half the threshold (the gap keeps a
+    store near the line from flapping). Indexes are built and dropped
+    CONCURRENTLY, so searches and embedding writes continue meanwhile; a store
+    without an index is searched exactly in the meantime.
+
+    Returns:
+        {'created': [...], 'rebuilt': [...], 'dropped': [...]} business IDs
+    """
+    from app import db
+
+    min_products = SHARD_MIN_PRODUCTS if min_products is None else min_products
+    counts = dict(db.session.execute(text("""
+        SELECT business_id, COUNT(*) FROM product_embeddings
+        WHERE business_id IS NOT NULL
+        GROUP BY business_id
+    """)).all())
+    existing = _load_shards(db.session)
+    db.session.commit()
+
+    created, rebuilt, dropped = [], [], []
+    for business_id, (lists, valid) in existing.items():
+        rows = counts.get(business_id, 0)
+        if rows < min_products // 2:
+            dropped.append(business_id)
+        elif not valid or not lists or max(lists, shard_lists(rows)) >= 2 * min(lists, shard_lists(rows)):
+            rebuilt.append(business_id)
+    for business_id, rows in counts.items():
+        if rows >= min_products and business_id not in existing:
+            created.append(business_id)
+
+    summary = {'created': sorted(created), 'rebuilt': sorted(rebuilt), 'dropped': sorted(dropped)}
+    if dry_run:
+        return summary
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for business_id in dropped + rebuilt:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {shard_index_name(business_id)}"))
+        for business_id in rebuilt + created:
+            lists = shard_lists(counts[business_id])
+            start = time.time()
+            connection.execute(text(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {shard_index_name(business_id)}
+                ON product_embeddings USING ivfflat (embedding vector_cosine_ops)
+                WITH (lists = {lists})
+                WHERE business_id = {int(business_id)}
+            """))
+            logger.info(f"Vector shard for business {business_id}: {counts[business_id]} rows, "
+                        f"{lists} lists, built in {time.time() - start:.1f}s")
+
+    _catalog.invalidate()
+    return summary
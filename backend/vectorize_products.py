@@ -4,15 +4,15 @@ Script to generate embeddings for all products using OpenAI API
 """
 import os
 import psycopg2
-from openai import OpenAI
+from llm_clients import get_openai_client
 from dotenv import load_dotenv
 import time
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Shared OpenAI client (pooled transport, timeouts, per-model limits)
+client = get_openai_client()
 
 # Connect to PostgreSQL
 conn = psycopg2.connect(os.environ.get("DATABASE_URL"))